@@ -5,6 +5,12 @@ Website Discovery and Processing Pipeline using Firecrawl Map
 """
 
 import modal
+import os
+
+from pipeline.autoscaler import QueuePoolScaler, StageAutoscaler, StageScaling
+from pipeline.rate_limiter import limited_chat_completion_sync
+from pipeline.storage import LIST_FAN_OUT_WORKERS, StorageKeyNotFound, get_storage_backend, list_keys
+from pipeline.work_queue import take_api_errors
 
 # Modal app configuration with mounted prompt files
 image = (
@@ -23,6 +29,7 @@ image = (
         "brotli"   # Required for brotli compression support
     ])
     .add_local_dir("/Users/varsha/src/profilicbot/src/prompts", remote_path="/prompts")
+    .add_local_python_source("pipeline")  # Storage, the LLM response cache and the OpenAI rate limiter shared with pipeline/
 )
 
 app = modal.App("gtm-pipeline")
@@ -34,6 +41,21 @@ secrets = [
     modal.Secret.from_name("aws-s3-credentials")
 ]
 
+# Worker pool sizing - pipeline/autoscaler.py's StageAutoscaler starts enough
+# workers to clear the queue in GTM_TARGET_MINUTES at the estimated time per
+# URL, then grows or shrinks the pool from the drain rate, failures and rate
+# limiting the workers report, within the API rate ceiling
+GTM_TARGET_MINUTES = float(os.environ.get('GTM_TARGET_MINUTES', '15'))
+GTM_SCALING = StageScaling(
+    max_workers=100,
+    max_items_per_minute=300,  # Firecrawl scrape rate ceiling
+    seconds_per_item=20        # Scrape + categorize + classify, before measurements
+)
+GTM_WAIT_POLL_SECONDS = 10
+
+# Each worker's running counts, in one Modal Dict per execution
+GTM_PROGRESS_COUNTERS = ('completed', 'failed', 'rate_limited')
+
 @app.function(
     image=image,
     secrets=secrets,
@@ -47,7 +69,7 @@ def start_gtm_pipeline(website_url: str, single_url: bool = False, user_email: s
         website_url: Target website URL (e.g., "https://example.com")
         single_url: If True, process only the single URL; if False, discover all URLs on website
         user_email: Email address to send completion notification (optional)
-        
+    
     Returns:
         Pipeline results with execution details
     """
@@ -72,18 +94,8 @@ def start_gtm_pipeline(website_url: str, single_url: bool = False, user_email: s
         
         print(f"✅ Stage 0: Loaded {url_count} URLs to queue")
         
-        # Use 50 workers for demo speed
-        max_workers = 50
-        print(f"🔧 Starting {max_workers} workers for parallel processing...")
-        
-        # Start workers
-        workers = [
-            gtm_worker.spawn(queue_name, execution_id, i) 
-            for i in range(max_workers)
-        ]
-        
-        # Wait for all workers to complete
-        print(f"⏳ Waiting for all workers to complete...")
+        # Start workers and wait for the queue to drain, growing the pool as needed
+        workers = run_gtm_workers(queue_name, execution_id, url_count)
         results = [worker.get() for worker in workers]
         
         # Calculate totals
@@ -95,7 +107,7 @@ def start_gtm_pipeline(website_url: str, single_url: bool = False, user_email: s
         
         # Consolidate results
         print(f"📋 Consolidating results...")
-        final_results_path = consolidate_gtm_results.remote(execution_id, website_url)
+        final_results_path = consolidate_gtm_results.remote(execution_id, website_url, url_count)
         
         # Send email notification if email provided
         if user_email:
@@ -132,7 +144,7 @@ def start_gtm_pipeline(website_url: str, single_url: bool = False, user_email: s
         print(f"📁 Results: {final_results_path}")
         
         return pipeline_result
-        
+    
     except Exception as e:
         error_result = {
             "status": "failed",
@@ -297,13 +309,76 @@ def discover_and_load_urls_to_queue(website_url: str, queue_name: str, execution
         
         print(f"✅ Added {len(filtered_urls)} URLs to queue: {queue_name}")
         return len(filtered_urls)
-        
+    
     except Exception as e:
         print(f"❌ URL discovery failed: {e}")
         # Fallback to single URL if discovery fails
         print(f"🔄 Falling back to single URL processing")
         return load_single_url_to_queue.remote(website_url, queue_name, execution_id)
 
+def gtm_progress_dict(execution_id: str):
+    """Modal Dict of each GTM worker's progress counts, keyed by worker_id"""
+    return modal.Dict.from_name(f"gtm-progress-{execution_id}", create_if_missing=True)
+
+def gtm_retire_queue_name(queue_name: str) -> str:
+    """Queue of stop tokens for the workers the autoscaler retires"""
+    return f"{queue_name}-retire"
+
+def run_gtm_workers(queue_name: str, execution_id: str, url_count: int) -> list:
+    """
+    Spawn GTM workers and block until they have all exited
+    
+    The pool is sized by a StageAutoscaler. Each poll, the workers' summed
+    progress counts (URLs done, failed, held back by the rate limiter) go to a
+    QueuePoolScaler, which adds workers when the remaining URLs would miss the
+    target time and retires surplus ones, with a stop token on the retire
+    queue, when URLs fail or the API throttles. Workers also leave on their
+    own once the queue is empty.
+    
+    Returns:
+        All spawned worker calls
+    """
+    import time
+    from modal import Queue
+    
+    queue = Queue.from_name(queue_name)
+    retire_queue = Queue.from_name(gtm_retire_queue_name(queue_name), create_if_missing=True)
+    progress = gtm_progress_dict(execution_id)
+    autoscaler = StageAutoscaler('gtm', url_count, GTM_TARGET_MINUTES, scaling=GTM_SCALING)
+    
+    worker_count = autoscaler.initial_workers(max(url_count, 1))
+    print(f"🔧 Starting {worker_count} workers for {url_count} URLs...")
+    workers = [gtm_worker.spawn(queue_name, execution_id, i) for i in range(worker_count)]
+    pool = QueuePoolScaler(autoscaler)
+    
+    print("⏳ Waiting for all workers to complete...")
+    while True:
+        time.sleep(GTM_WAIT_POLL_SECONDS)
+        
+        running = 0
+        for worker in workers:
+            try:
+                worker.get(timeout=0)
+            except (TimeoutError, modal.exception.TimeoutError):
+                running += 1
+            except Exception:
+                pass
+        if running == 0:
+            break
+        
+        totals = dict.fromkeys(GTM_PROGRESS_COUNTERS, 0)
+        for counts in progress.values():
+            for counter in totals:
+                totals[counter] += counts.get(counter, 0)
+        
+        change = pool.poll(totals, running, queue.len(), retire_queue.len())
+        if change > 0:
+            workers.extend(gtm_worker.spawn(queue_name, execution_id, len(workers) + i) for i in range(change))
+        elif change < 0:
+            retire_queue.put_many([True] * -change)
+    
+    return workers
+
 @app.function(
     image=image,
     secrets=secrets,
@@ -313,17 +388,24 @@ def discover_and_load_urls_to_queue(website_url: str, queue_name: str, execution
 def gtm_worker(queue_name: str, execution_id: str, worker_id: int):
     """
     Worker: Process URLs from the queue
-    Each worker processes multiple URLs until queue is empty
+    Each worker processes multiple URLs until queue is empty or the autoscaler retires it
     """
     from modal import Queue
     
     queue = Queue.from_name(queue_name)
+    retire_queue = Queue.from_name(gtm_retire_queue_name(queue_name), create_if_missing=True)
+    progress = gtm_progress_dict(execution_id)
+    counts = dict.fromkeys(GTM_PROGRESS_COUNTERS, 0)
     processed = 0
     errors = 0
     
     print(f"🔧 GTM Worker {worker_id} started")
     
     while True:
+        if retire_queue.get(block=False):
+            print(f"📉 GTM Worker {worker_id} retired by autoscaler (processed {processed})")
+            break
+        
         # Get work with timeout
         try:
             work_item = queue.get(timeout=60)  # Wait 60 seconds for work
@@ -342,14 +424,21 @@ def gtm_worker(queue_name: str, execution_id: str, worker_id: int):
             # Save result to S3
             save_gtm_result_to_s3(execution_id, work_item["url_id"], result)
             processed += 1
+            failed = any(result.get(f"{stage}_status") == "failed" for stage in ("extraction", "categorization", "classification"))
+            counts["failed" if failed else "completed"] += 1
             
             if processed % 10 == 0:
                 print(f"📊 GTM Worker {worker_id}: {processed} URLs completed")
-                
+        
         except Exception as e:
             print(f"❌ GTM Worker {worker_id} error on {work_item['url_id']}: {e}")
             save_gtm_error_to_s3(execution_id, work_item["url_id"], str(e), work_item)
             errors += 1
+            counts["failed"] += 1
+        
+        # Progress for the autoscaler, with the rate limiter's waits and 429s since the last URL
+        counts["rate_limited"] += take_api_errors()["rate_limited"]
+        progress.put(worker_id, dict(counts))
     
     return {
         "worker_id": worker_id,
@@ -366,7 +455,7 @@ def process_single_url(work_item):
     
     Args:
         work_item: Contains url and metadata
-        
+    
     Returns:
         Processed result with extracted content, categorization, and classification
     """
@@ -423,6 +512,12 @@ def process_single_url(work_item):
         "confidence_percentage": classification_result.get("confidencePercentage", 0),
         "classification_status": classification_result.get("status", "failed"),
         
+        # OpenAI calls answered from the LLM cache
+        "llm_cache_hits": sum(1 for result in (categorization_result, classification_result) if result.get("llm_cached")),
+        "llm_tokens_saved": sum(
+            result.get("llm_tokens", 0) for result in (categorization_result, classification_result) if result.get("llm_cached")
+        ),
+        
         # Metadata
         "processing_timestamp": time.time(),
         "overall_status": "completed"
@@ -516,7 +611,7 @@ def stage1_firecrawl_scrape(url: str):
                     print(f"⚠️ Extraction failed, retrying in {retry_delay}s (attempt {attempt + 1}/{max_retries})")
                     time.sleep(retry_delay)
                     retry_delay *= 2
-                    
+            
             except Exception as retry_e:
                 if attempt < max_retries - 1:
                     print(f"⚠️ Extraction API error, retrying in {retry_delay}s: {retry_e}")
@@ -529,7 +624,7 @@ def stage1_firecrawl_scrape(url: str):
             error_msg = "Failed to extract content"
             if hasattr(scrape_result, 'error') and scrape_result.error:
                 error_msg = f"Extraction failed: {scrape_result.error}"
-                
+            
             return {
                 "status": "failed",
                 "error": error_msg,
@@ -546,7 +641,7 @@ def stage1_firecrawl_scrape(url: str):
             "category": extracted_data.get("category", ""),
             "scraped_url": url
         }
-        
+    
     except Exception as e:
         return {
             "status": "failed",
@@ -590,7 +685,10 @@ def stage2_categorize_content(extraction_result):
         print(f"💬 User Prompt:\n{prompt[:500]}...")
         print(f"🤖 === END PROMPT ===")
         
-        response = client.chat.completions.create(
+        # Waits for the cluster-wide gpt-4o-mini budget shared with pipeline/, unless the reply is cached
+        response = limited_chat_completion_sync(
+            client,
+            validate=valid_categorization_reply,
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are an AI assistant that categorizes web content into predefined categories. Follow the instructions exactly and only use categories from the provided list."},
@@ -610,9 +708,11 @@ def stage2_categorize_content(extraction_result):
         
         return {
             "status": "success",
-            **categorization_result
+            **categorization_result,
+            "llm_cached": getattr(response, "cached", False),
+            "llm_tokens": getattr(response.usage, "total_tokens", 0) if response.usage else 0
         }
-        
+    
     except Exception as e:
         print(f"❌ Categorization failed: {e}")
         return {
@@ -729,7 +829,7 @@ def parse_categorization_response(response_text: str):
             "reasoning": result.get("reasoning", ""),
             "confidence": result.get("confidence", 0)
         }
-        
+    
     except Exception as e:
         return {
             "primary_category": "Parse Error",
@@ -739,6 +839,10 @@ def parse_categorization_response(response_text: str):
             "confidence": 0
         }
 
+def valid_categorization_reply(response_text: str) -> bool:
+    """Whether a categorization reply parsed to a primary category - only these are cached"""
+    return parse_categorization_response(response_text)["primary_category"] not in ("", "Parse Error")
+
 def stage3_classify_eligibility(extraction_result, categorization_result):
     """
     Stage 3: HSA/FSA eligibility classification using category-specific guides (dermstore pattern)
@@ -792,7 +896,9 @@ def stage3_classify_eligibility(extraction_result, categorization_result):
         print(f"💬 User Prompt:\n{prompt[:500]}...")
         print(f"🤖 === END PROMPT ===")
         
-        response = client.chat.completions.create(
+        response = limited_chat_completion_sync(
+            client,
+            validate=valid_classification_reply,
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are an AI medical assistant that determines HSA/FSA eligibility for products."},
@@ -813,9 +919,11 @@ def stage3_classify_eligibility(extraction_result, categorization_result):
         
         return {
             "status": "success",
-            **classification_result
+            **classification_result,
+            "llm_cached": getattr(response, "cached", False),
+            "llm_tokens": getattr(response.usage, "total_tokens", 0) if response.usage else 0
         }
-        
+    
     except Exception as e:
         print(f"❌ HSA/FSA Classification failed: {e}")
         return {
@@ -863,7 +971,7 @@ def lookup_guides_for_categories(guide_data, primary_category, secondary_categor
                 relevant_categories.append(guide_category)
                 print(f"✅ Matched: '{search_cat}' with guide category '{guide_category.get('category')}'")
                 break
-                
+    
     print(f"📚 Found {len(relevant_categories)} relevant guide categories")
     return relevant_categories
 
@@ -942,7 +1050,7 @@ def parse_classification_response(response_text: str):
             "lmnQualificationProbability": result.get("lmnQualificationProbability", "N/A"),
             "confidencePercentage": result.get("confidencePercentage", 0)
         }
-        
+    
     except Exception as e:
         return {
             "eligibilityStatus": "Parse Error",
@@ -952,33 +1060,40 @@ def parse_classification_response(response_text: str):
             "confidencePercentage": 0
         }
 
+def valid_classification_reply(response_text: str) -> bool:
+    """Whether a classification reply parsed to an eligibility status - only these are cached"""
+    return parse_classification_response(response_text)["eligibilityStatus"] not in ("Unknown", "Parse Error")
+
+LIST_PAGE_SIZE = 1000  # list_objects_v2 keys per page
+
+def result_key_shards(execution_id: str, url_count: int) -> list:
+    """
+    Split points between result files - url_ids are zero-padded sequence numbers
+    
+    Each range holds at least a page of keys so small runs stay a single listing.
+    """
+    if not url_count:
+        return []
+    step = max(LIST_PAGE_SIZE, -(-url_count // LIST_FAN_OUT_WORKERS))
+    return [f"{execution_id}_url_{idx:06d}" for idx in range(step, url_count, step)]
+
+
 def save_gtm_result_to_s3(execution_id: str, url_id: str, result):
     """Save worker result to S3"""
-    import boto3
     import json
     try:
-        s3_client = boto3.client('s3')
-        
         # Save as JSON
         json_key = f"gtm/{execution_id}/results/{url_id}.json"
-        s3_client.put_object(
-            Bucket='flex-ai',
-            Key=json_key,
-            Body=json.dumps(result, indent=2),
-            ContentType='application/json'
-        )
-        
+        get_storage_backend().put(json_key, json.dumps(result, indent=2), content_type='application/json')
+    
     except Exception as e:
         print(f"❌ Failed to save GTM result to S3: {e}")
 
 def save_gtm_error_to_s3(execution_id: str, url_id: str, error: str, original_data):
     """Save error result to S3"""
-    import boto3
     import json
     import time
     try:
-        s3_client = boto3.client('s3')
-        
         error_result = {
             **original_data,
             "processing_error": error,
@@ -988,60 +1103,89 @@ def save_gtm_error_to_s3(execution_id: str, url_id: str, error: str, original_da
         
         # Save as JSON
         json_key = f"gtm/{execution_id}/results/{url_id}_error.json"
-        s3_client.put_object(
-            Bucket='flex-ai',
-            Key=json_key,
-            Body=json.dumps(error_result, indent=2),
-            ContentType='application/json'
-        )
-        
+        get_storage_backend().put(json_key, json.dumps(error_result, indent=2), content_type='application/json')
+    
     except Exception as e:
         print(f"❌ Failed to save GTM error to S3: {e}")
 
+def bulk_download_gtm_results(s3_keys, max_workers: int = 32, max_retries: int = 3, ordered: bool = False):
+    """
+    Download worker result JSON files from S3 concurrently
+    
+    Yields (s3_key, result_data, error) - result_data is None when the key
+    could not be read after retries. ordered=True keeps s3_keys order.
+    """
+    import json
+    import time
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    storage = get_storage_backend()
+    
+    def fetch(s3_key):
+        last_error = None
+        for attempt in range(max_retries):
+            try:
+                return s3_key, json.loads(storage.get(s3_key)), None
+            except Exception as e:
+                last_error = e
+                if isinstance(e, (ValueError, StorageKeyNotFound)):
+                    break  # Retrying won't fix a missing key or bad JSON
+                time.sleep(0.5 * (2 ** attempt))
+        return s3_key, None, last_error
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if ordered:
+            yield from executor.map(fetch, s3_keys)
+        else:
+            futures = [executor.submit(fetch, s3_key) for s3_key in s3_keys]
+            for future in as_completed(futures):
+                yield future.result()
+
 @app.function(
     image=image,
     secrets=secrets,
     timeout=3600,   # 1 hour
     memory=4096     # 4GB for large dataset processing
 )
-def consolidate_gtm_results(execution_id: str, website_url: str):
+def consolidate_gtm_results(execution_id: str, website_url: str, url_count: int = None):
     """
     Consolidate all worker outputs into final results
+    
+    url_count (the number of URLs queued) lets the result listing fan out
+    across url_id ranges.
     """
-    import boto3
-    import json
     import pandas as pd
     from urllib.parse import urlparse
     
     print(f"📋 Consolidating GTM results for {execution_id}")
     
     try:
-        s3_client = boto3.client('s3')
+        storage = get_storage_backend()
         
         # List all worker output files
         prefix = f"gtm/{execution_id}/results/"
-        response = s3_client.list_objects_v2(
-            Bucket='flex-ai',
-            Prefix=prefix
-        )
+        result_keys = list_keys(prefix, shards=result_key_shards(execution_id, url_count))
         
-        if 'Contents' not in response:
+        if not result_keys:
             raise Exception("No worker output files found")
         
         # Collect all results
         all_results = []
         file_count = 0
         
-        for obj in response['Contents']:
-            key = obj['Key']
-            if key.endswith('.json'):
-                # Read JSON file
-                response = s3_client.get_object(Bucket='flex-ai', Key=key)
-                result_data = json.loads(response['Body'].read())
-                all_results.append(result_data)
-                file_count += 1
+        # Read JSON files concurrently, keeping listing order for the CSV
+        json_keys = [key for key in result_keys if key.endswith('.json')]
+        error_count = 0
         
-        print(f"📊 Collected {file_count} result files")
+        for key, result_data, error in bulk_download_gtm_results(json_keys, ordered=True):
+            if error:
+                print(f"⚠️  Failed to read {key}: {error}")
+                error_count += 1
+                continue
+            all_results.append(result_data)
+            file_count += 1
+        
+        print(f"📊 Collected {file_count} result files ({error_count} unreadable)")
         
         # Create DataFrame
         df = pd.DataFrame(all_results)
@@ -1054,20 +1198,20 @@ def consolidate_gtm_results(execution_id: str, website_url: str):
         final_csv_key = f"gtm/{execution_id}/outputs/{output_filename}"
         csv_buffer = df.to_csv(index=False)
         
-        s3_client.put_object(
-            Bucket='flex-ai',
-            Key=final_csv_key,
-            Body=csv_buffer,
-            ContentType='text/csv'
-        )
+        storage.put(final_csv_key, csv_buffer, content_type='text/csv')
         
-        final_csv_path = f"s3://flex-ai/{final_csv_key}"
+        final_csv_path = f"s3://{storage.bucket}/{final_csv_key}"
         
         print(f"✅ Consolidation Complete: {len(df)} URLs processed")
         print(f"📁 Final CSV: {final_csv_path}")
+        if 'llm_cache_hits' in df.columns:
+            llm_calls = int(df['categorization_status'].eq('success').sum() + df['classification_status'].eq('success').sum())
+            cache_hits = int(df['llm_cache_hits'].fillna(0).sum())
+            print(f"💾 LLM cache: {cache_hits}/{llm_calls} answers from cache, "
+                  f"{int(df['llm_tokens_saved'].fillna(0).sum()):,} tokens saved")
         
         return final_csv_path
-        
+    
     except Exception as e:
         print(f"❌ Consolidation failed: {e}")
         raise e
@@ -1183,16 +1327,13 @@ This notification was sent automatically by the GTM Pipeline system.
         """
         
         # Download CSV from S3 and send as attachment
-        s3_client = boto3.client('s3')
-        
-        # Extract S3 key from results_path (s3://flex-ai/path/file.csv)
-        s3_key = results_path.replace('s3://flex-ai/', '')
+        # Split results_path (s3://flex-ai/path/file.csv) into bucket and key
+        bucket, s3_key = results_path.replace('s3://', '').split('/', 1)
         
         print(f"📥 Downloading CSV from S3: {s3_key}")
         
         # Download CSV content
-        csv_response = s3_client.get_object(Bucket='flex-ai', Key=s3_key)
-        csv_content = csv_response['Body'].read()
+        csv_content = get_storage_backend(bucket).get(s3_key)
         
         # Create MIME email with attachment
         from email.mime.multipart import MIMEMultipart
@@ -1238,7 +1379,7 @@ This notification was sent automatically by the GTM Pipeline system.
             "recipient": user_email,
             "subject": subject
         }
-        
+    
     except Exception as e:
         print(f"❌ Failed to send email: {str(e)}")
         import traceback
@@ -1314,24 +1455,16 @@ def api_run_gtm_pipeline(data: dict):
                 # Send email if requested (async)
                 if user_email:
                     # Save single result to S3 for email attachment
-                    import boto3
                     import pandas as pd
                     import json
                     
-                    s3_client = boto3.client('s3')
-                    
                     # Convert to DataFrame and save as CSV
                     df = pd.DataFrame([result_data])
                     csv_content = df.to_csv(index=False)
                     
                     # Save to S3
                     s3_key = f"gtm/{execution_id}/outputs/single_url_result.csv"
-                    s3_client.put_object(
-                        Bucket='flex-ai',
-                        Key=s3_key,
-                        Body=csv_content,
-                        ContentType='text/csv'
-                    )
+                    get_storage_backend().put(s3_key, csv_content, content_type='text/csv')
                     
                     # Send email with attachment (spawn async to not block response)
                     send_completion_email.spawn(
@@ -1348,7 +1481,7 @@ def api_run_gtm_pipeline(data: dict):
                     "email_sent": user_email is not None,
                     "result": result_data  # Raw processing result included in response
                 }
-                
+            
             except Exception as e:
                 print(f"❌ Single URL processing failed: {str(e)}")
                 return {
@@ -1372,7 +1505,7 @@ def api_run_gtm_pipeline(data: dict):
                 "monitor_s3": f"https://s3.console.aws.amazon.com/s3/buckets/flex-ai?region=us-west-2&prefix=gtm/{execution_id}/",
                 "note": "Pipeline is running in the background. Check S3 for results or use call_id to monitor status."
             }
-        
+    
     except Exception as e:
         print(f"💥 GTM Pipeline API Error: {str(e)}")
         return {"status": "error", "error": str(e)}
@@ -71,8 +71,8 @@ def api_run_gtm_pipeline(data: dict):
         print(f"   Single URL Mode: {single_url}")
         print(f"   Email: {user_email or 'None'}")
         
-        # Import and run the pipeline
-        from pipeline import start_gtm_pipeline
+        # Run the deployed pipeline - "pipeline" is the shared package, not the GTM app
+        start_gtm_pipeline = modal.Function.from_name("gtm-pipeline", "start_gtm_pipeline")
         result = start_gtm_pipeline.remote(website_url, single_url, user_email)
         
         return {
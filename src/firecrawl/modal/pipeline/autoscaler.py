@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Stage Autoscaler for Modal Pipeline
+Sizes each stage's worker pool from observed batch latency, backlog and
+API error rates instead of fixed worker-count tables
+"""
+
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from .llm_client import LLM_CONCURRENCY, OPENAI_REQUESTS_PER_MINUTE
+
+# Every stage aims to finish within this many minutes of its workers starting
+AUTOSCALE_TARGET_MINUTES = float(os.environ.get('AUTOSCALE_TARGET_MINUTES', '30'))
+
+# Minimum time between scaling decisions, so one slow batch can't thrash the pool
+AUTOSCALE_COOLDOWN_SECONDS = 30
+
+# Share of items hitting 429s above which the pool shrinks instead of growing
+RATE_LIMIT_BACKOFF_RATIO = 0.05
+
+# Share of failed items above which more workers won't help - hold the pool
+ERROR_HOLD_RATIO = 0.5
+
+# Weight of the newest batch in the per-item latency estimate
+LATENCY_SMOOTHING = 0.3
+
+@dataclass
+class StageScaling:
+    """Scaling limits for one stage"""
+    max_workers: int            # Container ceiling - matches the worker's max_containers
+    max_items_per_minute: float # API rate ceiling across all workers
+    seconds_per_item: float     # Latency prior until batches report real timings
+
+# LLM stage containers keep LLM_CONCURRENCY requests in flight, so one container
+# covers that many single-request workers: per-item latency priors and container
+# ceilings are divided by it. Their request rate is held to the account quota by
+# rate_limiter.py, so the ceiling here is the quota itself (one request per item).
+# csv_discovery is product_eligibility.py's search for product pages of CSV rows.
+STAGE_SCALING = {
+    'csv_discovery': StageScaling(max_workers=30, max_items_per_minute=300, seconds_per_item=15),
+    'extraction': StageScaling(max_workers=100, max_items_per_minute=200, seconds_per_item=60),
+    'categorization': StageScaling(
+        max_workers=min(50, math.ceil(400 / LLM_CONCURRENCY)), max_items_per_minute=OPENAI_REQUESTS_PER_MINUTE,
+        seconds_per_item=10 / LLM_CONCURRENCY
+    ),
+    'classification': StageScaling(
+        max_workers=min(50, math.ceil(400 / LLM_CONCURRENCY)), max_items_per_minute=OPENAI_REQUESTS_PER_MINUTE,
+        seconds_per_item=15 / LLM_CONCURRENCY
+    ),
+    'turbopuffer': StageScaling(max_workers=10, max_items_per_minute=5000, seconds_per_item=0.3)
+}
+
+class StageAutoscaler:
+    """
+    Worker-count controller for one stage run
+    
+    The dispatcher feeds it batch completion records ('items', 'seconds',
+    'errors', 'rate_limited') and asks for a target worker count: enough
+    workers to clear the remaining items by the target time, capped by the
+    stage's container and API rate ceilings. A window with too many 429s cuts
+    the rate ceiling to the throughput the API accepted; clean windows raise
+    it back towards the configured limit.
+    """
+    
+    def __init__(
+        self,
+        stage: str,
+        total_items: int,
+        target_minutes: Optional[float] = None,
+        scaling: Optional[StageScaling] = None
+    ):
+        self.stage = stage
+        self.scaling = scaling or STAGE_SCALING[stage]
+        self.total_items = total_items
+        self.target_seconds = (target_minutes or AUTOSCALE_TARGET_MINUTES) * 60
+        self.started_at = time.time()
+        self.last_decision_at = self.started_at
+        
+        self.seconds_per_item = self.scaling.seconds_per_item
+        self.items_per_minute_ceiling = self.scaling.max_items_per_minute
+        self.completed_items = 0
+        
+        # Window since the last decision
+        self.window_items = 0
+        self.window_errors = 0
+        self.window_rate_limited = 0
+        self.peak_workers = 0
+    
+    def initial_workers(self, batch_count: int) -> int:
+        """Worker count to start with, from the latency prior"""
+        workers = self._desired(self.total_items, self.target_seconds, batch_count)
+        self.peak_workers = workers
+        self.last_decision_at = time.time()
+        print(f"📐 {self.stage} autoscaler: {self.total_items:,} items, {batch_count} batches, "
+              f"target {self.target_seconds/60:.0f} min → starting {workers} workers")
+        return workers
+    
+    def record(self, completion: Dict[str, Any]):
+        """Fold one batch completion record into the latency and error estimates"""
+        items = completion.get('items') or 0
+        seconds = completion.get('seconds')
+        self.completed_items += items
+        if completion.get('reused'):
+            return  # Output from an earlier attempt - says nothing about current throughput
+        self.window_items += items
+        self.window_errors += completion.get('errors') or 0
+        self.window_rate_limited += completion.get('rate_limited') or 0
+        
+        if items and seconds:
+            observed = seconds / items
+            self.seconds_per_item += LATENCY_SMOOTHING * (observed - self.seconds_per_item)
+    
+    def desired_workers(self, active_workers: int, remaining_batches: int) -> Optional[int]:
+        """
+        Target worker count, or None when it's too soon to decide or nothing should change
+        """
+        now = time.time()
+        if now - self.last_decision_at < AUTOSCALE_COOLDOWN_SECONDS or remaining_batches <= 0:
+            return None
+        
+        window_minutes = (now - self.last_decision_at) / 60
+        window_items = max(self.window_items, 1)
+        rate_limited_ratio = self.window_rate_limited / window_items
+        error_ratio = self.window_errors / window_items
+        
+        if rate_limited_ratio > RATE_LIMIT_BACKOFF_RATIO:
+            # The API pushed back - only the items that got through count towards the ceiling
+            accepted = self.window_items * (1 - rate_limited_ratio) / window_minutes
+            self.items_per_minute_ceiling = max(min(accepted, self.items_per_minute_ceiling), 1.0)
+            print(f"🚦 {self.stage}: {rate_limited_ratio:.0%} of items rate limited - ceiling now {self.items_per_minute_ceiling:.0f} items/min")
+        elif self.items_per_minute_ceiling < self.scaling.max_items_per_minute:
+            # Probe back towards the configured ceiling after a clean window
+            self.items_per_minute_ceiling = min(self.items_per_minute_ceiling * 1.25, self.scaling.max_items_per_minute)
+        
+        remaining_items = max(self.total_items - self.completed_items, 0)
+        remaining_seconds = max(self.target_seconds - (now - self.started_at), AUTOSCALE_COOLDOWN_SECONDS * 2)
+        desired = self._desired(remaining_items, remaining_seconds, remaining_batches)
+        
+        if error_ratio > ERROR_HOLD_RATIO and rate_limited_ratio <= RATE_LIMIT_BACKOFF_RATIO:
+            # Failing items don't get better with more workers
+            desired = min(desired, active_workers)
+        
+        self.last_decision_at = now
+        self.window_items = self.window_errors = self.window_rate_limited = 0
+        
+        # Ignore small adjustments - each new container pays a cold start
+        if abs(desired - active_workers) < max(1, math.ceil(active_workers * 0.2)):
+            return None
+        
+        self.peak_workers = max(self.peak_workers, desired)
+        print(f"📐 {self.stage}: {remaining_items:,} items left at {self.seconds_per_item:.1f}s/item "
+              f"→ {active_workers} → {desired} workers")
+        return desired
+    
+    def _desired(self, remaining_items: int, remaining_seconds: float, remaining_batches: int) -> int:
+        needed = math.ceil(remaining_items * self.seconds_per_item / remaining_seconds)
+        rate_ceiling = math.floor(self.items_per_minute_ceiling * self.seconds_per_item / 60)
+        return max(1, min(needed, rate_ceiling, self.scaling.max_workers, remaining_batches))
+
+# Running totals a queue-fed worker pool reports - every finished item, and those that failed or were set aside
+POOL_DONE_COUNTERS = ('completed', 'failed', 'deferred')
+POOL_ERROR_COUNTERS = ('failed', 'deferred')
+
+class QueuePoolScaler:
+    """
+    Drives a StageAutoscaler from the running totals of a queue-fed worker pool
+    
+    Workers that pull single items off a queue send no batch completion
+    records. Instead each poll passes the pool's cumulative counters
+    (completed, failed, deferred and rate_limited items, and enqueued when the
+    stage is still being fed), and the change since the previous poll becomes
+    one record. Worker time builds up between polls until items finish, and
+    only while the queue has a backlog - idle workers say nothing about how
+    long an item takes.
+    """
+    
+    def __init__(self, autoscaler: StageAutoscaler):
+        self.autoscaler = autoscaler
+        self.last_totals: Dict[str, int] = {}
+        self.last_poll = time.time()
+        self.worker_seconds = 0.0
+    
+    def poll(self, totals: Dict[str, int], running_workers: int, backlog: int, pending_retirements: int = 0) -> int:
+        """Workers to add (positive) or retire (negative) - 0 leaves the pool as it is"""
+        now = time.time()
+        elapsed = now - self.last_poll
+        change = {counter: count - self.last_totals.get(counter, 0) for counter, count in totals.items()}
+        self.last_totals, self.last_poll = dict(totals), now
+        
+        if 'enqueued' in totals:
+            self.autoscaler.total_items = totals['enqueued']
+        if backlog > 0:
+            self.worker_seconds += running_workers * elapsed
+        items = sum(change.get(counter, 0) for counter in POOL_DONE_COUNTERS)
+        self.autoscaler.record({
+            'items': items,
+            'seconds': self.worker_seconds,
+            'errors': sum(change.get(counter, 0) for counter in POOL_ERROR_COUNTERS),
+            'rate_limited': change.get('rate_limited', 0)
+        })
+        if items:
+            self.worker_seconds = 0.0
+        
+        # Stop tokens not yet taken still count as retired
+        active_workers = max(running_workers - pending_retirements, 0)
+        desired = self.autoscaler.desired_workers(active_workers, backlog)
+        return 0 if desired is None else desired - active_workers
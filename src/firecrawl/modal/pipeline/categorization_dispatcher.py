@@ -10,7 +10,19 @@ import pandas as pd
 from typing import List, Dict, Any
 
 from .config import app, image, secrets, categorization_queue
-from .s3_utils import S3Manager, create_dynamic_batches, combine_batch_results, BatchReference
+from .s3_utils import (
+    S3Manager, create_dynamic_batches_from_s3, stream_combine_batch_results, 
+    BatchReference, DEFAULT_ARTIFACT_FORMAT, PRIORITY_COLUMN, DEFAULT_CLASSIFICATION_PRIORITY, batch_priority,
+    BATCH_BY_TOKENS
+)
+from .work_queue import queue_batches, run_batch_worker, wait_for_batches, note_api_error
+from .autoscaler import StageAutoscaler, STAGE_SCALING
+from .llm_client import AsyncLLMRunner
+from .rate_limiter import limited_chat_completion
+from .retries import FailedItems, batch_result, call_with_retries_async, run_second_pass
+from .resume import reuse_batch_output
+from .llm_cache import take_cache_stats, with_cache_stats, summarize_cache_stats
+from .registry import ProductRegistry, stage_version
 
 try:
     import openai
@@ -19,6 +31,24 @@ except ImportError:
 
 OPENAI_MODEL = "gpt-4o-mini"
 
+# Prompt text, part of the registry's stage version - any edit stops it carrying earlier answers
+CATEGORIZATION_SYSTEM_PROMPT = "You are a precise product categorizer. Always respond with valid JSON."
+CATEGORIZATION_PROMPT = """You are a product categorization expert. Classify the following product into one of these categories:
+
+{categories_text}
+
+Product Name: {product_name}
+Product Description: {product_description}
+
+Analyze the product and return your classification in this exact JSON format:
+{{
+  "category": "exact category name from the list above",
+  "confidence": 0.85,
+  "reasoning": "brief explanation of why this category fits best"
+}}
+
+Choose the most specific and accurate category. If unsure, pick the closest match."""
+
 @app.function(
     image=image,
     
@@ -27,7 +57,9 @@ OPENAI_MODEL = "gpt-4o-mini"
 )
 def stage3_categorization_dispatcher(
     execution_id: str,
-    environment: str = "dev"
+    environment: str = "dev",
+    artifact_format: str = DEFAULT_ARTIFACT_FORMAT,
+    incremental: bool = True
 ) -> dict:
     """
     Stage 3: Categorization Dispatcher
@@ -36,7 +68,9 @@ def stage3_categorization_dispatcher(
     Args:
         execution_id: Unique execution ID from previous stages
         environment: dev or prod environment
-        
+        artifact_format: 'csv' or 'parquet' for this stage's artifacts
+        incremental: Carry forward products unchanged since their last categorization
+    
     Returns:
         Categorization results and statistics
     """
@@ -51,91 +85,133 @@ def stage3_categorization_dispatcher(
         # Read extraction CSV from S3
         s3_manager = S3Manager()
         extraction_csv_path = s3_manager.build_s3_path(
-            environment, execution_id, "extraction", "extracted_products.csv"
+            environment, execution_id, "extraction", "extracted_products.csv",
+            artifact_format=artifact_format
         )
         
+        # Products categorized before with the same data, model and prompt keep their answer
         print(f"📥 Reading extraction CSV from: {extraction_csv_path}")
-        df = s3_manager.download_dataframe(extraction_csv_path)
-        
-        if len(df) == 0:
-            raise Exception("No products found in extraction CSV")
-        
-        print(f"📊 Processing {len(df):,} products for categorization")
+        registry = None
+        batch_input_path, carried_batch = extraction_csv_path, None
+        if incremental:
+            registry = ProductRegistry(
+                s3_manager, environment, execution_id, "categorization",
+                stage_version(OPENAI_MODEL, CATEGORIZATION_SYSTEM_PROMPT, CATEGORIZATION_PROMPT, _load_categories()), artifact_format
+            )
+            batch_input_path, carried_batch = registry.split_input(extraction_csv_path)
+        carried_products = carried_batch.item_count if carried_batch else 0
         
-        # Create dynamic batches for categorization
+        # Stream the remaining products from S3 straight into batches
         # Categorization is faster than extraction (~10 seconds per product)
-        batch_references = create_dynamic_batches(
-            df=df,
-            execution_id=execution_id,
-            stage="categorization",
-            environment=environment,
-            processing_time_per_item=0.17  # ~10 seconds per product
-        )
-        
-        print(f"\n🚀 Starting {len(batch_references)} categorization workers...")
-        
-        # Queue batch references for workers
-        for batch_ref in batch_references:
-            categorization_queue.put(batch_ref)
+        batch_references, input_summary = [], {'total_items': 0}
+        if batch_input_path:
+            batch_references, input_summary = create_dynamic_batches_from_s3(
+                input_s3_path=batch_input_path,
+                execution_id=execution_id,
+                stage="categorization",
+                environment=environment,
+                processing_time_per_item=0.17,  # ~10 seconds per product
+                artifact_format=artifact_format,
+                batch_by=BATCH_BY_TOKENS  # descriptions vary from 200 to 10k+ characters
+            )
+        input_products = input_summary['total_items'] + carried_products
         
-        # Start categorization workers
-        categorization_futures = []
-        batch_size, max_workers = _calculate_worker_count(len(batch_references))
+        if input_products == 0:
+            raise Exception("No products found in extraction CSV")
         
-        for i in range(min(max_workers, len(batch_references))):
-            future = categorization_worker.spawn()
-            categorization_futures.append(future)
+        print(f"📊 Processing {input_products:,} products for categorization")
         
-        print(f"✅ Started {len(categorization_futures)} categorization workers")
+        # Long-lived workers drain the queue - the autoscaler sizes the pool as batches complete
+        autoscaler = StageAutoscaler("categorization", input_summary['total_items'])
+        completions = {}
+        if batch_references:
+            worker_count = autoscaler.initial_workers(len(batch_references))
+            queue_batches(categorization_queue, batch_references, execution_id, "categorization", worker_count)
+            
+            print(f"\n🚀 Starting {worker_count} categorization workers for {len(batch_references)} batches...")
+            categorization_futures = [
+                categorization_worker.spawn(queue_partition=execution_id)
+                for _ in range(worker_count)
+            ]
+            
+            print(f"⏳ Waiting for {len(batch_references)} categorization batches to complete...")
+            completions = wait_for_batches(
+                execution_id, "categorization", len(batch_references), categorization_futures,
+                batch_queue=categorization_queue,
+                spawn_worker=lambda: categorization_worker.spawn(queue_partition=execution_id),
+                autoscaler=autoscaler
+            )
+        completed_batches = [
+            batch_ref for batch_ref in batch_references
+            if completions.get(batch_ref.batch_number, {}).get('output_items')
+        ]
+        print(f"✅ {len(completions)}/{len(batch_references)} batches processed, {len(completed_batches)} with results")
         
-        # Wait for all workers to complete
-        print(f"⏳ Waiting for categorization workers to complete...")
-        completed_workers = 0
+        llm_cache = summarize_cache_stats("categorization", completions.values())
         
-        for future in categorization_futures:
-            try:
-                result = future.get()  # This blocks until worker completes
-                completed_workers += 1
-                print(f"   ✅ Worker {completed_workers}/{len(categorization_futures)} completed")
-            except Exception as e:
-                print(f"   ❌ Worker failed: {str(e)}")
+        # Second pass over products that failed transiently - recovered batches join the combine
+        retry_batches, retry_summary = run_second_pass(
+            "categorization", batch_references, completions,
+            lambda retry_refs: list(categorization_worker.map(retry_refs, return_exceptions=True))
+        )
+        completed_batches += retry_batches
+        processed_batches = list(completed_batches)
+        if carried_batch:
+            completed_batches.append(carried_batch)
         
         # Combine all batch results into final CSV
         print(f"\n📋 Combining categorization results...")
         
         categorization_csv_path = s3_manager.build_s3_path(
-            environment, execution_id, "categorization", "categorized_products.csv"
+            environment, execution_id, "categorization", "categorized_products.csv",
+            artifact_format=artifact_format
         )
         
-        final_df = combine_batch_results(batch_references, categorization_csv_path)
+        # Highest-priority products first, so classification batches come in priority order
+        combine_summary = stream_combine_batch_results(
+            completed_batches, categorization_csv_path, count_columns=['category', PRIORITY_COLUMN],
+            order_by=PRIORITY_COLUMN
+        )
+        categorized_products = combine_summary['total_items']
         
         dispatch_time = time.time() - start_time
         
-        if len(final_df) > 0:
-            # Calculate category distribution
-            category_distribution = final_df['category'].value_counts().to_dict()
+        if combine_summary['success'] and categorized_products > 0:
+            # Category distribution is counted while streaming
+            category_distribution = combine_summary['value_counts']['category']
+            priority_distribution = combine_summary['value_counts'][PRIORITY_COLUMN]
+            if registry:
+                registry.record(processed_batches)
             
             print(f"\n✅ CATEGORIZATION DISPATCH COMPLETE!")
             print(f"📁 Results saved to: {categorization_csv_path}")
-            print(f"📊 Successfully categorized: {len(final_df):,} products")
+            print(f"📊 Successfully categorized: {categorized_products:,} products")
             print(f"🏷️  Category distribution: {len(category_distribution)} unique categories")
+            print("🔢 Priority distribution: " + ", ".join(
+                f"P{priority}: {count:,}" for priority, count in sorted(priority_distribution.items())
+            ))
             print(f"⏱️  Total dispatch time: {dispatch_time/60:.1f} minutes")
             
             return {
                 'execution_id': execution_id,
                 'environment': environment,
-                'input_products': len(df),
-                'categorized_products': len(final_df),
+                'input_products': input_products,
+                'categorized_products': categorized_products,
                 'categorization_csv_path': categorization_csv_path,
                 'category_distribution': category_distribution,
+                'priority_distribution': priority_distribution,
                 'batch_count': len(batch_references),
-                'worker_count': len(categorization_futures),
+                'worker_count': autoscaler.peak_workers,
+                'carried_products': carried_products,
+                'retried_products': retry_summary['retried_items'],
+                'dead_letter_products': retry_summary['dead_letter_items'],
+                'llm_cache': llm_cache,
                 'dispatch_time': dispatch_time,
                 'status': 'completed'
             }
         else:
             raise Exception("No products were successfully categorized")
-            
+    
     except Exception as e:
         dispatch_time = time.time() - start_time
         print(f"❌ CATEGORIZATION DISPATCH FAILED: {str(e)}")
@@ -155,125 +231,191 @@ def stage3_categorization_dispatcher(
     image=image,
     
     secrets=secrets,
-    timeout=900,  # 15 minutes per worker
-    max_containers=50  # Auto-scale up to 50 workers (faster than extraction)
+    timeout=1800,  # 30 minutes per worker - each one drains many batches
+    max_containers=STAGE_SCALING['categorization'].max_workers  # Each container keeps LLM_CONCURRENCY requests in flight
 )
-def categorization_worker():
+def categorization_worker(batch_ref: BatchReference = None, queue_partition: str = None):
     """
-    Categorization Worker - Processes one batch of products from S3
+    Categorization Worker - Categorizes batches of products from S3
+    
+    The streaming pipeline passes batch_ref directly and gets that batch's
+    result back. Dispatchers leave it unset: the worker then keeps taking
+    batches from categorization_queue (queue_partition) until a poison pill,
+    loading the category list once. Products within a batch are categorized
+    concurrently, LLM_CONCURRENCY requests at a time.
     """
     import os
     
+    # Initialize OpenAI once per worker
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key or not openai:
+        print("❌ Worker error: OpenAI not available - cannot categorize products")
+        return
+    
+    # Load categories from mounted prompts
+    categories = _load_categories()
+    if not categories:
+        print("❌ Worker error: Categories not loaded - cannot categorize products")
+        return
+    
+    s3_manager = S3Manager()
+    llm = AsyncLLMRunner(api_key=api_key)
+    
+    def process_batch(batch_ref: BatchReference):
+        return _process_categorization_batch(categories, llm, s3_manager, batch_ref)
+    
     try:
-        # Get batch reference from queue
-        batch_ref: BatchReference = categorization_queue.get()
-        
-        if batch_ref is None:
-            return  # Poison pill to stop worker
-        
-        print(f"🏷️  Processing batch {batch_ref.batch_number}: {batch_ref.item_count} products")
-        
-        # Initialize OpenAI
-        api_key = os.environ.get('OPENAI_API_KEY')
-        if not api_key or not openai:
-            raise Exception("OpenAI not available - cannot categorize products")
-        
-        openai.api_key = api_key
-        
-        # Load categories from mounted prompts
-        categories = _load_categories()
-        if not categories:
-            raise Exception("Categories not loaded - cannot categorize products")
-        
-        # Load products from S3
-        s3_manager = S3Manager()
-        input_df = s3_manager.download_dataframe(batch_ref.s3_input_path)
-        
-        if len(input_df) == 0:
-            print(f"⚠️  Empty batch {batch_ref.batch_number}")
-            return
-        
-        # Process each product in the batch
-        results = []
-        for idx, row in input_df.iterrows():
-            product_name = row.get('name', 'Unknown Product')
-            product_description = row.get('description', '')
-            
-            print(f"   🤖 Categorizing: {product_name}")
-            
+        if batch_ref is not None:
             try:
-                # Categorize product using OpenAI
-                category_result = _categorize_single_product(
-                    categories, product_name, product_description
-                )
-                
-                if category_result:
-                    # Add categorization fields to existing product data
-                    product_data = row.to_dict()
-                    product_data.update({
-                        'category': category_result['category'],
-                        'category_confidence': category_result['confidence'],
-                        'category_reasoning': category_result['reasoning'],
-                        'categorization_timestamp': time.time()
-                    })
-                    
-                    results.append(product_data)
-                    print(f"   ✅ Categorized as: {category_result['category']} ({category_result['confidence']:.2f})")
-                else:
-                    print(f"   ❌ Failed to categorize: {product_name}")
-                    
+                take_cache_stats()
+                return with_cache_stats(process_batch(batch_ref))
             except Exception as e:
-                print(f"   ❌ Error categorizing {product_name}: {str(e)}")
-                continue
+                print(f"❌ Worker error: {str(e)}")
+                return
         
-        # Save results to S3
-        if results:
-            results_df = pd.DataFrame(results)
-            success = s3_manager.upload_dataframe(results_df, batch_ref.s3_output_path)
+        return run_batch_worker(categorization_queue, queue_partition, "categorization", process_batch)
+    finally:
+        llm.close()
+
+def _process_categorization_batch(categories: List[Dict[str, Any]], llm: AsyncLLMRunner, s3_manager: S3Manager, batch_ref: BatchReference):
+    """Categorize one batch - returns the batch number and output row count, or None if nothing was written"""
+    
+    # Batches finished before a resumed execution failed keep their output
+    reused = reuse_batch_output(s3_manager, batch_ref)
+    if reused:
+        return reused
+    
+    print(f"🏷️  Processing batch {batch_ref.batch_number}: {batch_ref.item_count} products")
+    
+    # Load products from S3
+    input_df = s3_manager.read_batch_input(batch_ref)
+    
+    if len(input_df) == 0:
+        print(f"⚠️  Empty batch {batch_ref.batch_number}")
+        return
+    
+    rows = [row for _, row in input_df.iterrows()]
+    
+    async def categorize_row(client, row):
+        product_name = row.get('name', 'Unknown Product')
+        print(f"   🤖 Categorizing: {product_name}")
+        return await _categorize_single_product(
+            client, categories, product_name, row.get('description', ''),
+            use_cache=not batch_ref.retry_pass
+        )
+    
+    # Categorize the whole batch with up to LLM_CONCURRENCY requests in flight
+    category_results = llm.map(categorize_row, rows)
+    
+    # Collect results in input order
+    results = []
+    failed = FailedItems(batch_ref)
+    for row, category_result in zip(rows, category_results):
+        product_name = row.get('name', 'Unknown Product')
+        
+        try:
+            if isinstance(category_result, Exception):
+                raise category_result
             
-            if success:
-                print(f"✅ Batch {batch_ref.batch_number} complete: {len(results)}/{batch_ref.item_count} successful")
+            if category_result:
+                # Add categorization fields to existing product data
+                product_data = row.to_dict()
+                hsa_fsa_likelihood, priority = _category_priority(categories, category_result['category'])
+                product_data.update({
+                    'category': category_result['category'],
+                    'category_confidence': category_result['confidence'],
+                    'category_reasoning': category_result['reasoning'],
+                    'hsa_fsa_likelihood': hsa_fsa_likelihood,
+                    PRIORITY_COLUMN: priority,
+                    'categorization_timestamp': time.time()
+                })
+                
+                results.append(product_data)
+                print(f"   ✅ Categorized as: {category_result['category']} ({category_result['confidence']:.2f})")
             else:
-                print(f"❌ Failed to save batch {batch_ref.batch_number} results")
+                print(f"   ❌ Failed to categorize: {product_name}")
+                failed.add(row.to_dict(), reason="InvalidResponse")
+        
+        except Exception as e:
+            print(f"   ❌ Error categorizing {product_name}: {str(e)}")
+            failed.add(row.to_dict(), e)
+            continue
+    
+    # Save results to S3, most likely eligible first
+    if results:
+        results_df = pd.DataFrame(results).sort_values(PRIORITY_COLUMN, kind='stable')
+        success = s3_manager.upload_dataframe(results_df, batch_ref.s3_output_path)
+        
+        if success:
+            print(f"✅ Batch {batch_ref.batch_number} complete: {len(results)}/{batch_ref.item_count} successful")
+            result = batch_result(batch_ref, len(results), failed, s3_manager)
+            result['priority'] = batch_priority(results_df)
+            return result
         else:
-            print(f"❌ Batch {batch_ref.batch_number}: No successful categorizations")
-            
-    except Exception as e:
-        print(f"❌ Worker error: {str(e)}")
+            print(f"❌ Failed to save batch {batch_ref.batch_number} results")
+    else:
+        print(f"❌ Batch {batch_ref.batch_number}: No successful categorizations")
+        return batch_result(batch_ref, 0, failed, s3_manager)
 
 def _load_categories() -> List[Dict[str, Any]]:
     """Load categories - simplified for Modal deployment"""
     
     try:
         # Basic categories based on your categories.txt file
+        # hsa_fsa_likelihood and priority mean what they do on CategorizedProduct (1 = classify first, 5 = skip)
         categories = [
-            {"name": "Acne & Blemish Control", "description": "Skincare products for acne treatment"},
-            {"name": "Allergy & Respiratory", "description": "Allergy medications and respiratory aids"},
-            {"name": "Cold & Flu", "description": "Cold and flu medications and remedies"},
-            {"name": "Dental & Oral Care", "description": "Dental care products and oral hygiene"},
-            {"name": "Diabetes Care", "description": "Blood glucose monitors and diabetic supplies"},
-            {"name": "Digestive Health", "description": "Digestive aids and stomach medications"},
-            {"name": "Eye & Vision Care", "description": "Eye drops, reading glasses, contact supplies"},
-            {"name": "First Aid & Wound Care", "description": "Bandages, antiseptics, wound care"},
-            {"name": "Medical Equipment & Supplies", "description": "Medical devices and diagnostic equipment"},
-            {"name": "Pain Relief & Anti-inflammatory", "description": "Pain medications and anti-inflammatory drugs"},
-            {"name": "Skin Care & Dermatology", "description": "Therapeutic skin care products"},
-            {"name": "Other / Miscellaneous", "description": "Products that don't fit other categories"}
+            {"name": "Acne & Blemish Control", "description": "Skincare products for acne treatment", "hsa_fsa_likelihood": "medium", "priority": 2},
+            {"name": "Allergy & Respiratory", "description": "Allergy medications and respiratory aids", "hsa_fsa_likelihood": "high", "priority": 1},
+            {"name": "Cold & Flu", "description": "Cold and flu medications and remedies", "hsa_fsa_likelihood": "high", "priority": 1},
+            {"name": "Dental & Oral Care", "description": "Dental care products and oral hygiene", "hsa_fsa_likelihood": "medium", "priority": 2},
+            {"name": "Diabetes Care", "description": "Blood glucose monitors and diabetic supplies", "hsa_fsa_likelihood": "high", "priority": 1},
+            {"name": "Digestive Health", "description": "Digestive aids and stomach medications", "hsa_fsa_likelihood": "medium", "priority": 2},
+            {"name": "Eye & Vision Care", "description": "Eye drops, reading glasses, contact supplies", "hsa_fsa_likelihood": "high", "priority": 1},
+            {"name": "First Aid & Wound Care", "description": "Bandages, antiseptics, wound care", "hsa_fsa_likelihood": "high", "priority": 1},
+            {"name": "Medical Equipment & Supplies", "description": "Medical devices and diagnostic equipment", "hsa_fsa_likelihood": "high", "priority": 1},
+            {"name": "Pain Relief & Anti-inflammatory", "description": "Pain medications and anti-inflammatory drugs", "hsa_fsa_likelihood": "high", "priority": 1},
+            {"name": "Skin Care & Dermatology", "description": "Therapeutic skin care products", "hsa_fsa_likelihood": "medium", "priority": 2},
+            {"name": "Other / Miscellaneous", "description": "Products that don't fit other categories", "hsa_fsa_likelihood": "low", "priority": 3}
         ]
         
         print(f"✅ Loaded {len(categories)} categories")
         return categories
-        
+    
     except Exception as e:
         print(f"❌ Error loading categories: {str(e)}")
         return []
 
-def _categorize_single_product(
+def _category_priority(categories: List[Dict[str, Any]], category: str):
+    """(hsa_fsa_likelihood, classification_priority) for a category name"""
+    for cat in categories:
+        if cat['name'] == category:
+            return cat.get('hsa_fsa_likelihood', 'low'), cat.get('priority', DEFAULT_CLASSIFICATION_PRIORITY)
+    return 'low', DEFAULT_CLASSIFICATION_PRIORITY
+
+def _categorization_reply_validator(categories: List[Dict[str, Any]]):
+    """Whether a reply is worth caching - JSON naming a category from the list, with a confidence"""
+    category_names = {cat['name'] for cat in categories}
+    
+    def validate(content: str) -> bool:
+        result = json.loads(content)
+        return result.get('category') in category_names and 'confidence' in result
+    
+    return validate
+
+async def _categorize_single_product(
+    client,
     categories: List[Dict[str, Any]], 
     product_name: str, 
-    product_description: str
+    product_description: str,
+    use_cache: bool = True
 ) -> Dict[str, Any]:
-    """Categorize a single product using OpenAI GPT-4o-mini"""
+    """
+    Categorize a single product using OpenAI GPT-4o-mini
+    
+    Returns None for a response without the expected fields; API errors that
+    outlast their retries are raised for the batch to set the product aside.
+    Second-pass batches set use_cache=False so the product is asked again.
+    """
     
     try:
         # Build categories list for prompt
@@ -287,28 +429,22 @@ def _categorize_single_product(
                 categories_text += f"   Keywords: {keywords_str}\n"
         
         # Create categorization prompt
-        prompt = f"""You are a product categorization expert. Classify the following product into one of these categories:
-
-{categories_text}
-
-Product Name: {product_name}
-Product Description: {product_description[:1000]}
-
-Analyze the product and return your classification in this exact JSON format:
-{{
-  "category": "exact category name from the list above",
-  "confidence": 0.85,
-  "reasoning": "brief explanation of why this category fits best"
-}}
-
-Choose the most specific and accurate category. If unsure, pick the closest match."""
+        prompt = CATEGORIZATION_PROMPT.format(
+            categories_text=categories_text,
+            product_name=product_name,
+            product_description=product_description[:1000]
+        )
         
         # Make OpenAI API call
-        if openai:
-            response = openai.chat.completions.create(
+        if client:
+            response = await call_with_retries_async(
+                limited_chat_completion,
+                client,
+                validate=_categorization_reply_validator(categories),
+                use_cache=use_cache,
                 model=OPENAI_MODEL,
                 messages=[
-                    {"role": "system", "content": "You are a precise product categorizer. Always respond with valid JSON."},
+                    {"role": "system", "content": CATEGORIZATION_SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.1,
@@ -330,26 +466,16 @@ Choose the most specific and accurate category. If unsure, pick the closest matc
             else:
                 print(f"   ⚠️  Invalid response format: {content}")
                 return None
-                
+        
         else:
             print(f"   ❌ OpenAI not available")
             return None
-            
+    
     except json.JSONDecodeError as e:
         print(f"   ❌ JSON parsing error: {str(e)}")
-        return None
-        
+        raise
+    
     except Exception as e:
         print(f"   ❌ Categorization error: {str(e)}")
-        return None
-
-def _calculate_worker_count(batch_count: int) -> tuple:
-    """Calculate optimal worker count based on batch count"""
-    if batch_count <= 10:
-        return 25, min(10, batch_count)
-    elif batch_count <= 50:
-        return 50, min(20, batch_count)
-    elif batch_count <= 200:
-        return 100, min(30, batch_count)
-    else:
-        return 200, min(50, batch_count)
\ No newline at end of file
+        note_api_error(e)
+        raise
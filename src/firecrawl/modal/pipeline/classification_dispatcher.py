@@ -10,7 +10,18 @@ import pandas as pd
 from typing import List, Dict, Any
 
 from .config import app, image, secrets, classification_queue
-from .s3_utils import S3Manager, create_dynamic_batches, combine_batch_results, BatchReference
+from .s3_utils import (
+    S3Manager, create_dynamic_batches_from_s3, stream_combine_batch_results, 
+    BatchReference, DEFAULT_ARTIFACT_FORMAT, PRIORITY_COLUMN, batch_priority, BATCH_BY_TOKENS
+)
+from .work_queue import queue_batches, run_batch_worker, wait_for_batches, note_api_error
+from .autoscaler import StageAutoscaler, STAGE_SCALING
+from .llm_client import AsyncLLMRunner
+from .rate_limiter import limited_chat_completion
+from .retries import FailedItems, batch_result, call_with_retries_async, run_second_pass
+from .resume import reuse_batch_output
+from .llm_cache import take_cache_stats, with_cache_stats, summarize_cache_stats
+from .registry import ProductRegistry, stage_version
 
 try:
     import openai
@@ -19,6 +30,19 @@ except ImportError:
 
 OPENAI_MODEL = "gpt-4o-mini"
 
+# Prompt text around the eligibility prompt and guides - all of it is part of the
+# registry's stage version, so any edit stops it carrying earlier answers
+CLASSIFICATION_SYSTEM_PROMPT = "You are an HSA/FSA eligibility expert. Always respond with valid JSON."
+CLASSIFICATION_REPLY_FORMAT = """
+Analyze this product and determine its HSA/FSA eligibility. Return your response in this exact JSON format:
+{
+  "status": "eligible|not_eligible|prescription_required|unclear",
+  "reasoning": "detailed explanation of your decision based on HSA/FSA rules and category guidelines",
+  "confidence": 0.85
+}
+
+Focus on the specific category guidelines and HSA/FSA eligibility criteria."""
+
 @app.function(
     image=image,
     
@@ -27,16 +51,28 @@ OPENAI_MODEL = "gpt-4o-mini"
 )
 def stage4_classification_dispatcher(
     execution_id: str,
-    environment: str = "dev"
+    environment: str = "dev",
+    artifact_format: str = DEFAULT_ARTIFACT_FORMAT,
+    max_priority: int = None,
+    incremental: bool = True
 ) -> dict:
     """
     Stage 4: HSA/FSA Classification Dispatcher
     Reads categorized CSV, creates dynamic batches, manages classification workers
     
+    The categorized artifact is in classification priority order, so batches
+    (and the classified artifact Turbopuffer uploads from) run most likely
+    eligible products first.
+    
     Args:
         execution_id: Unique execution ID from previous stages
         environment: dev or prod environment
-        
+        artifact_format: 'csv' or 'parquet' for this stage's artifacts
+        max_priority: Only classify products with classification_priority up to
+                      this value - the rest are deferred, e.g. for a time-boxed run
+        incremental: Carry forward products unchanged since their last classification,
+                     whatever their priority
+    
     Returns:
         Classification results and statistics
     """
@@ -51,79 +87,130 @@ def stage4_classification_dispatcher(
         # Read categorized CSV from S3
         s3_manager = S3Manager()
         categorization_csv_path = s3_manager.build_s3_path(
-            environment, execution_id, "categorization", "categorized_products.csv"
+            environment, execution_id, "categorization", "categorized_products.csv",
+            artifact_format=artifact_format
         )
         
+        # Products classified before with the same data, model and guides keep their answer
         print(f"📥 Reading categorized CSV from: {categorization_csv_path}")
-        df = s3_manager.download_dataframe(categorization_csv_path)
+        registry = None
+        batch_input_path, carried_batch = categorization_csv_path, None
+        if incremental:
+            registry = ProductRegistry(
+                s3_manager, environment, execution_id, "classification",
+                stage_version(
+                    OPENAI_MODEL, CLASSIFICATION_SYSTEM_PROMPT, CLASSIFICATION_REPLY_FORMAT,
+                    _load_eligibility_prompt(), _load_category_guides()
+                ), artifact_format
+            )
+            batch_input_path, carried_batch = registry.split_input(categorization_csv_path)
+        carried_products = carried_batch.item_count if carried_batch else 0
+        
+        # Deferred products are the tail of the priority-ordered artifact (the split keeps its order)
+        max_items = None
+        deferred_products = 0
+        if max_priority is not None and batch_input_path:
+            max_items, total_products = _priority_prefix(s3_manager, batch_input_path, max_priority)
+            if max_items is None:
+                print(f"⚠️  {batch_input_path} is not in priority order - classifying every product")
+            elif max_items == 0 and not carried_products:
+                raise Exception(f"No categorized products with priority {max_priority} or better")
+            else:
+                deferred_products = total_products - max_items
+                print(f"🔢 Priority {max_priority} or better: {max_items:,} products, {deferred_products:,} deferred")
         
-        if len(df) == 0:
+        # Stream the remaining products from S3 straight into batches
+        # Classification takes ~15 seconds per product (longer than categorization)
+        batch_references, input_summary = [], {'total_items': 0, 'value_counts': {'category': {}}}
+        if batch_input_path and max_items != 0:
+            batch_references, input_summary = create_dynamic_batches_from_s3(
+                input_s3_path=batch_input_path,
+                execution_id=execution_id,
+                stage="classification",
+                environment=environment,
+                processing_time_per_item=0.25,  # ~15 seconds per product
+                artifact_format=artifact_format,
+                max_items=max_items,
+                count_columns=['category'],
+                batch_by=BATCH_BY_TOKENS
+            )
+        input_products = input_summary['total_items'] + carried_products
+        
+        if input_products == 0:
             raise Exception("No products found in categorization CSV")
         
-        print(f"📊 Processing {len(df):,} products for HSA/FSA classification")
+        print(f"📊 Processing {input_products:,} products for HSA/FSA classification")
         
         # Show category distribution
-        category_counts = df['category'].value_counts()
+        category_counts = sorted(
+            input_summary['value_counts']['category'].items(), key=lambda item: item[1], reverse=True
+        )
         print(f"🏷️  Category distribution:")
-        for category, count in category_counts.head(10).items():
+        for category, count in category_counts[:10]:
             print(f"   {category}: {count} products")
         
-        # Create dynamic batches for classification
-        # Classification takes ~15 seconds per product (longer than categorization)
-        batch_references = create_dynamic_batches(
-            df=df,
-            execution_id=execution_id,
-            stage="classification",
-            environment=environment,
-            processing_time_per_item=0.25  # ~15 seconds per product
+        # Long-lived workers drain the queue - the autoscaler sizes the pool as batches complete
+        autoscaler = StageAutoscaler("classification", input_summary['total_items'])
+        completions = {}
+        if batch_references:
+            worker_count = autoscaler.initial_workers(len(batch_references))
+            queue_batches(classification_queue, batch_references, execution_id, "classification", worker_count)
+            
+            print(f"\n🚀 Starting {worker_count} classification workers for {len(batch_references)} batches...")
+            classification_futures = [
+                classification_worker.spawn(queue_partition=execution_id)
+                for _ in range(worker_count)
+            ]
+            
+            print(f"⏳ Waiting for {len(batch_references)} classification batches to complete...")
+            completions = wait_for_batches(
+                execution_id, "classification", len(batch_references), classification_futures,
+                batch_queue=classification_queue,
+                spawn_worker=lambda: classification_worker.spawn(queue_partition=execution_id),
+                autoscaler=autoscaler
+            )
+        completed_batches = [
+            batch_ref for batch_ref in batch_references
+            if completions.get(batch_ref.batch_number, {}).get('output_items')
+        ]
+        print(f"✅ {len(completions)}/{len(batch_references)} batches processed, {len(completed_batches)} with results")
+        
+        llm_cache = summarize_cache_stats("classification", completions.values())
+        
+        # Second pass over products that failed transiently - recovered batches join the combine
+        retry_batches, retry_summary = run_second_pass(
+            "classification", batch_references, completions,
+            lambda retry_refs: list(classification_worker.map(retry_refs, return_exceptions=True))
         )
-        
-        print(f"\n🚀 Starting {len(batch_references)} classification workers...")
-        
-        # Queue batch references for workers
-        for batch_ref in batch_references:
-            classification_queue.put(batch_ref)
-        
-        # Start classification workers
-        classification_futures = []
-        batch_size, max_workers = _calculate_worker_count(len(batch_references))
-        
-        for i in range(min(max_workers, len(batch_references))):
-            future = classification_worker.spawn()
-            classification_futures.append(future)
-        
-        print(f"✅ Started {len(classification_futures)} classification workers")
-        
-        # Wait for all workers to complete
-        print(f"⏳ Waiting for classification workers to complete...")
-        completed_workers = 0
-        
-        for future in classification_futures:
-            try:
-                result = future.get()  # This blocks until worker completes
-                completed_workers += 1
-                print(f"   ✅ Worker {completed_workers}/{len(classification_futures)} completed")
-            except Exception as e:
-                print(f"   ❌ Worker failed: {str(e)}")
+        completed_batches += retry_batches
+        processed_batches = list(completed_batches)
+        if carried_batch:
+            completed_batches.append(carried_batch)
         
         # Combine all batch results into final CSV
         print(f"\n📋 Combining classification results...")
         
         classification_csv_path = s3_manager.build_s3_path(
-            environment, execution_id, "classification", "classified_products.csv"
+            environment, execution_id, "classification", "classified_products.csv",
+            artifact_format=artifact_format
         )
         
-        final_df = combine_batch_results(batch_references, classification_csv_path)
+        combine_summary = stream_combine_batch_results(
+            completed_batches, classification_csv_path, count_columns=['hsa_fsa_status']
+        )
+        classified_products = combine_summary['total_items']
         
         dispatch_time = time.time() - start_time
         
-        if len(final_df) > 0:
-            # Calculate eligibility distribution
-            eligibility_distribution = final_df['hsa_fsa_status'].value_counts().to_dict()
+        if combine_summary['success'] and classified_products > 0:
+            # Eligibility distribution is counted while streaming
+            eligibility_distribution = combine_summary['value_counts']['hsa_fsa_status']
+            if registry:
+                registry.record(processed_batches)
             
             print(f"\n✅ CLASSIFICATION DISPATCH COMPLETE!")
             print(f"📁 Results saved to: {classification_csv_path}")
-            print(f"📊 Successfully classified: {len(final_df):,} products")
+            print(f"📊 Successfully classified: {classified_products:,} products")
             print(f"🏥 HSA/FSA eligibility distribution:")
             for status, count in eligibility_distribution.items():
                 print(f"   {status}: {count} products")
@@ -132,18 +219,23 @@ def stage4_classification_dispatcher(
             return {
                 'execution_id': execution_id,
                 'environment': environment,
-                'input_products': len(df),
-                'classified_products': len(final_df),
+                'input_products': input_products,
+                'classified_products': classified_products,
                 'classification_csv_path': classification_csv_path,
                 'eligibility_distribution': eligibility_distribution,
+                'deferred_products': deferred_products,
+                'carried_products': carried_products,
                 'batch_count': len(batch_references),
-                'worker_count': len(classification_futures),
+                'worker_count': autoscaler.peak_workers,
+                'retried_products': retry_summary['retried_items'],
+                'dead_letter_products': retry_summary['dead_letter_items'],
+                'llm_cache': llm_cache,
                 'dispatch_time': dispatch_time,
                 'status': 'completed'
             }
         else:
             raise Exception("No products were successfully classified")
-            
+    
     except Exception as e:
         dispatch_time = time.time() - start_time
         print(f"❌ CLASSIFICATION DISPATCH FAILED: {str(e)}")
@@ -163,98 +255,160 @@ def stage4_classification_dispatcher(
     image=image,
     
     secrets=secrets,
-    timeout=1200,  # 20 minutes per worker
-    max_containers=15  # Limited by OpenAI rate limits
+    timeout=2400,  # 40 minutes per worker - each one drains many batches
+    max_containers=STAGE_SCALING['classification'].max_workers  # OpenAI quota is enforced by rate_limiter.py
 )
-def classification_worker():
+def classification_worker(batch_ref: BatchReference = None, queue_partition: str = None):
     """
-    Classification Worker - Processes one batch of categorized products from S3
+    Classification Worker - Classifies batches of categorized products from S3
+    
+    The streaming pipeline passes batch_ref directly and gets that batch's
+    result back. Dispatchers leave it unset: the worker then takes batches
+    from classification_queue (queue_partition) until a poison pill, loading
+    the eligibility prompt and category guides once. Each batch is classified
+    with up to LLM_CONCURRENCY OpenAI requests in flight.
     """
     import os
     
+    # Initialize OpenAI once per worker
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key or not openai:
+        print(f"❌ Worker error: OpenAI not available - cannot classify products")
+        return
+    
+    # Load classification guides
+    eligibility_prompt = _load_eligibility_prompt()
+    category_guides = _load_category_guides()
+    
+    if not eligibility_prompt:
+        print(f"❌ Worker error: Eligibility prompt not loaded - cannot classify products")
+        return
+    
+    s3_manager = S3Manager()
+    llm = AsyncLLMRunner(api_key=api_key)
+    
+    def process_batch(batch_ref: BatchReference):
+        return _process_classification_batch(eligibility_prompt, category_guides, llm, s3_manager, batch_ref)
+    
     try:
-        # Get batch reference from queue
-        batch_ref: BatchReference = classification_queue.get()
-        
-        if batch_ref is None:
-            return  # Poison pill to stop worker
-        
-        print(f"🧠 Processing batch {batch_ref.batch_number}: {batch_ref.item_count} products")
-        
-        # Initialize OpenAI
-        api_key = os.environ.get('OPENAI_API_KEY')
-        if not api_key or not openai:
-            raise Exception("OpenAI not available - cannot classify products")
-        
-        openai.api_key = api_key
-        
-        # Load classification guides
-        eligibility_prompt = _load_eligibility_prompt()
-        category_guides = _load_category_guides()
+        if batch_ref is not None:
+            try:
+                take_cache_stats()
+                return with_cache_stats(process_batch(batch_ref))
+            except Exception as e:
+                print(f"❌ Worker error: {str(e)}")
+                return
         
-        if not eligibility_prompt:
-            raise Exception("Eligibility prompt not loaded - cannot classify products")
+        return run_batch_worker(classification_queue, queue_partition, "classification", process_batch)
+    finally:
+        llm.close()
+
+def _process_classification_batch(eligibility_prompt: str, category_guides: Dict[str, str], llm: AsyncLLMRunner, s3_manager: S3Manager, batch_ref: BatchReference):
+    """Classify one batch - returns the batch number and output row count, or None if nothing was written"""
+    
+    # Batches finished before a resumed execution failed keep their output
+    reused = reuse_batch_output(s3_manager, batch_ref)
+    if reused:
+        return reused
+    
+    print(f"🧠 Processing batch {batch_ref.batch_number}: {batch_ref.item_count} products")
+    
+    # Load products from S3
+    input_df = s3_manager.read_batch_input(batch_ref)
+    
+    if len(input_df) == 0:
+        print(f"⚠️  Empty batch {batch_ref.batch_number}")
+        return
+    
+    rows = [row for _, row in input_df.iterrows()]
+    
+    async def classify_row(client, row):
+        product_name = row.get('name', 'Unknown Product')
+        product_category = row.get('category', 'Other / Miscellaneous')
         
-        # Load products from S3
-        s3_manager = S3Manager()
-        input_df = s3_manager.download_dataframe(batch_ref.s3_input_path)
+        print(f"   🤖 Classifying: {product_name} (category: {product_category})")
         
-        if len(input_df) == 0:
-            print(f"⚠️  Empty batch {batch_ref.batch_number}")
-            return
+        # Get category-specific guide
+        category_guide = _get_category_guide(category_guides, product_category)
         
-        # Process each product in the batch
-        results = []
-        for idx, row in input_df.iterrows():
-            product_name = row.get('name', 'Unknown Product')
-            product_category = row.get('category', 'Other / Miscellaneous')
-            product_description = row.get('description', '')
-            
-            print(f"   🤖 Classifying: {product_name} (category: {product_category})")
+        # Classify product using OpenAI with targeted prompt
+        return await _classify_single_product(
+            client, eligibility_prompt, category_guide, product_name,
+            row.get('description', ''), product_category,
+            use_cache=not batch_ref.retry_pass
+        )
+    
+    classification_results = llm.map(classify_row, rows)
+    
+    # Collect results in input order
+    results = []
+    failed = FailedItems(batch_ref)
+    for row, classification_result in zip(rows, classification_results):
+        product_name = row.get('name', 'Unknown Product')
+        
+        try:
+            if isinstance(classification_result, Exception):
+                raise classification_result
             
-            try:
-                # Get category-specific guide
-                category_guide = _get_category_guide(category_guides, product_category)
-                
-                # Classify product using OpenAI with targeted prompt
-                classification_result = _classify_single_product(
-                    eligibility_prompt, category_guide, product_name, 
-                    product_description, product_category
-                )
+            if classification_result:
+                # Add classification fields to existing product data
+                product_data = row.to_dict()
+                product_data.update({
+                    'hsa_fsa_status': classification_result['status'],
+                    'hsa_fsa_reasoning': classification_result['reasoning'],
+                    'hsa_fsa_confidence': classification_result['confidence'],
+                    'classification_timestamp': time.time()
+                })
                 
-                if classification_result:
-                    # Add classification fields to existing product data
-                    product_data = row.to_dict()
-                    product_data.update({
-                        'hsa_fsa_status': classification_result['status'],
-                        'hsa_fsa_reasoning': classification_result['reasoning'],
-                        'hsa_fsa_confidence': classification_result['confidence'],
-                        'classification_timestamp': time.time()
-                    })
-                    
-                    results.append(product_data)
-                    print(f"   ✅ Classified as: {classification_result['status']} ({classification_result['confidence']:.2f})")
-                else:
-                    print(f"   ❌ Failed to classify: {product_name}")
-                    
-            except Exception as e:
-                print(f"   ❌ Error classifying {product_name}: {str(e)}")
-                continue
-        
-        # Save results to S3
-        if results:
-            results_df = pd.DataFrame(results)
-            success = s3_manager.upload_dataframe(results_df, batch_ref.s3_output_path)
-            
-            if success:
-                print(f"✅ Batch {batch_ref.batch_number} complete: {len(results)}/{batch_ref.item_count} successful")
+                results.append(product_data)
+                print(f"   ✅ Classified as: {classification_result['status']} ({classification_result['confidence']:.2f})")
             else:
-                print(f"❌ Failed to save batch {batch_ref.batch_number} results")
+                print(f"   ❌ Failed to classify: {product_name}")
+                failed.add(row.to_dict(), reason="InvalidResponse")
+        
+        except Exception as e:
+            print(f"   ❌ Error classifying {product_name}: {str(e)}")
+            failed.add(row.to_dict(), e)
+            continue
+    
+    # Save results to S3
+    if results:
+        results_df = pd.DataFrame(results)
+        success = s3_manager.upload_dataframe(results_df, batch_ref.s3_output_path)
+        
+        if success:
+            print(f"✅ Batch {batch_ref.batch_number} complete: {len(results)}/{batch_ref.item_count} successful")
+            result = batch_result(batch_ref, len(results), failed, s3_manager)
+            result['priority'] = batch_priority(results_df)
+            return result
         else:
-            print(f"❌ Batch {batch_ref.batch_number}: No successful classifications")
-            
-    except Exception as e:
-        print(f"❌ Worker error: {str(e)}")
+            print(f"❌ Failed to save batch {batch_ref.batch_number} results")
+    else:
+        print(f"❌ Batch {batch_ref.batch_number}: No successful classifications")
+        return batch_result(batch_ref, 0, failed, s3_manager)
+
+def _priority_prefix(s3_manager: S3Manager, artifact_path: str, max_priority: int):
+    """
+    Count the leading rows of a priority-ordered artifact within max_priority
+    
+    Returns:
+        (rows within max_priority, total rows) - the first is None when the
+        artifact has no priorities or they are out of order
+    """
+    within = 0
+    total = 0
+    past_cutoff = False
+    for chunk in s3_manager.iter_dataframe_chunks(artifact_path, columns=[PRIORITY_COLUMN]):
+        total += len(chunk)
+        if PRIORITY_COLUMN not in chunk.columns:
+            return None, total
+        keep = pd.to_numeric(chunk[PRIORITY_COLUMN], errors='coerce').fillna(float('inf')) <= max_priority
+        kept = int(keep.sum())
+        if kept and (past_cutoff or not keep.iloc[:kept].all()):
+            return None, total
+        within += kept
+        past_cutoff = past_cutoff or kept < len(chunk)
+    return within, total
 
 def _load_eligibility_prompt() -> str:
     """Load main HSA/FSA eligibility prompt"""
@@ -286,7 +440,7 @@ Return your assessment with confidence level and reasoning.
         
         print(f"✅ Loaded eligibility prompt ({len(eligibility_content)} chars)")
         return eligibility_content
-        
+    
     except Exception as e:
         print(f"❌ Error loading eligibility prompt: {str(e)}")
         return None
@@ -309,7 +463,7 @@ def _load_category_guides() -> Dict[str, str]:
         
         print(f"✅ Loaded {len(category_guides)} category-specific guides")
         return category_guides
-        
+    
     except Exception as e:
         print(f"❌ Error loading category guides: {str(e)}")
         return {}
@@ -336,14 +490,30 @@ def _get_category_guide(category_guides: Dict[str, str], product_category: str)
     
     return general_guide
 
-def _classify_single_product(
+# Statuses the classification prompt asks for
+CLASSIFICATION_STATUSES = {'eligible', 'not_eligible', 'prescription_required', 'unclear'}
+
+def _valid_classification_reply(content: str) -> bool:
+    """Whether a reply is worth caching - JSON with a known status and reasoning"""
+    result = json.loads(content)
+    return result.get('status') in CLASSIFICATION_STATUSES and 'reasoning' in result
+
+async def _classify_single_product(
+    client,
     eligibility_prompt: str,
     category_guide: str,
     product_name: str,
     product_description: str,
-    product_category: str
+    product_category: str,
+    use_cache: bool = True
 ) -> Dict[str, Any]:
-    """Classify a single product's HSA/FSA eligibility using targeted prompts"""
+    """
+    Classify a single product's HSA/FSA eligibility using targeted prompts
+    
+    Returns None for a response without the expected fields; API errors that
+    outlast their retries are raised for the batch to set the product aside.
+    Second-pass batches set use_cache=False so the product is asked again.
+    """
     
     try:
         # Build targeted classification prompt
@@ -360,24 +530,20 @@ def _classify_single_product(
         prompt_parts.append(f"Category: {product_category}")
         prompt_parts.append(f"Description: {product_description[:1500]}")  # Limit length
         
-        prompt_parts.append(f"""
-Analyze this product and determine its HSA/FSA eligibility. Return your response in this exact JSON format:
-{{
-  "status": "eligible|not_eligible|prescription_required|unclear",
-  "reasoning": "detailed explanation of your decision based on HSA/FSA rules and category guidelines",
-  "confidence": 0.85
-}}
-
-Focus on the specific category guidelines and HSA/FSA eligibility criteria.""")
+        prompt_parts.append(CLASSIFICATION_REPLY_FORMAT)
         
         full_prompt = "\n".join(prompt_parts)
         
         # Make OpenAI API call
-        if openai:
-            response = openai.chat.completions.create(
+        if client:
+            response = await call_with_retries_async(
+                limited_chat_completion,
+                client,
+                validate=_valid_classification_reply,
+                use_cache=use_cache,
                 model=OPENAI_MODEL,
                 messages=[
-                    {"role": "system", "content": "You are an HSA/FSA eligibility expert. Always respond with valid JSON."},
+                    {"role": "system", "content": CLASSIFICATION_SYSTEM_PROMPT},
                     {"role": "user", "content": full_prompt}
                 ],
                 temperature=0.1,
@@ -399,26 +565,16 @@ Focus on the specific category guidelines and HSA/FSA eligibility criteria.""")
             else:
                 print(f"   ⚠️  Invalid response format: {content}")
                 return None
-                
+        
         else:
             print(f"   ❌ OpenAI not available")
             return None
-            
+    
     except json.JSONDecodeError as e:
         print(f"   ❌ JSON parsing error: {str(e)}")
-        return None
-        
+        raise
+    
     except Exception as e:
         print(f"   ❌ Classification error: {str(e)}")
-        return None
-
-def _calculate_worker_count(batch_count: int) -> tuple:
-    """Calculate optimal worker count based on batch count (limited by OpenAI rate limits)"""
-    if batch_count <= 5:
-        return 25, min(5, batch_count)
-    elif batch_count <= 20:
-        return 50, min(10, batch_count)
-    elif batch_count <= 50:
-        return 100, min(15, batch_count)
-    else:
-        return 200, min(15, batch_count)  # Max 15 workers due to OpenAI limits
\ No newline at end of file
+        note_api_error(e)
+        raise
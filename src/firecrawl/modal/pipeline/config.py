@@ -22,7 +22,10 @@ image = (
         "beautifulsoup4",
         "python-dotenv",
         "turbopuffer",
-        "boto3"  # AWS SDK for S3 access
+        "boto3",  # AWS SDK for S3 access
+        "pyarrow",  # Parquet stage artifacts
+        "zstandard",  # Optional zstd artifact compression
+        "orjson"  # Fast compact JSON
     ])
 )
 
@@ -36,6 +39,9 @@ categorization_queue = Queue.from_name("categorized-products", create_if_missing
 classification_queue = Queue.from_name("classified-products", create_if_missing=True)
 turbopuffer_queue = Queue.from_name("turbopuffer-products", create_if_missing=True)
 
+# Batch dispatchers report finished batches here, partitioned per execution and stage
+batch_completion_queue = Queue.from_name("batch-completions", create_if_missing=True)
+
 # Shared secrets - you'll need to create these in Modal dashboard
 secrets = [
     Secret.from_name("aws-s3-credentials"),  # AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
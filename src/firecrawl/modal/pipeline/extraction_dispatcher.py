@@ -9,7 +9,22 @@ import pandas as pd
 from typing import List
 
 from .config import app, image, secrets, url_queue
-from .s3_utils import S3Manager, create_dynamic_batches, combine_batch_results, BatchReference
+from .s3_utils import (
+    S3Manager, create_dynamic_batches_from_s3, stream_combine_batch_results, 
+    BatchReference, DEFAULT_ARTIFACT_FORMAT
+)
+from .work_queue import queue_batches, run_batch_worker, wait_for_batches, note_api_error
+from .autoscaler import StageAutoscaler
+from .product_identity import product_id_for_url
+from .retries import FailedItems, batch_result, call_with_retries, run_second_pass
+from .resume import reuse_batch_output
+from .stragglers import LatencyTracker, call_with_deadline
+
+# Extraction only needs these discovery columns - products are rebuilt from Firecrawl
+EXTRACTION_INPUT_COLUMNS = ['url', 'estimated_name']
+
+# Firecrawl scrape latencies in this worker - slow scrapes get a duplicate past the p95
+SCRAPE_LATENCY = LatencyTracker()
 
 @app.function(
     image=image,
@@ -20,7 +35,8 @@ from .s3_utils import S3Manager, create_dynamic_batches, combine_batch_results,
 def stage2_extraction_dispatcher(
     execution_id: str,
     environment: str = "dev",
-    max_products: int = None
+    max_products: int = None,
+    artifact_format: str = DEFAULT_ARTIFACT_FORMAT
 ) -> dict:
     """
     Stage 2: Extraction Dispatcher
@@ -30,7 +46,8 @@ def stage2_extraction_dispatcher(
         execution_id: Unique execution ID from discovery stage
         environment: dev or prod environment
         max_products: Optional limit on number of products to process
-        
+        artifact_format: 'csv' or 'parquet' for this stage's artifacts
+    
     Returns:
         Extraction results and statistics
     """
@@ -45,92 +62,97 @@ def stage2_extraction_dispatcher(
         # Read discovery CSV from S3
         s3_manager = S3Manager()
         discovery_csv_path = s3_manager.build_s3_path(
-            environment, execution_id, "discovery", "discovered_urls.csv"
+            environment, execution_id, "discovery", "discovered_urls.csv",
+            artifact_format=artifact_format
         )
         
-        print(f"📥 Reading discovery CSV from: {discovery_csv_path}")
-        df = s3_manager.download_dataframe(discovery_csv_path)
-        
-        if len(df) == 0:
-            raise Exception("No URLs found in discovery CSV")
-        
-        # Apply max_products limit if specified
-        original_count = len(df)
-        if max_products and len(df) > max_products:
-            df = df.head(max_products)
-            print(f"⚠️  Limited to {max_products:,} products (from {original_count:,})")
-        
-        print(f"📊 Processing {len(df):,} URLs for extraction")
-        
-        # Create dynamic batches for extraction
+        # Stream discovery CSV from S3 straight into batches
         # Each URL takes ~1 minute to extract
-        batch_references = create_dynamic_batches(
-            df=df,
+        print(f"📥 Reading discovery CSV from: {discovery_csv_path}")
+        batch_references, input_summary = create_dynamic_batches_from_s3(
+            input_s3_path=discovery_csv_path,
             execution_id=execution_id,
             stage="extraction",
             environment=environment,
-            processing_time_per_item=1.0  # 1 minute per URL
+            processing_time_per_item=1.0,  # 1 minute per URL
+            artifact_format=artifact_format,
+            columns=EXTRACTION_INPUT_COLUMNS,
+            max_items=max_products
         )
+        input_urls = input_summary['total_items']
         
-        print(f"\n🚀 Starting {len(batch_references)} extraction workers...")
-        
-        # Queue batch references for workers
-        for batch_ref in batch_references:
-            url_queue.put(batch_ref)
-        
-        # Start extraction workers
-        extraction_futures = []
-        batch_size, max_workers = _calculate_worker_count(len(batch_references))
-        
-        for i in range(min(max_workers, len(batch_references))):
-            future = extraction_worker.spawn()
-            extraction_futures.append(future)
-        
-        print(f"✅ Started {len(extraction_futures)} extraction workers")
-        
-        # Wait for all workers to complete
-        print(f"⏳ Waiting for extraction workers to complete...")
-        completed_workers = 0
+        if input_urls == 0:
+            raise Exception("No URLs found in discovery CSV")
         
-        for future in extraction_futures:
-            try:
-                result = future.get()  # This blocks until worker completes
-                completed_workers += 1
-                print(f"   ✅ Worker {completed_workers}/{len(extraction_futures)} completed")
-            except Exception as e:
-                print(f"   ❌ Worker failed: {str(e)}")
+        print(f"📊 Processing {input_urls:,} URLs for extraction")
+        
+        # Long-lived workers drain the queue - the autoscaler sizes the pool as batches complete
+        autoscaler = StageAutoscaler("extraction", input_urls)
+        worker_count = autoscaler.initial_workers(len(batch_references))
+        queue_batches(url_queue, batch_references, execution_id, "extraction", worker_count)
+        
+        print(f"\n🚀 Starting {worker_count} extraction workers for {len(batch_references)} batches...")
+        extraction_futures = [
+            extraction_worker.spawn(queue_partition=execution_id)
+            for _ in range(worker_count)
+        ]
+        
+        # Completion is tracked per batch - a slow worker never holds up the count
+        print(f"⏳ Waiting for {len(batch_references)} extraction batches to complete...")
+        completions = wait_for_batches(
+            execution_id, "extraction", len(batch_references), extraction_futures,
+            batch_queue=url_queue,
+            spawn_worker=lambda: extraction_worker.spawn(queue_partition=execution_id),
+            autoscaler=autoscaler
+        )
+        completed_batches = [
+            batch_ref for batch_ref in batch_references
+            if completions.get(batch_ref.batch_number, {}).get('output_items')
+        ]
+        print(f"✅ {len(completions)}/{len(batch_references)} batches processed, {len(completed_batches)} with results")
+        
+        # Second pass over URLs that failed transiently - recovered batches join the combine
+        retry_batches, retry_summary = run_second_pass(
+            "extraction", batch_references, completions,
+            lambda retry_refs: list(extraction_worker.map(retry_refs, return_exceptions=True))
+        )
+        completed_batches += retry_batches
         
         # Combine all batch results into final CSV
         print(f"\n📋 Combining extraction results...")
         
         extraction_csv_path = s3_manager.build_s3_path(
-            environment, execution_id, "extraction", "extracted_products.csv"
+            environment, execution_id, "extraction", "extracted_products.csv",
+            artifact_format=artifact_format
         )
         
-        final_df = combine_batch_results(batch_references, extraction_csv_path)
+        combine_summary = stream_combine_batch_results(completed_batches, extraction_csv_path)
+        extracted_products = combine_summary['total_items']
         
         dispatch_time = time.time() - start_time
         
-        if len(final_df) > 0:
+        if combine_summary['success'] and extracted_products > 0:
             print(f"\n✅ EXTRACTION DISPATCH COMPLETE!")
             print(f"📁 Results saved to: {extraction_csv_path}")
-            print(f"📊 Successfully extracted: {len(final_df):,} products")
+            print(f"📊 Successfully extracted: {extracted_products:,} products")
             print(f"⏱️  Total dispatch time: {dispatch_time/60:.1f} minutes")
             
             return {
                 'execution_id': execution_id,
                 'environment': environment,
-                'input_urls': len(df),
-                'extracted_products': len(final_df),
+                'input_urls': input_urls,
+                'extracted_products': extracted_products,
                 'extraction_csv_path': extraction_csv_path,
                 'batch_count': len(batch_references),
-                'worker_count': len(extraction_futures),
+                'worker_count': autoscaler.peak_workers,
+                'retried_urls': retry_summary['retried_items'],
+                'dead_letter_urls': retry_summary['dead_letter_items'],
                 'dispatch_time': dispatch_time,
                 'status': 'completed'
             }
         else:
             raise Exception("No products were successfully extracted")
-            
+    
     except Exception as e:
         dispatch_time = time.time() - start_time
         print(f"❌ EXTRACTION DISPATCH FAILED: {str(e)}")
@@ -150,91 +172,125 @@ def stage2_extraction_dispatcher(
     image=image,
     
     secrets=secrets,
-    timeout=1800,  # 30 minutes per worker
+    timeout=3600,  # 1 hour per worker - each one drains many batches
     max_containers=100  # Auto-scale up to 100 workers
 )
-def extraction_worker():
+def extraction_worker(batch_ref: BatchReference = None, queue_partition: str = None):
     """
-    Extraction Worker - Processes one batch of URLs from S3
+    Extraction Worker - Extracts batches of URLs from S3
+    
+    The streaming pipeline passes batch_ref directly and gets that batch's
+    result back. Dispatchers leave it unset: the worker then takes batches from
+    url_queue (queue_partition) until a poison pill, reusing its Firecrawl
+    client for every batch.
     """
     import os
     
+    # Initialize Firecrawl once per worker
+    firecrawl = None
     try:
-        # Get batch reference from queue
-        batch_ref: BatchReference = url_queue.get()
-        
-        if batch_ref is None:
-            return  # Poison pill to stop worker
-        
-        print(f"🔍 Processing batch {batch_ref.batch_number}: {batch_ref.item_count} URLs")
-        
-        # Initialize Firecrawl
+        from firecrawl import FirecrawlApp
+        api_key = os.environ.get('FIRECRAWL_API_KEY')
+        if api_key:
+            firecrawl = FirecrawlApp(api_key=api_key)
+    except ImportError:
         firecrawl = None
+    
+    if not firecrawl:
+        print(f"❌ Worker error: Firecrawl not available - cannot extract products")
+        return
+    
+    s3_manager = S3Manager()
+    
+    def process_batch(batch_ref: BatchReference):
+        return _process_extraction_batch(firecrawl, s3_manager, batch_ref)
+    
+    if batch_ref is not None:
         try:
-            from firecrawl import FirecrawlApp
-            api_key = os.environ.get('FIRECRAWL_API_KEY')
-            if api_key:
-                firecrawl = FirecrawlApp(api_key=api_key)
-        except ImportError:
-            firecrawl = None
-        
-        if not firecrawl:
-            raise Exception("Firecrawl not available - cannot extract products")
-        
-        # Load URLs from S3
-        s3_manager = S3Manager()
-        input_df = s3_manager.download_dataframe(batch_ref.s3_input_path)
-        
-        if len(input_df) == 0:
-            print(f"⚠️  Empty batch {batch_ref.batch_number}")
+            return process_batch(batch_ref)
+        except Exception as e:
+            print(f"❌ Worker error: {str(e)}")
             return
+    
+    return run_batch_worker(url_queue, queue_partition, "extraction", process_batch)
+
+def _process_extraction_batch(firecrawl, s3_manager: S3Manager, batch_ref: BatchReference):
+    """Extract one batch - returns the batch number and output row count, or None if nothing was written"""
+    
+    # Batches finished before a resumed execution failed keep their output
+    reused = reuse_batch_output(s3_manager, batch_ref)
+    if reused:
+        return reused
+    
+    print(f"🔍 Processing batch {batch_ref.batch_number}: {batch_ref.item_count} URLs")
+    
+    # Load URLs from S3
+    input_df = s3_manager.read_batch_input(batch_ref, columns=EXTRACTION_INPUT_COLUMNS)
+    
+    if len(input_df) == 0:
+        print(f"⚠️  Empty batch {batch_ref.batch_number}")
+        return
+    
+    # Process each URL in the batch
+    results = []
+    failed = FailedItems(batch_ref)
+    for idx, row in input_df.iterrows():
+        url = row['url']
+        estimated_name = row.get('estimated_name', 'Unknown Product')
         
-        # Process each URL in the batch
-        results = []
-        for idx, row in input_df.iterrows():
-            url = row['url']
-            estimated_name = row.get('estimated_name', 'Unknown Product')
-            
-            print(f"   🤖 Extracting: {url}")
-            
-            try:
-                # Extract product data using Firecrawl
-                extracted_data = _extract_single_product(firecrawl, url, estimated_name)
-                if extracted_data:
-                    results.append(extracted_data)
-                    print(f"   ✅ Extracted: {extracted_data['name']}")
-                else:
-                    print(f"   ❌ Failed to extract: {url}")
-                    
-            except Exception as e:
-                print(f"   ❌ Error extracting {url}: {str(e)}")
-                continue
+        print(f"   🤖 Extracting: {url}")
         
-        # Save results to S3
-        if results:
-            results_df = pd.DataFrame(results)
-            success = s3_manager.upload_dataframe(results_df, batch_ref.s3_output_path)
-            
-            if success:
-                print(f"✅ Batch {batch_ref.batch_number} complete: {len(results)}/{batch_ref.item_count} successful")
+        try:
+            # Extract product data using Firecrawl
+            extracted_data = _extract_single_product(firecrawl, url, estimated_name)
+            if extracted_data:
+                results.append(extracted_data)
+                print(f"   ✅ Extracted: {extracted_data['name']}")
             else:
-                print(f"❌ Failed to save batch {batch_ref.batch_number} results")
+                print(f"   ❌ Failed to extract: {url}")
+                failed.add(row.to_dict())
+        
+        except Exception as e:
+            print(f"   ❌ Error extracting {url}: {str(e)}")
+            failed.add(row.to_dict(), e)
+            continue
+    
+    # Save results to S3
+    if results:
+        results_df = pd.DataFrame(results)
+        success = s3_manager.upload_dataframe(results_df, batch_ref.s3_output_path)
+        
+        if success:
+            print(f"✅ Batch {batch_ref.batch_number} complete: {len(results)}/{batch_ref.item_count} successful "
+                  f"({SCRAPE_LATENCY.hedged} scrapes hedged in this worker, {SCRAPE_LATENCY.hedge_wins} won by the duplicate)")
+            return batch_result(batch_ref, len(results), failed, s3_manager)
         else:
-            print(f"❌ Batch {batch_ref.batch_number}: No successful extractions")
-            
-    except Exception as e:
-        print(f"❌ Worker error: {str(e)}")
+            print(f"❌ Failed to save batch {batch_ref.batch_number} results")
+    else:
+        print(f"❌ Batch {batch_ref.batch_number}: No successful extractions")
+        return batch_result(batch_ref, 0, failed, s3_manager)
 
 def _extract_single_product(firecrawl, url: str, estimated_name: str) -> dict:
-    """Extract comprehensive product data from a single URL"""
+    """
+    Extract comprehensive product data from a single URL
+    
+    Transient Firecrawl errors are retried here; an error that outlasts the
+    retries is raised so the batch can set the URL aside. A scrape still
+    running past the recent p95 gets a duplicate request, and one with no
+    result by ITEM_DEADLINE_SECONDS is set aside the same way. Returns None
+    when the page scraped but held no product data.
+    """
     
     try:
         # Import schemas
         from .schemas import ProductExtractionSchema
         
         # Firecrawl structured extraction
-        scrape_result = firecrawl.scrape_url(
+        scrape_result = call_with_deadline(
+            call_with_retries,
+            firecrawl.scrape_url,
             url,
+            tracker=SCRAPE_LATENCY,
             formats=['extract'],
             extract={
                 'schema': ProductExtractionSchema.model_json_schema()
@@ -259,6 +315,7 @@ def _extract_single_product(firecrawl, url: str, estimated_name: str) -> dict:
         
         # Return standardized product data
         return {
+            'product_id': product_id_for_url(url),
             'url': url,
             'name': extract_data.get('name', estimated_name),
             'description': comprehensive_description,
@@ -275,10 +332,11 @@ def _extract_single_product(firecrawl, url: str, estimated_name: str) -> dict:
             'additional_info': extract_data.get('additional_info', ''),
             'extraction_timestamp': time.time()
         }
-        
+    
     except Exception as e:
         print(f"   ❌ Extraction error for {url}: {str(e)}")
-        return None
+        note_api_error(e)
+        raise
 
 def _build_comprehensive_description(extract_data: dict, markdown: str) -> str:
     """Build comprehensive 2000+ character product description"""
@@ -348,14 +406,3 @@ def _build_comprehensive_description(extract_data: dict, markdown: str) -> str:
     comprehensive_desc = comprehensive_desc.replace('  ', ' ').replace(' | |', ' |').strip()
     
     return comprehensive_desc
-
-def _calculate_worker_count(batch_count: int) -> tuple:
-    """Calculate optimal worker count based on batch count"""
-    if batch_count <= 10:
-        return 25, min(10, batch_count)
-    elif batch_count <= 100:
-        return 25, min(30, batch_count)
-    elif batch_count <= 500:
-        return 50, min(50, batch_count)
-    else:
-        return 100, min(100, batch_count)
\ No newline at end of file
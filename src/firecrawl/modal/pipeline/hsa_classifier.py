@@ -12,6 +12,7 @@ from typing import Dict, Any, Optional
 
 from .config import app, image, secrets, categorization_queue, classification_queue
 from .schemas import CategorizedProduct, ClassifiedProduct
+from .rate_limiter import limited_chat_completion_sync
 
 try:
     import openai
@@ -20,6 +21,10 @@ except ImportError:
 
 OPENAI_MODEL = "gpt-4o-mini"
 
+def _valid_classification_reply(content: str) -> bool:
+    """Whether a reply is worth caching - JSON carrying an eligibility status"""
+    return bool(json.loads(content).get('eligibilityStatus'))
+
 @app.function(
     image=image,
     
@@ -142,7 +147,9 @@ def _classify_single_product(categorized_product: CategorizedProduct, eligibilit
         
         # Make OpenAI API call
         if openai:
-            response = openai.chat.completions.create(
+            response = limited_chat_completion_sync(
+                openai,
+                validate=_valid_classification_reply,
                 model=OPENAI_MODEL,
                 messages=[
                     {"role": "system", "content": optimized_prompt},
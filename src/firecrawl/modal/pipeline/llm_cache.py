@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+LLM Response Cache for Modal Pipeline
+Chat completions stored by their normalized request, so the same product
+seen again (another merchant, a re-run, a reclassified CSV) costs no OpenAI call
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from .storage import StorageKeyNotFound, get_storage_backend
+
+# LLM_CACHE=off sends every request to OpenAI
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE', 'on').lower() not in ('off', 'false', '0')
+
+# Stored responses are asked again after this long - a model name can change behaviour
+LLM_CACHE_TTL_SECONDS = float(os.environ.get('LLM_CACHE_TTL_DAYS', '30')) * 86400
+
+# Part of every key - bump LLM_CACHE_VERSION to drop every stored response at once
+LLM_CACHE_VERSION = os.environ.get('LLM_CACHE_VERSION', '1')
+
+# Durable tier: one JSON object per response under llm_cache/ in the storage backend
+LLM_CACHE_FOLDER = 'llm_cache'
+
+# Local tier: most recently used responses kept in each container
+LLM_CACHE_LOCAL_ENTRIES = 10000
+
+# Request fields that change the answer - the rest (timeouts, headers) share an entry
+KEY_FIELDS = ('model', 'messages', 'temperature', 'top_p', 'max_tokens', 'response_format', 'seed')
+
+def _normalize_text(text: Any) -> str:
+    """Whitespace differences between renders of the same prompt don't change the key"""
+    return re.sub(r'\s+', ' ', str(text)).strip()
+
+def request_key(request: Dict[str, Any]) -> str:
+    """
+    Cache key of a chat completion request
+    
+    The prompt is keyed as rendered, so any edit to a template, category list
+    or guide that reaches the prompt makes new keys - stale answers are never
+    served for a changed prompt, whatever its version number says.
+    """
+    fields = {field: request[field] for field in KEY_FIELDS if request.get(field) is not None}
+    fields['messages'] = [
+        {'role': message.get('role'), 'content': _normalize_text(message.get('content', ''))}
+        for message in request.get('messages', [])
+    ]
+    payload = json.dumps([LLM_CACHE_VERSION, fields], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def accepts(validate: Callable[[str], bool], content: str) -> bool:
+    """True when the caller's validator takes a reply - a validator that raises rejects it"""
+    try:
+        return bool(validate(content))
+    except Exception:
+        return False
+
+def cached_response(entry: Dict[str, Any]):
+    """A stored entry shaped like the parsed OpenAI response the call sites read"""
+    prompt_tokens = entry.get('prompt_tokens') or 0
+    completion_tokens = entry.get('completion_tokens') or 0
+    return SimpleNamespace(
+        model=entry.get('model'),
+        choices=[SimpleNamespace(
+            index=0,
+            message=SimpleNamespace(role='assistant', content=entry['content']),
+            finish_reason=entry.get('finish_reason', 'stop')
+        )],
+        usage=SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        ),
+        cached=True
+    )
+
+# Hits and misses since the last take_cache_stats() - batch completion records report them
+_cache_stats = {'cache_hits': 0, 'cache_misses': 0, 'cache_saved_tokens': 0}
+_cache_stats_lock = threading.Lock()
+
+def _count(hit: bool, saved_tokens: int = 0):
+    with _cache_stats_lock:
+        _cache_stats['cache_hits' if hit else 'cache_misses'] += 1
+        _cache_stats['cache_saved_tokens'] += saved_tokens
+
+def take_cache_stats() -> Dict[str, int]:
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+        for name in _cache_stats:
+            _cache_stats[name] = 0
+    return stats
+
+def with_cache_stats(batch_result: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """A batch result carrying the cache hits counted since the last take_cache_stats()"""
+    stats = take_cache_stats()
+    return {**batch_result, **stats} if batch_result else batch_result
+
+def summarize_cache_stats(stage: str, records: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Hit rate and tokens saved over a stage's batch results or completion records"""
+    hits = misses = saved_tokens = 0
+    for record in records:
+        record = record or {}
+        hits += record.get('cache_hits') or 0
+        misses += record.get('cache_misses') or 0
+        saved_tokens += record.get('cache_saved_tokens') or 0
+    lookups = hits + misses
+    summary = {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / lookups if lookups else 0.0,
+        'saved_tokens': saved_tokens
+    }
+    if lookups:
+        print(f"💾 {stage} LLM cache: {hits:,}/{lookups:,} requests answered from cache "
+              f"({summary['hit_rate']:.0%}), {saved_tokens:,} tokens saved")
+    return summary
+
+class LLMResponseCache:
+    """
+    Two-tier store of chat completions: an in-container LRU in front of storage
+    
+    Only complete answers the caller's validator accepts are stored
+    (finish_reason "stop" and a reply that parses to a usable result), so a
+    truncated, refused or malformed response is asked again next time.
+    Lookups check the validator too, dropping entries stored before it
+    existed or under a looser one. Storage errors are printed and treated as
+    misses - the cache never fails a request.
+    """
+    
+    def __init__(self, max_entries: int = LLM_CACHE_LOCAL_ENTRIES, ttl_seconds: float = LLM_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _storage_key(self, key: str) -> str:
+        return f"{LLM_CACHE_FOLDER}/{key[:2]}/{key}.json"
+    
+    def _remember(self, key: str, entry: Dict[str, Any]):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        try:
+            entry = json.loads(get_storage_backend().get(self._storage_key(key)))
+        except StorageKeyNotFound:
+            return None
+        except Exception as e:
+            print(f"⚠️  LLM cache read failed: {str(e)}")
+            return None
+        self._remember(key, entry)
+        return entry
+    
+    def _forget(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def lookup(self, request: Dict[str, Any], validate: Callable[[str], bool]):
+        """The cached response for request, or None when it has to be sent"""
+        key = request_key(request)
+        entry = self._load(key)
+        if entry is not None and not accepts(validate, entry.get('content', '')):
+            self._forget(key)
+            entry = None
+        if entry is None or time.time() - entry.get('created_at', 0) > self.ttl_seconds:
+            _count(hit=False)
+            return None
+        _count(hit=True, saved_tokens=(entry.get('prompt_tokens') or 0) + (entry.get('completion_tokens') or 0))
+        return cached_response(entry)
+    
+    def store(self, request: Dict[str, Any], response, validate: Callable[[str], bool]):
+        """Keep a fresh response for the next identical request, if validate accepts its content"""
+        choice = response.choices[0]
+        if getattr(choice, 'finish_reason', None) != 'stop' or not choice.message.content:
+            return
+        if not accepts(validate, choice.message.content):
+            return
+        usage = getattr(response, 'usage', None)
+        entry = {
+            'content': choice.message.content,
+            'finish_reason': choice.finish_reason,
+            'model': getattr(response, 'model', None) or request.get('model'),
+            'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+            'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+            'created_at': time.time()
+        }
+        key = request_key(request)
+        self._remember(key, entry)
+        try:
+            get_storage_backend().put(
+                self._storage_key(key), json.dumps(entry).encode('utf-8'), content_type='application/json'
+            )
+        except Exception as e:
+            print(f"⚠️  LLM cache write failed: {str(e)}")
+
+# One cache per container, shared by every call site and thread
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+def llm_response_cache() -> Optional[LLMResponseCache]:
+    """The container's response cache, or None when LLM_CACHE is off"""
+    global _llm_cache
+    
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMResponseCache()
+        return _llm_cache
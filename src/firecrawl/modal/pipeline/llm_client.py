@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Async LLM Client for Modal Pipeline
+Keeps many OpenAI requests in flight from one worker container so LLM-bound
+stages overlap their network waits instead of calling one product at a time
+"""
+
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, List, Optional
+
+try:
+    import openai
+except ImportError:
+    openai = None
+
+# OpenAI requests each worker container keeps in flight - 1 calls one product at a time
+LLM_CONCURRENCY = max(1, int(os.environ.get('LLM_CONCURRENCY', '32')))
+
+# Account quota the shared rate limiter starts from - the x-ratelimit-limit-* headers
+# on the first response replace it with the real one
+OPENAI_REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', '5000'))
+OPENAI_TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', '2000000'))
+
+class AsyncLLMRunner:
+    """
+    Event loop and AsyncOpenAI client for one worker
+    
+    Workers are synchronous Modal functions, so the runner owns a private
+    event loop and reuses it (and the client's connection pool) for every
+    batch the worker processes.
+    """
+    
+    def __init__(self, api_key: Optional[str] = None, concurrency: Optional[int] = None):
+        self.concurrency = max(1, concurrency or LLM_CONCURRENCY)
+        self.loop = asyncio.new_event_loop()
+        self.client = openai.AsyncOpenAI(api_key=api_key)
+    
+    def map(self, call: Callable[[Any, Any], Awaitable[Any]], items: List[Any]) -> List[Any]:
+        """
+        Run call(client, item) for every item, at most `concurrency` at a time
+        
+        Results come back in input order; an exception raised for one item is
+        returned in its slot instead of failing the others.
+        """
+        async def run_all():
+            semaphore = asyncio.Semaphore(self.concurrency)
+            
+            async def run_one(item):
+                async with semaphore:
+                    return await call(self.client, item)
+            
+            return await asyncio.gather(*(run_one(item) for item in items), return_exceptions=True)
+        
+        return self.loop.run_until_complete(run_all())
+    
+    def close(self):
+        try:
+            self.loop.run_until_complete(self.client.close())
+        finally:
+            self.loop.close()
@@ -4,16 +4,41 @@ Main Pipeline Orchestrator for Modal S3-based Product Processing
 Coordinates all 5 stages: Discovery → Extraction → Categorization → Classification → Turbopuffer
 """
 
+import heapq
+import itertools
 import time
 import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Dict, Any, List
 
 from .config import app, image, secrets
+from .s3_utils import (
+    S3Manager, BatchReference, create_dynamic_batches_from_s3, stream_combine_batch_results,
+    PRIORITY_COLUMN, DEFAULT_CLASSIFICATION_PRIORITY
+)
 from .url_discovery import stage1_discovery_orchestrator
-from .extraction_dispatcher import stage2_extraction_dispatcher
-from .categorization_dispatcher import stage3_categorization_dispatcher
-from .classification_dispatcher import stage4_classification_dispatcher
-from .turbopuffer_dispatcher import stage5_turbopuffer_dispatcher
+from .extraction_dispatcher import stage2_extraction_dispatcher, extraction_worker, EXTRACTION_INPUT_COLUMNS
+from .categorization_dispatcher import stage3_categorization_dispatcher, categorization_worker
+from .classification_dispatcher import stage4_classification_dispatcher, classification_worker
+from .turbopuffer_dispatcher import stage5_turbopuffer_dispatcher, turbopuffer_worker
+from .autoscaler import STAGE_SCALING
+from .retries import second_pass_batches, retry_handoff_span, retry_handoff_number
+from .resume import PIPELINE_ARTIFACTS, completed_stages, load_run_settings, save_run_settings
+from .llm_cache import summarize_cache_stats
+
+# Streaming mode - stages 2-5 in pipeline order with their combined artifact and
+# the column counted while combining. Concurrency is each stage's container ceiling.
+STREAMING_STAGES = [
+    ('extraction', 'extracted_products.csv', None),
+    ('categorization', 'categorized_products.csv', 'category'),
+    ('classification', 'classified_products.csv', 'hsa_fsa_status'),
+    ('turbopuffer', 'uploaded_products.csv', 'upload_success')
+]
+STREAMING_CONCURRENCY = {stage: STAGE_SCALING[stage].max_workers for stage, _, _ in STREAMING_STAGES}
+
+# Combined artifacts written in an order, matching what the dispatchers write
+STREAMING_ORDER_BY = {'categorization': PRIORITY_COLUMN}
 
 @app.function(
     image=image,
@@ -24,7 +49,12 @@ def run_complete_pipeline(
     base_urls: List[str],
     environment: str = "dev",
     max_products: int = None,
-    turbopuffer_namespace: str = None
+    turbopuffer_namespace: str = None,
+    artifact_format: str = "csv",
+    streaming: bool = False,
+    max_priority: int = None,
+    resume_execution_id: str = None,
+    incremental: bool = True
 ) -> Dict[str, Any]:
     """
     Run the complete 5-stage S3-based product processing pipeline
@@ -34,16 +64,64 @@ def run_complete_pipeline(
         environment: dev or prod environment
         max_products: Optional limit on number of products to process
         turbopuffer_namespace: Optional Turbopuffer namespace override
-        
+        artifact_format: Stage artifact format in S3 - 'csv' or 'parquet'
+        streaming: Overlap stages 2-5 - each finished batch goes straight to the
+                   next stage instead of waiting for the whole stage
+        max_priority: Only classify and upload products with classification_priority
+                      up to this value (1 = most likely eligible) - the rest are deferred
+        resume_execution_id: Continue a failed execution instead of starting a new one.
+                             Stages whose artifact is in S3 are skipped, batches with
+                             an output are not rerun, and the other settings are taken
+                             from the original run
+        incremental: Carry forward categorization, classification and upload results
+                     of products unchanged since an earlier execution (batch mode only)
+    
     Returns:
         Complete pipeline results with stage-by-stage statistics
     """
     
     pipeline_start = time.time()
-    execution_id = str(uuid.uuid4())[:8]
+    s3_manager = S3Manager()
+    settings = None
+    resumed_stages = {}
+    
+    if resume_execution_id:
+        execution_id = resume_execution_id
+        settings = load_run_settings(s3_manager, environment, execution_id)
+        if settings:
+            # Same settings as the original run, so batches line up with the outputs it left
+            base_urls = settings['base_urls']
+            max_products = settings['max_products']
+            turbopuffer_namespace = settings['turbopuffer_namespace']
+            artifact_format = settings['artifact_format']
+            streaming = settings['streaming']
+            max_priority = settings['max_priority']
+            incremental = settings.get('incremental', incremental)
+        else:
+            print(f"⚠️  No saved settings for {execution_id} - resuming with the ones given")
+        resumed_stages = completed_stages(s3_manager, environment, execution_id, artifact_format)
+    else:
+        execution_id = str(uuid.uuid4())[:8]
+    
+    if settings is None:
+        save_run_settings(s3_manager, environment, execution_id, {
+            'base_urls': base_urls,
+            'max_products': max_products,
+            'turbopuffer_namespace': turbopuffer_namespace,
+            'artifact_format': artifact_format,
+            'streaming': streaming,
+            'max_priority': max_priority,
+            'incremental': incremental
+        })
+    if 'turbopuffer' in resumed_stages:
+        resumed_stages['turbopuffer']['turbopuffer_namespace'] = turbopuffer_namespace or f"ecommerce-products-{environment}"
     
-    print(f"🚀 STARTING COMPLETE PIPELINE")
+    print(f"🚀 {'RESUMING' if resume_execution_id else 'STARTING'} COMPLETE PIPELINE")
     print(f"📋 Execution ID: {execution_id}")
+    if resume_execution_id:
+        next_stage = next((stage for stage, _, _ in PIPELINE_ARTIFACTS if stage not in resumed_stages), None)
+        print(f"♻️  Completed stages: {', '.join(resumed_stages) or 'none'} - "
+              f"{'nothing left to run' if next_stage is None else f'resuming at {next_stage}'}")
     print(f"🌍 Environment: {environment}")
     print(f"🔗 Base URLs: {len(base_urls)} sites")
     if max_products:
@@ -54,6 +132,10 @@ def run_complete_pipeline(
         'environment': environment,
         'base_urls': base_urls,
         'max_products': max_products,
+        'streaming': streaming,
+        'max_priority': max_priority,
+        'incremental': incremental,
+        'resumed_stages': list(resumed_stages),
         'pipeline_start': pipeline_start,
         'stages': {}
     }
@@ -64,15 +146,19 @@ def run_complete_pipeline(
         print(f"🔍 STAGE 1: URL DISCOVERY")
         print(f"="*60)
         
-        # Need to create DiscoveryJob object for stage1
-        from .schemas import DiscoveryJob
-        discovery_job = DiscoveryJob(
-            base_urls=base_urls,  
-            execution_id=execution_id,
-            environment=environment
-        )
-        
-        stage1_result = stage1_discovery_orchestrator.remote(discovery_job)
+        if 'discovery' in resumed_stages:
+            stage1_result = resumed_stages['discovery']
+        else:
+            # Need to create DiscoveryJob object for stage1
+            from .schemas import DiscoveryJob
+            discovery_job = DiscoveryJob(
+                base_urls=base_urls,  
+                execution_id=execution_id,
+                environment=environment,
+                artifact_format=artifact_format
+            )
+            
+            stage1_result = stage1_discovery_orchestrator.remote(discovery_job)
         
         results['stages']['discovery'] = stage1_result
         
@@ -82,16 +168,34 @@ def run_complete_pipeline(
         discovered_urls = stage1_result['discovered_urls']
         print(f"✅ Stage 1 complete: {discovered_urls:,} URLs discovered")
         
+        if streaming and 'turbopuffer' in resumed_stages:
+            streaming_results = resumed_stages
+        elif streaming:
+            print("\n" + "="*60)
+            print("🌊 STAGES 2-5: STREAMING")
+            print("="*60)
+            
+            # Stages 2-5 run as one - on a resumed execution their finished batches are reused
+            streaming_results = _run_streaming_stages(
+                execution_id, environment, max_products, turbopuffer_namespace, artifact_format, max_priority
+            )
+        
         # STAGE 2: Product Extraction
         print(f"\n" + "="*60)
         print(f"🤖 STAGE 2: PRODUCT EXTRACTION")
         print(f"="*60)
         
-        stage2_result = stage2_extraction_dispatcher.remote(
-            execution_id=execution_id,
-            environment=environment,
-            max_products=max_products
-        )
+        if streaming:
+            stage2_result = streaming_results['extraction']
+        elif 'extraction' in resumed_stages:
+            stage2_result = resumed_stages['extraction']
+        else:
+            stage2_result = stage2_extraction_dispatcher.remote(
+                execution_id=execution_id,
+                environment=environment,
+                max_products=max_products,
+                artifact_format=artifact_format
+            )
         
         results['stages']['extraction'] = stage2_result
         
@@ -106,10 +210,17 @@ def run_complete_pipeline(
         print(f"🏷️  STAGE 3: PRODUCT CATEGORIZATION")
         print(f"="*60)
         
-        stage3_result = stage3_categorization_dispatcher.remote(
-            execution_id=execution_id,
-            environment=environment
-        )
+        if streaming:
+            stage3_result = streaming_results['categorization']
+        elif 'categorization' in resumed_stages:
+            stage3_result = resumed_stages['categorization']
+        else:
+            stage3_result = stage3_categorization_dispatcher.remote(
+                execution_id=execution_id,
+                environment=environment,
+                artifact_format=artifact_format,
+                incremental=incremental
+            )
         
         results['stages']['categorization'] = stage3_result
         
@@ -124,10 +235,18 @@ def run_complete_pipeline(
         print(f"🏥 STAGE 4: HSA/FSA CLASSIFICATION")
         print(f"="*60)
         
-        stage4_result = stage4_classification_dispatcher.remote(
-            execution_id=execution_id,
-            environment=environment
-        )
+        if streaming:
+            stage4_result = streaming_results['classification']
+        elif 'classification' in resumed_stages:
+            stage4_result = resumed_stages['classification']
+        else:
+            stage4_result = stage4_classification_dispatcher.remote(
+                execution_id=execution_id,
+                environment=environment,
+                artifact_format=artifact_format,
+                max_priority=max_priority,
+                incremental=incremental
+            )
         
         results['stages']['classification'] = stage4_result
         
@@ -147,11 +266,18 @@ def run_complete_pipeline(
         print(f"🗄️  STAGE 5: TURBOPUFFER UPLOAD")
         print(f"="*60)
         
-        stage5_result = stage5_turbopuffer_dispatcher.remote(
-            execution_id=execution_id,
-            environment=environment,
-            turbopuffer_namespace=turbopuffer_namespace
-        )
+        if streaming:
+            stage5_result = streaming_results['turbopuffer']
+        elif 'turbopuffer' in resumed_stages:
+            stage5_result = resumed_stages['turbopuffer']
+        else:
+            stage5_result = stage5_turbopuffer_dispatcher.remote(
+                execution_id=execution_id,
+                environment=environment,
+                turbopuffer_namespace=turbopuffer_namespace,
+                artifact_format=artifact_format,
+                incremental=incremental
+            )
         
         results['stages']['turbopuffer'] = stage5_result
         
@@ -178,6 +304,15 @@ def run_complete_pipeline(
         print(f"🏷️  Products categorized: {categorized_products:,}")
         print(f"🏥 Products classified: {classified_products:,}")
         print(f"🗄️  Products uploaded: {uploaded_products:,}")
+        
+        # Resumed stages have no cache figures - only this run's requests count
+        llm_cache = [results['stages'][stage].get('llm_cache') or {} for stage in ('categorization', 'classification')]
+        cache_hits = sum(stats.get('hits', 0) for stats in llm_cache)
+        cache_lookups = cache_hits + sum(stats.get('misses', 0) for stats in llm_cache)
+        tokens_saved = sum(stats.get('saved_tokens', 0) for stats in llm_cache)
+        if cache_lookups:
+            print(f"💾 LLM cache: {cache_hits:,}/{cache_lookups:,} requests ({cache_hits / cache_lookups:.0%}), "
+                  f"{tokens_saved:,} tokens saved")
         print(f"⏱️  Total pipeline time: {pipeline_time/60:.1f} minutes")
         
         results.update({
@@ -191,12 +326,15 @@ def run_complete_pipeline(
                 'products_classified': classified_products,
                 'products_uploaded': uploaded_products,
                 'failed_uploads': failed_uploads,
-                'turbopuffer_namespace': namespace
+                'turbopuffer_namespace': namespace,
+                'llm_cache_hits': cache_hits,
+                'llm_cache_hit_rate': cache_hits / cache_lookups if cache_lookups else 0.0,
+                'llm_tokens_saved': tokens_saved
             }
         })
         
         return results
-        
+    
     except Exception as e:
         pipeline_time = time.time() - pipeline_start
         error_msg = str(e)
@@ -212,6 +350,228 @@ def run_complete_pipeline(
         
         return results
 
+def _run_streaming_stages(
+    execution_id: str,
+    environment: str,
+    max_products: int = None,
+    turbopuffer_namespace: str = None,
+    artifact_format: str = "csv",
+    max_priority: int = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Run stages 2-5 as overlapping micro-batches
+    
+    Discovery output is split into extraction batches as usual. Whenever a
+    worker writes a batch output, that file becomes a batch for the next stage
+    right away, so all four stages work at once and end-to-end time tracks the
+    slowest stage rather than the sum. Items a stage set aside after transient
+    failures get their second pass once that stage and everything upstream of
+    it has drained. Each stage's batch outputs are combined into its usual
+    artifact at the end.
+    
+    Batches wait for a free slot in their stage in classification priority
+    order, so the products most likely to be eligible are classified and
+    uploaded first. Categorized batches with nothing within max_priority are
+    not classified at all.
+    
+    Returns:
+        Results per stage, shaped like the matching dispatcher's results
+    """
+    
+    start_time = time.time()
+    if not turbopuffer_namespace:
+        turbopuffer_namespace = f"ecommerce-products-{environment}"
+    
+    s3_manager = S3Manager()
+    discovery_csv_path = s3_manager.build_s3_path(
+        environment, execution_id, "discovery", "discovered_urls.csv",
+        artifact_format=artifact_format
+    )
+    extraction_batches, input_summary = create_dynamic_batches_from_s3(
+        input_s3_path=discovery_csv_path,
+        execution_id=execution_id,
+        stage="extraction",
+        environment=environment,
+        processing_time_per_item=1.0,
+        artifact_format=artifact_format,
+        columns=EXTRACTION_INPUT_COLUMNS,
+        max_items=max_products
+    )
+    
+    stage_workers = {
+        'extraction': lambda batch_ref: extraction_worker.remote(batch_ref),
+        'categorization': lambda batch_ref: categorization_worker.remote(batch_ref),
+        'classification': lambda batch_ref: classification_worker.remote(batch_ref),
+        'turbopuffer': lambda batch_ref: turbopuffer_worker.remote(turbopuffer_namespace, batch_ref)
+    }
+    stage_names = [stage for stage, _, _ in STREAMING_STAGES]
+    next_stage = dict(zip(stage_names, stage_names[1:] + [None]))
+    
+    # One pool per stage so handed-off batches never queue behind upstream work
+    executors = {
+        stage: ThreadPoolExecutor(max_workers=STREAMING_CONCURRENCY[stage], thread_name_prefix=f"stream-{stage}")
+        for stage in stage_names
+    }
+    stage_batches = {stage: [] for stage in stage_names}
+    pending_retries = {stage: [] for stage in stage_names}
+    dead_letters = {stage: 0 for stage in stage_names}
+    worker_results = {stage: [] for stage in stage_names}
+    deferred_products = 0
+    in_flight = {}
+    
+    # Batches waiting for a free slot in their stage, lowest priority number first
+    waiting = {stage: [] for stage in stage_names}
+    arrival = itertools.count()
+    
+    # Second-pass outputs are new inputs downstream - numbered from their source so a resume finds the same outputs
+    handoff_span = retry_handoff_span(extraction_batches)
+    
+    def submit(stage: str, batch_ref: BatchReference):
+        priority = batch_ref.priority if batch_ref.priority is not None else DEFAULT_CLASSIFICATION_PRIORITY
+        heapq.heappush(waiting[stage], (priority, next(arrival), batch_ref))
+        stage_batches[stage].append(batch_ref)
+    
+    def start_waiting():
+        running = Counter(stage for stage, _ in in_flight.values())
+        for stage in stage_names:
+            while waiting[stage] and running[stage] < STREAMING_CONCURRENCY[stage]:
+                _, _, batch_ref = heapq.heappop(waiting[stage])
+                future = executors[stage].submit(stage_workers[stage], batch_ref)
+                in_flight[future] = (stage, batch_ref)
+                running[stage] += 1
+    
+    print(f"🌊 Streaming {len(extraction_batches)} batches through {' → '.join(stage_names)}")
+    for batch_ref in extraction_batches:
+        submit('extraction', batch_ref)
+    start_waiting()
+    
+    last_progress = time.time()
+    try:
+        while in_flight:
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, batch_ref = in_flight.pop(future)
+                try:
+                    worker_result = future.result()
+                except Exception as e:
+                    print(f"   ❌ {stage} batch {batch_ref.batch_number} failed: {str(e)}")
+                    continue
+                
+                worker_result = worker_result or {}
+                worker_results[stage].append(worker_result)
+                dead_letters[stage] += worker_result.get('dead_letters') or 0
+                pending_retries[stage] += second_pass_batches([batch_ref], {batch_ref.batch_number: worker_result})
+                
+                output_items = worker_result.get('output_items', 0)
+                if not output_items or next_stage[stage] is None:
+                    continue
+                
+                # The batch output is the next stage's input - no combine in between
+                handoff_stage = next_stage[stage]
+                handoff_priority = worker_result.get('priority')
+                if (handoff_stage == 'classification' and max_priority is not None
+                        and handoff_priority is not None and handoff_priority > max_priority):
+                    deferred_products += output_items
+                    continue
+                handoff_number = batch_ref.batch_number
+                if batch_ref.retry_pass:
+                    handoff_number = retry_handoff_number(batch_ref.batch_number, stage_names.index(stage), handoff_span)
+                submit(handoff_stage, BatchReference(
+                    execution_id=execution_id,
+                    stage=handoff_stage,
+                    batch_number=handoff_number,
+                    item_count=output_items,
+                    s3_input_path=batch_ref.s3_output_path,
+                    s3_output_path=s3_manager.build_s3_path(
+                        environment, execution_id, handoff_stage, f"batch_{handoff_number}_output.csv",
+                        artifact_format=artifact_format
+                    ),
+                    environment=environment,
+                    priority=handoff_priority
+                ))
+            
+            # A stage's second pass starts once it can't receive any more first-pass work
+            busy_stages = {in_flight_stage for in_flight_stage, _ in in_flight.values()}
+            busy_stages.update(stage for stage in stage_names if waiting[stage])
+            for stage in stage_names:
+                if stage in busy_stages:
+                    break
+                if pending_retries[stage]:
+                    retry_items = sum(batch_ref.item_count for batch_ref in pending_retries[stage])
+                    print(f"   🔁 {stage}: second pass over {retry_items:,} items")
+                    for retry_ref in pending_retries[stage]:
+                        submit(stage, retry_ref)
+                    pending_retries[stage] = []
+                    break
+            start_waiting()
+            
+            if time.time() - last_progress >= 30:
+                last_progress = time.time()
+                print("   🌊 Batches in flight: " + ", ".join(
+                    f"{stage} {sum(1 for in_flight_stage, _ in in_flight.values() if in_flight_stage == stage)}"
+                    f" (+{len(waiting[stage])} waiting)"
+                    for stage in stage_names
+                ))
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+    
+    print(f"⏱️  Streaming stages finished in {(time.time() - start_time)/60:.1f} minutes - combining artifacts")
+    
+    stage_results = {}
+    for stage, filename, count_column in STREAMING_STAGES:
+        artifact_path = s3_manager.build_s3_path(
+            environment, execution_id, stage, filename, artifact_format=artifact_format
+        )
+        combine_summary = stream_combine_batch_results(
+            stage_batches[stage], artifact_path, count_columns=[count_column] if count_column else None,
+            order_by=STREAMING_ORDER_BY.get(stage)
+        )
+        value_counts = combine_summary['value_counts'].get(count_column, {})
+        stage_result = {
+            'execution_id': execution_id,
+            'environment': environment,
+            'batch_count': len(stage_batches[stage]),
+            'dead_letter_items': dead_letters[stage],
+            'dispatch_time': time.time() - start_time,
+            'status': 'completed' if combine_summary['success'] and combine_summary['total_items'] > 0 else 'failed'
+        }
+        
+        if stage == 'extraction':
+            stage_result.update({
+                'input_urls': input_summary['total_items'],
+                'extracted_products': combine_summary['total_items'],
+                'extraction_csv_path': artifact_path
+            })
+        elif stage == 'categorization':
+            stage_result.update({
+                'categorized_products': combine_summary['total_items'],
+                'categorization_csv_path': artifact_path,
+                'category_distribution': value_counts,
+                'llm_cache': summarize_cache_stats(stage, worker_results[stage])
+            })
+        elif stage == 'classification':
+            stage_result.update({
+                'classified_products': combine_summary['total_items'],
+                'classification_csv_path': artifact_path,
+                'eligibility_distribution': value_counts,
+                'deferred_products': deferred_products,
+                'llm_cache': summarize_cache_stats(stage, worker_results[stage])
+            })
+        else:
+            stage_result.update({
+                'turbopuffer_namespace': turbopuffer_namespace,
+                'successful_uploads': value_counts.get(True, 0),
+                'failed_uploads': value_counts.get(False, 0) + dead_letters[stage],
+                'turbopuffer_csv_path': artifact_path
+            })
+        
+        if stage_result['status'] == 'failed':
+            stage_result['error'] = f"No products made it through {stage}"
+        stage_results[stage] = stage_result
+    
+    return stage_results
+
 @app.function(
     image=image,
     
@@ -230,7 +590,7 @@ def run_pipeline_test(
         base_urls: List of e-commerce site URLs
         max_products: Number of products to limit test to (default 10)
         environment: dev or prod environment
-        
+    
     Returns:
         Test results
     """
@@ -252,14 +612,19 @@ def run_pipeline_test(
     secrets=secrets,
     timeout=60
 )
-def get_pipeline_status(execution_id: str, environment: str = "dev") -> Dict[str, Any]:
+def get_pipeline_status(
+    execution_id: str, 
+    environment: str = "dev", 
+    artifact_format: str = "csv"
+) -> Dict[str, Any]:
     """
     Get the current status of a pipeline execution by checking S3 outputs
     
     Args:
         execution_id: Pipeline execution ID
         environment: dev or prod environment
-        
+        artifact_format: Stage artifact format the execution was run with
+    
     Returns:
         Pipeline status information
     """
@@ -274,25 +639,21 @@ def get_pipeline_status(execution_id: str, environment: str = "dev") -> Dict[str
     }
     
     # Check each stage's output
-    stages = [
-        ('discovery', 'discovered_urls.csv'),
-        ('extraction', 'extracted_products.csv'),
-        ('categorization', 'categorized_products.csv'),
-        ('classification', 'classified_products.csv'),
-        ('turbopuffer', 'uploaded_products.csv')
-    ]
-    
-    for stage_name, filename in stages:
+    for stage_name, filename, _ in PIPELINE_ARTIFACTS:
         try:
-            s3_path = s3_manager.build_s3_path(environment, execution_id, stage_name, filename)
-            df = s3_manager.download_dataframe(s3_path)
+            s3_path = s3_manager.build_s3_path(
+                environment, execution_id, stage_name, filename, artifact_format=artifact_format
+            )
+            
+            # Only the row count is needed - taken from the Parquet footer or the CSV row index when there is one
+            record_count = s3_manager.count_rows(s3_path)
             
             status['stages'][stage_name] = {
                 'status': 'completed',
-                'record_count': len(df),
+                'record_count': record_count,
                 's3_path': s3_path
             }
-            
+        
         except Exception as e:
             status['stages'][stage_name] = {
                 'status': 'not_found',
@@ -304,7 +665,7 @@ def get_pipeline_status(execution_id: str, environment: str = "dev") -> Dict[str
 # Convenience function for common use cases
 @app.function(
     image=image,
-     
+    
     secrets=secrets,
     timeout=14400
 )
@@ -320,7 +681,7 @@ def run_single_site_pipeline(
         site_url: Single e-commerce site URL
         environment: dev or prod environment
         max_products: Optional limit on products
-        
+    
     Returns:
         Pipeline results
     """
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Canonical Product Identity for Modal Pipeline
+Turns product URLs into stable IDs shared by every stage, execution and vector upsert
+"""
+
+import hashlib
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Query params that never change which product a URL points at - only click IDs
+# and analytics params that no store uses for anything else. Generic names like
+# "source", "ref" or "cid" can select a product or variant, so they are kept.
+TRACKING_QUERY_PARAMS = {
+    'gclid', 'gbraid', 'wbraid', 'dclid', 'fbclid', 'msclkid', 'yclid', 'igshid',
+    'srsltid', 'mc_cid', 'mc_eid', '_ga', '_gl', '_hsenc', '_hsmi', '_kx',
+    'irclickid', 'spm', 'sc_channel'
+}
+TRACKING_QUERY_PREFIXES = ('utm_', 'pk_', 'mtm_')
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+PRODUCT_ID_PREFIX = "p_"
+PRODUCT_ID_HASH_LENGTH = 16
+
+def canonicalize_url(url: str) -> str:
+    """
+    Normalize a product URL so equivalent links compare equal
+
+    - http/https and a leading "www." are treated as the same site
+    - host is lowercased and default ports dropped
+    - duplicate and trailing slashes are removed from the path
+    - tracking query params are dropped, the rest sorted - variant params
+      (sku, size, count, flavor, ...) stay, so a 30-count and a 90-count
+      pack are different products
+    - fragments are dropped
+    """
+    url = str(url or '').strip()
+    if not url:
+        return ''
+    if '://' not in url:
+        url = f"https://{url.lstrip('/')}"
+
+    parts = urlsplit(url)
+    original_scheme = parts.scheme.lower()
+    scheme = 'https' if original_scheme == 'http' else original_scheme
+
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    port = str(parts.port) if parts.port else ''
+    if port and port != DEFAULT_PORTS.get(original_scheme):
+        host = f"{host}:{port}"
+
+    path = re.sub(r'/{2,}', '/', parts.path or '/')
+    if len(path) > 1:
+        path = path.rstrip('/')
+
+    query_params = []
+    for key, value in parse_qsl(parts.query, keep_blank_values=False):
+        normalized_key = key.lower()
+        if normalized_key in TRACKING_QUERY_PARAMS:
+            continue
+        if normalized_key.startswith(TRACKING_QUERY_PREFIXES):
+            continue
+        query_params.append((key, value))
+    query = urlencode(sorted(query_params))
+
+    return urlunsplit((scheme, host, path, query, ''))
+
+def product_id_for_url(url: str) -> str:
+    """Stable product ID - a content hash of the canonical URL"""
+    digest = hashlib.sha256(canonicalize_url(url).encode('utf-8')).hexdigest()
+    return f"{PRODUCT_ID_PREFIX}{digest[:PRODUCT_ID_HASH_LENGTH]}"
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Cluster-wide OpenAI Rate Limiter for Modal Pipeline
+Request and token budgets shared by every container through a Modal Dict,
+adapted from the x-ratelimit-* headers OpenAI returns
+"""
+
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import modal
+
+from .llm_client import OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE
+from .work_queue import note_throttled
+from .llm_cache import llm_response_cache
+
+# Share of the quota handed out - the rest covers token estimate errors and other API clients
+RATE_LIMIT_HEADROOM = 0.9
+
+# Each window's budget is split into leases that containers claim one at a time,
+# so a container only touches the shared store once per lease, not per request
+RATE_WINDOW_SECONDS = 10
+LEASES_PER_WINDOW = 20
+
+# Pause the whole cluster until the API's window resets once it reports less than this share left
+REMAINING_PAUSE_RATIO = 0.05
+
+# Waits at least this long count as throttled items for the stage autoscaler
+THROTTLED_WAIT_SECONDS = 1.0
+
+# Rough prompt size when the tokenizer isn't worth loading
+CHARS_PER_TOKEN = 4
+
+# Store selection - RATE_LIMIT_STORE is "modal" (default) or "local" for single-process runs
+RATE_LIMIT_STORE_ENV = 'RATE_LIMIT_STORE'
+RATE_LIMIT_DICT_NAME = 'openai-rate-limits'
+
+class RateLimitStore:
+    """Shared state for rate limiters - claim() must be an atomic put-if-absent"""
+    
+    def claim(self, key: str) -> bool:
+        raise NotImplementedError
+    
+    def release(self, key: str):
+        raise NotImplementedError
+    
+    def get(self, key: str, default=None):
+        raise NotImplementedError
+    
+    def put(self, key: str, value):
+        raise NotImplementedError
+
+class ModalDictRateLimitStore(RateLimitStore):
+    """Rate limit state in a Modal Dict, shared by every container of every app run"""
+    
+    def __init__(self, name: str = RATE_LIMIT_DICT_NAME):
+        self.dict = modal.Dict.from_name(name, create_if_missing=True)
+    
+    def claim(self, key: str) -> bool:
+        return self.dict.put(key, time.time(), skip_if_exists=True)
+    
+    def release(self, key: str):
+        self.dict.pop(key, None)
+    
+    def get(self, key: str, default=None):
+        return self.dict.get(key, default)
+    
+    def put(self, key: str, value):
+        self.dict.put(key, value)
+
+class LocalRateLimitStore(RateLimitStore):
+    """Process-local stand-in for offline runs and tests"""
+    
+    def __init__(self):
+        self.values: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+    
+    def claim(self, key: str) -> bool:
+        with self._lock:
+            if key in self.values:
+                return False
+            self.values[key] = time.time()
+            return True
+    
+    def release(self, key: str):
+        with self._lock:
+            self.values.pop(key, None)
+    
+    def get(self, key: str, default=None):
+        with self._lock:
+            return self.values.get(key, default)
+    
+    def put(self, key: str, value):
+        with self._lock:
+            self.values[key] = value
+
+RATE_LIMIT_STORES = {
+    'modal': ModalDictRateLimitStore,
+    'local': LocalRateLimitStore
+}
+
+def parse_reset_seconds(value: Optional[str]) -> Optional[float]:
+    """Seconds from an x-ratelimit-reset-* header such as "20ms", "1s" or "6m0s" """
+    if not value:
+        return None
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def estimate_chat_tokens(request: Dict[str, Any]) -> int:
+    """Tokens OpenAI charges against TPM for a chat request - prompt estimate plus max_tokens"""
+    prompt_chars = sum(len(str(message.get('content', ''))) for message in request.get('messages', []))
+    return prompt_chars // CHARS_PER_TOKEN + int(request.get('max_tokens') or 0)
+
+def estimate_embedding_tokens(texts: List[str]) -> int:
+    return sum(len(text) for text in texts) // CHARS_PER_TOKEN
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute, shared across containers
+    
+    Time is cut into RATE_WINDOW_SECONDS windows whose budget is split into
+    LEASES_PER_WINDOW leases. A container claims a lease with an atomic
+    put-if-absent on the store and spends it locally; when every lease of the
+    window is taken it waits for the next window. A request larger than the
+    lease in hand is let through and its overdraft carried into the next
+    window, so big prompts can't starve.
+    
+    Response headers keep the budget honest: the limit headers replace the
+    configured quota, and when the remaining headers show the API's own
+    bucket nearly empty every container pauses until it resets.
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        store: Optional[RateLimitStore] = None,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None
+    ):
+        self.name = name
+        self.store = store
+        self.requests_per_minute = requests_per_minute or OPENAI_REQUESTS_PER_MINUTE
+        self.tokens_per_minute = tokens_per_minute or OPENAI_TOKENS_PER_MINUTE
+        
+        self.window = None
+        self.requests_left = 0.0
+        self.tokens_left = 0.0
+        self.leases_exhausted = False
+        self.paused_until = 0.0
+        self.claimed_keys: List[str] = []
+        self._lock = threading.Lock()
+    
+    def _store(self) -> RateLimitStore:
+        if self.store is None:
+            store_name = os.environ.get(RATE_LIMIT_STORE_ENV, 'modal').lower()
+            if store_name not in RATE_LIMIT_STORES:
+                raise ValueError(f"Unknown rate limit store: {store_name} (expected one of {list(RATE_LIMIT_STORES)})")
+            self.store = RATE_LIMIT_STORES[store_name]()
+        return self.store
+    
+    def acquire(self, tokens: int = 0) -> float:
+        """Block until one request of `tokens` tokens fits the budget - returns seconds waited"""
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                break
+            time.sleep(wait)
+            waited += wait
+        self._note_wait(waited)
+        return waited
+    
+    async def acquire_async(self, tokens: int = 0) -> float:
+        """
+        acquire() for coroutines - waits without blocking the worker's event loop
+        
+        Spending from the lease in hand stays on the loop. Claiming a lease
+        takes store round trips (Modal Dict calls) under the limiter's lock,
+        so it runs on a thread, leaving the loop free for the requests in flight.
+        """
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(tokens, claim=False)
+            if wait is None:
+                wait = await asyncio.to_thread(self._try_acquire, tokens)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+            waited += wait
+        self._note_wait(waited)
+        return waited
+    
+    def _note_wait(self, waited: float):
+        if waited >= THROTTLED_WAIT_SECONDS:
+            note_throttled()
+    
+    def _try_acquire(self, tokens: int, claim: bool = True) -> Optional[float]:
+        """
+        Spend from the local lease, claiming another if needed - returns 0 or seconds to wait
+        
+        With claim=False the store is never touched and the lock never waited
+        on: None means a lease has to be claimed, or another thread is busy
+        claiming one, so the caller should retry with claim=True off the loop.
+        """
+        if not self._lock.acquire(blocking=claim):
+            return None
+        try:
+            now = time.time()
+            if now < self.paused_until:
+                return self.paused_until - now
+            
+            window = int(now // RATE_WINDOW_SECONDS)
+            if window != self.window:
+                # Unused budget expires with its window; an overdraft carries over
+                self.window = window
+                self.requests_left = min(self.requests_left, 0.0)
+                self.tokens_left = min(self.tokens_left, 0.0)
+                self.leases_exhausted = False
+            
+            while self.requests_left < 1 or self.tokens_left <= 0:
+                if not claim and not self.leases_exhausted:
+                    return None
+                if self.leases_exhausted or not self._claim_lease(window):
+                    self.leases_exhausted = True
+                    next_window = (window + 1) * RATE_WINDOW_SECONDS
+                    return max(next_window - now, 0.01) + random.uniform(0, 0.1)
+                if now < self.paused_until:
+                    return self.paused_until - now
+            
+            self.requests_left -= 1
+            self.tokens_left -= tokens
+            return 0.0
+        finally:
+            self._lock.release()
+    
+    def _claim_lease(self, window: int) -> bool:
+        store = self._store()
+        
+        # Pick up limits and pauses published by other containers
+        shared = store.get(f"{self.name}:state") or {}
+        self.requests_per_minute = shared.get('requests_per_minute', self.requests_per_minute)
+        self.tokens_per_minute = shared.get('tokens_per_minute', self.tokens_per_minute)
+        self.paused_until = max(self.paused_until, shared.get('paused_until', 0.0))
+        
+        # Start at a random lease so containers don't all contend for the same keys
+        start = random.randrange(LEASES_PER_WINDOW)
+        for offset in range(LEASES_PER_WINDOW):
+            key = f"{self.name}:{window}:{(start + offset) % LEASES_PER_WINDOW}"
+            if store.claim(key):
+                share = RATE_LIMIT_HEADROOM * RATE_WINDOW_SECONDS / 60 / LEASES_PER_WINDOW
+                self.requests_left += self.requests_per_minute * share
+                self.tokens_left += self.tokens_per_minute * share
+                self._release_old_leases(store, window)
+                self.claimed_keys.append(key)
+                return True
+        return False
+    
+    def _release_old_leases(self, store: RateLimitStore, window: int):
+        # Each container deletes the leases it claimed in past windows, keeping the store small
+        current = [key for key in self.claimed_keys if int(key.split(':')[-2]) >= window - 1]
+        for key in self.claimed_keys:
+            if key not in current:
+                store.release(key)
+        self.claimed_keys = current
+    
+    def observe(self, headers):
+        """Adapt to the x-ratelimit-* headers of a response (or of a 429 error)"""
+        if not headers:
+            return
+        
+        updates = {}
+        for kind, current in [('requests', self.requests_per_minute), ('tokens', self.tokens_per_minute)]:
+            limit = headers.get(f'x-ratelimit-limit-{kind}')
+            if limit and limit.isdigit() and int(limit) != current:
+                updates[f'{kind}_per_minute'] = int(limit)
+            
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            reset_seconds = parse_reset_seconds(headers.get(f'x-ratelimit-reset-{kind}'))
+            limit_value = int(limit) if limit and limit.isdigit() else current
+            if remaining and remaining.isdigit() and reset_seconds and int(remaining) < limit_value * REMAINING_PAUSE_RATIO:
+                updates['paused_until'] = max(updates.get('paused_until', 0.0), time.time() + reset_seconds)
+        
+        retry_after = parse_reset_seconds(headers.get('retry-after'))
+        if retry_after:
+            updates['paused_until'] = max(updates.get('paused_until', 0.0), time.time() + retry_after)
+        
+        # Only publish pauses that move the shared resume time meaningfully
+        if updates.get('paused_until', 0.0) < self.paused_until + 0.5:
+            updates.pop('paused_until', None)
+        if updates:
+            self._publish(updates)
+    
+    def observe_error(self, error: Exception):
+        """Pause the cluster after a 429, using the error's headers when it has them"""
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if getattr(error, 'status_code', None) == 429 or getattr(response, 'status_code', None) == 429:
+            self.observe(headers)
+            with self._lock:
+                paused = self.paused_until > time.time()
+            if not paused:
+                self._publish({'paused_until': time.time() + 1.0})
+    
+    def _publish(self, updates: Dict[str, Any]):
+        with self._lock:
+            self.requests_per_minute = updates.get('requests_per_minute', self.requests_per_minute)
+            self.tokens_per_minute = updates.get('tokens_per_minute', self.tokens_per_minute)
+            self.paused_until = max(self.paused_until, updates.get('paused_until', 0.0))
+            state = {
+                'requests_per_minute': self.requests_per_minute,
+                'tokens_per_minute': self.tokens_per_minute,
+                'paused_until': self.paused_until
+            }
+        
+        if 'requests_per_minute' in updates or 'tokens_per_minute' in updates:
+            print(f"🚦 {self.name} quota: {self.requests_per_minute:,} requests/min, {self.tokens_per_minute:,} tokens/min")
+        try:
+            self._store().put(f"{self.name}:state", state)
+        except Exception as e:
+            print(f"⚠️  Could not publish rate limit state: {str(e)}")
+
+# OpenAI quotas are per model - one limiter per model per process, shared by all its call sites
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+def openai_rate_limiter(model: str) -> RateLimiter:
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            _rate_limiters[model] = RateLimiter(f"openai-{model}")
+        return _rate_limiters[model]
+
+async def limited_chat_completion(client, validate: Optional[Callable[[str], bool]] = None, use_cache: bool = True, **request):
+    """
+    Async chat completion that waits for the cluster-wide budget of its model first
+    
+    validate takes the reply's message content and says whether the caller
+    could use it. With a validator, a cached response for the same request
+    is returned without using any budget, and a fresh reply is cached only
+    when validate accepts it - so a reply that fails to parse or names an
+    unknown category is asked again next time. Without one nothing is cached.
+    use_cache=False sends the request even when a reply is cached (retries
+    and fallbacks after a bad reply); a good fresh reply still replaces it.
+    Cache reads and writes can reach storage, so they run off the event loop.
+    """
+    cache = llm_response_cache() if validate else None
+    if cache and use_cache:
+        cached = await asyncio.to_thread(cache.lookup, request, validate)
+        if cached is not None:
+            return cached
+    
+    limiter = openai_rate_limiter(request['model'])
+    await limiter.acquire_async(estimate_chat_tokens(request))
+    try:
+        raw = await client.chat.completions.with_raw_response.create(**request)
+    except Exception as e:
+        # Publishing a pause writes to the store - keep it off the loop too
+        await asyncio.to_thread(limiter.observe_error, e)
+        raise
+    await asyncio.to_thread(limiter.observe, raw.headers)
+    response = raw.parse()
+    if cache:
+        await asyncio.to_thread(cache.store, request, response, validate)
+    return response
+
+def limited_chat_completion_sync(client, validate: Optional[Callable[[str], bool]] = None, use_cache: bool = True, **request):
+    """limited_chat_completion() for the synchronous client"""
+    cache = llm_response_cache() if validate else None
+    cached = cache.lookup(request, validate) if cache and use_cache else None
+    if cached is not None:
+        return cached
+    
+    limiter = openai_rate_limiter(request['model'])
+    limiter.acquire(estimate_chat_tokens(request))
+    try:
+        raw = client.chat.completions.with_raw_response.create(**request)
+    except Exception as e:
+        limiter.observe_error(e)
+        raise
+    limiter.observe(raw.headers)
+    response = raw.parse()
+    if cache:
+        cache.store(request, response, validate)
+    return response
+
+def limited_embeddings(client, model: str, input: List[str]):
+    """Embeddings request that waits for the cluster-wide budget of its model first"""
+    limiter = openai_rate_limiter(model)
+    limiter.acquire(estimate_embedding_tokens(input))
+    try:
+        raw = client.embeddings.with_raw_response.create(model=model, input=input)
+    except Exception as e:
+        limiter.observe_error(e)
+        raise
+    limiter.observe(raw.headers)
+    return raw.parse()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Product Registry for Modal Pipeline
+Per-site record of each product's latest stage results, so a re-run only sends
+new or changed products through the LLM and embedding stages
+"""
+
+import hashlib
+import json
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import pandas as pd
+
+from .s3_utils import S3Manager, BatchReference, StreamingDataFrameWriter
+from .product_identity import canonicalize_url, product_id_for_url
+
+# Registries outlive executions - one JSON document per site under {environment}/product_registry/
+REGISTRY_FOLDER = 'product_registry'
+
+# Columns that differ between runs over an unchanged product - kept out of fingerprints
+VOLATILE_COLUMNS = {'execution_id', 'batch_number'}
+VOLATILE_COLUMN_SUFFIXES = ('_timestamp', '_time', '_worker_id')
+
+def site_for_url(url: str) -> str:
+    """Registry key of the site a product URL belongs to"""
+    return urlsplit(canonicalize_url(url)).netloc or 'unknown'
+
+def _row_product_id(row: Dict[str, Any]) -> str:
+    product_id = row.get('product_id')
+    if isinstance(product_id, str) and product_id:
+        return product_id
+    return product_id_for_url(row.get('url', ''))
+
+def _plain_value(value: Any) -> Any:
+    """numpy scalar -> python, NaN -> None"""
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def _stable_value(value: Any) -> Optional[str]:
+    """Value as text, with the type drift of a CSV round trip (1 vs 1.0, NaN vs missing) removed"""
+    value = _plain_value(value)
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value)
+    return text if text else None
+
+def fingerprint_row(row: Dict[str, Any], version: str = '') -> str:
+    """Content hash of a stage input row and stage version - equal for equal products across executions"""
+    stable = {}
+    for column, value in row.items():
+        if column in VOLATILE_COLUMNS or column.endswith(VOLATILE_COLUMN_SUFFIXES):
+            continue
+        text = _stable_value(value)
+        if text is not None:
+            stable[column] = text
+    return hashlib.sha256(json.dumps([version, stable], sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+def stage_version(*parts: Any) -> str:
+    """Version string for a stage's model and prompt - any change re-runs every product"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+class ProductRegistry:
+    """
+    One stage's view of the product registries of every site in an execution
+    
+    Each product's entry keeps, per stage, the fingerprint of the row the
+    stage was given, the stage version, and the columns the stage added. A
+    product whose fingerprint and version both match is carried forward: its
+    stored columns are joined back onto today's row instead of calling the
+    API. Entries are written once the stage has combined its results, so a
+    failed stage leaves the registry as it was.
+    
+    Concurrent executions over the same site overwrite each other's updates;
+    the loser's products are simply processed again next time.
+    """
+    
+    def __init__(
+        self,
+        s3_manager: S3Manager,
+        environment: str,
+        execution_id: str,
+        stage: str,
+        version: str,
+        artifact_format: str
+    ):
+        self.s3_manager = s3_manager
+        self.environment = environment
+        self.execution_id = execution_id
+        self.stage = stage
+        self.version = version
+        self.artifact_format = artifact_format
+        self._sites = {}
+        self._pending = {}  # product_id -> (site, url, fingerprint) for products sent through the stage
+        self._input_columns = []
+    
+    def _path(self, site: str) -> str:
+        return f"s3://{self.s3_manager.bucket}/{self.environment}/{REGISTRY_FOLDER}/{site}.json"
+    
+    def _site(self, site: str) -> Dict[str, Dict[str, Any]]:
+        if site not in self._sites:
+            path = self._path(site)
+            entries = self.s3_manager.download_json(path) if self.s3_manager.exists(path) else None
+            self._sites[site] = entries or {}
+        return self._sites[site]
+    
+    def carried_columns(self, row: Dict[str, Any], fingerprint: str) -> Optional[Dict[str, Any]]:
+        """The stage's stored columns for an unchanged product, or None if it has to be processed"""
+        entry = self._site(site_for_url(row.get('url', ''))).get(_row_product_id(row), {})
+        stage_entry = entry.get(self.stage)
+        if stage_entry and stage_entry['fingerprint'] == fingerprint and stage_entry['version'] == self.version:
+            return stage_entry['columns']
+        return None
+    
+    def split_input(self, input_s3_path: str) -> Tuple[Optional[str], Optional[BatchReference]]:
+        """
+        Split a stage's input into products to process and products carried forward
+        
+        Returns:
+            (artifact to batch - None when nothing changed, batch reference of
+            the carried rows' output - None when nothing was carried)
+        """
+        changed_path = self.s3_manager.build_s3_path(
+            self.environment, self.execution_id, self.stage, "changed_input.csv", artifact_format=self.artifact_format
+        )
+        carried_path = self.s3_manager.build_s3_path(
+            self.environment, self.execution_id, self.stage, "batch_carried_output.csv", artifact_format=self.artifact_format
+        )
+        changed_writer = StreamingDataFrameWriter(self.s3_manager, changed_path)
+        carried_writer = StreamingDataFrameWriter(self.s3_manager, carried_path)
+        total_rows = 0
+        
+        try:
+            for chunk in self.s3_manager.iter_dataframe_chunks(input_s3_path):
+                if not self._input_columns:
+                    self._input_columns = list(chunk.columns)
+                total_rows += len(chunk)
+                
+                changed = []
+                carried_rows = []
+                for _, row in chunk.iterrows():
+                    row = row.to_dict()
+                    fingerprint = fingerprint_row(row, self.version)
+                    stored_columns = self.carried_columns(row, fingerprint)
+                    if stored_columns is None:
+                        changed.append(True)
+                        self._pending[_row_product_id(row)] = (site_for_url(row.get('url', '')), row.get('url', ''), fingerprint)
+                    else:
+                        changed.append(False)
+                        carried_rows.append({**row, **stored_columns})
+                
+                changed_writer.write(chunk[changed])
+                if carried_rows:
+                    carried_writer.write(pd.DataFrame(carried_rows))
+        except Exception:
+            changed_writer.abort()
+            carried_writer.abort()
+            raise
+        
+        carried_count = carried_writer.rows_written
+        print(f"♻️  {self.stage}: {carried_count:,} of {total_rows:,} products unchanged since their last run - "
+              f"{total_rows - carried_count:,} to process")
+        
+        if carried_count == 0:
+            # Nothing to carry - batch the original artifact rather than the copy
+            changed_writer.abort()
+            carried_writer.abort()
+            return input_s3_path, None
+        
+        carried_writer.close()
+        carried_batch = BatchReference(
+            execution_id=self.execution_id,
+            stage=self.stage,
+            batch_number=-1,
+            item_count=carried_count,
+            s3_input_path=input_s3_path,
+            s3_output_path=carried_path,
+            environment=self.environment
+        )
+        if changed_writer.rows_written == 0:
+            changed_writer.abort()
+            return None, carried_batch
+        changed_writer.close()
+        return changed_path, carried_batch
+    
+    def record(self, batch_references: List[BatchReference], keep_row=None) -> int:
+        """
+        Store the stage's results for the products it processed, then save the touched sites
+        
+        keep_row(row) can reject results that shouldn't be carried, e.g. failed uploads.
+        Returns the number of entries written.
+        """
+        touched_sites = set()
+        recorded = 0
+        for batch_ref in batch_references:
+            for chunk in self.s3_manager.iter_dataframe_chunks(batch_ref.s3_output_path):
+                added_columns = [column for column in chunk.columns if column not in self._input_columns]
+                for _, row in chunk.iterrows():
+                    row = row.to_dict()
+                    pending = self._pending.get(_row_product_id(row))
+                    if pending is None or (keep_row and not keep_row(row)):
+                        continue
+                    site, url, fingerprint = pending
+                    entry = self._site(site).setdefault(_row_product_id(row), {})
+                    entry['url'] = url
+                    entry[self.stage] = {
+                        'fingerprint': fingerprint,
+                        'version': self.version,
+                        'columns': {column: _plain_value(row[column]) for column in added_columns},
+                        'execution_id': self.execution_id,
+                        'updated_at': time.time()
+                    }
+                    touched_sites.add(site)
+                    recorded += 1
+        
+        for site in touched_sites:
+            self.s3_manager.upload_json(self._site(site), self._path(site))
+        print(f"📒 {self.stage}: recorded {recorded:,} products in the registries of {len(touched_sites)} sites")
+        return recorded
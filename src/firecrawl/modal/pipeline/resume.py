@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Execution Resume for Modal Pipeline
+Picks a failed execution up where it stopped - finished stages are skipped and
+finished batches keep their outputs
+"""
+
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from .s3_utils import S3Manager, BatchReference, batch_priority, PRIORITY_COLUMN
+from .retries import retry_input_path, dead_letter_path
+
+# Stage artifacts in pipeline order, with the column counted for the stage result
+PIPELINE_ARTIFACTS = [
+    ('discovery', 'discovered_urls.csv', None),
+    ('extraction', 'extracted_products.csv', None),
+    ('categorization', 'categorized_products.csv', 'category'),
+    ('classification', 'classified_products.csv', 'hsa_fsa_status'),
+    ('turbopuffer', 'uploaded_products.csv', 'upload_success')
+]
+
+# Settings a resumed execution takes from the original run, so its batches line up
+RUN_SETTINGS_FILE = 'pipeline_run.json'
+RESUMED_SETTINGS = ['base_urls', 'max_products', 'turbopuffer_namespace', 'artifact_format', 'streaming', 'max_priority', 'incremental']
+
+def run_settings_path(s3_manager: S3Manager, environment: str, execution_id: str) -> str:
+    return f"s3://{s3_manager.bucket}/{environment}/{execution_id}/{RUN_SETTINGS_FILE}"
+
+def save_run_settings(s3_manager: S3Manager, environment: str, execution_id: str, settings: Dict[str, Any]) -> bool:
+    return s3_manager.upload_json(
+        {key: settings.get(key) for key in RESUMED_SETTINGS},
+        run_settings_path(s3_manager, environment, execution_id)
+    )
+
+def load_run_settings(s3_manager: S3Manager, environment: str, execution_id: str) -> Optional[Dict[str, Any]]:
+    """Settings saved when the execution started, or None for executions from before they were saved"""
+    path = run_settings_path(s3_manager, environment, execution_id)
+    if not s3_manager.exists(path):
+        return None
+    return s3_manager.download_json(path)
+
+def completed_stages(s3_manager: S3Manager, environment: str, execution_id: str, artifact_format: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Stage results rebuilt from the leading run of stage artifacts already in S3
+    
+    Stops at the first stage without a non-empty artifact - later artifacts
+    were built from inputs that are about to be redone, so they don't count.
+    """
+    results = {}
+    for stage, filename, count_column in PIPELINE_ARTIFACTS:
+        artifact_path = s3_manager.build_s3_path(environment, execution_id, stage, filename, artifact_format=artifact_format)
+        if not s3_manager.exists(artifact_path):
+            break
+        
+        row_count = s3_manager.count_rows(artifact_path)
+        if row_count == 0:
+            break
+        
+        value_counts = Counter()
+        if count_column:
+            for chunk in s3_manager.iter_dataframe_chunks(artifact_path, columns=[count_column]):
+                if count_column in chunk.columns:
+                    value_counts.update(chunk[count_column].tolist())
+        
+        results[stage] = _stage_result(stage, artifact_path, row_count, dict(value_counts))
+        results[stage].update({'execution_id': execution_id, 'environment': environment})
+    return results
+
+def _stage_result(stage: str, artifact_path: str, row_count: int, value_counts: Dict[Any, int]) -> Dict[str, Any]:
+    """The parts of a dispatcher's result the orchestrator reads, for a stage that isn't rerun"""
+    result = {'status': 'completed', 'resumed': True}
+    if stage == 'discovery':
+        result.update({'discovered_urls': row_count, 'discovery_csv_path': artifact_path})
+    elif stage == 'extraction':
+        result.update({'extracted_products': row_count, 'extraction_csv_path': artifact_path})
+    elif stage == 'categorization':
+        result.update({
+            'categorized_products': row_count,
+            'categorization_csv_path': artifact_path,
+            'category_distribution': value_counts
+        })
+    elif stage == 'classification':
+        result.update({
+            'classified_products': row_count,
+            'classification_csv_path': artifact_path,
+            'eligibility_distribution': value_counts
+        })
+    else:
+        result.update({
+            'successful_uploads': value_counts.get(True, 0),
+            'failed_uploads': value_counts.get(False, 0),
+            'turbopuffer_csv_path': artifact_path
+        })
+    return result
+
+def reuse_batch_output(s3_manager: S3Manager, batch_ref: BatchReference) -> Optional[Dict[str, Any]]:
+    """
+    Batch result for a batch whose output an earlier attempt already wrote
+    
+    Outputs are only written once a batch finishes, so an existing one is
+    complete. The retry and dead-letter files it left are counted as if the
+    batch had just run, so its second pass still happens. None when the
+    batch has to run.
+    """
+    if not s3_manager.exists(batch_ref.s3_output_path):
+        return None
+    
+    result = {
+        'batch_number': batch_ref.batch_number,
+        'output_items': s3_manager.count_rows(batch_ref.s3_output_path),
+        'retry_items': 0,
+        'dead_letters': 0,
+        'reused': True
+    }
+    if not batch_ref.retry_pass and s3_manager.exists(retry_input_path(batch_ref)):
+        result['retry_items'] = s3_manager.count_rows(retry_input_path(batch_ref))
+    if s3_manager.exists(dead_letter_path(batch_ref)):
+        result['dead_letters'] = s3_manager.count_rows(dead_letter_path(batch_ref))
+    if batch_ref.stage == 'categorization':
+        result['priority'] = batch_priority(s3_manager.download_dataframe(batch_ref.s3_output_path, columns=[PRIORITY_COLUMN]))
+    
+    print(f"♻️  Batch {batch_ref.batch_number}: reusing {result['output_items']} items from an earlier attempt")
+    return result
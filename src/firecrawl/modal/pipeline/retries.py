@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Item Retries for Modal Pipeline
+Per-item retries with jittered backoff and a retry budget, dead-letter files
+for items that still fail, and the end-of-stage second pass over transient failures
+"""
+
+import asyncio
+import dataclasses
+import random
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from .work_queue import is_rate_limit_error, note_throttled
+
+# Attempts per item within a batch, including the first
+RETRY_ATTEMPTS = 3
+
+# Backoff before retry n is a random wait up to RETRY_BASE_SECONDS * 2**n ("full jitter")
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 30.0
+
+# Each first attempt earns this share of a retry, on top of a fixed reserve - when
+# most calls fail the budget runs dry and failures go to the second pass instead
+# of multiplying load on an API that is already struggling
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_RESERVE = 10.0
+
+# Pause before the second pass, so a provider outage has time to clear
+SECOND_PASS_DELAY_SECONDS = 30
+
+# HTTP statuses worth another attempt
+TRANSIENT_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+_STATUS_IN_MESSAGE = re.compile(r'\b(?:status(?: code)?|error code|http)[:\s]+(\d{3})\b', re.IGNORECASE)
+_TRANSIENT_MESSAGES = ('timed out', 'timeout', 'temporarily unavailable', 'connection reset', 'connection aborted', 'connection error')
+
+class RetryBudget:
+    """
+    Token bucket shared by every retry in one worker process
+
+    First attempts deposit RETRY_BUDGET_RATIO tokens and each retry withdraws
+    one, so retries stay a bounded share of traffic however many items fail.
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, reserve: float = RETRY_BUDGET_RESERVE):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+        self._lock = threading.Lock()
+
+    def record_attempt(self):
+        with self._lock:
+            self.tokens = min(self.tokens + self.ratio, self.reserve)
+
+    def try_spend(self) -> bool:
+        """Take one retry from the budget - False when it is exhausted"""
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+RETRY_BUDGET = RetryBudget()
+
+def error_status(error: Exception) -> Optional[int]:
+    """HTTP status of an API client error, from its attributes or its message"""
+    for status in (getattr(error, 'status_code', None), getattr(error, 'status', None),
+                   getattr(getattr(error, 'response', None), 'status_code', None)):
+        if isinstance(status, int):
+            return status
+    match = _STATUS_IN_MESSAGE.search(str(error))
+    return int(match.group(1)) if match else None
+
+def is_transient_error(error: Exception) -> bool:
+    """True for failures a later attempt can fix - rate limits, 5xx, timeouts, dropped connections"""
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+
+    error_class = type(error).__name__
+    if 'Timeout' in error_class or 'Connection' in error_class:
+        return True
+
+    status = error_status(error)
+    if status is not None:
+        return status in TRANSIENT_STATUS_CODES
+
+    message = str(error).lower()
+    return is_rate_limit_error(error) or any(text in message for text in _TRANSIENT_MESSAGES)
+
+def backoff_seconds(retry_number: int) -> float:
+    """Full-jitter exponential backoff before the given retry (1-based)"""
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** retry_number))
+
+def _next_retry_wait(error: Exception, attempt: int, budget: RetryBudget) -> Optional[float]:
+    """Backoff before the next attempt, or None when the error should be raised"""
+    if attempt >= RETRY_ATTEMPTS or not is_transient_error(error) or not budget.try_spend():
+        return None
+    if is_rate_limit_error(error):
+        note_throttled()
+    return backoff_seconds(attempt)
+
+def call_with_retries(call: Callable[..., Any], *args, budget: RetryBudget = RETRY_BUDGET, **kwargs) -> Any:
+    """
+    Run call(*args, **kwargs), retrying transient failures with jittered backoff
+
+    Gives up after RETRY_ATTEMPTS or when the retry budget runs out, raising
+    the last error. Permanent errors (4xx, bad responses) are raised at once.
+    """
+    budget.record_attempt()
+    attempt = 1
+    while True:
+        try:
+            return call(*args, **kwargs)
+        except Exception as e:
+            wait = _next_retry_wait(e, attempt, budget)
+            if wait is None:
+                raise
+            print(f"   🔁 {type(e).__name__} - retry {attempt}/{RETRY_ATTEMPTS - 1} in {wait:.1f}s")
+            time.sleep(wait)
+            attempt += 1
+
+async def call_with_retries_async(call: Callable[..., Awaitable[Any]], *args, budget: RetryBudget = RETRY_BUDGET, **kwargs) -> Any:
+    """call_with_retries() for coroutines - backoff sleeps don't block the worker's other requests"""
+    budget.record_attempt()
+    attempt = 1
+    while True:
+        try:
+            return await call(*args, **kwargs)
+        except Exception as e:
+            wait = _next_retry_wait(e, attempt, budget)
+            if wait is None:
+                raise
+            print(f"   🔁 {type(e).__name__} - retry {attempt}/{RETRY_ATTEMPTS - 1} in {wait:.1f}s")
+            await asyncio.sleep(wait)
+            attempt += 1
+
+# ============================================================================
+# DEAD LETTERS AND THE SECOND PASS
+# ============================================================================
+
+def _stage_dir(batch_ref) -> str:
+    return batch_ref.s3_output_path.rsplit('/', 1)[0]
+
+def retry_input_path(batch_ref) -> str:
+    """Items of a batch set aside for the stage's second pass"""
+    return f"{_stage_dir(batch_ref)}/retry/batch_{batch_ref.batch_number}_input.csv"
+
+def dead_letter_path(batch_ref) -> str:
+    """Items of a batch that failed for good, with their error class"""
+    suffix = "_retry" if batch_ref.retry_pass else ""
+    return f"{_stage_dir(batch_ref)}/dead_letter/batch_{batch_ref.batch_number}{suffix}.csv"
+
+class FailedItems:
+    """
+    Failed input rows of one batch
+
+    Transient failures from a first-pass batch are kept for the second pass;
+    everything else (and anything failing in the second pass) becomes a dead
+    letter: the original row plus dead_letter_* columns with the error class,
+    message and stage.
+    """
+
+    def __init__(self, batch_ref):
+        self.batch_ref = batch_ref
+        self.retry_rows = []
+        self.dead_letters = []
+
+    def add(self, row: Dict[str, Any], error: Optional[Exception] = None, reason: str = "EmptyResult"):
+        """Record one failed row - error is None when the call succeeded but returned nothing usable"""
+        transient = error is not None and is_transient_error(error)
+        if transient and not self.batch_ref.retry_pass:
+            self.retry_rows.append(dict(row))
+            return
+
+        dead_letter = dict(row)
+        dead_letter.update({
+            'dead_letter_stage': self.batch_ref.stage,
+            'dead_letter_error_class': type(error).__name__ if error is not None else reason,
+            'dead_letter_error': str(error)[:500] if error is not None else reason,
+            'dead_letter_transient': transient,
+            'dead_letter_retry_pass': self.batch_ref.retry_pass,
+            'dead_letter_timestamp': time.time()
+        })
+        self.dead_letters.append(dead_letter)
+
+    def save(self, s3_manager) -> Dict[str, int]:
+        """Write the retry and dead-letter files - returns counts for the batch result"""
+        if self.retry_rows:
+            s3_manager.upload_dataframe(pd.DataFrame(self.retry_rows), retry_input_path(self.batch_ref))
+        if self.dead_letters:
+            s3_manager.upload_dataframe(pd.DataFrame(self.dead_letters), dead_letter_path(self.batch_ref))
+            print(f"   ☠️  Batch {self.batch_ref.batch_number}: {len(self.dead_letters)} items dead-lettered")
+        return {'retry_items': len(self.retry_rows), 'dead_letters': len(self.dead_letters)}
+
+def batch_result(batch_ref, output_items: int, failed: FailedItems, s3_manager) -> Dict[str, Any]:
+    """Batch result dict for run_batch_worker, after saving the batch's failed items"""
+    result = {'batch_number': batch_ref.batch_number, 'output_items': output_items}
+    result.update(failed.save(s3_manager))
+    return result
+
+def second_pass_batches(batch_references: List[Any], completions: Dict[int, Dict[str, Any]]) -> List[Any]:
+    """One retry batch per first-pass batch that set items aside"""
+    retry_batches = []
+    for batch_ref in batch_references:
+        retry_items = completions.get(batch_ref.batch_number, {}).get('retry_items')
+        if not retry_items:
+            continue
+        extension = batch_ref.s3_output_path.rsplit('.', 1)[-1]
+        retry_batches.append(dataclasses.replace(
+            batch_ref,
+            item_count=retry_items,
+            s3_input_path=retry_input_path(batch_ref),
+            s3_output_path=f"{_stage_dir(batch_ref)}/batch_{batch_ref.batch_number}_retry_output.{extension}",
+            row_start=None,
+            row_end=None,
+            retry_pass=True
+        ))
+    return retry_batches
+
+def retry_handoff_span(first_pass_batches: List[Any]) -> int:
+    """Power of ten above every first-pass batch number - see retry_handoff_number()"""
+    span = 10
+    while span <= max((batch_ref.batch_number for batch_ref in first_pass_batches), default=0):
+        span *= 10
+    return span
+
+def retry_handoff_number(batch_number: int, stage_index: int, span: int) -> int:
+    """
+    Batch number downstream for the output of a second-pass batch
+
+    Derived from the source batch alone, so a resumed run gives the same
+    rows the same number and finds their earlier output. Each stage adds its
+    own bit of span (span, 2*span, 4*span, ...) - an item gets at most one
+    second pass per stage, so numbers never collide with first-pass numbers
+    or each other.
+    """
+    return batch_number + span * 2 ** stage_index
+
+def run_second_pass(
+    stage: str,
+    batch_references: List[Any],
+    completions: Dict[int, Dict[str, Any]],
+    run_batches: Callable[[List[Any]], List[Any]]
+) -> Tuple[List[Any], Dict[str, int]]:
+    """
+    Retry a stage's transient failures once its first pass is done
+
+    run_batches runs the given batch references to completion and returns
+    each one's result dict (or None / an exception). Anything that fails again
+    is dead-lettered by the workers.
+
+    Returns:
+        (retry batches with output to combine, retry summary)
+    """
+    first_pass_dead = sum((record.get('dead_letters') or 0) for record in completions.values())
+    retry_batches = second_pass_batches(batch_references, completions)
+    summary = {'retried_items': 0, 'recovered_items': 0, 'dead_letter_items': first_pass_dead}
+    if not retry_batches:
+        return [], summary
+
+    summary['retried_items'] = sum(batch_ref.item_count for batch_ref in retry_batches)
+    print(f"🔁 {stage}: second pass over {summary['retried_items']:,} items from {len(retry_batches)} batches "
+          f"in {SECOND_PASS_DELAY_SECONDS}s")
+    time.sleep(SECOND_PASS_DELAY_SECONDS)
+
+    recovered_batches = []
+    for batch_ref, result in zip(retry_batches, run_batches(retry_batches)):
+        result = result if isinstance(result, dict) else {}
+        summary['dead_letter_items'] += result.get('dead_letters') or 0
+        if result.get('output_items'):
+            summary['recovered_items'] += result['output_items']
+            recovered_batches.append(batch_ref)
+
+    print(f"🔁 {stage}: recovered {summary['recovered_items']:,}/{summary['retried_items']:,} items, "
+          f"{summary['dead_letter_items']:,} dead-lettered in total")
+    return recovered_batches, summary
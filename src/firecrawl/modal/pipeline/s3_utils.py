@@ -4,18 +4,91 @@ S3 Utilities and Dynamic Batching for Modal Pipeline
 Common functions for S3-based processing across all stages
 """
 
-import boto3
+import numpy as np
 import pandas as pd
 import json
 import uuid
 import time
-from typing import List, Dict, Any, Tuple
+import bisect
+import heapq
+import io
+from io import BytesIO
+from typing import List, Dict, Any, Tuple, Optional, Iterator
 from dataclasses import dataclass
 import os
+import gzip
+import tempfile
+
+from .storage import StorageBackend, StorageKeyNotFound, get_storage_backend
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Stage artifact formats - CSV stays the default, Parquet keeps column types
+# and lets readers load only the columns they need
+ARTIFACT_FORMATS = {
+    'csv': {'extension': '.csv', 'content_type': 'text/csv'},
+    'parquet': {'extension': '.parquet', 'content_type': 'application/vnd.apache.parquet'}
+}
+DEFAULT_ARTIFACT_FORMAT = 'csv'
+
+# CSV and JSON artifacts are compressed on write and detected by magic bytes on
+# read, so uncompressed artifacts from older runs still load. gzip is the
+# default because browsers and the S3 console decode it via Content-Encoding;
+# set ARTIFACT_COMPRESSION=zstd for smaller, faster artifacts or "none" to disable.
+COMPRESSION_CODECS = ('gzip', 'zstd', 'none')
+DEFAULT_COMPRESSION = os.environ.get('ARTIFACT_COMPRESSION', 'gzip')
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+PARQUET_COMPRESSION = 'zstd'
+
+# Streaming settings - rows per chunk read and bytes per multipart part
+# (S3 requires every part except the last to be at least 5MB)
+DEFAULT_CHUNK_SIZE = 10000
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+# Row-addressable artifacts - CSV is written as independently compressed blocks
+# of ROW_BLOCK_SIZE rows with a sidecar index ({key}.rows.json) of each block's
+# first row and byte offset; Parquet uses row groups of the same size. Batches
+# can then reference a row range of the stage artifact instead of a copy.
+ROW_BLOCK_SIZE = 1000
+ROW_INDEX_SUFFIX = '.rows.json'
+
+# Classification priority column set by categorization (1 = classify first,
+# 5 = skip) and the priority of products or batches that don't carry one
+PRIORITY_COLUMN = 'classification_priority'
+DEFAULT_CLASSIFICATION_PRIORITY = 3
+
+# Batching modes - "items" cuts batches by row count; "tokens" cuts the same
+# number of row ranges at equal estimated prompt tokens, so a batch of long
+# descriptions holds fewer products. An item's estimate is its text columns at
+# about TOKEN_CHARS characters per token plus a fixed per-request overhead
+# (prompt template and reply).
+BATCH_BY_ITEMS = 'items'
+BATCH_BY_TOKENS = 'tokens'
+TOKEN_TEXT_COLUMNS = ['name', 'description']
+TOKEN_CHARS = 4
+ITEM_OVERHEAD_TOKENS = 500
 
 @dataclass
 class BatchReference:
-    """Reference to a batch stored in S3"""
+    """
+    Reference to a batch stored in S3
+    
+    With row_start/row_end set the batch is rows [row_start, row_end) of the
+    shared artifact at s3_input_path; otherwise s3_input_path is the batch's
+    own input file. columns is the input projection workers should load.
+    retry_pass marks a stage's second pass over items that failed transiently.
+    priority is the most urgent classification priority among the batch's
+    products, when known - schedulers start lower numbers first.
+    """
     execution_id: str
     stage: str
     batch_number: int
@@ -23,78 +96,268 @@ class BatchReference:
     s3_input_path: str
     s3_output_path: str
     environment: str
+    row_start: Optional[int] = None
+    row_end: Optional[int] = None
+    columns: Optional[List[str]] = None
+    retry_pass: bool = False
+    priority: Optional[int] = None
+
+def batch_priority(df: pd.DataFrame) -> Optional[int]:
+    """Most urgent classification priority in a batch, or None if it has none"""
+    if PRIORITY_COLUMN not in df.columns:
+        return None
+    priorities = pd.to_numeric(df[PRIORITY_COLUMN], errors='coerce').dropna()
+    return int(priorities.min()) if len(priorities) else None
 
 class S3Manager:
     """Centralized S3 operations for the pipeline"""
     
     def __init__(self):
-        # AWS credentials are automatically loaded from environment variables
-        # AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_DEFAULT_REGION
-        self.s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
-        )
-        self.bucket = "flex-ai"
+        # Cheap to construct - the configured backend is shared per process
+        self.storage = get_storage_backend()
+        self.bucket = self.storage.bucket
+    
+    def _resolve(self, s3_path: str) -> Tuple[StorageBackend, str]:
+        """Storage backend and key for an s3://bucket/key path"""
+        bucket, key = s3_path.replace("s3://", "").split("/", 1)
+        return get_storage_backend(bucket), key
     
-    def build_s3_path(self, environment: str, execution_id: str, stage: str, filename: str) -> str:
-        """Build standardized S3 path"""
+    def build_s3_path(
+        self, 
+        environment: str, 
+        execution_id: str, 
+        stage: str, 
+        filename: str,
+        artifact_format: Optional[str] = None
+    ) -> str:
+        """
+        Build standardized S3 path
+        
+        If artifact_format is given, the filename extension is swapped for that
+        format's extension (e.g. extracted_products.csv -> extracted_products.parquet)
+        """
+        if artifact_format:
+            filename = os.path.splitext(filename)[0] + ARTIFACT_FORMATS[artifact_format]['extension']
         return f"s3://{self.bucket}/{environment}/{execution_id}/{stage}/{filename}"
     
-    def upload_dataframe(self, df: pd.DataFrame, s3_path: str) -> bool:
-        """Upload pandas DataFrame to S3 as CSV"""
+    def upload_dataframe(self, df: pd.DataFrame, s3_path: str, compression: Optional[str] = None) -> bool:
+        """
+        Upload pandas DataFrame to S3 as CSV or Parquet (chosen by file extension)
+        
+        CSV is compressed with compression (default ARTIFACT_COMPRESSION) in
+        row blocks and gets a row index; Parquet compresses its column chunks
+        internally.
+        """
         try:
-            # Parse S3 path
-            path_parts = s3_path.replace("s3://", "").split("/", 1)
-            bucket = path_parts[0]
-            key = path_parts[1]
+            storage, key = self._resolve(s3_path)
             
-            # Upload CSV
-            csv_buffer = df.to_csv(index=False)
-            self.s3_client.put_object(
-                Bucket=bucket,
-                Key=key,
-                Body=csv_buffer.encode('utf-8'),
-                ContentType='text/csv'
+            artifact_format = get_artifact_format(s3_path)
+            content_encoding = None
+            row_index = None
+            if artifact_format == 'parquet':
+                body = _dataframe_to_parquet(df)
+            else:
+                body, content_encoding, row_index = _encode_csv_blocks(df, compression)
+            
+            storage.put(
+                key, body,
+                content_type=ARTIFACT_FORMATS[artifact_format]['content_type'],
+                content_encoding=content_encoding
             )
+            if row_index is not None:
+                storage.put(key + ROW_INDEX_SUFFIX, encode_json(row_index), content_type='application/json')
             return True
         except Exception as e:
             print(f"❌ Error uploading to S3: {str(e)}")
             return False
     
-    def download_dataframe(self, s3_path: str) -> pd.DataFrame:
-        """Download CSV from S3 as pandas DataFrame"""
+    def download_dataframe(self, s3_path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Download CSV or Parquet from S3 as pandas DataFrame
+        
+        Args:
+            s3_path: S3 path of the stage artifact
+            columns: Optional list of columns to load. Columns missing from the
+                     artifact are ignored. Parquet skips the other columns entirely.
+        """
         try:
-            # Parse S3 path
-            path_parts = s3_path.replace("s3://", "").split("/", 1)
-            bucket = path_parts[0]
-            key = path_parts[1]
+            storage, key = self._resolve(s3_path)
             
-            # Download and parse CSV
-            obj = self.s3_client.get_object(Bucket=bucket, Key=key)
-            df = pd.read_csv(obj['Body'])
+            # Download and parse artifact
+            if get_artifact_format(s3_path) == 'parquet':
+                df = _parquet_to_dataframe(storage.get(key), columns)
+            else:
+                usecols = (lambda column: column in columns) if columns else None
+                with storage.open_stream(key) as body:
+                    df = pd.read_csv(open_decompressed_stream(body), usecols=usecols)
             return df
         except Exception as e:
             print(f"❌ Error downloading from S3: {str(e)}")
             return pd.DataFrame()
     
-    def upload_json(self, data: Any, s3_path: str) -> bool:
-        """Upload JSON data to S3"""
+    def iter_dataframe_chunks(
+        self, 
+        s3_path: str, 
+        chunksize: int = DEFAULT_CHUNK_SIZE, 
+        columns: Optional[List[str]] = None
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Stream a CSV or Parquet artifact from S3 as DataFrame chunks
+        
+        CSV is parsed straight off the response body. Parquet needs a seekable
+        file, so it is spooled to local disk first and read one row batch at a time.
+        Unlike download_dataframe, errors are raised to the caller.
+        """
+        storage, key = self._resolve(s3_path)
+        
+        if get_artifact_format(s3_path) == 'parquet':
+            import pyarrow.parquet as pq
+            
+            with tempfile.TemporaryFile() as local_file:
+                storage.download_to_file(key, local_file)
+                local_file.seek(0)
+                
+                parquet_file = pq.ParquetFile(local_file)
+                if columns:
+                    available_columns = set(parquet_file.schema_arrow.names)
+                    columns = [column for column in columns if column in available_columns]
+                for record_batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+                    yield record_batch.to_pandas()
+        else:
+            usecols = (lambda column: column in columns) if columns else None
+            with storage.open_stream(key) as body:
+                try:
+                    reader = pd.read_csv(open_decompressed_stream(body), chunksize=chunksize, usecols=usecols)
+                except pd.errors.EmptyDataError:
+                    return
+                with reader:
+                    for chunk in reader:
+                        yield chunk
+    
+    def exists(self, s3_path: str) -> bool:
+        """True if the artifact has been written"""
+        storage, key = self._resolve(s3_path)
+        return storage.exists(key)
+    
+    def count_rows(self, s3_path: str) -> int:
+        """Count rows in an artifact without holding it in memory"""
+        row_count = self.count_addressable_rows(s3_path)
+        if row_count is not None:
+            return row_count
+        return sum(len(chunk) for chunk in self.iter_dataframe_chunks(s3_path))
+    
+    def load_row_index(self, s3_path: str, verify_size: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Row index of a CSV artifact, or None if it was written without one
+        
+        verify_size also checks the index still matches the artifact, in case
+        the artifact was since overwritten by something that doesn't index.
+        """
+        storage, key = self._resolve(s3_path)
         try:
-            # Parse S3 path
-            path_parts = s3_path.replace("s3://", "").split("/", 1)
-            bucket = path_parts[0]
-            key = path_parts[1]
+            row_index = decode_json(storage.get(key + ROW_INDEX_SUFFIX))
+        except StorageKeyNotFound:
+            return None
+        if verify_size and storage.size(key) != row_index['bytes']:
+            print(f"⚠️  Stale row index for {s3_path} - ignoring it")
+            return None
+        return row_index
+    
+    def count_addressable_rows(self, s3_path: str) -> Optional[int]:
+        """
+        Row count if rows of the artifact can be read by range, otherwise None
+        
+        Parquet always can (its footer records row groups); CSV needs a valid row index.
+        """
+        if get_artifact_format(s3_path) == 'parquet':
+            import pyarrow.parquet as pq
             
-            # Upload JSON
-            json_data = json.dumps(data, indent=2, default=str)
-            self.s3_client.put_object(
-                Bucket=bucket,
-                Key=key,
-                Body=json_data.encode('utf-8'),
-                ContentType='application/json'
+            storage, key = self._resolve(s3_path)
+            return pq.ParquetFile(_RangedObjectFile(storage, key)).metadata.num_rows
+        
+        row_index = self.load_row_index(s3_path, verify_size=True)
+        return row_index['rows'] if row_index is not None else None
+    
+    def read_row_range(
+        self,
+        s3_path: str,
+        row_start: int,
+        row_end: int,
+        columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        """
+        Read rows [row_start, row_end) of an artifact with ranged GETs
+        
+        Only the CSV blocks or Parquet row groups overlapping the range are
+        fetched. Errors are raised to the caller.
+        """
+        storage, key = self._resolve(s3_path)
+        
+        if get_artifact_format(s3_path) == 'parquet':
+            import pyarrow.parquet as pq
+            
+            parquet_file = pq.ParquetFile(_RangedObjectFile(storage, key), pre_buffer=True)
+            row_groups = []
+            first_row = None
+            group_start = 0
+            for group_number in range(parquet_file.metadata.num_row_groups):
+                group_end = group_start + parquet_file.metadata.row_group(group_number).num_rows
+                if group_start < row_end and group_end > row_start:
+                    row_groups.append(group_number)
+                    first_row = group_start if first_row is None else first_row
+                group_start = group_end
+            if not row_groups:
+                return pd.DataFrame()
+            
+            if columns:
+                available_columns = set(parquet_file.schema_arrow.names)
+                columns = [column for column in columns if column in available_columns]
+            df = parquet_file.read_row_groups(row_groups, columns=columns).to_pandas()
+        else:
+            row_index = self.load_row_index(s3_path)
+            if row_index is None:
+                raise ValueError(f"{s3_path} has no row index - it can't be read by row range")
+            
+            blocks = row_index['blocks']
+            block_first_rows = [block[0] for block in blocks]
+            first_block = bisect.bisect_right(block_first_rows, row_start) - 1
+            last_block = bisect.bisect_right(block_first_rows, row_end - 1) - 1
+            byte_start = blocks[first_block][1]
+            byte_end = blocks[last_block + 1][1] if last_block + 1 < len(blocks) else row_index['bytes']
+            first_row = blocks[first_block][0]
+            
+            # Only the first block carries the CSV header
+            data = decompress_bytes(storage.get_range(key, byte_start, byte_end))
+            usecols = (lambda column: column in columns) if columns else None
+            df = pd.read_csv(
+                BytesIO(data),
+                header=0 if first_row == 0 else None,
+                names=row_index['columns'],
+                usecols=usecols
             )
+        
+        return df.iloc[row_start - first_row:row_end - first_row].reset_index(drop=True)
+    
+    def read_batch_input(self, batch_ref: BatchReference, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Load a batch's input rows, whether it is a row range or its own file"""
+        columns = columns or batch_ref.columns
+        if batch_ref.row_start is None:
+            return self.download_dataframe(batch_ref.s3_input_path, columns=columns)
+        
+        try:
+            return self.read_row_range(batch_ref.s3_input_path, batch_ref.row_start, batch_ref.row_end, columns)
+        except Exception as e:
+            print(f"❌ Error reading rows {batch_ref.row_start}-{batch_ref.row_end} of {batch_ref.s3_input_path}: {str(e)}")
+            return pd.DataFrame()
+    
+    def upload_json(self, data: Any, s3_path: str, compression: Optional[str] = None) -> bool:
+        """Upload JSON data to S3 (compact encoding, compressed)"""
+        try:
+            storage, key = self._resolve(s3_path)
+            
+            # Upload JSON
+            body, content_encoding = compress_bytes(encode_json(data), compression)
+            storage.put(key, body, content_type='application/json', content_encoding=content_encoding)
             return True
         except Exception as e:
             print(f"❌ Error uploading JSON to S3: {str(e)}")
@@ -103,19 +366,437 @@ class S3Manager:
     def download_json(self, s3_path: str) -> Any:
         """Download JSON from S3"""
         try:
-            # Parse S3 path
-            path_parts = s3_path.replace("s3://", "").split("/", 1)
-            bucket = path_parts[0]  
-            key = path_parts[1]
+            storage, key = self._resolve(s3_path)
             
             # Download and parse JSON
-            obj = self.s3_client.get_object(Bucket=bucket, Key=key)
-            data = json.loads(obj['Body'].read().decode('utf-8'))
+            data = decode_json(decompress_bytes(storage.get(key)))
             return data
         except Exception as e:
             print(f"❌ Error downloading JSON from S3: {str(e)}")
             return None
 
+class _MultipartBuffer:
+    """Write-only file object that collects bytes for the next multipart part"""
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+        self.closed = False
+    
+    def write(self, data) -> int:
+        self.buffer.extend(data)
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self) -> int:
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+
+class StreamingDataFrameWriter:
+    """
+    Append DataFrame chunks to a single S3 artifact through a multipart upload
+    
+    Memory use is bounded by part_size rather than the artifact size. The first
+    chunk fixes the columns - later chunks are aligned to them. Small artifacts
+    that never fill a part are written with a single put_object on close.
+    CSV is compressed in blocks of block_rows rows and its row index is
+    written after the artifact.
+    
+    Usage:
+        with StreamingDataFrameWriter(s3_manager, s3_path) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+    
+    def __init__(
+        self,
+        s3_manager: 'S3Manager',
+        s3_path: str,
+        part_size: int = MULTIPART_PART_SIZE,
+        compression: Optional[str] = None,
+        block_rows: int = ROW_BLOCK_SIZE
+    ):
+        self.s3_manager = s3_manager
+        self.s3_path = s3_path
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.block_rows = block_rows
+        self.artifact_format = get_artifact_format(s3_path)
+        self.rows_written = 0
+        
+        self.storage, self.key = s3_manager._resolve(s3_path)
+        
+        self._sink = _MultipartBuffer()
+        # CSV bytes pass through a streaming compressor on their way to the sink,
+        # restarted every block so each block decodes on its own
+        self.compression = _resolve_compression(compression)
+        self.content_encoding = None
+        if self.artifact_format == 'csv' and self.compression != 'none':
+            self.content_encoding = self.compression
+        self._csv_stream = None
+        self._block_row_count = 0
+        self._row_blocks = []
+        self._columns = None
+        self._parquet_writer = None
+        self._parquet_schema = None
+        self._upload_id = None
+        self._parts = []
+    
+    def write(self, df: pd.DataFrame):
+        """Append one chunk"""
+        if len(df) == 0:
+            return
+        
+        if self._columns is None:
+            self._columns = list(df.columns)
+        else:
+            df = df.reindex(columns=self._columns)
+        
+        if self.artifact_format == 'parquet':
+            self._write_parquet(df)
+            self.rows_written += len(df)
+        else:
+            self._write_csv(df)
+        
+        if len(self._sink.buffer) >= self.part_size:
+            self._upload_part()
+    
+    def _write_csv(self, df: pd.DataFrame):
+        start = 0
+        while start < len(df):
+            if self._csv_stream is None:
+                self._row_blocks.append([self.rows_written, self._sink.tell()])
+                self._csv_stream, _ = _open_compressor(self._sink, self.compression)
+                self._block_row_count = 0
+            
+            piece = df.iloc[start:start + self.block_rows - self._block_row_count]
+            csv_data = piece.to_csv(index=False, header=(self.rows_written == 0))
+            self._csv_stream.write(csv_data.encode('utf-8'))
+            
+            start += len(piece)
+            self.rows_written += len(piece)
+            self._block_row_count += len(piece)
+            if self._block_row_count >= self.block_rows:
+                self._end_csv_block()
+    
+    def _end_csv_block(self):
+        """Finish the current block's compressed frame (the sink stays open)"""
+        if self._csv_stream is not None and self._csv_stream is not self._sink:
+            self._csv_stream.close()
+        self._csv_stream = None
+    
+    def _write_parquet(self, df: pd.DataFrame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        table = pa.Table.from_pandas(_normalize_for_parquet(df), preserve_index=False)
+        
+        if self._parquet_writer is None:
+            # Columns that are empty in the first chunk get a string type
+            # so later chunks with values can still be cast to the schema
+            fields = [
+                pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                for field in table.schema
+            ]
+            self._parquet_schema = pa.schema(fields)
+            self._parquet_writer = pq.ParquetWriter(
+                self._sink, self._parquet_schema, compression=PARQUET_COMPRESSION
+            )
+        
+        self._parquet_writer.write_table(table.cast(self._parquet_schema), row_group_size=ROW_BLOCK_SIZE)
+    
+    def _upload_part(self):
+        """Send the buffered bytes as the next multipart part"""
+        if self._upload_id is None:
+            self._upload_id = self.storage.create_multipart_upload(
+                self.key,
+                content_type=ARTIFACT_FORMATS[self.artifact_format]['content_type'],
+                content_encoding=self.content_encoding
+            )
+        
+        part_number = len(self._parts) + 1
+        self._parts.append(
+            self.storage.upload_part(self.key, self._upload_id, part_number, bytes(self._sink.buffer))
+        )
+        self._sink.buffer = bytearray()
+    
+    def close(self) -> bool:
+        """Flush remaining bytes and complete the upload"""
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        self._end_csv_block()  # Writes the compressor's trailing frame
+        
+        if self._upload_id is None:
+            self.storage.put(
+                self.key,
+                bytes(self._sink.buffer),
+                content_type=ARTIFACT_FORMATS[self.artifact_format]['content_type'],
+                content_encoding=self.content_encoding
+            )
+        else:
+            if self._sink.buffer:
+                self._upload_part()
+            self.storage.complete_multipart_upload(self.key, self._upload_id, self._parts)
+        
+        if self.artifact_format == 'csv':
+            row_index = {
+                'columns': self._columns or [],
+                'rows': self.rows_written,
+                'bytes': self._sink.tell(),
+                'blocks': self._row_blocks
+            }
+            self.storage.put(self.key + ROW_INDEX_SUFFIX, encode_json(row_index), content_type='application/json')
+        return True
+    
+    def abort(self):
+        """Abandon the upload so no partial artifact or orphaned parts remain"""
+        if self._upload_id is not None:
+            try:
+                self.storage.abort_multipart_upload(self.key, self._upload_id)
+            except Exception as e:
+                print(f"⚠️  Failed to abort multipart upload for {self.s3_path}: {str(e)}")
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return False
+        try:
+            self.close()
+        except Exception:
+            self.abort()
+            raise
+        return False
+
+def get_artifact_format(s3_path: str) -> str:
+    """Detect the artifact format of an S3 path from its extension (defaults to CSV)"""
+    for artifact_format, format_info in ARTIFACT_FORMATS.items():
+        if s3_path.endswith(format_info['extension']):
+            return artifact_format
+    return DEFAULT_ARTIFACT_FORMAT
+
+def _normalize_for_parquet(df: pd.DataFrame) -> pd.DataFrame:
+    """Store mixed-type object columns as strings so Arrow can infer a type"""
+    df = df.copy()
+    
+    # Stage outputs mix strings, numbers and NaN in the same object column
+    # (e.g. price), which Arrow refuses to infer
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return df
+
+def _dataframe_to_parquet(df: pd.DataFrame) -> bytes:
+    """Serialize a DataFrame to Parquet bytes"""
+    buffer = BytesIO()
+    _normalize_for_parquet(df).to_parquet(
+        buffer, index=False, compression=PARQUET_COMPRESSION, row_group_size=ROW_BLOCK_SIZE
+    )
+    return buffer.getvalue()
+
+def _encode_csv_blocks(
+    df: pd.DataFrame,
+    compression: Optional[str] = None,
+    block_rows: int = ROW_BLOCK_SIZE
+) -> Tuple[bytes, Optional[str], Dict[str, Any]]:
+    """
+    Serialize a DataFrame to CSV compressed in independent blocks of block_rows rows
+    
+    Returns:
+        (body, content_encoding, row_index)
+    """
+    blocks = []
+    row_blocks = []
+    offset = 0
+    content_encoding = None
+    
+    for first_row in range(0, max(len(df), 1), block_rows):
+        csv_data = df.iloc[first_row:first_row + block_rows].to_csv(index=False, header=(first_row == 0))
+        block, content_encoding = compress_bytes(csv_data.encode('utf-8'), compression)
+        row_blocks.append([first_row, offset])
+        blocks.append(block)
+        offset += len(block)
+    
+    row_index = {'columns': list(df.columns), 'rows': len(df), 'bytes': offset, 'blocks': row_blocks}
+    return b''.join(blocks), content_encoding, row_index
+
+class _RangedObjectFile(io.RawIOBase):
+    """Seekable read-only view of a stored object - every read is a ranged GET"""
+    
+    def __init__(self, storage: StorageBackend, key: str):
+        self.storage = storage
+        self.key = key
+        self.object_size = storage.size(key)
+        self.position = 0
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self.position
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.object_size
+        self.position = max(0, offset)
+        return self.position
+    
+    def read(self, size: int = -1) -> bytes:
+        end = self.object_size if size is None or size < 0 else min(self.object_size, self.position + size)
+        data = self.storage.get_range(self.key, self.position, end) if end > self.position else b''
+        self.position += len(data)
+        return data
+    
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+def _parquet_to_dataframe(data: bytes, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Deserialize Parquet bytes, reading only the requested columns"""
+    import pyarrow.parquet as pq
+    
+    parquet_file = pq.ParquetFile(BytesIO(data))
+    if columns:
+        available_columns = set(parquet_file.schema_arrow.names)
+        columns = [column for column in columns if column in available_columns]
+    return parquet_file.read(columns=columns).to_pandas()
+
+def encode_json(data: Any) -> bytes:
+    """Compact JSON bytes - orjson when installed, otherwise json without whitespace"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=str, option=orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            pass  # e.g. non-string dict keys - fall back to the stdlib encoder
+    return json.dumps(data, separators=(',', ':'), default=str).encode('utf-8')
+
+def decode_json(data: bytes) -> Any:
+    """Parse JSON bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+def _resolve_compression(compression: Optional[str]) -> str:
+    codec = (compression or DEFAULT_COMPRESSION).lower()
+    if codec not in COMPRESSION_CODECS:
+        raise ValueError(f"Unknown compression codec: {codec} (expected one of {COMPRESSION_CODECS})")
+    if codec == 'zstd' and zstandard is None:
+        codec = 'gzip'  # zstandard missing from this image
+    return codec
+
+def compress_bytes(data: bytes, compression: Optional[str] = None) -> Tuple[bytes, Optional[str]]:
+    """
+    Compress a payload for upload
+    
+    Returns:
+        (body, content_encoding) - content_encoding is None when uncompressed
+    """
+    codec = _resolve_compression(compression)
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=6, mtime=0), 'gzip'
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data), 'zstd'
+    return data, None
+
+def decompress_bytes(data: bytes) -> bytes:
+    """Undo compress_bytes - payloads without a known magic number are returned as-is"""
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    if data[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("Artifact is zstd-compressed but zstandard is not installed")
+        # Block-compressed CSV is a sequence of frames
+        return zstandard.ZstdDecompressor().stream_reader(BytesIO(data), read_across_frames=True).read()
+    return data
+
+class _PeekedStream:
+    """Replays bytes already read off a non-seekable stream before the rest of it"""
+    
+    def __init__(self, prefix: bytes, stream):
+        self.prefix = prefix
+        self.stream = stream
+    
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            data = self.prefix + self.stream.read()
+            self.prefix = b''
+            return data
+        if not self.prefix:
+            return self.stream.read(size)
+        data = self.prefix[:size]
+        self.prefix = self.prefix[len(data):]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+    
+    def readable(self) -> bool:
+        return True
+
+def open_decompressed_stream(stream):
+    """Wrap a binary stream so reads return decompressed bytes (sniffs the codec)"""
+    prefix = stream.read(4)
+    peeked = _PeekedStream(prefix, stream)
+    if prefix[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=peeked, mode='rb')
+    if prefix[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("Artifact is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(peeked, read_across_frames=True)
+    return peeked
+
+def _open_compressor(sink, compression: Optional[str] = None):
+    """Streaming compressor writing into sink - returns (writable, content_encoding)"""
+    codec = _resolve_compression(compression)
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=sink, mode='wb', compresslevel=6, mtime=0), 'gzip'
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).stream_writer(sink, closefd=False), 'zstd'
+    return sink, None
+
+def estimate_item_tokens(df: pd.DataFrame, item_overhead_tokens: int = ITEM_OVERHEAD_TOKENS) -> np.ndarray:
+    """Estimated prompt tokens per row, from whichever TOKEN_TEXT_COLUMNS are present"""
+    text_chars = np.zeros(len(df))
+    for column in TOKEN_TEXT_COLUMNS:
+        if column in df.columns:
+            text_chars += df[column].fillna('').astype(str).str.len().to_numpy()
+    return item_overhead_tokens + text_chars / TOKEN_CHARS
+
+def token_balanced_row_starts(item_tokens: np.ndarray, batch_count: int) -> List[int]:
+    """
+    First row of each batch when rows are cut into batch_count ranges of
+    roughly equal total tokens
+    
+    Rows keep their order, so batches stay row ranges of the artifact and a
+    priority-ordered artifact is still worked through in order. An item bigger
+    than a batch's share closes its batch early, so there may be fewer batches
+    than asked for.
+    """
+    if len(item_tokens) == 0:
+        return []
+    cumulative = np.cumsum(item_tokens)
+    targets = cumulative[-1] * np.arange(1, batch_count) / batch_count
+    # Cut after the row whose running total reaches each target
+    cuts = np.searchsorted(cumulative, targets) + 1
+    return sorted({0} | {int(cut) for cut in cuts if cut < len(item_tokens)})
+
+def _describe_token_batches(row_starts: List[int], total_items: int, item_tokens: np.ndarray):
+    batch_items = np.diff(row_starts + [total_items])
+    batch_tokens = np.add.reduceat(item_tokens, row_starts)
+    print(f"   Token-balanced: {batch_items.min()}-{batch_items.max()} items per batch, "
+          f"~{batch_tokens.mean():,.0f} tokens each (max {batch_tokens.max():,.0f})")
+
 def calculate_optimal_batching(total_items: int, processing_time_per_item: float = 1.0) -> Tuple[int, int]:
     """
     Calculate optimal batch size and worker count based on total items
@@ -153,17 +834,24 @@ def create_dynamic_batches(
     execution_id: str, 
     stage: str, 
     environment: str,
-    processing_time_per_item: float = 1.0
+    processing_time_per_item: float = 1.0,
+    artifact_format: str = DEFAULT_ARTIFACT_FORMAT,
+    batch_by: str = BATCH_BY_ITEMS
 ) -> List[BatchReference]:
     """
     Create dynamic batches from DataFrame and return batch references
     
+    The DataFrame is uploaded once as the stage's batch input and each batch
+    references a row range of it.
+    
     Args:
         df: Input DataFrame to batch
         execution_id: Unique execution ID
         stage: Processing stage name
         environment: dev/prod environment
         processing_time_per_item: Processing time per item (for optimization)
+        artifact_format: 'csv' or 'parquet' for batch input/output files
+        batch_by: 'items' for equal row counts, 'tokens' for equal estimated tokens
     
     Returns:
         List of BatchReference objects
@@ -178,53 +866,264 @@ def create_dynamic_batches(
     print(f"   Max workers: {max_workers}")
     print(f"   Estimated batches: {(total_items + batch_size - 1) // batch_size}")
     
+    row_starts = None
+    if batch_by == BATCH_BY_TOKENS:
+        item_tokens = estimate_item_tokens(df)
+        row_starts = token_balanced_row_starts(item_tokens, (total_items + batch_size - 1) // batch_size)
+        _describe_token_batches(row_starts, total_items, item_tokens)
+    
     s3_manager = S3Manager()
+    
+    input_s3_path = s3_manager.build_s3_path(
+        environment, execution_id, stage, "batch_input.csv", artifact_format=artifact_format
+    )
+    if not s3_manager.upload_dataframe(df, input_s3_path):
+        print(f"❌ Failed to upload batch input: {input_s3_path}")
+        return []
+    
+    batch_references = _row_range_batches(
+        s3_manager, input_s3_path, total_items, batch_size, execution_id, stage, environment, artifact_format,
+        row_starts=row_starts
+    )
+    
+    print(f"📤 Created {len(batch_references)} batches for processing")
+    return batch_references
+
+def create_dynamic_batches_from_s3(
+    input_s3_path: str,
+    execution_id: str,
+    stage: str,
+    environment: str,
+    processing_time_per_item: float = 1.0,
+    artifact_format: str = DEFAULT_ARTIFACT_FORMAT,
+    columns: Optional[List[str]] = None,
+    max_items: Optional[int] = None,
+    count_columns: Optional[List[str]] = None,
+    chunksize: int = DEFAULT_CHUNK_SIZE,
+    batch_by: str = BATCH_BY_ITEMS
+) -> Tuple[List[BatchReference], Dict[str, Any]]:
+    """
+    Create dynamic batches by streaming a stage artifact from S3
+    
+    Same batches as create_dynamic_batches, but the input is never fully
+    loaded. If the artifact is row-addressable (Parquet, or CSV with a row
+    index) batches are row ranges of it and nothing is uploaded; otherwise
+    each batch is copied to its own input file, holding one chunk and one
+    batch in memory at a time.
+    
+    batch_by='tokens' only applies to row-addressable artifacts, where the
+    text columns are read once to place the cuts; copied batches always
+    split by item count.
+    
+    Args:
+        input_s3_path: S3 path of the previous stage's artifact
+        execution_id: Unique execution ID
+        stage: Processing stage name
+        environment: dev/prod environment
+        processing_time_per_item: Processing time per item (for optimization)
+        artifact_format: 'csv' or 'parquet' for batch input/output files
+        columns: Optional column projection for the input
+        max_items: Optional limit on number of rows to batch
+        count_columns: Columns to build value counts for while streaming
+        chunksize: Rows read from S3 per chunk
+        batch_by: 'items' for equal row counts, 'tokens' for equal estimated tokens
+    
+    Returns:
+        (batch_references, input_summary) where input_summary has
+        'total_items' and 'value_counts' per count column
+    """
+    
+    s3_manager = S3Manager()
+    
+    addressable_rows = s3_manager.count_addressable_rows(input_s3_path)
+    if addressable_rows is not None:
+        total_items = addressable_rows
+    else:
+        total_items = s3_manager.count_rows(input_s3_path)
+    if max_items and total_items > max_items:
+        print(f"⚠️  Limited to {max_items:,} items (from {total_items:,})")
+        total_items = max_items
+    
+    input_summary = {
+        'total_items': total_items,
+        'value_counts': {column: {} for column in count_columns or []}
+    }
     batch_references = []
     
-    # Create batches
-    for batch_num in range(0, total_items, batch_size):
-        batch_df = df.iloc[batch_num:batch_num + batch_size].copy()
+    if total_items == 0:
+        return batch_references, input_summary
+    
+    batch_size, max_workers = calculate_optimal_batching(total_items, processing_time_per_item)
+    
+    print("📊 Dynamic Batching Strategy (streaming):")
+    print(f"   Total items: {total_items:,}")
+    print(f"   Batch size: {batch_size}")
+    print(f"   Max workers: {max_workers}")
+    print(f"   Estimated batches: {(total_items + batch_size - 1) // batch_size}")
+    
+    if addressable_rows is not None:
+        # Only the count and text columns are read - workers fetch their own rows
+        balance_tokens = batch_by == BATCH_BY_TOKENS
+        scan_columns = list(count_columns or []) + (TOKEN_TEXT_COLUMNS if balance_tokens else [])
+        token_chunks = []
+        if scan_columns:
+            rows_read = 0
+            for chunk in s3_manager.iter_dataframe_chunks(input_s3_path, chunksize, scan_columns):
+                if rows_read >= total_items:
+                    break
+                chunk = chunk.iloc[:total_items - rows_read]
+                rows_read += len(chunk)
+                _update_value_counts(input_summary['value_counts'], chunk)
+                if balance_tokens:
+                    token_chunks.append(estimate_item_tokens(chunk))
         
-        if len(batch_df) == 0:
-            continue
+        row_starts = None
+        if balance_tokens:
+            item_tokens = np.concatenate(token_chunks) if token_chunks else np.zeros(0)
+            row_starts = token_balanced_row_starts(item_tokens, (total_items + batch_size - 1) // batch_size)
+            _describe_token_batches(row_starts, total_items, item_tokens)
+        
+        batch_references = _row_range_batches(
+            s3_manager, input_s3_path, total_items, batch_size,
+            execution_id, stage, environment, artifact_format, columns, row_starts
+        )
+        print(f"📤 Created {len(batch_references)} row-range batches over {input_s3_path}")
+        return batch_references, input_summary
+    
+    if batch_by == BATCH_BY_TOKENS:
+        print(f"   ⚠️  {input_s3_path} isn't row-addressable - batching by item count")
+    
+    pending_chunks = []
+    pending_rows = 0
+    rows_read = 0
+    
+    for chunk in s3_manager.iter_dataframe_chunks(input_s3_path, chunksize, columns):
+        if rows_read >= total_items:
+            break
+        
+        chunk = chunk.iloc[:total_items - rows_read]
+        rows_read += len(chunk)
+        _update_value_counts(input_summary['value_counts'], chunk)
+        
+        # Fill the current batch, uploading each time it reaches batch_size
+        start = 0
+        while start < len(chunk):
+            piece = chunk.iloc[start:start + batch_size - pending_rows]
+            pending_chunks.append(piece)
+            pending_rows += len(piece)
+            start += len(piece)
             
-        # Create batch reference
-        batch_ref = BatchReference(
+            if pending_rows == batch_size:
+                _upload_batch(
+                    s3_manager, pd.concat(pending_chunks, ignore_index=True), batch_references,
+                    execution_id, stage, environment, artifact_format
+                )
+                pending_chunks = []
+                pending_rows = 0
+    
+    if pending_chunks:
+        _upload_batch(
+            s3_manager, pd.concat(pending_chunks, ignore_index=True), batch_references,
+            execution_id, stage, environment, artifact_format
+        )
+    
+    print(f"📤 Created {len(batch_references)} batches for processing")
+    return batch_references, input_summary
+
+def _row_range_batches(
+    s3_manager: S3Manager,
+    input_s3_path: str,
+    total_items: int,
+    batch_size: int,
+    execution_id: str,
+    stage: str,
+    environment: str,
+    artifact_format: str,
+    columns: Optional[List[str]] = None,
+    row_starts: Optional[List[int]] = None
+) -> List[BatchReference]:
+    """Batch references covering rows [0, total_items) of one artifact, cut at row_starts if given"""
+    batch_references = []
+    
+    if row_starts is None:
+        row_starts = list(range(0, total_items, batch_size))
+    row_ends = row_starts[1:] + [total_items]
+    
+    for batch_number, (row_start, row_end) in enumerate(zip(row_starts, row_ends)):
+        batch_references.append(BatchReference(
             execution_id=execution_id,
             stage=stage,
-            batch_number=len(batch_references),
-            item_count=len(batch_df),
-            s3_input_path=s3_manager.build_s3_path(
-                environment, execution_id, stage, f"batch_{len(batch_references)}_input.csv"
-            ),
+            batch_number=batch_number,
+            item_count=row_end - row_start,
+            s3_input_path=input_s3_path,
             s3_output_path=s3_manager.build_s3_path(
-                environment, execution_id, stage, f"batch_{len(batch_references)}_output.csv"
+                environment, execution_id, stage, f"batch_{batch_number}_output.csv",
+                artifact_format=artifact_format
             ),
-            environment=environment
-        )
-        
-        # Upload batch to S3
-        success = s3_manager.upload_dataframe(batch_df, batch_ref.s3_input_path)
-        if success:
-            batch_references.append(batch_ref)
-            print(f"   ✅ Created batch {batch_ref.batch_number}: {batch_ref.item_count} items")
-        else:
-            print(f"   ❌ Failed to create batch {len(batch_references)}")
+            environment=environment,
+            row_start=row_start,
+            row_end=row_end,
+            columns=columns
+        ))
     
-    print(f"📤 Created {len(batch_references)} batches for processing")
     return batch_references
 
+def _upload_batch(
+    s3_manager: S3Manager,
+    batch_df: pd.DataFrame,
+    batch_references: List[BatchReference],
+    execution_id: str,
+    stage: str,
+    environment: str,
+    artifact_format: str
+):
+    """Upload one batch input file and append its reference on success"""
+    batch_number = len(batch_references)
+    
+    batch_ref = BatchReference(
+        execution_id=execution_id,
+        stage=stage,
+        batch_number=batch_number,
+        item_count=len(batch_df),
+        s3_input_path=s3_manager.build_s3_path(
+            environment, execution_id, stage, f"batch_{batch_number}_input.csv",
+            artifact_format=artifact_format
+        ),
+        s3_output_path=s3_manager.build_s3_path(
+            environment, execution_id, stage, f"batch_{batch_number}_output.csv",
+            artifact_format=artifact_format
+        ),
+        environment=environment
+    )
+    
+    # Upload batch to S3
+    success = s3_manager.upload_dataframe(batch_df, batch_ref.s3_input_path)
+    if success:
+        batch_references.append(batch_ref)
+        print(f"   ✅ Created batch {batch_ref.batch_number}: {batch_ref.item_count} items")
+    else:
+        print(f"   ❌ Failed to create batch {batch_number}")
+
+def _update_value_counts(value_counts: Dict[str, Dict[Any, int]], df: pd.DataFrame):
+    """Add one chunk's value counts into running totals"""
+    for column, counts in value_counts.items():
+        if column not in df.columns:
+            continue
+        for value, count in df[column].value_counts().items():
+            value = value.item() if hasattr(value, 'item') else value  # numpy scalar -> python
+            counts[value] = counts.get(value, 0) + int(count)
+
 def combine_batch_results(
     batch_references: List[BatchReference],
     output_s3_path: str
 ) -> pd.DataFrame:
     """
-    Combine results from all batches into a single CSV
+    Combine results from all batches into a single stage artifact
     
     Args:
         batch_references: List of batch references
-        output_s3_path: S3 path for combined results
-        
+        output_s3_path: S3 path for combined results (.csv or .parquet)
+    
     Returns:
         Combined DataFrame
     """
@@ -255,12 +1154,179 @@ def combine_batch_results(
             print(f"📊 Total items: {len(final_df):,}")
         else:
             print(f"❌ Failed to upload combined results")
-            
+        
         return final_df
     else:
         print(f"❌ No batch results to combine")
         return pd.DataFrame()
 
+def _ordered_rows(
+    s3_manager: S3Manager,
+    batch_ref: BatchReference,
+    position: int,
+    order_by: str,
+    chunksize: int
+) -> Iterator[Tuple[Tuple[bool, Any], int, pd.DataFrame, int]]:
+    """
+    (sort key, position, chunk, row) for each row of a batch output already ordered by one column
+    
+    Rows without a value sort last. A read error ends the batch early, as in
+    the unordered combine.
+    """
+    chunks = s3_manager.iter_dataframe_chunks(batch_ref.s3_output_path, chunksize)
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        except Exception as e:
+            print(f"   ❌ Failed to combine batch {batch_ref.batch_number}: {str(e)}")
+            return
+        
+        values = chunk[order_by].tolist() if order_by in chunk.columns else [None] * len(chunk)
+        for row, value in enumerate(values):
+            missing = bool(pd.isna(value))
+            yield (missing, None if missing else value), position, chunk, row
+
+def _merge_ordered_chunks(
+    s3_manager: S3Manager,
+    batch_references: List[BatchReference],
+    order_by: str,
+    chunksize: int
+) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """
+    (position, chunk) pieces of every batch output, k-way merged on order_by
+    
+    Each batch output is read once. Ties keep batch order, so the merge is
+    stable. Pieces are runs of consecutive rows from one source chunk,
+    sliced rather than rebuilt row by row.
+    """
+    merged = heapq.merge(
+        *(_ordered_rows(s3_manager, batch_ref, position, order_by, chunksize)
+          for position, batch_ref in enumerate(batch_references)),
+        key=lambda item: item[0]
+    )
+    run_chunk, run_position, run_start, run_end = None, None, 0, 0
+    for _, position, chunk, row in merged:
+        if chunk is run_chunk and row == run_end:
+            run_end += 1
+            continue
+        if run_chunk is not None:
+            yield run_position, run_chunk.iloc[run_start:run_end]
+        run_chunk, run_position, run_start, run_end = chunk, position, row, row + 1
+    if run_chunk is not None:
+        yield run_position, run_chunk.iloc[run_start:run_end]
+
+def _concat_pieces(pieces: List[pd.DataFrame]) -> pd.DataFrame:
+    return pieces[0] if len(pieces) == 1 else pd.concat(pieces, ignore_index=True)
+
+def _batch_chunks(
+    s3_manager: S3Manager,
+    batch_references: List[BatchReference],
+    chunksize: int
+) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """(position, chunk) for every batch output in batch order"""
+    for position, batch_ref in enumerate(batch_references):
+        chunks = s3_manager.iter_dataframe_chunks(batch_ref.s3_output_path, chunksize)
+        
+        # Read errors skip the rest of the batch, upload errors abort the combine
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            except Exception as e:
+                print(f"   ❌ Failed to combine batch {batch_ref.batch_number}: {str(e)}")
+                break
+            yield position, chunk
+
+def stream_combine_batch_results(
+    batch_references: List[BatchReference],
+    output_s3_path: str,
+    count_columns: Optional[List[str]] = None,
+    chunksize: int = DEFAULT_CHUNK_SIZE,
+    order_by: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Combine batch results into a single stage artifact without loading them all
+    
+    Each batch output is streamed chunk by chunk into a multipart upload, so
+    memory stays bounded regardless of stage size. Returns counts instead of
+    the combined DataFrame.
+    
+    Args:
+        batch_references: List of batch references
+        output_s3_path: S3 path for combined results (.csv or .parquet)
+        count_columns: Columns to build value counts for while streaming
+        chunksize: Rows read from S3 per chunk
+        order_by: Column to order the artifact by (ascending, stable, missing
+                  values last) - each batch output must already be ordered by
+                  it, and they are k-way merged instead of sorted in memory
+    
+    Returns:
+        Summary with 'total_items', 'value_counts' and 'success'
+    """
+    
+    s3_manager = S3Manager()
+    summary = {
+        'total_items': 0,
+        'value_counts': {column: {} for column in count_columns or []},
+        'success': False
+    }
+    writer = None
+    
+    print(f"🔄 Streaming {len(batch_references)} batch results...")
+    
+    try:
+        if order_by:
+            print(f"   ↕️  Merging in {order_by} order")
+            pieces = _merge_ordered_chunks(s3_manager, batch_references, order_by, chunksize)
+        else:
+            pieces = _batch_chunks(s3_manager, batch_references, chunksize)
+        batch_items = [0] * len(batch_references)
+        
+        # Merged pieces can be a few rows each - they are written in chunks of about chunksize rows
+        pending, pending_rows = [], 0
+        for position, piece in pieces:
+            if len(piece) == 0:
+                continue
+            batch_items[position] += len(piece)
+            _update_value_counts(summary['value_counts'], piece)
+            pending.append(piece)
+            pending_rows += len(piece)
+            if pending_rows >= chunksize:
+                if writer is None:
+                    writer = StreamingDataFrameWriter(s3_manager, output_s3_path)
+                writer.write(_concat_pieces(pending))
+                pending, pending_rows = [], 0
+        if pending:
+            if writer is None:
+                writer = StreamingDataFrameWriter(s3_manager, output_s3_path)
+            writer.write(_concat_pieces(pending))
+        
+        for batch_ref, items in zip(batch_references, batch_items):
+            summary['total_items'] += items
+            if items > 0:
+                print(f"   ✅ Combined batch {batch_ref.batch_number}: {items} items")
+            else:
+                print(f"   ⚠️  Empty batch {batch_ref.batch_number}")
+        
+        if writer is None:
+            print("❌ No batch results to combine")
+            return summary
+        
+        writer.close()
+        summary['success'] = True
+        print(f"✅ Combined results uploaded to: {output_s3_path}")
+        print(f"📊 Total items: {summary['total_items']:,}")
+    
+    except Exception as e:
+        if writer is not None:
+            writer.abort()
+        print(f"❌ Failed to upload combined results: {str(e)}")
+    
+    return summary
+
 def generate_execution_id() -> str:
     """Generate unique execution ID for pipeline run"""
     timestamp = int(time.time())
@@ -300,11 +1366,12 @@ def test_s3_connection() -> bool:
         s3_manager = S3Manager()
         
         print(f"🔍 Testing S3 connection...")
+        print(f"🗄️  Backend: {s3_manager.storage.name}")
         print(f"🪣 Bucket: {s3_manager.bucket}")
         print(f"🌍 Region: {os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')}")
         
         # Test bucket access
-        response = s3_manager.s3_client.head_bucket(Bucket=s3_manager.bucket)
+        s3_manager.storage.list("dev/test/connection/")
         print(f"✅ Bucket access successful")
         
         # Test write permissions with a small test file
@@ -321,11 +1388,8 @@ def test_s3_connection() -> bool:
                 print(f"✅ Read permissions successful")
                 
                 # Clean up test file
-                path_parts = test_path.replace("s3://", "").split("/", 1)
-                s3_manager.s3_client.delete_object(
-                    Bucket=path_parts[0], 
-                    Key=path_parts[1]
-                )
+                storage, key = s3_manager._resolve(test_path)
+                storage.delete(key)
                 print(f"🧹 Test file cleaned up")
                 
                 print(f"🎉 S3 connection test PASSED!")
@@ -336,7 +1400,7 @@ def test_s3_connection() -> bool:
         else:
             print(f"❌ Write test failed")
             return False
-            
+    
     except Exception as e:
         print(f"❌ S3 connection test FAILED: {str(e)}")
         print(f"💡 Check your AWS credentials and bucket permissions")
@@ -19,6 +19,7 @@ class DiscoveryJob:
     execution_id: str
     environment: str
     max_products: Optional[int] = None
+    artifact_format: str = "csv"  # csv or parquet
 
 @dataclass
 class ProductURL:
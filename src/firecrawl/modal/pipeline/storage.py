@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+"""
+Storage Backends for Modal Pipeline
+One interface for stage artifacts and checkpoints - S3 in production,
+local disk or memory for offline runs and profiling
+"""
+
+import os
+import uuid
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+
+# Backend selection - STORAGE_BACKEND is "s3" (default), "local" or "memory",
+# STORAGE_BUCKET overrides the bucket used for stage artifacts
+STORAGE_BACKEND_ENV = 'STORAGE_BACKEND'
+STORAGE_LOCAL_ROOT_ENV = 'STORAGE_LOCAL_ROOT'
+DEFAULT_STORAGE_BACKEND = 's3'
+DEFAULT_LOCAL_ROOT = '/tmp/flex-ai-storage'
+DEFAULT_BUCKET = os.environ.get('STORAGE_BUCKET', 'flex-ai')
+
+# Key ranges listed at once by list_keys()
+LIST_FAN_OUT_WORKERS = 16
+
+# Shared S3 client - one per container, reused by every backend and thread
+S3_MAX_POOL_CONNECTIONS = 64
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """
+    Return the process-wide S3 client, creating it on first use
+    
+    boto3 clients are thread-safe once created, so all stages share one client
+    and its warm connection pool instead of resolving credentials and opening
+    new TLS connections per call.
+    """
+    global _s3_client
+    
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                # AWS credentials are automatically loaded from environment variables
+                # AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_DEFAULT_REGION
+                _s3_client = boto3.client(
+                    's3',
+                    aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+                    aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                    region_name=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+                    config=Config(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        tcp_keepalive=True,
+                        retries={'max_attempts': 5, 'mode': 'adaptive'}
+                    )
+                )
+    return _s3_client
+
+class StorageKeyNotFound(KeyError):
+    """Raised by get/open_stream when the key does not exist"""
+
+class StorageBackend:
+    """
+    Object storage interface used by the pipeline
+    
+    Keys are relative to the backend's bucket. Multipart uploads collect parts
+    in order and only make the object visible on complete_multipart_upload.
+    content_encoding is stored as object metadata where the backend has any -
+    bodies are always returned exactly as they were written.
+    """
+    
+    name = 'base'
+    
+    # Whether list_keys() should split listings into key ranges - worth it only
+    # where each listing is a slow paginated API
+    parallel_listing = False
+    
+    def __init__(self, bucket: str = DEFAULT_BUCKET):
+        self.bucket = bucket
+    
+    def put(self, key: str, body: bytes, content_type: Optional[str] = None, content_encoding: Optional[str] = None):
+        raise NotImplementedError
+    
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+    
+    def open_stream(self, key: str):
+        """Readable binary file object for the key (default: buffers the whole object)"""
+        return BytesIO(self.get(key))
+    
+    def get_range(self, key: str, start: int, end: int) -> bytes:
+        """Bytes [start, end) of the object (default: slices the whole object)"""
+        return self.get(key)[start:end]
+    
+    def size(self, key: str) -> int:
+        """Object size in bytes"""
+        return len(self.get(key))
+    
+    def download_to_file(self, key: str, fileobj):
+        """Copy the object into an open binary file"""
+        shutil.copyfileobj(self.open_stream(key), fileobj)
+    
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+    
+    def delete(self, key: str):
+        raise NotImplementedError
+    
+    def list(
+        self,
+        prefix: str,
+        start_after: Optional[str] = None,
+        direct_children_only: bool = False,
+        end_at: Optional[str] = None
+    ) -> List[str]:
+        """
+        Sorted keys under prefix (direct_children_only skips deeper "folders")
+        
+        start_after and end_at bound the listing to the key range (start_after, end_at]
+        """
+        raise NotImplementedError
+    
+    def create_multipart_upload(self, key: str, content_type: Optional[str] = None, content_encoding: Optional[str] = None) -> str:
+        raise NotImplementedError
+    
+    def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> dict:
+        """Upload one part - returns the part descriptor to pass to complete"""
+        raise NotImplementedError
+    
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: List[dict]):
+        raise NotImplementedError
+    
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        raise NotImplementedError
+
+def _filter_keys(
+    keys,
+    prefix: str,
+    start_after: Optional[str],
+    direct_children_only: bool,
+    end_at: Optional[str] = None
+) -> List[str]:
+    """Apply list() semantics to an unordered set of keys"""
+    selected = []
+    for key in keys:
+        if not key.startswith(prefix):
+            continue
+        if start_after and key <= start_after:
+            continue
+        if end_at and key > end_at:
+            continue
+        if direct_children_only and '/' in key[len(prefix):]:
+            continue
+        selected.append(key)
+    return sorted(selected)
+
+class S3StorageBackend(StorageBackend):
+    """Production backend on the shared pooled S3 client"""
+    
+    name = 's3'
+    parallel_listing = True
+    
+    def __init__(self, bucket: str = DEFAULT_BUCKET, client=None):
+        super().__init__(bucket)
+        self.client = client or get_s3_client()
+    
+    @staticmethod
+    def _is_not_found(error: Exception) -> bool:
+        error_code = (getattr(error, 'response', None) or {}).get('Error', {}).get('Code')
+        return error_code in ('NoSuchKey', '404', 'NotFound')
+    
+    def put(self, key: str, body: bytes, content_type: Optional[str] = None, content_encoding: Optional[str] = None):
+        put_kwargs = {'Bucket': self.bucket, 'Key': key, 'Body': body}
+        if content_type:
+            put_kwargs['ContentType'] = content_type
+        if content_encoding:
+            put_kwargs['ContentEncoding'] = content_encoding
+        self.client.put_object(**put_kwargs)
+    
+    def get(self, key: str) -> bytes:
+        return self.open_stream(key).read()
+    
+    def open_stream(self, key: str):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        except Exception as e:
+            if self._is_not_found(e):
+                raise StorageKeyNotFound(key) from e
+            raise
+    
+    def get_range(self, key: str, start: int, end: int) -> bytes:
+        if end <= start:
+            return b''
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end - 1}")
+        except Exception as e:
+            if self._is_not_found(e):
+                raise StorageKeyNotFound(key) from e
+            raise
+        return response['Body'].read()
+    
+    def size(self, key: str) -> int:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        except Exception as e:
+            if self._is_not_found(e):
+                raise StorageKeyNotFound(key) from e
+            raise
+    
+    def download_to_file(self, key: str, fileobj):
+        self.client.download_fileobj(self.bucket, key, fileobj)
+    
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception as e:
+            if self._is_not_found(e):
+                return False
+            raise
+    
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+    
+    def list(
+        self,
+        prefix: str,
+        start_after: Optional[str] = None,
+        direct_children_only: bool = False,
+        end_at: Optional[str] = None
+    ) -> List[str]:
+        keys = []
+        continuation_token = None
+        
+        while True:
+            list_kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+            if direct_children_only:
+                list_kwargs['Delimiter'] = '/'
+            if start_after:
+                list_kwargs['StartAfter'] = start_after
+            if continuation_token:
+                list_kwargs['ContinuationToken'] = continuation_token
+            response = self.client.list_objects_v2(**list_kwargs)
+            
+            page_keys = [obj['Key'] for obj in response.get('Contents', [])]
+            keys.extend(page_keys)
+            
+            # Keys come back in order - stop once a page runs past the end of the range
+            page_prefixes = [common['Prefix'] for common in response.get('CommonPrefixes', [])]
+            if end_at and max(page_keys + page_prefixes, default='') > end_at:
+                break
+            if response.get('IsTruncated'):
+                continuation_token = response.get('NextContinuationToken')
+            else:
+                break
+        
+        if end_at:
+            keys = [key for key in keys if key <= end_at]
+        return keys
+    
+    def create_multipart_upload(self, key: str, content_type: Optional[str] = None, content_encoding: Optional[str] = None) -> str:
+        upload_kwargs = {'Bucket': self.bucket, 'Key': key}
+        if content_type:
+            upload_kwargs['ContentType'] = content_type
+        if content_encoding:
+            upload_kwargs['ContentEncoding'] = content_encoding
+        return self.client.create_multipart_upload(**upload_kwargs)['UploadId']
+    
+    def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> dict:
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+    
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: List[dict]):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+    
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Backend on the local filesystem - {root}/{bucket}/{key}
+    
+    Objects are written to a temp file and renamed into place, so readers never
+    see partial objects. Multipart parts are staged under {root}/.multipart/.
+    """
+    
+    name = 'local'
+    
+    def __init__(self, bucket: str = DEFAULT_BUCKET, root: Optional[str] = None):
+        super().__init__(bucket)
+        self.root = os.path.abspath(root or os.environ.get(STORAGE_LOCAL_ROOT_ENV, DEFAULT_LOCAL_ROOT))
+        self.bucket_dir = os.path.join(self.root, bucket)
+        self.multipart_dir = os.path.join(self.root, '.multipart')
+        os.makedirs(self.bucket_dir, exist_ok=True)
+    
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.bucket_dir, key))
+        if not path.startswith(self.bucket_dir + os.sep):
+            raise ValueError(f"Key escapes storage root: {key}")
+        return path
+    
+    def _write_atomic(self, path: str, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                write(f)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    def put(self, key: str, body: bytes, content_type: Optional[str] = None, content_encoding: Optional[str] = None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self._write_atomic(self._path(key), lambda f: f.write(body))
+    
+    def get(self, key: str) -> bytes:
+        with self.open_stream(key) as f:
+            return f.read()
+    
+    def open_stream(self, key: str):
+        try:
+            return open(self._path(key), 'rb')
+        except FileNotFoundError as e:
+            raise StorageKeyNotFound(key) from e
+    
+    def get_range(self, key: str, start: int, end: int) -> bytes:
+        with self.open_stream(key) as f:
+            f.seek(start)
+            return f.read(max(0, end - start))
+    
+    def size(self, key: str) -> int:
+        try:
+            return os.path.getsize(self._path(key))
+        except FileNotFoundError as e:
+            raise StorageKeyNotFound(key) from e
+    
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+    
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+    
+    def list(
+        self,
+        prefix: str,
+        start_after: Optional[str] = None,
+        direct_children_only: bool = False,
+        end_at: Optional[str] = None
+    ) -> List[str]:
+        # Only walk the deepest directory the prefix names
+        search_dir = os.path.join(self.bucket_dir, os.path.dirname(prefix))
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(search_dir):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                keys.append(os.path.relpath(os.path.join(dirpath, filename), self.bucket_dir).replace(os.sep, '/'))
+        return _filter_keys(keys, prefix, start_after, direct_children_only, end_at)
+    
+    def create_multipart_upload(self, key: str, content_type: Optional[str] = None, content_encoding: Optional[str] = None) -> str:
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.multipart_dir, upload_id))
+        return upload_id
+    
+    def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> dict:
+        part_path = os.path.join(self.multipart_dir, upload_id, f"{part_number:05d}")
+        with open(part_path, 'wb') as f:
+            f.write(body)
+        return {'ETag': f"{upload_id}-{part_number}", 'PartNumber': part_number}
+    
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: List[dict]):
+        upload_dir = os.path.join(self.multipart_dir, upload_id)
+        
+        def write_parts(f):
+            for part in sorted(parts, key=lambda part: part['PartNumber']):
+                with open(os.path.join(upload_dir, f"{part['PartNumber']:05d}"), 'rb') as part_file:
+                    shutil.copyfileobj(part_file, f)
+        
+        self._write_atomic(self._path(key), write_parts)
+        shutil.rmtree(upload_dir, ignore_errors=True)
+    
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        shutil.rmtree(os.path.join(self.multipart_dir, upload_id), ignore_errors=True)
+
+class InMemoryStorageBackend(StorageBackend):
+    """Process-local backend for tests and profiling - nothing touches disk or network"""
+    
+    name = 'memory'
+    
+    def __init__(self, bucket: str = DEFAULT_BUCKET):
+        super().__init__(bucket)
+        self.objects: Dict[str, bytes] = {}
+        self.uploads: Dict[str, Dict[int, bytes]] = {}
+        self._lock = threading.Lock()
+    
+    def put(self, key: str, body: bytes, content_type: Optional[str] = None, content_encoding: Optional[str] = None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with self._lock:
+            self.objects[key] = bytes(body)
+    
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            if key not in self.objects:
+                raise StorageKeyNotFound(key)
+            return self.objects[key]
+    
+    def exists(self, key: str) -> bool:
+        with self._lock:
+            return key in self.objects
+    
+    def delete(self, key: str):
+        with self._lock:
+            self.objects.pop(key, None)
+    
+    def list(
+        self,
+        prefix: str,
+        start_after: Optional[str] = None,
+        direct_children_only: bool = False,
+        end_at: Optional[str] = None
+    ) -> List[str]:
+        with self._lock:
+            keys = list(self.objects)
+        return _filter_keys(keys, prefix, start_after, direct_children_only, end_at)
+    
+    def create_multipart_upload(self, key: str, content_type: Optional[str] = None, content_encoding: Optional[str] = None) -> str:
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = {}
+        return upload_id
+    
+    def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> dict:
+        with self._lock:
+            self.uploads[upload_id][part_number] = bytes(body)
+        return {'ETag': f"{upload_id}-{part_number}", 'PartNumber': part_number}
+    
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: List[dict]):
+        with self._lock:
+            uploaded = self.uploads.pop(upload_id)
+            self.objects[key] = b''.join(uploaded[part['PartNumber']] for part in sorted(parts, key=lambda part: part['PartNumber']))
+    
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        with self._lock:
+            self.uploads.pop(upload_id, None)
+
+STORAGE_BACKENDS = {
+    's3': S3StorageBackend,
+    'local': LocalStorageBackend,
+    'memory': InMemoryStorageBackend
+}
+
+# One backend per bucket per process, so the in-memory backend is shared
+# by every stage running in the same process
+_storage_backends: Dict[str, StorageBackend] = {}
+_storage_backends_lock = threading.Lock()
+
+def get_storage_backend(bucket: Optional[str] = None) -> StorageBackend:
+    """
+    Return the configured storage backend for a bucket
+    
+    The backend type comes from the STORAGE_BACKEND environment variable;
+    the local backend stores files under STORAGE_LOCAL_ROOT.
+    """
+    bucket = bucket or DEFAULT_BUCKET
+    backend = _storage_backends.get(bucket)
+    if backend is None:
+        with _storage_backends_lock:
+            backend = _storage_backends.get(bucket)
+            if backend is None:
+                backend_name = os.environ.get(STORAGE_BACKEND_ENV, DEFAULT_STORAGE_BACKEND).lower()
+                if backend_name not in STORAGE_BACKENDS:
+                    raise ValueError(f"Unknown storage backend: {backend_name} (expected one of {list(STORAGE_BACKENDS)})")
+                backend = STORAGE_BACKENDS[backend_name](bucket)
+                _storage_backends[bucket] = backend
+    return backend
+
+def set_storage_backend(backend: StorageBackend):
+    """Use a specific backend instance for its bucket (e.g. a pre-populated InMemoryStorageBackend)"""
+    with _storage_backends_lock:
+        _storage_backends[backend.bucket] = backend
+
+def split_key_ranges(prefix: str, shards, start_after: Optional[str] = None) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Split a listing into contiguous (start_after, end_at] key ranges
+    
+    Every prefix + shard is a split point. The first range starts at start_after
+    and the last one is open-ended, so the ranges cover every key under the
+    prefix whatever the shards are - they only decide how evenly work divides.
+    """
+    ranges = []
+    lower = start_after
+    for boundary in sorted({f"{prefix}{shard}" for shard in shards}):
+        if lower is not None and boundary <= lower:
+            continue
+        ranges.append((lower, boundary))
+        lower = boundary
+    ranges.append((lower, None))
+    return ranges
+
+def list_keys(
+    prefix: str,
+    suffix: Optional[str] = None,
+    direct_children_only: bool = False,
+    bucket: Optional[str] = None,
+    start_after: Optional[str] = None,
+    shards=None,
+    max_workers: int = LIST_FAN_OUT_WORKERS
+) -> List[str]:
+    """
+    Every key under a prefix, in order, optionally only those ending in suffix
+    
+    shards are key fragments after the prefix (hash characters, sequence
+    numbers, timestamps) at which the listing is split into ranges that are
+    listed in parallel - see split_key_ranges. Backends without
+    parallel_listing list the prefix in one go.
+    """
+    storage = get_storage_backend(bucket)
+    if shards and storage.parallel_listing:
+        key_ranges = split_key_ranges(prefix, shards, start_after)
+    else:
+        key_ranges = [(start_after, None)]
+    
+    def list_range(key_range):
+        range_start, range_end = key_range
+        return storage.list(prefix, start_after=range_start, direct_children_only=direct_children_only, end_at=range_end)
+    
+    if len(key_ranges) == 1:
+        keys = list_range(key_ranges[0])
+    else:
+        # Ranges are disjoint and in key order, so the concatenated pages stay sorted
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(key_ranges))) as executor:
+            keys = [key for page in executor.map(list_range, key_ranges) for key in page]
+    
+    return [key for key in keys if suffix is None or key.endswith(suffix)]
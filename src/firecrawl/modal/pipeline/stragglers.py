@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Straggler Control for Modal Pipeline
+Per-item deadlines and speculative duplicate calls, so one hung API call
+can't hold up its batch and then the whole stage
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from typing import Any, Callable, Optional
+
+# An item still unresolved this long after it started is given up on
+ITEM_DEADLINE_SECONDS = 180
+
+# A duplicate call is started once an item runs past this percentile of recent latencies
+HEDGE_PERCENTILE = 0.95
+
+# Percentiles from fewer samples are noise - no duplicates until the worker has seen this many
+HEDGE_MIN_SAMPLES = 20
+
+# Never duplicate a call sooner than this, however fast the stage usually is
+HEDGE_MIN_SECONDS = 5.0
+
+# Latencies kept per stage for the percentile
+LATENCY_WINDOW = 500
+
+class ItemDeadlineExceeded(TimeoutError):
+    """No attempt at an item finished within its deadline"""
+
+class LatencyTracker:
+    """
+    Recent successful item latencies of one stage in this worker process
+    
+    Long-lived workers see thousands of items, so the window fills quickly
+    and the percentile follows the API's current behaviour.
+    """
+    
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+    
+    def record(self, seconds: float, hedged: bool = False, hedge_won: bool = False):
+        """Record a successful item - hedged when it got a duplicate call, hedge_won when the duplicate finished first"""
+        with self._lock:
+            self.samples.append(seconds)
+            self.hedged += hedged
+            self.hedge_wins += hedge_won
+    
+    def hedge_after(self) -> Optional[float]:
+        """Seconds before an item gets a duplicate call - None until there are enough samples"""
+        with self._lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))
+        return max(HEDGE_MIN_SECONDS, ordered[index])
+
+def _start_call(call: Callable[..., Any], args, kwargs) -> Future:
+    """
+    Run call on its own daemon thread
+    
+    A thread pool would keep a slot (and interpreter shutdown) waiting on every
+    call that hangs; abandoned daemon threads just end with the container.
+    """
+    future = Future()
+    
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(call(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=run, daemon=True, name="hedged-call").start()
+    return future
+
+def call_with_deadline(
+    call: Callable[..., Any],
+    *args,
+    tracker: LatencyTracker,
+    deadline: float = ITEM_DEADLINE_SECONDS,
+    **kwargs
+) -> Any:
+    """
+    Run call(*args, **kwargs) with a deadline and at most one speculative duplicate
+    
+    Once the call outlives the tracker's percentile a second copy is started
+    and whichever succeeds first wins. If one copy fails the other is still
+    awaited. Raises the last error when both fail, or ItemDeadlineExceeded (a
+    transient error, so the item goes to the second pass) when nothing has
+    finished by the deadline - the slow calls are left running and ignored.
+    """
+    start = time.time()
+    hedge_after = tracker.hedge_after()
+    attempts = {_start_call(call, args, kwargs)}
+    first_attempt = next(iter(attempts))
+    hedged = False
+    last_error = None
+    
+    while attempts:
+        elapsed = time.time() - start
+        if not hedged and hedge_after is not None:
+            timeout = min(hedge_after, deadline) - elapsed
+        else:
+            timeout = deadline - elapsed
+        
+        done, attempts = wait(attempts, timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                tracker.record(time.time() - start, hedged, future is not first_attempt)
+                return future.result()
+            last_error = future.exception()
+        
+        if done:
+            continue
+        if time.time() - start >= deadline:
+            break
+        if not hedged and hedge_after is not None:
+            hedged = True
+            print(f"   🐢 Call still running after {hedge_after:.1f}s (p{HEDGE_PERCENTILE * 100:.0f}) - starting a duplicate")
+            attempts.add(_start_call(call, args, kwargs))
+    
+    if not attempts and last_error is not None:
+        raise last_error
+    raise ItemDeadlineExceeded(f"No result within {deadline:.0f}s")
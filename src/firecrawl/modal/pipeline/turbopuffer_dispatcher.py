@@ -9,7 +9,17 @@ import pandas as pd
 from typing import List, Dict, Any
 
 from .config import app, image, secrets, turbopuffer_queue
-from .s3_utils import S3Manager, create_dynamic_batches, combine_batch_results, BatchReference
+from .s3_utils import (
+    S3Manager, create_dynamic_batches_from_s3, stream_combine_batch_results, 
+    BatchReference, DEFAULT_ARTIFACT_FORMAT, BATCH_BY_TOKENS
+)
+from .work_queue import queue_batches, run_batch_worker, wait_for_batches, note_api_error
+from .autoscaler import StageAutoscaler
+from .product_identity import product_id_for_url
+from .rate_limiter import limited_embeddings
+from .retries import FailedItems, batch_result, call_with_retries, run_second_pass
+from .resume import reuse_batch_output
+from .registry import ProductRegistry, stage_version
 
 try:
     import turbopuffer as tpuf
@@ -33,7 +43,9 @@ TURBOPUFFER_BATCH_SIZE = 100  # Upload in batches for efficiency
 def stage5_turbopuffer_dispatcher(
     execution_id: str,
     environment: str = "dev",
-    turbopuffer_namespace: str = None
+    turbopuffer_namespace: str = None,
+    artifact_format: str = DEFAULT_ARTIFACT_FORMAT,
+    incremental: bool = True
 ) -> dict:
     """
     Stage 5: Turbopuffer Upload Dispatcher
@@ -43,7 +55,9 @@ def stage5_turbopuffer_dispatcher(
         execution_id: Unique execution ID from previous stages
         environment: dev or prod environment
         turbopuffer_namespace: Turbopuffer namespace (defaults to environment-based)
-        
+        artifact_format: 'csv' or 'parquet' for this stage's artifacts
+        incremental: Skip products already uploaded to this namespace unchanged
+    
     Returns:
         Turbopuffer upload results and statistics
     """
@@ -63,76 +77,110 @@ def stage5_turbopuffer_dispatcher(
         # Read classified CSV from S3
         s3_manager = S3Manager()
         classification_csv_path = s3_manager.build_s3_path(
-            environment, execution_id, "classification", "classified_products.csv"
+            environment, execution_id, "classification", "classified_products.csv",
+            artifact_format=artifact_format
         )
         
+        # Documents already in the namespace with the same content need no new embedding
         print(f"📥 Reading classified CSV from: {classification_csv_path}")
-        df = s3_manager.download_dataframe(classification_csv_path)
+        registry = None
+        batch_input_path, carried_batch = classification_csv_path, None
+        if incremental:
+            registry = ProductRegistry(
+                s3_manager, environment, execution_id, "turbopuffer",
+                stage_version(EMBEDDING_MODEL, turbopuffer_namespace), artifact_format
+            )
+            batch_input_path, carried_batch = registry.split_input(classification_csv_path)
+        carried_products = carried_batch.item_count if carried_batch else 0
+        
+        # Stream the remaining products from S3 straight into batches
+        # Turbopuffer upload takes ~30 seconds per batch (including embedding generation)
+        batch_references, input_summary = [], {'total_items': 0, 'value_counts': {'hsa_fsa_status': {}}}
+        if batch_input_path:
+            batch_references, input_summary = create_dynamic_batches_from_s3(
+                input_s3_path=batch_input_path,
+                execution_id=execution_id,
+                stage="turbopuffer",
+                environment=environment,
+                processing_time_per_item=0.3,  # ~30 seconds per 100 products (batched)
+                artifact_format=artifact_format,
+                count_columns=['hsa_fsa_status'],
+                batch_by=BATCH_BY_TOKENS  # embedding time follows text length
+            )
+        input_products = input_summary['total_items'] + carried_products
         
-        if len(df) == 0:
+        if input_products == 0:
             raise Exception("No products found in classification CSV")
         
-        print(f"📊 Processing {len(df):,} products for Turbopuffer upload")
+        print(f"📊 Processing {input_products:,} products for Turbopuffer upload")
         
         # Show HSA/FSA distribution
-        status_counts = df['hsa_fsa_status'].value_counts()
+        status_counts = input_summary['value_counts']['hsa_fsa_status']
         print(f"🏥 HSA/FSA status distribution:")
         for status, count in status_counts.items():
             print(f"   {status}: {count} products")
         
-        # Create dynamic batches for Turbopuffer upload
-        # Turbopuffer upload takes ~30 seconds per batch (including embedding generation)
-        batch_references = create_dynamic_batches(
-            df=df,
-            execution_id=execution_id,
-            stage="turbopuffer",
-            environment=environment,
-            processing_time_per_item=0.3  # ~30 seconds per 100 products (batched)
+        # Long-lived workers drain the queue - the autoscaler sizes the pool as batches complete
+        autoscaler = StageAutoscaler("turbopuffer", input_summary['total_items'])
+        completions = {}
+        if batch_references:
+            worker_count = autoscaler.initial_workers(len(batch_references))
+            queue_batches(turbopuffer_queue, batch_references, execution_id, "turbopuffer", worker_count)
+            
+            print(f"\n🚀 Starting {worker_count} Turbopuffer upload workers for {len(batch_references)} batches...")
+            turbopuffer_futures = [
+                turbopuffer_worker.spawn(turbopuffer_namespace, queue_partition=execution_id)
+                for _ in range(worker_count)
+            ]
+            
+            print(f"⏳ Waiting for {len(batch_references)} Turbopuffer upload batches to complete...")
+            completions = wait_for_batches(
+                execution_id, "turbopuffer", len(batch_references), turbopuffer_futures,
+                batch_queue=turbopuffer_queue,
+                spawn_worker=lambda: turbopuffer_worker.spawn(turbopuffer_namespace, queue_partition=execution_id),
+                autoscaler=autoscaler
+            )
+        completed_batches = [
+            batch_ref for batch_ref in batch_references
+            if completions.get(batch_ref.batch_number, {}).get('output_items')
+        ]
+        print(f"✅ {len(completions)}/{len(batch_references)} batches processed, {len(completed_batches)} with results")
+        
+        # Second pass over uploads that failed transiently - recovered batches join the combine
+        retry_batches, retry_summary = run_second_pass(
+            "turbopuffer", batch_references, completions,
+            lambda retry_refs: list(turbopuffer_worker.map(
+                [turbopuffer_namespace] * len(retry_refs), retry_refs, return_exceptions=True
+            ))
         )
-        
-        print(f"\n🚀 Starting {len(batch_references)} Turbopuffer upload workers...")
-        
-        # Queue batch references for workers
-        for batch_ref in batch_references:
-            turbopuffer_queue.put(batch_ref)
-        
-        # Start Turbopuffer upload workers
-        turbopuffer_futures = []
-        batch_size, max_workers = _calculate_worker_count(len(batch_references))
-        
-        for i in range(min(max_workers, len(batch_references))):
-            future = turbopuffer_worker.spawn(turbopuffer_namespace)
-            turbopuffer_futures.append(future)
-        
-        print(f"✅ Started {len(turbopuffer_futures)} Turbopuffer upload workers")
-        
-        # Wait for all workers to complete
-        print(f"⏳ Waiting for Turbopuffer upload workers to complete...")
-        completed_workers = 0
-        
-        for future in turbopuffer_futures:
-            try:
-                result = future.get()  # This blocks until worker completes
-                completed_workers += 1
-                print(f"   ✅ Worker {completed_workers}/{len(turbopuffer_futures)} completed")
-            except Exception as e:
-                print(f"   ❌ Worker failed: {str(e)}")
+        completed_batches += retry_batches
+        processed_batches = list(completed_batches)
+        if carried_batch:
+            completed_batches.append(carried_batch)
         
         # Combine all batch results into final CSV
         print(f"\n📋 Combining Turbopuffer upload results...")
         
         turbopuffer_csv_path = s3_manager.build_s3_path(
-            environment, execution_id, "turbopuffer", "uploaded_products.csv"
+            environment, execution_id, "turbopuffer", "uploaded_products.csv",
+            artifact_format=artifact_format
         )
         
-        final_df = combine_batch_results(batch_references, turbopuffer_csv_path)
+        combine_summary = stream_combine_batch_results(
+            completed_batches, turbopuffer_csv_path, count_columns=['upload_success']
+        )
         
         dispatch_time = time.time() - start_time
         
-        if len(final_df) > 0:
-            # Calculate upload statistics
-            successful_uploads = len(final_df[final_df['upload_success'] == True])
-            failed_uploads = len(final_df[final_df['upload_success'] == False])
+        if combine_summary['success'] and combine_summary['total_items'] > 0:
+            # Upload statistics are counted while streaming
+            upload_counts = combine_summary['value_counts']['upload_success']
+            successful_uploads = upload_counts.get(True, 0)
+            # Failed uploads are dead-lettered rather than written to the results
+            failed_uploads = upload_counts.get(False, 0) + retry_summary['dead_letter_items']
+            if registry:
+                # Failed uploads have to be tried again next run
+                registry.record(processed_batches, keep_row=lambda row: row.get('upload_success') in (True, 'True'))
             
             print(f"\n✅ TURBOPUFFER DISPATCH COMPLETE!")
             print(f"📁 Results saved to: {turbopuffer_csv_path}")
@@ -144,18 +192,20 @@ def stage5_turbopuffer_dispatcher(
                 'execution_id': execution_id,
                 'environment': environment,
                 'turbopuffer_namespace': turbopuffer_namespace,
-                'input_products': len(df),
+                'input_products': input_products,
                 'successful_uploads': successful_uploads,
                 'failed_uploads': failed_uploads,
                 'turbopuffer_csv_path': turbopuffer_csv_path,
+                'carried_products': carried_products,
                 'batch_count': len(batch_references),
-                'worker_count': len(turbopuffer_futures),
+                'worker_count': autoscaler.peak_workers,
+                'retried_products': retry_summary['retried_items'],
                 'dispatch_time': dispatch_time,
                 'status': 'completed'
             }
         else:
             raise Exception("No products were successfully uploaded to Turbopuffer")
-            
+    
     except Exception as e:
         dispatch_time = time.time() - start_time
         print(f"❌ TURBOPUFFER DISPATCH FAILED: {str(e)}")
@@ -177,67 +227,99 @@ def stage5_turbopuffer_dispatcher(
     image=image,
     
     secrets=secrets,
-    timeout=1800,  # 30 minutes per worker
+    timeout=3600,  # 1 hour per worker - each one drains many batches
     max_containers=10  # Limited concurrency for Turbopuffer uploads
 )
-def turbopuffer_worker(turbopuffer_namespace: str):
+def turbopuffer_worker(turbopuffer_namespace: str, batch_ref: BatchReference = None, queue_partition: str = None):
     """
-    Turbopuffer Upload Worker - Processes one batch of classified products from S3
+    Turbopuffer Upload Worker - Uploads batches of classified products from S3
+    
+    The streaming pipeline passes batch_ref directly and gets that batch's
+    result back. Dispatchers leave it unset: the worker then takes batches
+    from turbopuffer_queue (queue_partition) until a poison pill, upserting
+    through a single Turbopuffer client.
     """
     import os
     
-    try:
-        # Get batch reference from queue
-        batch_ref: BatchReference = turbopuffer_queue.get()
-        
-        if batch_ref is None:
-            return  # Poison pill to stop worker
-        
-        print(f"🗄️  Processing batch {batch_ref.batch_number}: {batch_ref.item_count} products")
-        
-        # Initialize services
-        api_key = os.environ.get('TURBOPUFFER_API_KEY')
-        openai_key = os.environ.get('OPENAI_API_KEY')
-        
-        if not api_key or not tpuf:
-            raise Exception("Turbopuffer not available - cannot upload products")
-        
-        if not openai_key or not openai:
-            raise Exception("OpenAI not available for embeddings - cannot upload products")
-        
-        openai.api_key = openai_key
-        
-        # Load products from S3
-        s3_manager = S3Manager()
-        input_df = s3_manager.download_dataframe(batch_ref.s3_input_path)
-        
-        if len(input_df) == 0:
-            print(f"⚠️  Empty batch {batch_ref.batch_number}")
+    # Initialize services once per worker
+    api_key = os.environ.get('TURBOPUFFER_API_KEY')
+    openai_key = os.environ.get('OPENAI_API_KEY')
+    
+    if not api_key or not tpuf:
+        print("❌ Worker error: Turbopuffer not available - cannot upload products")
+        return
+    
+    if not openai_key or not openai:
+        print("❌ Worker error: OpenAI not available for embeddings - cannot upload products")
+        return
+    
+    openai.api_key = openai_key
+    client = tpuf.Turbopuffer()
+    s3_manager = S3Manager()
+    
+    def process_batch(batch_ref: BatchReference):
+        return _process_turbopuffer_batch(client, turbopuffer_namespace, s3_manager, batch_ref)
+    
+    if batch_ref is not None:
+        try:
+            return process_batch(batch_ref)
+        except Exception as e:
+            print(f"❌ Worker error: {str(e)}")
             return
+    
+    return run_batch_worker(turbopuffer_queue, queue_partition, "turbopuffer", process_batch)
+
+def _process_turbopuffer_batch(client, turbopuffer_namespace: str, s3_manager: S3Manager, batch_ref: BatchReference):
+    """Upload one batch - returns the batch number and output row count, or None if nothing was written"""
+    
+    # Batches finished before a resumed execution failed keep their output
+    reused = reuse_batch_output(s3_manager, batch_ref)
+    if reused:
+        return reused
+    
+    print(f"🗄️  Processing batch {batch_ref.batch_number}: {batch_ref.item_count} products")
+    
+    # Load products from S3
+    input_df = s3_manager.read_batch_input(batch_ref)
+    
+    if len(input_df) == 0:
+        print(f"⚠️  Empty batch {batch_ref.batch_number}")
+        return
+    
+    # Process batch upload - embeddings and the upsert succeed or fail for the whole batch
+    failed = FailedItems(batch_ref)
+    try:
+        upload_results = _upload_batch_to_turbopuffer(input_df, turbopuffer_namespace, batch_ref.batch_number, client)
+    except Exception as e:
+        for _, row in input_df.iterrows():
+            failed.add(row.to_dict(), e)
+        upload_results = []
+    
+    # Save results to S3
+    if upload_results:
+        results_df = pd.DataFrame(upload_results)
+        success = s3_manager.upload_dataframe(results_df, batch_ref.s3_output_path)
         
-        # Process batch upload
-        upload_results = _upload_batch_to_turbopuffer(input_df, turbopuffer_namespace, batch_ref.batch_number)
+        successful_count = sum(1 for result in upload_results if result.get('upload_success', False))
         
-        # Save results to S3
-        if upload_results:
-            results_df = pd.DataFrame(upload_results)
-            success = s3_manager.upload_dataframe(results_df, batch_ref.s3_output_path)
-            
-            successful_count = sum(1 for result in upload_results if result.get('upload_success', False))
-            
-            if success:
-                print(f"✅ Batch {batch_ref.batch_number} complete: {successful_count}/{batch_ref.item_count} successful uploads")
-            else:
-                print(f"❌ Failed to save batch {batch_ref.batch_number} results")
+        if success:
+            print(f"✅ Batch {batch_ref.batch_number} complete: {successful_count}/{batch_ref.item_count} successful uploads")
+            return batch_result(batch_ref, len(upload_results), failed, s3_manager)
         else:
-            print(f"❌ Batch {batch_ref.batch_number}: No upload results")
-            
-    except Exception as e:
-        print(f"❌ Worker error: {str(e)}")
+            print(f"❌ Failed to save batch {batch_ref.batch_number} results")
+    else:
+        print(f"❌ Batch {batch_ref.batch_number}: No upload results")
+        return batch_result(batch_ref, 0, failed, s3_manager)
 
-def _upload_batch_to_turbopuffer(df: pd.DataFrame, namespace: str, batch_number: int) -> List[Dict[str, Any]]:
-    """Upload a batch of classified products to Turbopuffer with embeddings"""
+def _upload_batch_to_turbopuffer(df: pd.DataFrame, namespace: str, batch_number: int, client=None) -> List[Dict[str, Any]]:
+    """
+    Upload a batch of classified products to Turbopuffer with embeddings (client: reuse a worker's Turbopuffer client)
     
+    The embeddings request and the upsert retry transient errors; an error that
+    outlasts them is raised for the whole batch.
+    """
+    
+    upload_results = []
     try:
         print(f"   🧠 Generating embeddings for {len(df)} products...")
         
@@ -249,10 +331,7 @@ def _upload_batch_to_turbopuffer(df: pd.DataFrame, namespace: str, batch_number:
         
         # Generate embeddings from OpenAI
         if openai:
-            response = openai.embeddings.create(
-                model=EMBEDDING_MODEL,
-                input=embedding_texts
-            )
+            response = call_with_retries(limited_embeddings, openai, EMBEDDING_MODEL, embedding_texts)
             embeddings = [item.embedding for item in response.data]
         else:
             raise Exception("OpenAI not available for embeddings")
@@ -267,8 +346,8 @@ def _upload_batch_to_turbopuffer(df: pd.DataFrame, namespace: str, batch_number:
         for idx, (row_idx, row) in enumerate(df.iterrows()):
             upload_timestamp = time.time()
             
-            # Create unique ID for Turbopuffer
-            turbopuffer_id = f"{row['url']}_{batch_number}_{idx}"
+            # Canonical product ID - re-uploading a product overwrites its vector
+            turbopuffer_id = product_id_for_url(row['url'])
             
             record = {
                 "id": turbopuffer_id,
@@ -303,11 +382,11 @@ def _upload_batch_to_turbopuffer(df: pd.DataFrame, namespace: str, batch_number:
         print(f"   🚀 Uploading {len(records)} records to Turbopuffer namespace: {namespace}")
         
         if tpuf:
-            # Initialize Turbopuffer client
-            client = tpuf.Turbopuffer()
+            # Initialize Turbopuffer client unless the worker passed one in
+            client = client or tpuf.Turbopuffer()
             
             # Upload records
-            client.upsert(namespace, records)
+            call_with_retries(client.upsert, namespace, records)
             
             print(f"   ✅ Successfully uploaded {len(records)} records to Turbopuffer")
             
@@ -318,16 +397,11 @@ def _upload_batch_to_turbopuffer(df: pd.DataFrame, namespace: str, batch_number:
             raise Exception("Turbopuffer client not available")
         
         return upload_results
-        
+    
     except Exception as e:
         print(f"   ❌ Batch upload failed: {str(e)}")
-        
-        # Mark all products as failed uploads
-        for result in upload_results:
-            result['upload_success'] = False
-            result['upload_error'] = str(e)
-        
-        return upload_results
+        note_api_error(e, len(df))
+        raise
 
 def _create_embedding_text(row: pd.Series) -> str:
     """Create optimized text for embedding generation"""
@@ -371,17 +445,6 @@ def _create_embedding_text(row: pd.Series) -> str:
     
     return embedding_text
 
-def _calculate_worker_count(batch_count: int) -> tuple:
-    """Calculate optimal worker count based on batch count (limited by Turbopuffer rate limits)"""
-    if batch_count <= 5:
-        return 50, min(5, batch_count)
-    elif batch_count <= 20:
-        return 100, min(8, batch_count)
-    elif batch_count <= 50:
-        return 200, min(10, batch_count)
-    else:
-        return 500, min(10, batch_count)  # Max 10 workers for Turbopuffer
-
 # Utility function for searching Turbopuffer (for testing/validation)
 @app.function(
     image=image,
@@ -423,10 +486,7 @@ def search_turbopuffer_products(
         openai.api_key = openai_key
         
         # Generate embedding for query
-        response = openai.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=[query]
-        )
+        response = limited_embeddings(openai, EMBEDDING_MODEL, [query])
         query_embedding = response.data[0].embedding
         
         # Search Turbopuffer
@@ -459,7 +519,7 @@ def search_turbopuffer_products(
         
         print(f"🔍 Found {len(formatted_results)} results for query: {query}")
         return formatted_results
-        
+    
     except Exception as e:
         print(f"❌ Search error: {str(e)}")
         return []
\ No newline at end of file
@@ -11,6 +11,8 @@ from typing import List, Dict, Any
 
 from .config import app, image, secrets, classification_queue, turbopuffer_queue
 from .schemas import ClassifiedProduct, TurbopufferProduct
+from .product_identity import product_id_for_url
+from .rate_limiter import limited_embeddings
 
 try:
     import turbopuffer as tpuf
@@ -106,10 +108,7 @@ def _upload_batch_to_turbopuffer(batch: List[ClassifiedProduct], namespace: str)
         
         # Get embeddings from OpenAI
         if openai:
-            response = openai.embeddings.create(
-                model=EMBEDDING_MODEL,
-                input=embedding_texts
-            )
+            response = limited_embeddings(openai, EMBEDDING_MODEL, embedding_texts)
             embeddings = [item.embedding for item in response.data]
         else:
             print("   ❌ OpenAI not available for embeddings")
@@ -124,8 +123,8 @@ def _upload_batch_to_turbopuffer(batch: List[ClassifiedProduct], namespace: str)
         for i, (product, embedding) in enumerate(zip(batch, embeddings)):
             upload_timestamp = time.time()
             
-            # Create unique ID for Turbopuffer
-            turbopuffer_id = f"{product.batch_id}-{hash(product.url) % 1000000}"
+            # Canonical product ID - stable across batches and processes
+            turbopuffer_id = product_id_for_url(product.url)
             
             record = {
                 "id": turbopuffer_id,
@@ -333,10 +332,7 @@ def search_turbopuffer(query: str, namespace: str = None, limit: int = 10) -> li
     
     try:
         # Generate embedding for query
-        response = openai.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=[query]
-        )
+        response = limited_embeddings(openai, EMBEDDING_MODEL, [query])
         query_embedding = response.data[0].embedding
         
         # Search Turbopuffer
@@ -13,6 +13,7 @@ import requests
 from .config import app, image, secrets
 from .schemas import DiscoveryJob
 from .s3_utils import S3Manager
+from .product_identity import product_id_for_url
 
 @app.function(
     image=image,
@@ -51,6 +52,16 @@ def stage1_discovery_orchestrator(discovery_job: DiscoveryJob) -> dict:
         
         print(f"\n📊 Total discovered URLs: {len(all_discovered_urls)}")
         
+        # Key every product by its canonical URL and drop duplicate links
+        unique_products = {}
+        for product in all_discovered_urls:
+            product_id = product_id_for_url(product['url'])
+            if product_id not in unique_products:
+                unique_products[product_id] = {'product_id': product_id, **product}
+        if len(unique_products) < len(all_discovered_urls):
+            print(f"🔁 Removed {len(all_discovered_urls) - len(unique_products)} duplicate URLs")
+        all_discovered_urls = list(unique_products.values())
+        
         # Apply max_products limit if specified
         if discovery_job.max_products and len(all_discovered_urls) > discovery_job.max_products:
             all_discovered_urls = all_discovered_urls[:discovery_job.max_products]
@@ -62,7 +73,8 @@ def stage1_discovery_orchestrator(discovery_job: DiscoveryJob) -> dict:
         # Save to S3
         s3_manager = S3Manager()
         discovery_csv_path = s3_manager.build_s3_path(
-            discovery_job.environment, discovery_job.execution_id, "discovery", "discovered_urls.csv"
+            discovery_job.environment, discovery_job.execution_id, "discovery", "discovered_urls.csv",
+            artifact_format=discovery_job.artifact_format
         )
         
         success = s3_manager.upload_dataframe(df, discovery_csv_path)
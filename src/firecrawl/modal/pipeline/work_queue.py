@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Batch Work Queues for Modal Pipeline
+Long-lived stage workers that drain a batch queue, and completion tracking
+for the dispatchers that feed them
+"""
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import modal
+
+from .autoscaler import StageAutoscaler
+from .config import batch_completion_queue
+from .llm_cache import take_cache_stats
+
+# Workers exit on a poison pill (None) - the idle timeout only matters if the
+# pills were lost, e.g. the dispatcher died before queueing them
+WORKER_IDLE_TIMEOUT = 120
+
+# How long the dispatcher waits on the completion queue between checks
+# that its workers are still running
+COMPLETION_POLL_SECONDS = 10
+
+# Per-item API errors noted by the stage code while the current batch runs
+_api_errors = {'errors': 0, 'rate_limited': 0}
+_api_errors_lock = threading.Lock()
+
+def completion_partition(execution_id: str, stage: str) -> str:
+    """Completion queue partition for one stage of one execution"""
+    return f"{execution_id}-{stage}"
+
+def retire_partition(execution_id: str) -> str:
+    """Batch queue partition holding stop tokens for workers the autoscaler retires"""
+    return f"{execution_id}-retire"
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """True for HTTP 429 / rate-limit errors from the OpenAI, Firecrawl or Turbopuffer clients"""
+    if getattr(error, 'status_code', None) == 429 or getattr(error, 'status', None) == 429:
+        return True
+    message = str(error).lower()
+    return '429' in message or 'rate limit' in message or 'too many requests' in message
+
+def note_api_error(error: Exception, item_count: int = 1):
+    """Count per-item API failures - batch completion records report them to the autoscaler"""
+    with _api_errors_lock:
+        _api_errors['errors'] += item_count
+        if is_rate_limit_error(error):
+            _api_errors['rate_limited'] += item_count
+
+def note_throttled(item_count: int = 1):
+    """Count items held back by the shared rate limiter - the autoscaler treats them like 429s"""
+    with _api_errors_lock:
+        _api_errors['rate_limited'] += item_count
+
+def take_api_errors() -> Dict[str, int]:
+    """Errors and rate-limited items noted since the last call, resetting the counts"""
+    with _api_errors_lock:
+        counts = dict(_api_errors)
+        _api_errors['errors'] = _api_errors['rate_limited'] = 0
+    return counts
+
+def queue_batches(batch_queue: modal.Queue, batch_references: List[Any], execution_id: str, stage: str, worker_count: int):
+    """
+    Queue a stage's batches followed by one poison pill per worker
+    
+    Batches go in the execution's own partition, so concurrent executions and
+    leftovers from earlier attempts never mix.
+    """
+    batch_queue.clear(partition=execution_id)
+    batch_queue.clear(partition=retire_partition(execution_id))
+    batch_completion_queue.clear(partition=completion_partition(execution_id, stage))
+    batch_queue.put_many(list(batch_references) + [None] * worker_count, partition=execution_id)
+
+def run_batch_worker(
+    batch_queue: modal.Queue,
+    queue_partition: Optional[str],
+    stage: str,
+    process_batch: Callable[[Any], Optional[Dict[str, Any]]]
+) -> Dict[str, Any]:
+    """
+    Take batches from the queue until a poison pill or the queue stays empty
+    
+    process_batch returns the batch's result dict (with 'output_items') or None.
+    Every batch taken is reported to the completion queue, including failures,
+    so the dispatcher can count batches instead of waiting on workers. Records
+    carry the batch's timing and API error counts for the autoscaler, the
+    items it set aside for the second pass or dead-lettered (see retries.py),
+    and its LLM cache hits.
+    """
+    batches_processed = 0
+    items_written = 0
+    
+    while True:
+        # The autoscaler retires surplus workers with a stop token
+        if queue_partition and batch_queue.get(block=False, partition=retire_partition(queue_partition)):
+            print(f"📉 {stage} worker retired by autoscaler")
+            break
+        
+        try:
+            batch_ref = batch_queue.get(timeout=WORKER_IDLE_TIMEOUT, partition=queue_partition)
+        except queue.Empty:
+            break  # Idle timeout
+        if batch_ref is None:
+            break  # Poison pill
+        
+        take_api_errors()
+        take_cache_stats()
+        batch_start = time.time()
+        try:
+            batch_result = process_batch(batch_ref)
+        except Exception as e:
+            print(f"❌ Batch {batch_ref.batch_number} error: {str(e)}")
+            note_api_error(e)
+            batch_result = None
+        api_errors = take_api_errors()
+        cache_stats = take_cache_stats()
+        
+        output_items = (batch_result or {}).get('output_items', 0)
+        batch_completion_queue.put(
+            {
+                'batch_number': batch_ref.batch_number,
+                'output_items': output_items,
+                'items': batch_ref.item_count,
+                'seconds': time.time() - batch_start,
+                'errors': max(api_errors['errors'], batch_ref.item_count - output_items),
+                'rate_limited': api_errors['rate_limited'],
+                'retry_items': (batch_result or {}).get('retry_items', 0),
+                'dead_letters': (batch_result or {}).get('dead_letters', 0),
+                'reused': bool((batch_result or {}).get('reused')),
+                **cache_stats
+            },
+            partition=completion_partition(batch_ref.execution_id, stage)
+        )
+        batches_processed += 1
+        items_written += output_items
+    
+    print(f"🏁 {stage} worker done: {batches_processed} batches, {items_written} items written")
+    return {'batches_processed': batches_processed, 'items_written': items_written}
+
+def _call_finished(function_call) -> bool:
+    """True once a spawned worker has returned or failed"""
+    try:
+        function_call.get(timeout=0)
+        return True
+    except (TimeoutError, modal.exception.TimeoutError):
+        return False
+    except Exception:
+        return True
+
+def wait_for_batches(
+    execution_id: str,
+    stage: str,
+    batch_count: int,
+    worker_calls: List[Any],
+    batch_queue: Optional[modal.Queue] = None,
+    spawn_worker: Optional[Callable[[], Any]] = None,
+    autoscaler: Optional[StageAutoscaler] = None
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Block until every batch of a stage is reported done
+    
+    With an autoscaler, completion records drive the worker pool: extra workers
+    are spawned with spawn_worker (each followed by a poison pill on
+    batch_queue) and surplus ones get a stop token. Stops early if all workers
+    have exited with batches still unreported (a worker crashed mid-batch),
+    printing the missing batch numbers.
+    
+    Returns:
+        Completion records by batch number
+    """
+    partition = completion_partition(execution_id, stage)
+    completions = {}
+    last_progress = time.time()
+    
+    while len(completions) < batch_count:
+        try:
+            records = batch_completion_queue.get_many(
+                batch_count - len(completions), timeout=COMPLETION_POLL_SECONDS, partition=partition
+            )
+        except queue.Empty:
+            records = []
+        for record in records:
+            completions[record['batch_number']] = record
+            if autoscaler:
+                autoscaler.record(record)
+        
+        if records and time.time() - last_progress >= 30:
+            last_progress = time.time()
+            print(f"   📦 {len(completions)}/{batch_count} {stage} batches complete")
+        
+        running_calls = [call for call in worker_calls if not _call_finished(call)]
+        
+        if not records and not running_calls:
+            # Drain anything reported between the last poll and the final worker exit
+            for record in batch_completion_queue.get_many(batch_count, block=False, partition=partition):
+                completions[record['batch_number']] = record
+            break
+        
+        if autoscaler and spawn_worker and batch_queue is not None:
+            # Stop tokens are only taken between batches - unclaimed ones still count as retired
+            pending_retirements = batch_queue.len(partition=retire_partition(execution_id))
+            active_workers = max(len(running_calls) - pending_retirements, 0)
+            desired = autoscaler.desired_workers(active_workers, batch_count - len(completions))
+            
+            if desired is not None and desired > active_workers:
+                added = desired - active_workers
+                worker_calls.extend(spawn_worker() for _ in range(added))
+                batch_queue.put_many([None] * added, partition=execution_id)
+            elif desired is not None and desired < active_workers:
+                retired = active_workers - desired
+                batch_queue.put_many([True] * retired, partition=retire_partition(execution_id))
+    
+    missing = batch_count - len(completions)
+    if missing:
+        print(f"⚠️  {missing} {stage} batches were never reported - their workers exited early")
+    return completions
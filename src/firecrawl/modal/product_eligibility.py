@@ -5,6 +5,18 @@ Clean deployment with separate functions for each pipeline stage
 """
 
 import modal
+import os
+
+from pipeline.autoscaler import STAGE_SCALING, QueuePoolScaler, StageAutoscaler
+from pipeline.llm_cache import take_cache_stats
+from pipeline.llm_client import AsyncLLMRunner
+from pipeline.product_identity import product_id_for_url
+from pipeline.rate_limiter import limited_chat_completion, limited_embeddings
+from pipeline.retries import SECOND_PASS_DELAY_SECONDS, call_with_retries, call_with_retries_async, is_transient_error
+from pipeline.s3_utils import compress_bytes, decode_json, decompress_bytes, encode_json
+from pipeline.storage import StorageKeyNotFound, get_storage_backend, list_keys
+from pipeline.stragglers import LatencyTracker, call_with_deadline
+from pipeline.work_queue import take_api_errors
 
 # Image with required dependencies and mounted prompts directory  
 image = (
@@ -19,11 +31,14 @@ image = (
         "python-dotenv",
         "turbopuffer",
         "boto3",
+        "zstandard",  # Optional zstd payload compression
+        "orjson",  # Fast compact JSON for checkpoints
         "fastapi[standard]",  # Required for web endpoints
         "aiohttp",  # Required for async HTTP requests in hybrid discovery
         "brotli"   # Required for brotli compression support
     ])
     .add_local_dir("/Users/varsha/src/profilicbot/src/prompts", remote_path="/prompts")
+    .add_local_python_source("pipeline")  # Storage, rate limiting, retries and caching shared with pipeline/
 )
 
 # Create new app for product eligibility
@@ -56,15 +71,13 @@ def discovery_worker(execution_id: str, environment: str, base_url: str):
     import time
     import requests
     from bs4 import BeautifulSoup
-    import boto3
-    import json
     from modal import Queue
     
     print(f"DISCOVERY WORKER STARTED - {execution_id}")
     
     try:
         discovery_queue = Queue.from_name(f"discovery-{execution_id}", create_if_missing=True)
-        s3_client = boto3.client('s3')
+        storage = get_storage_backend()
         
         processed_count = 0
         
@@ -77,17 +90,14 @@ def discovery_worker(execution_id: str, environment: str, base_url: str):
                 
                 print(f"   Processing: {url_to_scrape}")
                 
-                # Check if already processed (checkpoint)
-                url_hash = str(hash(url_to_scrape))[-8:]
-                checkpoint_key = f"{environment}/{execution_id}/checkpoints/discovery/{url_hash}.json"
+                # Check if already processed (checkpoint keyed by canonical URL, stable across containers)
+                url_id = product_id_for_url(url_to_scrape)
+                checkpoint_key = f"{environment}/{execution_id}/checkpoints/discovery/{url_id}.json"
                 
-                try:
-                    s3_client.head_object(Bucket='flex-ai', Key=checkpoint_key)
+                if storage.exists(checkpoint_key):
                     print(f"   SKIPPING {url_to_scrape} - already processed")
                     discovery_queue.task_done()
                     continue
-                except:
-                    pass  # Not processed yet
                 
                 # Scrape the URL
                 headers = {'User-Agent': 'Mozilla/5.0 (compatible; ProductBot/1.0)'}
@@ -106,8 +116,9 @@ def discovery_worker(execution_id: str, environment: str, base_url: str):
                             href = base_url.rstrip('/') + href
                         elif not href.startswith('http'):
                             continue
-                            
+                        
                         discovered_products.append({
+                            'product_id': product_id_for_url(href),
                             'url': href,
                             'estimated_name': text[:100] if text else href.split('/')[-1],
                             'discovered_from': url_to_scrape,
@@ -124,19 +135,14 @@ def discovery_worker(execution_id: str, environment: str, base_url: str):
                     'worker_id': str(uuid.uuid4())[:8]
                 }
                 
-                s3_client.put_object(
-                    Bucket='flex-ai',
-                    Key=checkpoint_key,
-                    Body=json.dumps(checkpoint_data, indent=2),
-                    ContentType='application/json'
-                )
+                put_compressed(checkpoint_key, encode_json(checkpoint_data), 'application/json')
                 
                 processed_count += 1
                 print(f"   DISCOVERED {len(discovered_products)} products from {url_to_scrape}")
                 print(f"   CHECKPOINTED: {checkpoint_key}")
                 
                 discovery_queue.task_done()
-                
+            
             except Exception as queue_error:
                 if "Empty" in str(queue_error):
                     print(f"Discovery worker finished - processed {processed_count} URLs")
@@ -145,7 +151,7 @@ def discovery_worker(execution_id: str, environment: str, base_url: str):
                     print(f"   Error processing URL: {queue_error}")
                     discovery_queue.task_done()
                     continue
-                    
+    
     except Exception as e:
         print(f"Discovery worker failed: {e}")
         return {'status': 'failed', 'error': str(e)}
@@ -179,23 +185,20 @@ def discover_urls_from_csv(csv_path: str, base_url: str, max_products: int, exec
     # Load CSV - assume it has a 'name' column
     try:
         if csv_path.startswith('s3://'):
-            import boto3
-            from io import StringIO
-            s3_client = boto3.client('s3')
             bucket = csv_path.replace('s3://', '').split('/')[0]
             key = '/'.join(csv_path.replace('s3://', '').split('/')[1:])
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            df = pd.read_csv(StringIO(response['Body'].read().decode('utf-8')))
+            body = get_storage_backend(bucket).get(key)
+            df = read_csv_payload(body)
         else:
             df = pd.read_csv(csv_path)
-            
+        
         print(f"✅ Loaded {len(df)} products from CSV")
         
         # Limit products if specified
         if max_products and len(df) > max_products:
             df = df.head(max_products)
             print(f"🔢 Limited to {max_products} products")
-            
+    
     except Exception as e:
         print(f"❌ Error loading CSV: {e}")
         return []
@@ -209,7 +212,7 @@ def discover_urls_from_csv(csv_path: str, base_url: str, max_products: int, exec
         product_name = str(row.get('name', ''))
         if not product_name or product_name == 'nan':
             continue
-            
+        
         print(f"   {i+1}/{len(df)}: Searching for '{product_name[:50]}...'")
         
         try:
@@ -276,7 +279,7 @@ def discover_urls_from_csv(csv_path: str, base_url: str, max_products: int, exec
                     print(f"     ❌ Not found in search results")
             else:
                 print(f"     ❌ Search failed with status {response.status_code}")
-                
+        
         except Exception as e:
             print(f"     ❌ Error searching for '{product_name}': {e}")
         
@@ -291,30 +294,26 @@ def discover_urls_from_csv_queue_based(csv_path: str, base_url: str, max_product
     Queue-based CSV discovery for large datasets (12K+ products)
     """
     import pandas as pd
-    import boto3
-    import time
     from modal import Queue
-    from io import StringIO
     
     print(f"📄 QUEUE-BASED CSV DISCOVERY: Loading from {csv_path}")
     
     # Load CSV
     try:
         if csv_path.startswith('s3://'):
-            s3_client = boto3.client('s3')
             bucket = csv_path.replace('s3://', '').split('/')[0]
             key = '/'.join(csv_path.replace('s3://', '').split('/')[1:])
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            df = pd.read_csv(StringIO(response['Body'].read().decode('utf-8')))
+            body = get_storage_backend(bucket).get(key)
+            df = read_csv_payload(body)
         else:
             df = pd.read_csv(csv_path)
-            
+        
         print(f"✅ Loaded {len(df)} products from CSV")
         
         if max_products and len(df) > max_products:
             df = df.head(max_products)
             print(f"🔢 Limited to {max_products} products")
-            
+    
     except Exception as e:
         print(f"❌ Error loading CSV: {e}")
         return []
@@ -335,17 +334,25 @@ def discover_urls_from_csv_queue_based(csv_path: str, base_url: str, max_product
     
     # Queue all products
     print(f"Queueing {len(df)} products for discovery...")
+    queued_ids = set()
     for i, (_, row) in enumerate(df.iterrows()):
         product_name = str(row.get('name', ''))
-        if product_name and product_name != 'nan':
+        product_id = product_id_for_csv_row(row)
+        if product_name and product_name != 'nan' and product_id not in queued_ids:
+            queued_ids.add(product_id)
             discovery_queue.put({
-                'product_id': f'csv_product_{i:06d}',
+                'product_id': product_id,
                 'product_name': product_name,
                 'base_url': base_url,
                 'execution_id': execution_id,
                 'environment': environment
             })
     
+    # Workers stop once the ledger accounts for every queued product
+    discovery_ledger = StageLedger(execution_id, 'csv-discovery')
+    discovery_ledger.record('enqueued', len(queued_ids))
+    discovery_ledger.close_input()
+    
     print(f"Starting {worker_count} CSV discovery workers...")
     
     # Start discovery workers
@@ -354,16 +361,6 @@ def discover_urls_from_csv_queue_based(csv_path: str, base_url: str, max_product
         worker = csv_discovery_worker.spawn(execution_id, base_url, environment)
         discovery_workers.append(worker)
     
-    # Send completion signals
-    print("Sending completion signals to discovery workers...")
-    for _ in range(worker_count):
-        discovery_queue.put({
-            'product_id': 'CSV_DISCOVERY_COMPLETE',
-            'stage': 'csv_discovery',
-            'execution_id': execution_id,
-            'signal': 'CSV_DISCOVERY_COMPLETE'
-        })
-    
     # Wait for workers to complete
     print("Waiting for CSV discovery workers to complete...")
     for worker in discovery_workers:
@@ -371,27 +368,13 @@ def discover_urls_from_csv_queue_based(csv_path: str, base_url: str, max_product
     
     print("All CSV discovery workers completed!")
     
-    # Collect results from S3
-    s3_client = boto3.client('s3')
+    # Collect results from the workers' checkpoint segments
     discovered_links = []
     
     try:
-        response = s3_client.list_objects_v2(
-            Bucket='flex-ai',
-            Prefix=f'{environment}/{execution_id}/csv_discovery/'
-        )
-        
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                if obj['Key'].endswith('.json'):
-                    try:
-                        response = s3_client.get_object(Bucket='flex-ai', Key=obj['Key'])
-                        import json
-                        result = json.loads(response['Body'].read().decode('utf-8'))
-                        if result.get('status') == 'success' and result.get('url'):
-                            discovered_links.append(result)
-                    except Exception as e:
-                        print(f"Error reading {obj['Key']}: {e}")
+        for result in load_stage_checkpoints(f"{environment}/{execution_id}/csv_discovery"):
+            if result.get('status') == 'success' and result.get('url'):
+                discovered_links.append(result)
     
     except Exception as e:
         print(f"Error collecting results: {e}")
@@ -416,45 +399,40 @@ def csv_discovery_worker(execution_id: str, base_url: str, environment: str = "d
     import time
     import urllib.parse
     import uuid
-    import json
-    import boto3
     
     print(f"CSV DISCOVERY WORKER STARTED - {execution_id}")
     worker_id = str(uuid.uuid4())[:8]
+    checkpoint_writer = None
+    ledger = StageLedger(execution_id, 'csv-discovery', worker_id)
     
     try:
         queue_name = f"csv-discovery-{execution_id}"
         processed_count = 0
-        s3_client = boto3.client('s3')
         base_domain = base_url.rstrip('/')
         
+        stage_prefix = f"{environment}/{execution_id}/csv_discovery"
+        checkpoint_writer = CheckpointSegmentWriter(stage_prefix, f"csv-discovery-{worker_id}")
+        completed_ids = CompletedItemIndex(stage_prefix)
+        
         while True:
             try:
                 # Get work item from queue
-                work_item = queue_helper(queue_name, "get", timeout=60)
+                work_item = queue_helper(queue_name, "get", timeout=LEDGER_POLL_SECONDS)
                 
                 if work_item is None:
                     raise Exception("Empty")
                 
                 product_id = work_item['product_id']
                 
-                # Check for completion signal
-                if product_id == 'CSV_DISCOVERY_COMPLETE':
-                    print(f"[{worker_id}] Received CSV_DISCOVERY_COMPLETE signal - worker finished - processed {processed_count} products")
-                    break
-                
                 product_name = work_item['product_name']
                 print(f"   [{worker_id}] Searching for: {product_name[:50]}...")
                 
                 # Check if already processed (checkpoint)
-                output_path = f"{environment}/{execution_id}/csv_discovery/{product_id}.json"
-                try:
-                    s3_client.head_object(Bucket='flex-ai', Key=output_path)
+                if product_id in completed_ids:
                     print(f"   [{worker_id}] SKIPPING {product_id} - already processed")
+                    ledger.record('completed')
                     queue_helper(queue_name, "task_done")
                     continue
-                except:
-                    pass  # Not processed yet
                 
                 # Search for product URL
                 try:
@@ -527,19 +505,16 @@ def csv_discovery_worker(execution_id: str, base_url: str, environment: str = "d
                         print(f"   [{worker_id}] ❌ Search failed: {response.status_code}")
                         result['error'] = f"Search failed with status {response.status_code}"
                     
-                    # Save result to S3
-                    s3_client.put_object(
-                        Bucket='flex-ai',
-                        Key=output_path,
-                        Body=json.dumps(result, indent=2),
-                        ContentType='application/json'
-                    )
+                    # Buffer result into the current checkpoint segment
+                    checkpoint_writer.add(product_id, result)
+                    completed_ids.add(product_id)
+                    ledger.record('completed')
                     
                     processed_count += 1
                     
                     # Small delay to be respectful
                     time.sleep(0.5)
-                    
+                
                 except Exception as search_error:
                     print(f"   [{worker_id}] ❌ Error searching: {search_error}")
                     
@@ -554,19 +529,18 @@ def csv_discovery_worker(execution_id: str, base_url: str, environment: str = "d
                         'discovery_time': time.time()
                     }
                     
-                    s3_client.put_object(
-                        Bucket='flex-ai',
-                        Key=output_path,
-                        Body=json.dumps(error_result, indent=2),
-                        ContentType='application/json'
-                    )
+                    checkpoint_writer.add(product_id, error_result)
+                    completed_ids.add(product_id)
+                    ledger.record('failed')
                 
                 queue_helper(queue_name, "task_done")
-                
+            
             except Exception as queue_error:
                 if "Empty" in str(queue_error):
-                    print(f"   [{worker_id}] Queue empty, waiting for more work...")
-                    time.sleep(5)
+                    checkpoint_writer.flush_if_due()
+                    if ledger.is_drained():
+                        print(f"[{worker_id}] CSV discovery input drained - worker finished - processed {processed_count} products")
+                        break
                 else:
                     print(f"   [{worker_id}] Queue error: {queue_error}")
                     time.sleep(1)
@@ -574,6 +548,10 @@ def csv_discovery_worker(execution_id: str, base_url: str, environment: str = "d
     except Exception as e:
         print(f"CSV Discovery worker failed: {e}")
         return {'status': 'failed', 'error': str(e)}
+    finally:
+        if checkpoint_writer:
+            checkpoint_writer.close()
+        ledger.publish()
     
     return {'status': 'success', 'processed_count': processed_count}
 
@@ -611,10 +589,7 @@ def discovery_stage(
     import time
     import requests
     from bs4 import BeautifulSoup
-    import boto3
-    from modal import Queue
     
-    import uuid
     if not execution_id:
         execution_id = str(uuid.uuid4())[:8]
     print(f"STAGE 1: DISCOVERY (QUEUE-BASED)")
@@ -653,7 +628,7 @@ def discovery_stage(
                     print(f"     Found {len(sitemap_urls)} sitemaps in robots.txt")
                 except Exception as robots_error:
                     print(f"     Robots.txt check failed: {robots_error}")
-            
+                
                 # Fallback to standard sitemap locations if robots.txt didn't work
                 if not sitemap_urls:
                     sitemap_urls = [
@@ -662,7 +637,7 @@ def discovery_stage(
                         f"{base_url.rstrip('/')}/product-sitemap.xml",
                         f"{base_url.rstrip('/')}/sitemap_index.xml"
                     ]
-            
+                
                 # Universal exclude patterns for non-product pages
                 exclude_patterns = [
                 # Account/Auth pages
@@ -686,7 +661,7 @@ def discovery_stage(
                 # Filter/sort URLs
                 '?', '#', 'filter=', 'sort=', 'page='
                 ]
-            
+                
                 # Universal product indicators - look for individual product patterns
                 # Most e-commerce sites use these patterns for individual products
                 product_indicators = [
@@ -695,9 +670,9 @@ def discovery_stage(
                     # Some sites use these for individual products
                     '-p-', '-product-', '/buy/', '_p_'
                 ]
-            
+                
                 headers = {'User-Agent': 'Mozilla/5.0 (compatible; ProductBot/1.0)'}
-            
+                
                 for sitemap_url in sitemap_urls:
                     try:
                         print(f"     Checking {sitemap_url}")
@@ -779,26 +754,26 @@ def discovery_stage(
                         if product_links:
                             print(f"   Sitemap discovery found {len(product_links)} URLs from {sitemap_url}")
                             break  # Found products, no need to try other sitemaps
-                        
+                    
                     except Exception as e:
                         print(f"     Sitemap {sitemap_url} failed: {e}")
                         continue
-            
+                
                 if not product_links:
                     raise Exception("No products found in sitemaps")
-                
+            
             except Exception as sitemap_error:
                 print(f"   Sitemap discovery failed: {sitemap_error}")
                 print("   Using Firecrawl Link Discovery + Manual Fetch approach...")
-        
+            
             try:
                 import os
                 import asyncio
                 import aiohttp
                 from firecrawl import FirecrawlApp
-            
+                
                 firecrawl = FirecrawlApp(api_key=os.environ.get("FIRECRAWL_API_KEY"))
-            
+                
                 # Normalize the base URL for Firecrawl
                 normalized_url = base_url
                 if not normalized_url.startswith('http'):
@@ -807,7 +782,7 @@ def discovery_stage(
                     normalized_url = f"{normalized_url}/"
                 
                 print(f"   Using normalized URL: {normalized_url}")
-            
+                
                 # Step 1: Use Firecrawl purely for URL discovery (50 pages max)
                 print(f"   Step 1: Firecrawl URL discovery (50 pages)...")
                 try:
@@ -913,14 +888,14 @@ def discovery_stage(
                                 r'/item/([a-zA-Z0-9\-]+)', 
                                 r'/p/([a-zA-Z0-9\-]+)'
                             ]
-                                
+                            
                             for pattern in ecommerce_patterns:
                                 matches = re.findall(pattern, markdown_text)
                                 for match in matches[:20]:  # Limit per pattern
                                     pattern_base = pattern.split('(')[0]  # Get the path part
                                     product_url = f"{base_domain}{pattern_base}{match}"
                                     discovered_links.append(product_url)
-                        
+                    
                     if url and url != 'None':
                         discovered_links.append(url)
                     
@@ -959,11 +934,11 @@ def discovery_stage(
                                 time.sleep(10)
                             
                             poll_count += 1
-                            
+                        
                         except Exception as poll_error:
                             print(f"   Polling error: {poll_error}")
                             break
-                    
+                
                 if poll_count >= max_polls:
                     print(f"   Timeout waiting for crawl completion")
                 
@@ -1024,7 +999,7 @@ def discovery_stage(
                     
                     # Include everything else - commerce pages, categories, products
                     return True
-                
+                    
                     valuable_urls = [url for url in discovered_links if is_valuable_url(url)]
                     print(f"   Filtered to {len(valuable_urls)} valuable URLs (products + categories)")
                 
@@ -1054,7 +1029,7 @@ def discovery_stage(
                         # Add random delay to avoid being detected as bot
                         import random
                         await asyncio.sleep(random.uniform(0.5, 2.0))
-                        
+                    
                     max_retries = 3
                     for attempt in range(max_retries):
                         try:
@@ -1065,7 +1040,7 @@ def discovery_stage(
                                 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Edge/91.0.864.59',
                                 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15'
                             ]
-                                
+                            
                             headers = {
                                 'User-Agent': random.choice(user_agents),
                                 'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
@@ -1082,7 +1057,7 @@ def discovery_stage(
                                 
                                 # Longer timeout with exponential backoff
                             timeout = 10 + (attempt * 5)  # 10s, 15s, 20s
-                                
+                            
                             async with session.get(url, headers=headers, timeout=timeout) as response:
                                 if response.status == 200:
                                     html = await response.text()
@@ -1090,7 +1065,7 @@ def discovery_stage(
                                         
                                         # Extract product name
                                     estimated_name = url.split('/')[-1]  # Default fallback
-                                        
+                                    
                                     title_tag = soup.find('title')
                                     if title_tag and title_tag.get_text().strip():
                                         estimated_name = title_tag.get_text().strip()[:100]
@@ -1098,7 +1073,7 @@ def discovery_stage(
                                         h1_tag = soup.find('h1')
                                         if h1_tag and h1_tag.get_text().strip():
                                             estimated_name = h1_tag.get_text().strip()[:100]
-                                        
+                                    
                                     print(f"     ✅ Success: {estimated_name[:50]}")
                                     return {
                                         'url': url,
@@ -1118,7 +1093,7 @@ def discovery_stage(
                                 else:
                                     print(f"     ❌ HTTP {response.status}: {url}")
                                     return None
-                                        
+                        
                         except asyncio.TimeoutError:
                             print(f"     ⏰ Timeout attempt {attempt + 1}/{max_retries}: {url}")
                             if attempt < max_retries - 1:
@@ -1134,7 +1109,7 @@ def discovery_stage(
                                 continue
                             else:
                                 return None
-                        
+                    
                     return None
                 
                 async def crawl_products_async(urls):
@@ -1233,7 +1208,7 @@ def discovery_stage(
                                     'discovery_method': 'firecrawl_discovery_url_only'
                                 })
                                 print(f"       📄 URL only: {url}")
-                                
+                        
                         except Exception as firecrawl_extract_error:
                             print(f"       ❌ Firecrawl extract failed: {firecrawl_extract_error}")
                             # Still keep the URL even if Firecrawl fails
@@ -1248,33 +1223,23 @@ def discovery_stage(
                     
                     product_links = firecrawl_extracted
                     print(f"   Firecrawl extraction result: {len(product_links)} products")
-                
+                    
                     if not product_links:
                         raise Exception("Both manual fetch and Firecrawl extraction returned no products")
-                    
+            
             except Exception as firecrawl_error:
                 print(f"   Hybrid approach failed: {firecrawl_error}")
                 print("   Pipeline failed - no fallback methods available.")
                 raise Exception(f"Discovery failed completely. Sitemap: {sitemap_error}. Hybrid: {firecrawl_error}")
         
         # Save consolidated results
-        s3_client = boto3.client('s3')
-        
         if product_links:
             import pandas as pd
-            from io import StringIO
             
             discovery_df = pd.DataFrame(product_links)
             discovery_key = f"{environment}/{execution_id}/discovery/discovered_urls.csv"
             
-            csv_buffer = StringIO()
-            discovery_df.to_csv(csv_buffer, index=False)
-            s3_client.put_object(
-                Bucket='flex-ai',
-                Key=discovery_key,
-                Body=csv_buffer.getvalue(),
-                ContentType='text/csv'
-            )
+            upload_csv(discovery_df, discovery_key)
             
             print(f"Discovered {len(product_links)} URLs")
             print(f"Saved to s3://flex-ai/{discovery_key}")
@@ -1287,7 +1252,7 @@ def discovery_stage(
             's3_path': f"s3://flex-ai/{discovery_key}" if product_links else None,
             'next_stage': 'extraction_stage'
         }
-        
+    
     except Exception as e:
         print(f"Discovery failed: {e}")
         return {
@@ -1296,83 +1261,105 @@ def discovery_stage(
             'execution_id': execution_id
         }
 
+# =============================================================================
+# CONCURRENT LLM REQUESTS
+# =============================================================================
+
+class ChatCompletionRunner(AsyncLLMRunner):
+    """AsyncLLMRunner for the workers' chat completions - one call sends a group of requests"""
+    
+    def complete(self, requests: list, validate=None, use_cache: bool = True) -> list:
+        """
+        Run chat.completions.create(**request) for each request, at most
+        `concurrency` at a time, through the shared rate limiter and response cache
+        
+        validate is one reply validator for every request, or a list with one
+        per request - only replies it accepts are cached (see
+        limited_chat_completion). use_cache=False asks again even when a
+        reply is cached.
+        
+        Returns each response's message content in request order, or the
+        exception that request raised once its retries ran out.
+        """
+        validators = validate if isinstance(validate, list) else [validate] * len(requests)
+        
+        async def complete_one(client, request_and_validator):
+            request, request_validate = request_and_validator
+            response = await call_with_retries_async(
+                limited_chat_completion, client, validate=request_validate, use_cache=use_cache, **request
+            )
+            return response.choices[0].message.content
+        
+        if not requests:
+            return []
+        return self.map(complete_one, list(zip(requests, validators)))
+
+# =============================================================================
+# LLM RESPONSE CACHE
+# =============================================================================
+
+# Chat completions are answered from pipeline/llm_cache.py when the same request
+# was seen before. Workers add their hits to the stage ledger, which reports them here.
+
+def llm_cache_report(execution_id: str) -> dict:
+    """Cache hits and tokens saved by an execution's categorization and classification workers"""
+    totals = [StageLedger(execution_id, stage).totals() for stage in ('categorization', 'classification')]
+    hits = sum(stage_totals['cache_hits'] for stage_totals in totals)
+    lookups = hits + sum(stage_totals['cache_misses'] for stage_totals in totals)
+    report = {
+        'hits': hits,
+        'misses': lookups - hits,
+        'hit_rate': hits / lookups if lookups else 0.0,
+        'saved_tokens': sum(stage_totals['cache_saved_tokens'] for stage_totals in totals)
+    }
+    print(f"LLM CACHE: {hits}/{lookups} requests answered from cache ({report['hit_rate']:.0%}), "
+          f"{report['saved_tokens']} tokens saved")
+    return report
+
 # =============================================================================
 # DYNAMIC WORKER CALCULATION
 # =============================================================================
 
-def calculate_optimal_workers(queue_size: int, stage: str) -> dict:
+# Stage limits and latency priors are pipeline/autoscaler.py's STAGE_SCALING,
+# and the pools are sized by its StageAutoscaler - the same 429- and
+# error-aware controller the batch dispatchers use.
+AUTOSCALE_WAIT_POLL_SECONDS = 10
+
+def calculate_optimal_workers(queue_size: int, stage: str, target_minutes: float = None) -> dict:
     """
-    Calculate optimal worker count based on queue size and stage characteristics
+    Calculate the starting worker count for a stage
+    
+    StageAutoscaler's starting size for queue_size items: enough to clear them
+    within the target time (AUTOSCALE_TARGET_MINUTES by default) at the stage's
+    latency prior, capped by its container and API rate ceilings.
+    QueueAutoscaler adjusts it once the stage is running.
     
     Args:
         queue_size: Number of items to process
         stage: Pipeline stage name
+        target_minutes: Target completion time for the stage
     
     Returns:
         Dict with worker_count, estimated_time_minutes, and reasoning
     """
+    import math
     
-    # Stage-specific characteristics
-    stage_configs = {
-        'extraction': {
-            'max_workers': 50,
-            'time_per_item': 10,  # seconds (Firecrawl API call)
-            'products_per_worker': 100,
-            'description': 'Firecrawl data extraction'
-        },
-        'categorization': {
-            'max_workers': 30, 
-            'time_per_item': 3,   # seconds (OpenAI API call)
-            'products_per_worker': 200,
-            'description': 'OpenAI categorization'
-        },
-        'classification': {
-            'max_workers': 30,
-            'time_per_item': 4,   # seconds (OpenAI API call) 
-            'products_per_worker': 200,
-            'description': 'HSA/FSA classification'
-        },
-        'turbopuffer': {
-            'max_workers': 20,
-            'time_per_item': 2,   # seconds (embedding + upload)
-            'products_per_worker': 300,
-            'description': 'Vector database upload'
-        },
-        'csv_discovery': {
-            'max_workers': 40,
-            'time_per_item': 15,  # seconds (web scraping + search)
-            'products_per_worker': 50,
-            'description': 'CSV-based product URL discovery'
-        }
-    }
-    
-    if stage not in stage_configs:
+    if stage not in STAGE_SCALING:
         raise ValueError(f"Unknown stage: {stage}")
     
-    config = stage_configs[stage]
-    
-    # Dynamic calculation based on queue size
-    if queue_size <= 0:
-        worker_count = 1
-        reasoning = "Minimum 1 worker for empty queue"
-    elif queue_size <= 10:
-        worker_count = min(5, queue_size)
-        reasoning = "Small job - minimal workers to avoid over-provisioning"
-    elif queue_size <= 100:
-        worker_count = min(10, max(5, queue_size // 5))
-        reasoning = "Medium job - balanced parallelization"
-    elif queue_size <= 1000:
-        worker_count = min(20, max(10, queue_size // 25))
-        reasoning = "Large job - good parallelization"
-    elif queue_size <= 10000:
-        worker_count = min(config['max_workers'], max(20, queue_size // config['products_per_worker']))
-        reasoning = "Very large job - high parallelization"
+    scaling = STAGE_SCALING[stage]
+    autoscaler = StageAutoscaler(stage, queue_size, target_minutes)
+    worker_count = autoscaler.initial_workers(max(queue_size, 1))
+    
+    if worker_count >= scaling.max_workers:
+        reasoning = f"Container ceiling ({scaling.max_workers} workers)"
+    elif worker_count >= math.floor(scaling.max_items_per_minute * scaling.seconds_per_item / 60):
+        reasoning = f"API rate ceiling ({scaling.max_items_per_minute:.0f} items/min)"
     else:
-        worker_count = config['max_workers']
-        reasoning = "Maximum scale for 10K+ products"
+        reasoning = f"Enough workers to finish in {autoscaler.target_seconds / 60:.0f} minutes"
     
     # Calculate estimated time
-    estimated_seconds = (queue_size * config['time_per_item']) / worker_count
+    estimated_seconds = (queue_size * scaling.seconds_per_item) / worker_count
     estimated_minutes = max(1, int(estimated_seconds / 60))
     
     return {
@@ -1380,10 +1367,163 @@ def calculate_optimal_workers(queue_size: int, stage: str) -> dict:
         'estimated_time_minutes': estimated_minutes,
         'estimated_seconds': estimated_seconds,
         'reasoning': reasoning,
-        'stage_description': config['description'],
         'products_per_worker': queue_size // worker_count if worker_count > 0 else 0
     }
 
+def running_workers(workers: list) -> list:
+    """Spawned workers that have not returned yet"""
+    running = []
+    for worker in workers:
+        try:
+            worker.get(timeout=0)
+        except (TimeoutError, modal.exception.TimeoutError):
+            running.append(worker)
+        except Exception:
+            pass
+    return running
+
+def retire_queue_name(stage: str, execution_id: str) -> str:
+    """Queue of stop tokens for the stage workers QueueAutoscaler retires"""
+    return f"{stage}-retire-{execution_id}"
+
+class QueueAutoscaler:
+    """
+    Sizes a queue-fed stage's worker pool while it runs
+    
+    Each poll hands the stage ledger's totals to a QueuePoolScaler: finished
+    items set the per-item latency, failed and deferred items the error rate,
+    and items held back by the rate limiter or a 429 the rate-limited share -
+    so a throttled stage shrinks and a failing one holds instead of growing.
+    Workers are spawned up to the target, and surplus ones retired with stop
+    tokens on the stage's retire queue, which workers check between items.
+    """
+    
+    def __init__(self, stage: str, execution_id: str, spawn_worker, workers: list, target_minutes: float = None):
+        self.stage = stage
+        self.spawn_worker = spawn_worker
+        self.workers = workers
+        self.ledger = StageLedger(execution_id, stage)
+        self.retire_queue_name = retire_queue_name(stage, execution_id)
+        self.pool = QueuePoolScaler(StageAutoscaler(stage, 0, target_minutes))
+    
+    def poll(self):
+        """Feed the ledger's progress to the autoscaler and spawn or retire workers to its target"""
+        from modal import Queue
+        
+        retire_queue = Queue.from_name(self.retire_queue_name, create_if_missing=True)
+        backlog = Queue.from_name(self.ledger.queue_name, create_if_missing=True).len()
+        change = self.pool.poll(
+            self.ledger.totals(), len(running_workers(self.workers)), backlog, retire_queue.len()
+        )
+        if change > 0:
+            for _ in range(change):
+                self.workers.append(self.spawn_worker())
+        elif change < 0:
+            retire_queue.put_many([True] * -change)
+
+def autoscale_until_done(wait_for, *also_scale: QueueAutoscaler):
+    """
+    Block until every worker of wait_for (a QueueAutoscaler or a plain list of
+    spawned workers) has exited, autoscaling it and the also_scale stages
+    (downstream stages running concurrently) meanwhile
+    """
+    import time
+    
+    if isinstance(wait_for, QueueAutoscaler):
+        workers, scalers = wait_for.workers, (wait_for,) + also_scale
+    else:
+        workers, scalers = wait_for, also_scale
+    
+    while running_workers(workers):
+        for scaler in scalers:
+            scaler.poll()
+        time.sleep(AUTOSCALE_WAIT_POLL_SECONDS)
+    
+    # Surface worker failures the way waiting on each worker did
+    for worker in workers:
+        worker.get()
+
+# =============================================================================
+# ITEM RETRIES AND DEAD LETTERS
+# =============================================================================
+
+# Products that failed for good, one record each with the error class
+DEAD_LETTER_FOLDER = "dead_letter"
+
+def retry_queue_name(stage: str, execution_id: str) -> str:
+    """Queue holding a stage's transient failures until its second pass"""
+    return f"{stage}-retry-{execution_id}"
+
+def set_aside_for_retry(stage: str, execution_id: str, work_item: dict, error: Exception) -> bool:
+    """
+    Park a transiently failed item for the stage's second pass
+    
+    Returns False - the caller records the failure - when the error isn't
+    transient or the item is already on its second pass.
+    """
+    if work_item.get('retry_pass') or not is_transient_error(error):
+        return False
+    queue_helper(retry_queue_name(stage, execution_id), "put", work_item)
+    return True
+
+def dead_letter_record(stage: str, product_id: str, product_data: dict, error: Exception, work_item: dict) -> dict:
+    """Dead-letter entry for a product whose error outlasted its retries"""
+    import time
+    
+    return {
+        **product_data,
+        'product_id': product_id,
+        'dead_letter_stage': stage,
+        'dead_letter_error_class': type(error).__name__,
+        'dead_letter_error': str(error)[:500],
+        'dead_letter_transient': is_transient_error(error),
+        'dead_letter_retry_pass': bool(work_item.get('retry_pass')),
+        'dead_letter_timestamp': time.time()
+    }
+
+def run_second_pass(stage: str, execution_id: str, spawn_worker, *also_scale: QueueAutoscaler) -> int:
+    """
+    Give a stage's transient failures one more pass once its workers have exited
+    
+    Parked items go back on the stage queue marked retry_pass, after
+    SECOND_PASS_DELAY_SECONDS, and are counted in the stage ledger so fresh
+    workers drain them. Failures on this pass are dead-lettered. Downstream
+    stages in also_scale keep autoscaling meanwhile.
+    
+    Returns:
+        Number of items retried
+    """
+    import time
+    from modal import Queue
+    
+    retry_items = []
+    while True:
+        items = queue_helper(retry_queue_name(stage, execution_id), "get_many", max_items=100)
+        if not items:
+            break
+        retry_items.extend(items)
+    
+    if not retry_items:
+        return 0
+    
+    print(f"SECOND PASS {stage}: retrying {len(retry_items)} products in {SECOND_PASS_DELAY_SECONDS}s")
+    time.sleep(SECOND_PASS_DELAY_SECONDS)
+    
+    # Stop tokens left over from the first pass would retire the fresh workers
+    Queue.from_name(retire_queue_name(stage, execution_id), create_if_missing=True).clear()
+    
+    # Count the items before queueing them so no worker sees the stage as drained in between
+    ledger = StageLedger(execution_id, stage)
+    ledger.record('enqueued', len(retry_items))
+    ledger.publish()
+    for item in retry_items:
+        queue_helper(ledger.queue_name, "put", {**item, 'retry_pass': True})
+    
+    workers = [spawn_worker() for _ in range(calculate_optimal_workers(len(retry_items), stage)['worker_count'])]
+    autoscale_until_done(workers, *also_scale)
+    print(f"SECOND PASS {stage}: done")
+    return len(retry_items)
+
 # =============================================================================
 # REUSABLE QUEUE-BASED STAGE UTILITIES
 # =============================================================================
@@ -1410,36 +1550,21 @@ def create_queue_based_stage(
     Returns:
         Dict with stage results
     """
-    import boto3
     import pandas as pd
-    from io import StringIO
     from modal import Queue
     import time
     
     start_time = time.time()
-    s3_client = boto3.client('s3')
     
     print(f"STAGE: {stage_name.upper()} (QUEUE-BASED WITH DYNAMIC WORKERS)")
     print(f"Execution ID: {execution_id}")
     
     try:
-        # List all input files from S3
+        # Load all input records from the previous stage's checkpoints
         input_prefix = f"{input_s3_prefix}/"
-        response = s3_client.list_objects_v2(
-            Bucket='flex-ai',
-            Prefix=input_prefix
-        )
+        input_records = load_stage_checkpoints(input_s3_prefix)
         
-        input_files = []
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                if obj['Key'].endswith('.json'):
-                    input_files.append(obj['Key'])
-        
-        queue_size = len(input_files)
-        print(f"Found {queue_size} products to process")
-        
-        if queue_size == 0:
+        if not input_records:
             print(f"No input files found in {input_prefix}")
             return {
                 'status': 'success',
@@ -1447,75 +1572,70 @@ def create_queue_based_stage(
                 'message': 'No products to process'
             }
         
-        # Use fixed 50 workers for classification, dynamic for others
-        if stage_name == 'classification':
-            worker_count = 50
-            print(f"FIXED WORKER COUNT FOR CLASSIFICATION:")
-            print(f"   Queue Size: {queue_size}")
-            print(f"   Workers: {worker_count} (maximum parallelization)")
-            print(f"   Products per Worker: ~{queue_size // worker_count}")
-            print(f"   Stage: HSA/FSA classification with maximum speed")
-        else:
-            # Calculate optimal worker count dynamically for other stages
-            worker_config = calculate_optimal_workers(queue_size, stage_name)
-            worker_count = worker_config['worker_count']
-            
-            print(f"DYNAMIC WORKER CALCULATION:")
-            print(f"   Queue Size: {queue_size}")
-            print(f"   Optimal Workers: {worker_count}")
-            print(f"   Products per Worker: ~{worker_config['products_per_worker']}")
-            print(f"   Estimated Time: {worker_config['estimated_time_minutes']} minutes")
-            print(f"   Reasoning: {worker_config['reasoning']}")
-            print(f"   Stage: {worker_config['stage_description']}")
+        # On resume, don't enqueue products this stage already checkpointed
+        output_prefix = f"{environment}/{execution_id}/{stage_name}"
+        completed_ids = CompletedItemIndex(output_prefix)
+        pending_records = [record for record in input_records if record['product_id'] not in completed_ids.completed_ids]
+        
+        queue_size = len(pending_records)
+        print(f"Found {len(input_records)} products, {queue_size} still to process ({len(input_records) - queue_size} already completed)")
+        
+        # Starting worker count - QueueAutoscaler adjusts it while the stage runs
+        worker_config = calculate_optimal_workers(queue_size, stage_name)
+        worker_count = worker_config['worker_count']
+        
+        print("DYNAMIC WORKER CALCULATION:")
+        print(f"   Queue Size: {queue_size}")
+        print(f"   Starting Workers: {worker_count}")
+        print(f"   Products per Worker: ~{worker_config['products_per_worker']}")
+        print(f"   Estimated Time: {worker_config['estimated_time_minutes']} minutes")
+        print(f"   Reasoning: {worker_config['reasoning']}")
         
         # Create queue and enqueue work
         queue_name = f"{stage_name}-{execution_id}"
         stage_queue = Queue.from_name(queue_name, create_if_missing=True)
         
         print(f"Enqueuing {queue_size} products...")
-        for file_key in input_files:
-            product_id = file_key.split('/')[-1].replace('.json', '')
+        ledger = StageLedger(execution_id, stage_name)
+        ledger.record('enqueued', queue_size)
+        ledger.publish()
+        for record in pending_records:
             queue_helper(queue_name, "put", {
-                'product_id': product_id,
-                's3_path': file_key,
+                'product_id': record['product_id'],
+                'product_data': record,
                 'stage': stage_name,
                 'execution_id': execution_id
             })
         
-        print(f"Starting {worker_count} {stage_name} workers...")
+        # Everything is queued - workers finish as soon as the ledger accounts for it
+        ledger.close_input()
+        
         workers = []
-        for i in range(worker_count):
-            worker = worker_function.spawn(execution_id, environment)
-            workers.append(worker)
+        if queue_size == 0:
+            print(f"All products already completed - skipping {stage_name} workers")
+        else:
+            print(f"Starting {worker_count} {stage_name} workers...")
+            for i in range(worker_count):
+                worker = worker_function.spawn(execution_id, environment)
+                workers.append(worker)
         
-        # Wait for all workers to complete
+        # Wait for all workers to complete, scaling the pool to the measured throughput
         print(f"Waiting for {stage_name} workers to complete...")
-        for worker in workers:
-            worker.get()
+        scaler = QueueAutoscaler(
+            stage_name, execution_id,
+            lambda: worker_function.spawn(execution_id, environment), workers
+        )
+        autoscale_until_done(scaler)
+        run_second_pass(stage_name, execution_id, lambda: worker_function.spawn(execution_id, environment))
+        worker_count = len(workers)
         
         print(f"All {stage_name} work completed")
         
         # Collect results
         print(f"Collecting {stage_name} results...")
-        output_prefix = f"{environment}/{execution_id}/{stage_name}/"
-        response = s3_client.list_objects_v2(
-            Bucket='flex-ai',
-            Prefix=output_prefix
-        )
-        
-        processed_products = []
-        successful_count = 0
-        
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                if obj['Key'].endswith('.json'):
-                    try:
-                        product_data = download_product_from_s3(obj['Key'])
-                        processed_products.append(product_data)
-                        if product_data.get('status') == 'success':
-                            successful_count += 1
-                    except Exception as e:
-                        print(f"Error reading {obj['Key']}: {e}")
+        processed_products = load_stage_checkpoints(output_prefix)
+        successful_count = sum(1 for product in processed_products if product.get('status') == 'success')
+        write_completed_index_snapshot(output_prefix, completed_ids)
         
         # Save consolidated CSV
         if processed_products:
@@ -1532,14 +1652,7 @@ def create_queue_based_stage(
             
             results_key = f"{environment}/{execution_id}/{stage_name}/{csv_filename}"
             
-            csv_buffer = StringIO()
-            results_df.to_csv(csv_buffer, index=False)
-            s3_client.put_object(
-                Bucket='flex-ai',
-                Key=results_key,
-                Body=csv_buffer.getvalue(),
-                ContentType='text/csv'
-            )
+            upload_csv(results_df, results_key)
             
             actual_time_minutes = int((time.time() - start_time) / 60)
             
@@ -1566,7 +1679,7 @@ def create_queue_based_stage(
             'worker_config': worker_config,
             'actual_time_minutes': int((time.time() - start_time) / 60)
         }
-        
+    
     except Exception as e:
         print(f"{stage_name} failed: {e}")
         return {
@@ -1579,21 +1692,24 @@ def create_queue_based_stage(
 # QUEUE HELPER UTILITIES
 # =============================================================================
 
-def queue_helper(queue_name: str, operation: str = "get", item: dict = None, timeout: int = 30):
+def queue_helper(queue_name: str, operation: str = "get", item: dict = None, timeout: int = 30, max_items: int = 1):
     """
     Unified queue helper for all stages with better error handling
     
     Args:
         queue_name: Name of the queue
-        operation: "put", "get", or "task_done" 
+        operation: "put", "get", "get_many", or "task_done" 
         item: Item to put (for put operation)
         timeout: Timeout for get operation
+        max_items: Most items to take for get_many
     
     Returns:
         For get: work item dict
+        For get_many: list of the work items already queued (possibly empty) - never waits
         For put/task_done: True
     """
     import time
+    from queue import Empty as QueueEmpty
     from modal import Queue
     from modal.exception import ClientClosed
     
@@ -1603,7 +1719,7 @@ def queue_helper(queue_name: str, operation: str = "get", item: dict = None, tim
         if operation == "put":
             if not item:
                 raise ValueError("Item required for put operation")
-                
+            
             queue_item = {
                 'product_id': item['product_id'],
                 'stage': item['stage'],
@@ -1614,36 +1730,25 @@ def queue_helper(queue_name: str, operation: str = "get", item: dict = None, tim
             # Add s3_path if provided (for legacy compatibility)
             if 's3_path' in item:
                 queue_item['s3_path'] = item['s3_path']
-                
-            # Add direct data if provided (for optimization)
-            for key in ['url', 'estimated_name', 'discovered_from', 'discovery_time']:
+            
+            # Add direct data if provided (for optimization) - product_data carries
+            # the previous stage's record so workers don't read it back from S3
+            for key in ['url', 'estimated_name', 'discovered_from', 'discovery_time', 'product_data', 'retry_pass']:
                 if key in item:
                     queue_item[key] = item[key]
             queue.put(queue_item)
             return True
-            
+        
         elif operation == "get":
             try:
-                # Manual timeout implementation since Modal doesn't support it
-                start_time = time.time()
-                while time.time() - start_time < timeout:
-                    try:
-                        work_item = queue.get(block=False)  # Non-blocking get
-                        if work_item is not None:  # Ensure we got a valid item
-                            return work_item
-                        else:
-                            time.sleep(0.5)  # None returned, wait and retry
-                            continue
-                    except Exception as get_error:
-                        if "empty" in str(get_error).lower() or "no items" in str(get_error).lower():
-                            time.sleep(0.5)  # Wait before retry
-                            continue
-                        else:
-                            raise get_error
-                
-                # Timeout reached
+                # Block server-side so an item is handed over the moment it is queued
+                work_item = queue.get(block=True, timeout=timeout)
+                if work_item is None:
+                    raise Exception("Empty")
+                return work_item
+            
+            except QueueEmpty:
                 raise Exception("Empty")
-                
             except ClientClosed as cc_error:
                 print(f"   Client connection closed during queue get: {cc_error}")
                 raise Exception("Empty")  # Treat as empty to allow graceful shutdown
@@ -1651,61 +1756,611 @@ def queue_helper(queue_name: str, operation: str = "get", item: dict = None, tim
                 if "empty" in str(e).lower() or "no items" in str(e).lower():
                     raise Exception("Empty")
                 raise e
-            
+        
+        elif operation == "get_many":
+            if max_items < 1:
+                return []
+            return [work_item for work_item in queue.get_many(max_items, block=False) if work_item is not None]
+        
         elif operation == "task_done":
             # Modal Queue doesn't have task_done - just return True
             return True
-            
+        
         else:
             raise ValueError(f"Unknown operation: {operation}")
-            
+    
     except ClientClosed as cc_error:
         print(f"   Client connection closed during queue operation: {cc_error}")
         if operation == "get":
             raise Exception("Empty")  # Allow graceful shutdown
+        if operation == "get_many":
+            return []
         return True  # For put/task_done, just return success
 
-def download_product_from_s3(s3_path: str, bucket: str = "flex-ai"):
-    """Download product data from S3"""
-    import boto3
-    import json
-    
-    s3_client = boto3.client('s3')
-    response = s3_client.get_object(Bucket=bucket, Key=s3_path)
-    return json.loads(response['Body'].read().decode('utf-8'))
+# =============================================================================
+# STAGE LEDGER
+# =============================================================================
 
-def upload_product_to_s3(product_data: dict, s3_path: str, bucket: str = "flex-ai"):
-    """Upload product data to S3"""
-    import boto3
-    import json
-    
-    s3_client = boto3.client('s3')
-    s3_client.put_object(
-        Bucket=bucket,
-        Key=s3_path,
-        Body=json.dumps(product_data, indent=2),
-        ContentType='application/json'
-    )
-    return True
+# Every queue-fed stage keeps enqueued/completed/failed/deferred counters in one
+# Modal Dict per execution. Each writer (orchestrator, worker, second pass) owns
+# its own "{stage}:{writer_id}" entry, so containers never update the same key.
+# A stage is drained once its input is closed, its queue is empty and
+# completed + failed + deferred (set aside for the second pass) covers every
+# enqueued item - workers exit then instead of waiting for signals or silence.
 
+# How long an idle worker blocks on its queue before consulting the ledger
+LEDGER_POLL_SECONDS = 5
 
-# =============================================================================
-# STAGE 2: EXTRACTION (Queue-Based)
-# =============================================================================
+# A busy writer publishes its counts at most this often, so QueueAutoscaler sees progress
+LEDGER_PUBLISH_SECONDS = 15
 
-@app.function(
-    image=image,
-    secrets=[
-        modal.Secret.from_name("aws-s3-credentials"),
-        modal.Secret.from_name("firecrawl-api-key")
-    ],
-    timeout=86400,  # 24 hours - maximum Modal allows
-    memory=2048,    # 2GB memory for extraction processing
-    max_containers=50
-)
-def extraction_worker(execution_id: str, environment: str = "dev"):
+# A closed, empty stage whose totals stop moving this long while still short of
+# enqueued counts as drained - the missing items died with a crashed worker
+LEDGER_STALL_SECONDS = 600
+
+LEDGER_OUTCOMES = ('enqueued', 'completed', 'failed', 'deferred')
+
+# Also kept per writer, for the execution's LLM cache report - not part of draining
+LEDGER_CACHE_COUNTERS = ('cache_hits', 'cache_misses', 'cache_saved_tokens')
+
+# Items held back by the rate limiter or a 429, for QueueAutoscaler - not part of draining
+LEDGER_RATE_COUNTERS = ('rate_limited',)
+
+LEDGER_COUNTERS = LEDGER_OUTCOMES + LEDGER_CACHE_COUNTERS + LEDGER_RATE_COUNTERS
+
+class StageLedger:
     """
-    Extraction worker - processes URLs from extraction queue using references
+    One writer's counters for a stage, plus the stage-wide totals
+    
+    record() counts locally and publishes at most every LEDGER_PUBLISH_SECONDS;
+    publish() writes the counts to the shared Dict, and is_drained() publishes
+    before it reads.
+    """
+    
+    def __init__(self, execution_id: str, stage: str, writer_id: str = None, queue_name: str = None):
+        import uuid
+        
+        self.execution_id = execution_id
+        self.stage = stage
+        self.writer_id = writer_id or str(uuid.uuid4())[:8]
+        self.queue_name = queue_name or f"{stage}-{execution_id}"
+        self.counts = dict.fromkeys(LEDGER_COUNTERS, 0)
+        self.published = None
+        self.published_at = 0.0
+        self.last_totals = None
+        self.last_change = None
+    
+    def _ledger(self):
+        from modal import Dict
+        
+        return Dict.from_name(f"ledger-{self.execution_id}", create_if_missing=True)
+    
+    def record(self, outcome: str, count: int = 1):
+        import time
+        
+        self.counts[outcome] += count
+        if time.time() - self.published_at >= LEDGER_PUBLISH_SECONDS:
+            self.publish()
+    
+    def record_llm_cache(self):
+        """Add the container's LLM cache hits and misses since the last call"""
+        for counter, count in take_cache_stats().items():
+            self.counts[counter] += count
+    
+    def record_rate_limited(self):
+        """Add the container's rate-limited items (limiter waits and 429s) since the last call"""
+        self.counts['rate_limited'] += take_api_errors()['rate_limited']
+    
+    def retired(self) -> bool:
+        """Take a stop token QueueAutoscaler left for one of the stage's workers, if there is one"""
+        from modal import Queue
+        
+        return bool(Queue.from_name(retire_queue_name(self.stage, self.execution_id), create_if_missing=True).get(block=False))
+    
+    def accounted(self) -> int:
+        """Items this writer has completed, failed or deferred"""
+        return self.counts['completed'] + self.counts['failed'] + self.counts['deferred']
+    
+    def publish(self):
+        """Write this writer's counts to the shared ledger if they changed"""
+        import time
+        
+        self.published_at = time.time()
+        if self.counts != self.published:
+            self._ledger().put(f"{self.stage}:{self.writer_id}", dict(self.counts))
+            self.published = dict(self.counts)
+    
+    def totals(self) -> dict:
+        """Counts summed over every writer of the stage"""
+        totals = dict.fromkeys(LEDGER_COUNTERS, 0)
+        prefix = f"{self.stage}:"
+        for key, counts in self._ledger().items():
+            if isinstance(key, str) and key.startswith(prefix):
+                for outcome in totals:
+                    totals[outcome] += counts.get(outcome, 0)
+        return totals
+    
+    def close_input(self):
+        """Declare that only the stage's second pass will enqueue anything more"""
+        self.publish()
+        self._ledger().put(f"{self.stage}#closed", True)
+        print(f"LEDGER {self.stage}: input closed - {self.totals()}")
+    
+    def is_drained(self) -> bool:
+        """True once the input is closed, the queue is empty and every enqueued item is accounted for"""
+        import time
+        from modal import Queue
+        
+        self.publish()
+        if not self._ledger().get(f"{self.stage}#closed", False):
+            return False
+        if Queue.from_name(self.queue_name, create_if_missing=True).len() > 0:
+            return False
+        
+        totals = self.totals()
+        if totals['completed'] + totals['failed'] + totals['deferred'] >= totals['enqueued']:
+            return True
+        
+        # The rest is in flight with other workers - unless nothing has moved for too long
+        now = time.time()
+        if totals != self.last_totals:
+            self.last_totals, self.last_change = totals, now
+        elif now - self.last_change >= LEDGER_STALL_SECONDS:
+            print(f"LEDGER {self.stage}: {totals} unchanged for {LEDGER_STALL_SECONDS}s - treating the stage as drained")
+            return True
+        return False
+
+# =============================================================================
+# PAYLOAD ENCODING
+# =============================================================================
+#
+# JSON is written compactly (orjson when available) and JSON/CSV payloads are
+# compressed with PAYLOAD_COMPRESSION ("gzip" default, "zstd" or "none").
+# The codec is recorded as Content-Encoding and sniffed from magic bytes on
+# read, so uncompressed objects from earlier runs still decode.
+
+PAYLOAD_COMPRESSION = os.environ.get('PAYLOAD_COMPRESSION', 'gzip')
+
+def put_compressed(key: str, data: bytes, content_type: str, bucket: str = None):
+    """Compress and store a payload, recording the codec as Content-Encoding"""
+    body, content_encoding = compress_bytes(data, PAYLOAD_COMPRESSION)
+    get_storage_backend(bucket).put(key, body, content_type=content_type, content_encoding=content_encoding)
+
+def upload_csv(df, key: str, bucket: str = None):
+    """Store a DataFrame as compressed CSV"""
+    put_compressed(key, df.to_csv(index=False).encode('utf-8'), 'text/csv', bucket)
+
+def read_csv_payload(body: bytes):
+    """DataFrame from a (possibly compressed) CSV payload"""
+    import pandas as pd
+    from io import BytesIO
+    
+    return pd.read_csv(BytesIO(decompress_bytes(body)))
+
+def download_product_from_s3(s3_path: str, bucket: str = None):
+    """Download product data from storage"""
+    return decode_json(decompress_bytes(get_storage_backend(bucket).get(s3_path)))
+
+def upload_product_to_s3(product_data: dict, s3_path: str, bucket: str = None):
+    """Upload product data to storage"""
+    put_compressed(s3_path, encode_json(product_data), 'application/json', bucket)
+    return True
+
+# =============================================================================
+# PRODUCT IDENTITY
+# =============================================================================
+#
+# Products are keyed by a hash of their canonical URL (or, for CSV rows with
+# no URL, of their normalized name and description) so the same product gets
+# the same ID in every stage, checkpoint and execution.
+
+def product_id_for_csv_row(row) -> str:
+    """Stable product ID for an input CSV row - by URL when it has one, else by content"""
+    import hashlib
+    
+    url = str(row.get('url', '') or '')
+    if url and url != 'nan':
+        return product_id_for_url(url)
+    
+    content = '\n'.join(
+        ' '.join(str(row.get(field, '') or '').split()).lower()
+        for field in ('name', 'description')
+    )
+    return f"p_{hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]}"
+
+# =============================================================================
+# BULK S3 READ UTILITIES
+# =============================================================================
+
+BULK_DOWNLOAD_WORKERS = 32
+BULK_DOWNLOAD_RETRIES = 3
+
+def bulk_download_products_from_s3(
+    s3_keys: list,
+    bucket: str = None,
+    max_workers: int = BULK_DOWNLOAD_WORKERS,
+    max_retries: int = BULK_DOWNLOAD_RETRIES,
+    ordered: bool = False,
+    decoder=None
+):
+    """
+    Download many product JSON files from S3 concurrently
+    
+    Args:
+        s3_keys: S3 keys of the JSON files to read
+        bucket: S3 bucket
+        max_workers: Number of concurrent downloads
+        max_retries: Attempts per key before giving up (with exponential backoff)
+        ordered: Yield in s3_keys order instead of completion order
+        decoder: Optional function turning the raw object bytes into the yielded
+                 value (defaults to parsing a single JSON document)
+    
+    Yields:
+        (s3_key, product_data, error) - product_data is None and error is set
+        when the key could not be read
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    # S3 backend: the shared client is thread-safe and its pool covers BULK_DOWNLOAD_WORKERS
+    storage = get_storage_backend(bucket)
+    
+    if decoder is None:
+        decoder = lambda body: decode_json(decompress_bytes(body))
+    
+    def fetch(s3_key):
+        last_error = None
+        for attempt in range(max_retries):
+            try:
+                return s3_key, decoder(storage.get(s3_key)), None
+            except Exception as e:
+                last_error = e
+                # Missing keys and invalid JSON won't succeed on retry
+                if isinstance(e, (ValueError, StorageKeyNotFound)):
+                    break
+                time.sleep(0.5 * (2 ** attempt))
+        return s3_key, None, last_error
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if ordered:
+            for result in executor.map(fetch, s3_keys):
+                yield result
+        else:
+            futures = [executor.submit(fetch, s3_key) for s3_key in s3_keys]
+            for future in as_completed(futures):
+                yield future.result()
+
+# =============================================================================
+# CHECKPOINT SEGMENT UTILITIES
+# =============================================================================
+#
+# Workers buffer stage results and write them as compressed JSONL segments:
+#   {env}/{exec}/{stage}/segments/{writer_id}-{seq}.jsonl.gz (.jsonl.zst with zstd)
+# Every flushed segment gets a small manifest entry listing its product IDs:
+#   {env}/{exec}/{stage}/manifest/{timestamp_ms}-{writer_id}-{seq}.json
+# Manifest keys sort by flush time, so later entries win when a product was
+# processed twice. Older executions wrote one {product_id}.json per product
+# directly under the stage prefix - readers still pick those up.
+
+CHECKPOINT_FLUSH_ITEMS = 200
+CHECKPOINT_FLUSH_SECONDS = 30
+
+# Manifest listings fan out over 30-minute slices of the last two days
+MANIFEST_LIST_WINDOW_MS = 48 * 60 * 60 * 1000
+MANIFEST_LIST_SHARD_MS = 30 * 60 * 1000
+
+def decode_checkpoint_segment(body: bytes) -> list:
+    """Decode a compressed JSONL segment into its list of records"""
+    lines = decompress_bytes(body).splitlines()
+    return [decode_json(line) for line in lines if line.strip()]
+
+class CheckpointSegmentWriter:
+    """
+    Buffers one worker's stage results and flushes them as a single segment
+    
+    A flush happens every flush_items records or flush_seconds, whichever
+    comes first, and at close(). If a worker dies, at most one unflushed
+    buffer is lost - those products are simply processed again on resume.
+    """
+    
+    def __init__(
+        self,
+        stage_prefix: str,
+        writer_id: str,
+        flush_items: int = CHECKPOINT_FLUSH_ITEMS,
+        flush_seconds: int = CHECKPOINT_FLUSH_SECONDS
+    ):
+        import time
+        
+        self.stage_prefix = stage_prefix.rstrip('/')
+        self.writer_id = writer_id
+        self.flush_items = flush_items
+        self.flush_seconds = flush_seconds
+        self.sequence = 0
+        self.records = []
+        self.last_flush = time.time()
+        self.retry_after = 0
+    
+    def add(self, product_id: str, record: dict):
+        """Buffer one result, flushing if the segment is full or old enough"""
+        self.records.append({**record, 'product_id': product_id})
+        self.flush_if_due()
+    
+    def flush_if_due(self):
+        """Flush when enough records or time have accumulated (call while idle too)"""
+        import time
+        
+        if not self.records or time.time() < self.retry_after:
+            return
+        if len(self.records) >= self.flush_items or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+    
+    def flush(self):
+        """Write buffered records as one segment plus its manifest entry"""
+        import time
+        
+        if not self.records:
+            return None
+        
+        storage = get_storage_backend()
+        segment_name = f"{self.writer_id}-{self.sequence:05d}"
+        
+        try:
+            body = b'\n'.join(encode_json(record) for record in self.records) + b'\n'
+            compressed, encoding = compress_bytes(body)
+            extension = {'gzip': '.gz', 'zstd': '.zst'}.get(encoding, '')
+            segment_key = f"{self.stage_prefix}/segments/{segment_name}.jsonl{extension}"
+            storage.put(segment_key, compressed, content_type='application/x-ndjson', content_encoding=encoding)
+            
+            # Manifest entry is written after the segment so it never points at a missing file
+            flushed_at = time.time()
+            manifest_entry = {
+                'segment_key': segment_key,
+                'writer_id': self.writer_id,
+                'sequence': self.sequence,
+                'item_count': len(self.records),
+                'product_ids': [record['product_id'] for record in self.records],
+                'flushed_at': flushed_at
+            }
+            manifest_key = f"{self.stage_prefix}/manifest/{int(flushed_at * 1000):013d}-{segment_name}.json"
+            storage.put(manifest_key, encode_json(manifest_entry), content_type='application/json')
+        except Exception as e:
+            # Keep the buffer - retry shortly with these records included
+            print(f"   [{self.writer_id}] Checkpoint flush failed ({len(self.records)} buffered): {e}")
+            self.retry_after = time.time() + 5
+            return None
+        
+        print(f"   [{self.writer_id}] CHECKPOINTED {len(self.records)} products: {segment_key}")
+        self.records = []
+        self.sequence += 1
+        self.last_flush = time.time()
+        return segment_key
+    
+    def close(self):
+        """Flush whatever is left - call when the worker exits"""
+        self.flush()
+
+def manifest_time_shards(window_ms: int = MANIFEST_LIST_WINDOW_MS, shard_ms: int = MANIFEST_LIST_SHARD_MS) -> list:
+    """
+    Flush-time split points for listing manifest keys in parallel
+    
+    Manifest keys start with a 13-digit millisecond timestamp, so the recent
+    window is cut into shard_ms slices. Older entries fall into the first range.
+    """
+    import time
+    
+    now_ms = int(time.time() * 1000)
+    return [f"{timestamp_ms:013d}" for timestamp_ms in range(now_ms - window_ms, now_ms, shard_ms)]
+
+def load_checkpoint_manifest(stage_prefix: str, start_after: str = None, skip_keys: set = None) -> list:
+    """
+    Read manifest entries for a stage, oldest flush first
+    
+    Each entry gets a 'manifest_key' field. start_after/skip_keys let callers
+    read only the entries they haven't seen yet.
+    """
+    stage_prefix = stage_prefix.rstrip('/')
+    manifest_keys = sorted(list_keys(
+        f"{stage_prefix}/manifest/",
+        suffix='.json',
+        start_after=start_after,
+        shards=manifest_time_shards()
+    ))
+    if skip_keys:
+        manifest_keys = [key for key in manifest_keys if key not in skip_keys]
+    
+    entries = []
+    for key, entry, error in bulk_download_products_from_s3(manifest_keys, ordered=True):
+        if error:
+            print(f"Error reading manifest entry {key}: {error}")
+            continue
+        entries.append({**entry, 'manifest_key': key})
+    return entries
+
+def load_stage_checkpoints(stage_prefix: str) -> list:
+    """
+    Load every checkpointed record for a stage
+    
+    Reads the segments listed in the manifest plus any legacy per-product JSON
+    files. Each product appears once - the most recently flushed record wins.
+    
+    Args:
+        stage_prefix: e.g. "{environment}/{execution_id}/categorization"
+    
+    Returns:
+        List of product records
+    """
+    stage_prefix = stage_prefix.rstrip('/')
+    records_by_id = {}
+    
+    # Legacy one-object-per-product layout (direct children of the stage prefix)
+    legacy_keys = list_keys(f"{stage_prefix}/", suffix='.json', direct_children_only=True)
+    for key, record, error in bulk_download_products_from_s3(legacy_keys, ordered=True):
+        if error:
+            print(f"Error reading {key}: {error}")
+            continue
+        product_id = record.get('product_id') or key.split('/')[-1].replace('.json', '')
+        records_by_id[product_id] = record
+    
+    # Segment layout - apply in manifest order so later flushes override
+    segment_keys = [entry['segment_key'] for entry in load_checkpoint_manifest(stage_prefix)]
+    for key, records, error in bulk_download_products_from_s3(
+        segment_keys, ordered=True, decoder=decode_checkpoint_segment
+    ):
+        if error:
+            print(f"Error reading segment {key}: {error}")
+            continue
+        for record in records:
+            records_by_id[record['product_id']] = record
+    
+    print(f"Loaded {len(records_by_id)} checkpointed products from {len(legacy_keys)} files and {len(segment_keys)} segments")
+    return list(records_by_id.values())
+
+# =============================================================================
+# COMPLETED-ITEM INDEX
+# =============================================================================
+#
+# Workers skip products that already have a checkpoint by checking an
+# in-memory index instead of probing S3 per product. The index is built from
+# manifest entries (product IDs only - segments are never downloaded) and a
+# compact snapshot written when a stage is consolidated:
+#   {env}/{exec}/{stage}/completed_index.json.gz
+
+COMPLETED_INDEX_SNAPSHOT = "completed_index.json.gz"
+COMPLETED_INDEX_REFRESH_SECONDS = 30
+# Writers stamp manifest keys with their own clock, so re-list a little before
+# the newest key we've seen to catch entries from slightly-behind workers
+COMPLETED_INDEX_CLOCK_SKEW_MS = 60000
+
+class CompletedItemIndex:
+    """
+    Set of product IDs already checkpointed for a stage
+    
+    Loaded once when a worker starts, then refreshed incrementally: a refresh
+    only lists manifest keys newer than the last one seen and reads just those
+    entries. Lookups are set membership checks - a miss triggers a refresh at
+    most every refresh_seconds, so products finished by other workers are
+    picked up without an S3 call per item.
+    """
+    
+    def __init__(self, stage_prefix: str, refresh_seconds: int = COMPLETED_INDEX_REFRESH_SECONDS):
+        self.stage_prefix = stage_prefix.rstrip('/')
+        self.refresh_seconds = refresh_seconds
+        self.completed_ids = set()
+        self.seen_manifest_keys = set()
+        self.latest_manifest_key = None
+        self.last_refresh = 0
+        
+        self._load_snapshot()
+        self._load_legacy_ids()
+        self.refresh()
+    
+    def _load_snapshot(self):
+        """Start from the consolidation snapshot if one exists"""
+        snapshot_key = f"{self.stage_prefix}/{COMPLETED_INDEX_SNAPSHOT}"
+        try:
+            snapshot = decode_json(decompress_bytes(get_storage_backend().get(snapshot_key)))
+        except StorageKeyNotFound:
+            return
+        except Exception as e:
+            print(f"Could not read completed index snapshot {snapshot_key}: {e}")
+            return
+        
+        self.completed_ids.update(snapshot.get('product_ids', []))
+        self.latest_manifest_key = snapshot.get('latest_manifest_key')
+    
+    def _load_legacy_ids(self):
+        """Per-product JSON files from older executions - the key is the product ID"""
+        for key in list_keys(f"{self.stage_prefix}/", suffix='.json', direct_children_only=True):
+            self.completed_ids.add(key.split('/')[-1].replace('.json', ''))
+    
+    def _refresh_start_key(self):
+        """List from slightly before the newest manifest key seen so far"""
+        if not self.latest_manifest_key:
+            return None
+        timestamp_ms = int(self.latest_manifest_key.split('/')[-1].split('-')[0])
+        return f"{self.stage_prefix}/manifest/{max(0, timestamp_ms - COMPLETED_INDEX_CLOCK_SKEW_MS):013d}"
+    
+    def refresh(self):
+        """Pull in manifest entries flushed since the last refresh"""
+        import time
+        
+        entries = load_checkpoint_manifest(
+            self.stage_prefix,
+            start_after=self._refresh_start_key(),
+            skip_keys=self.seen_manifest_keys
+        )
+        for entry in entries:
+            self.completed_ids.update(entry.get('product_ids', []))
+            self.seen_manifest_keys.add(entry['manifest_key'])
+            if self.latest_manifest_key is None or entry['manifest_key'] > self.latest_manifest_key:
+                self.latest_manifest_key = entry['manifest_key']
+        
+        self.last_refresh = time.time()
+        return len(entries)
+    
+    def add(self, product_id: str):
+        """Record a product this worker just checkpointed"""
+        self.completed_ids.add(product_id)
+    
+    def __contains__(self, product_id) -> bool:
+        import time
+        
+        if product_id in self.completed_ids:
+            return True
+        if time.time() - self.last_refresh >= self.refresh_seconds:
+            self.refresh()
+            return product_id in self.completed_ids
+        return False
+    
+    def __len__(self) -> int:
+        return len(self.completed_ids)
+
+def write_completed_index_snapshot(stage_prefix: str, index: CompletedItemIndex = None) -> str:
+    """
+    Save a stage's completed IDs as one compact object
+    
+    Resumed runs load this instead of re-reading every manifest entry.
+    
+    Returns:
+        S3 key of the snapshot
+    """
+    import time
+    
+    stage_prefix = stage_prefix.rstrip('/')
+    if index is None:
+        index = CompletedItemIndex(stage_prefix)
+    else:
+        index.refresh()
+    
+    snapshot = {
+        'product_ids': sorted(index.completed_ids),
+        'latest_manifest_key': index.latest_manifest_key,
+        'created_at': time.time()
+    }
+    snapshot_key = f"{stage_prefix}/{COMPLETED_INDEX_SNAPSHOT}"
+    put_compressed(snapshot_key, encode_json(snapshot), 'application/json')
+    print(f"Saved completed index ({len(index)} products) to s3://flex-ai/{snapshot_key}")
+    return snapshot_key
+
+
+# =============================================================================
+# STAGE 2: EXTRACTION (Queue-Based)
+# =============================================================================
+
+@app.function(
+    image=image,
+    secrets=[
+        modal.Secret.from_name("aws-s3-credentials"),
+        modal.Secret.from_name("firecrawl-api-key")
+    ],
+    timeout=86400,  # 24 hours - maximum Modal allows
+    memory=2048,    # 2GB memory for extraction processing
+    max_containers=50
+)
+def extraction_worker(execution_id: str, environment: str = "dev"):
+    """
+    Extraction worker - processes URLs from extraction queue using references
     """
     from firecrawl import FirecrawlApp
     import os
@@ -1714,8 +2369,18 @@ def extraction_worker(execution_id: str, environment: str = "dev"):
     
     print(f"EXTRACTION WORKER STARTED - {execution_id}")
     worker_id = str(uuid.uuid4())[:8]
+    checkpoint_writer = None
+    dead_letter_writer = None
+    ledger = StageLedger(execution_id, 'extraction', worker_id)
+    handoff_ledger = StageLedger(execution_id, 'categorization', worker_id)
     
     try:
+        # Results are buffered into checkpoint segments instead of one object per product
+        stage_prefix = f"{environment}/{execution_id}/extraction"
+        checkpoint_writer = CheckpointSegmentWriter(stage_prefix, f"extraction-{worker_id}")
+        dead_letter_writer = CheckpointSegmentWriter(f"{environment}/{execution_id}/{DEAD_LETTER_FOLDER}", f"extraction-{worker_id}")
+        completed_ids = CompletedItemIndex(stage_prefix)
+        
         # Initialize Firecrawl
         firecrawl = FirecrawlApp(api_key=os.environ.get("FIRECRAWL_API_KEY"))
         
@@ -1734,31 +2399,35 @@ def extraction_worker(execution_id: str, environment: str = "dev"):
         
         queue_name = f"extraction-{execution_id}"
         processed_count = 0
+        scrape_latency = LatencyTracker()
         
         while True:
+            # Surplus workers leave between items when the autoscaler shrinks the pool
+            if ledger.retired():
+                print(f"[{worker_id}] Extraction worker retired by the autoscaler - processed {processed_count} products")
+                break
+            
+            work_items = []
             try:
-                # Get work item reference from queue with timeout - now handled in queue_helper
-                work_item = queue_helper(queue_name, "get", timeout=60)
+                # Block briefly for work; in between, the ledger decides whether the stage is done
+                work_item = queue_helper(queue_name, "get", timeout=LEDGER_POLL_SECONDS)
                 
                 # Safety check for None work_item
                 if work_item is None:
                     raise Exception("Empty")
-                    
+                work_items = [work_item]
+                taken_at = ledger.accounted()
+                
                 product_id = work_item['product_id']
                 
                 print(f"   [{worker_id}] Processing: {product_id}")
-                empty_checks = 0  # Reset counter when we get work
                 
                 # Check if already processed (checkpoint)
-                output_path = f"{environment}/{execution_id}/extraction/{product_id}.json"
-                try:
-                    # Try to download existing result - if exists, skip
-                    existing_result = download_product_from_s3(output_path)
+                if product_id in completed_ids:
                     print(f"   SKIPPING {product_id} - already extracted")
+                    ledger.record('completed')
                     queue_helper(queue_name, "task_done")
                     continue
-                except:
-                    pass  # Not processed yet
                 
                 # Get product data directly from queue (no S3 download needed)
                 url = work_item['url']
@@ -1771,10 +2440,14 @@ def extraction_worker(execution_id: str, environment: str = "dev"):
                     'execution_id': execution_id
                 }
                 
-                # Extract product data using Firecrawl
+                # Extract product data using Firecrawl - transient errors are retried in place,
+                # and a scrape that hangs gets a duplicate and then a deadline
                 try:
-                    result = firecrawl.scrape_url(
+                    result = call_with_deadline(
+                        call_with_retries,
+                        firecrawl.scrape_url,
                         url,
+                        tracker=scrape_latency,
                         formats=['extract'],
                         extract={'schema': schema}
                     )
@@ -1805,8 +2478,14 @@ def extraction_worker(execution_id: str, environment: str = "dev"):
                             'extraction_timestamp': time.time()
                         }
                         print(f"   [{worker_id}] No data extracted for {product_id}")
-                        
+                
                 except Exception as extract_error:
+                    if set_aside_for_retry('extraction', execution_id, work_item, extract_error):
+                        print(f"   [{worker_id}] Extraction error: {extract_error} - {product_id} set aside for the second pass")
+                        ledger.record('deferred')
+                        queue_helper(queue_name, "task_done")
+                        continue
+                    
                     extracted_product = {
                         **discovery_data,
                         'name': 'Error',
@@ -1815,44 +2494,65 @@ def extraction_worker(execution_id: str, environment: str = "dev"):
                         'status': 'error',
                         'extraction_worker_id': worker_id,
                         'extraction_timestamp': time.time(),
-                        'error_details': str(extract_error)
+                        'error_details': str(extract_error),
+                        'error_class': type(extract_error).__name__
                     }
+                    dead_letter_writer.add(
+                        f"extraction_{product_id}",
+                        dead_letter_record('extraction', product_id, discovery_data, extract_error, work_item)
+                    )
                     print(f"   [{worker_id}] Extraction error: {extract_error}")
                 
-                # Save extracted product to S3 immediately (checkpoint)
-                upload_product_to_s3(extracted_product, output_path)
-                print(f"   [{worker_id}] CHECKPOINTED: {output_path}")
+                # Buffer extracted product into the current checkpoint segment
+                checkpoint_writer.add(product_id, extracted_product)
+                completed_ids.add(product_id)
                 
                 # Queue for next stage (categorization) - only if successful
                 if extracted_product['status'] == 'success':
                     queue_helper(f"categorization-{execution_id}", "put", {
                         'product_id': product_id,
-                        's3_path': output_path,
+                        'product_data': extracted_product,
                         'stage': 'categorization',
                         'execution_id': execution_id
                     })
+                    handoff_ledger.record('enqueued')
                     print(f"   [{worker_id}] Queued {product_id} for categorization")
                 else:
                     print(f"   [{worker_id}] Skipping {product_id} for categorization - extraction failed")
                 
+                ledger.record_rate_limited()
+                ledger.record('completed' if extracted_product['status'] == 'success' else 'failed')
                 processed_count += 1
                 queue_helper(queue_name, "task_done")
-                
+            
             except Exception as queue_error:
                 if "Empty" in str(queue_error):
-                    print(f"[{worker_id}] Extraction worker finished - processed {processed_count} products")
-                    break
+                    handoff_ledger.publish()
+                    if ledger.is_drained():
+                        print(f"[{worker_id}] Extraction input drained - worker finished - processed {processed_count} products, "
+                          f"{scrape_latency.hedged} after a duplicate scrape")
+                        break
+                    continue
                 elif "ClientClosed" in str(queue_error):
                     print(f"[{worker_id}] Connection closed - extraction worker finished gracefully - processed {processed_count} products")
                     break
                 else:
                     print(f"   [{worker_id}] Queue error: {queue_error}")
+                    if work_items:
+                        ledger.record('failed', len(work_items) - (ledger.accounted() - taken_at))
                     queue_helper(queue_name, "task_done")
                     continue
-                    
+    
     except Exception as e:
         print(f"[{worker_id}] Extraction worker failed: {e}")
         return {'status': 'failed', 'error': str(e), 'worker_id': worker_id}
+    finally:
+        if checkpoint_writer:
+            checkpoint_writer.close()
+        if dead_letter_writer:
+            dead_letter_writer.close()
+        ledger.publish()
+        handoff_ledger.publish()
     
     return {'status': 'success', 'processed_count': processed_count, 'worker_id': worker_id}
 
@@ -1877,10 +2577,7 @@ def extraction_stage(
     Returns:
         Dict with extraction results
     """
-    import boto3
     import pandas as pd
-    from io import StringIO
-    import json
     import time
     from modal import Queue
     
@@ -1891,34 +2588,37 @@ def extraction_stage(
     
     try:
         # Read discovery results CSV
-        s3_client = boto3.client('s3')
+        storage = get_storage_backend()
         discovery_key = f"{environment}/{execution_id}/discovery/discovered_urls.csv"
         
-        response = s3_client.get_object(Bucket='flex-ai', Key=discovery_key)
-        discovery_df = pd.read_csv(StringIO(response['Body'].read().decode('utf-8')))
+        body = storage.get(discovery_key)
+        discovery_df = read_csv_payload(body)
         
         queue_size = len(discovery_df)
         print(f"Found {queue_size} URLs to extract")
         
-        # Calculate optimal worker count dynamically
+        # Starting worker count - QueueAutoscaler adjusts it while the stage runs
         worker_config = calculate_optimal_workers(queue_size, 'extraction')
         worker_count = worker_config['worker_count']
         
         print(f"DYNAMIC WORKER CALCULATION:")
         print(f"   Queue Size: {queue_size}")
-        print(f"   Optimal Workers: {worker_count}")
+        print(f"   Starting Workers: {worker_count}")
         print(f"   Products per Worker: ~{worker_config['products_per_worker']}")
         print(f"   Estimated Time: {worker_config['estimated_time_minutes']} minutes")
         print(f"   Reasoning: {worker_config['reasoning']}")
-        print(f"   Stage: {worker_config['stage_description']}")
         
         # Single-threaded bulk queueing (avoid contention issues)
         print("Queueing products for extraction using bulk operations...")
         
         # Build all queue items at once
         all_queue_items = []
-        for i, (_, row) in enumerate(discovery_df.iterrows()):
-            product_id = f"product_{i:06d}"
+        queued_ids = set()
+        for _, row in discovery_df.iterrows():
+            product_id = product_id_for_url(row['url'])
+            if product_id in queued_ids:
+                continue  # Same product reached through a different link
+            queued_ids.add(product_id)
             
             queue_item = {
                 'product_id': product_id,
@@ -1936,6 +2636,11 @@ def extraction_stage(
         from modal import Queue
         extraction_queue = Queue.from_name(f"extraction-{execution_id}", create_if_missing=True)
         
+        # Count everything up front - workers only stop once the ledger accounts for it all
+        extraction_ledger = StageLedger(execution_id, 'extraction')
+        extraction_ledger.record('enqueued', len(all_queue_items))
+        extraction_ledger.publish()
+        
         # Queue first 1000 items quickly to get workers started
         initial_batch_size = min(1000, len(all_queue_items))
         print(f"Queueing first {initial_batch_size} products to start workers...")
@@ -1974,19 +2679,37 @@ def extraction_stage(
                 import time
                 time.sleep(0.1)
         
-        # Start next stages IMMEDIATELY with balanced parallelism
-        print("Starting 30 categorization workers immediately to process results as they come in...")
+        extraction_ledger.close_input()
+        
+        # Start next stages IMMEDIATELY, sized for the same item count - their
+        # autoscalers follow the products as extraction hands them over
+        categorization_count = calculate_optimal_workers(queue_size, 'categorization')['worker_count']
+        print(f"Starting {categorization_count} categorization workers immediately to process results as they come in...")
         categorization_workers = []
-        for i in range(30):  # Balanced worker count
+        for i in range(categorization_count):
             cat_worker = categorization_worker.spawn(execution_id, environment)
             categorization_workers.append(cat_worker)
         
-        print("Starting 30 classification workers immediately for full 3-stage overlap...")
+        classification_count = calculate_optimal_workers(queue_size, 'classification')['worker_count']
+        print(f"Starting {classification_count} classification workers immediately for full 3-stage overlap...")
         classification_workers = []
-        for i in range(30):  # Balanced worker count
+        for i in range(classification_count):
             class_worker = classification_worker.spawn(execution_id, environment)
             classification_workers.append(class_worker)
-            
+        
+        extraction_scaler = QueueAutoscaler(
+            'extraction', execution_id,
+            lambda: extraction_worker.spawn(execution_id, environment), workers
+        )
+        categorization_scaler = QueueAutoscaler(
+            'categorization', execution_id,
+            lambda: categorization_worker.spawn(execution_id, environment), categorization_workers
+        )
+        classification_scaler = QueueAutoscaler(
+            'classification', execution_id,
+            lambda: classification_worker.spawn(execution_id, environment), classification_workers
+        )
+        
         print("All 3 stages now running in parallel from the start!")
         print("Pipeline flow: Products → Extract → Categorize → Classify (all simultaneous)")
         
@@ -1997,44 +2720,34 @@ def extraction_stage(
         # Monitor progress and wait for extraction workers to complete
         print("Waiting for extraction workers to complete...")
         
-        # Wait for all extraction worker handles to complete
-        for worker in workers:
-            worker.get()  # This blocks until the worker completes
+        # Wait for all extraction worker handles to complete, autoscaling all three stages
+        autoscale_until_done(extraction_scaler, categorization_scaler, classification_scaler)
         
-        print("All extraction workers completed! Signaling categorization workers to finish...")
+        # Retry transient extraction failures while the downstream workers are still running
+        run_second_pass('extraction', execution_id, lambda: extraction_worker.spawn(execution_id, environment),
+                        categorization_scaler, classification_scaler)
+        
+        print("All extraction workers completed! Closing categorization input...")
+        
+        # Categorization workers finish once everything extraction handed over is accounted for
+        StageLedger(execution_id, 'categorization').close_input()
         
-        # Signal categorization workers that extraction is complete
-        categorization_queue_name = f"categorization-{execution_id}"
-        for i in range(30):  # Send COMPLETE signal to all 30 categorization workers
-            queue_helper(categorization_queue_name, "put", {
-                'product_id': 'EXTRACTION_COMPLETE',
-                'stage': 'categorization', 
-                'execution_id': execution_id,
-                'signal': 'EXTRACTION_COMPLETE'
-            })
-            
         # Wait for categorization workers to complete
         print("Waiting for categorization workers to complete...")
-        for worker in categorization_workers:
-            worker.get()
+        autoscale_until_done(categorization_scaler, classification_scaler)
+        run_second_pass('categorization', execution_id, lambda: categorization_worker.spawn(execution_id, environment),
+                        classification_scaler)
         
-        print("All categorization workers completed! Signaling classification workers to finish...")
+        print("All categorization workers completed! Closing classification input...")
         
-        # Signal classification workers that categorization is complete
-        classification_queue_name = f"classification-{execution_id}"
-        for i in range(30):  # Send COMPLETE signal to all 30 classification workers
-            queue_helper(classification_queue_name, "put", {
-                'product_id': 'CATEGORIZATION_COMPLETE',
-                'stage': 'classification',
-                'execution_id': execution_id,
-                'signal': 'CATEGORIZATION_COMPLETE'
-            })
+        # Classification workers finish once everything categorization handed over is accounted for
+        StageLedger(execution_id, 'classification').close_input()
         
         # Wait for classification workers to complete
         print("Waiting for classification workers to complete...")
-        for worker in classification_workers:
-            worker.get()
-            
+        autoscale_until_done(classification_scaler)
+        run_second_pass('classification', execution_id, lambda: classification_worker.spawn(execution_id, environment))
+        
         print("All workers completed! Creating consolidated CSV files...")
         
         # Create consolidated CSV files using the dedicated function
@@ -2056,39 +2769,16 @@ def extraction_stage(
         # Collect results and create summary CSV
         print("Collecting extraction results...")
         
-        extraction_prefix = f"{environment}/{execution_id}/extraction/"
-        response = s3_client.list_objects_v2(
-            Bucket='flex-ai',
-            Prefix=extraction_prefix
-        )
-        
-        extracted_products = []
-        successful_extractions = 0
-        
-        if 'Contents' in response:
-            print(f"Found {len(response['Contents'])} extraction results")
-            for obj in response['Contents']:
-                try:
-                    product_data = download_product_from_s3(obj['Key'])
-                    extracted_products.append(product_data)
-                    if product_data.get('status') == 'success':
-                        successful_extractions += 1
-                except Exception as e:
-                    print(f"Error reading {obj['Key']}: {e}")
+        extracted_products = load_stage_checkpoints(f"{environment}/{execution_id}/extraction")
+        successful_extractions = sum(1 for product in extracted_products if product.get('status') == 'success')
+        print(f"Found {len(extracted_products)} extraction results")
         
         # Save consolidated CSV
         if extracted_products:
             extraction_df = pd.DataFrame(extracted_products)  
             extraction_key = f"{environment}/{execution_id}/extraction/extracted_products.csv"
             
-            csv_buffer = StringIO()
-            extraction_df.to_csv(csv_buffer, index=False)
-            s3_client.put_object(
-                Bucket='flex-ai',
-                Key=extraction_key,
-                Body=csv_buffer.getvalue(),
-                ContentType='text/csv'
-            )
+            upload_csv(extraction_df, extraction_key)
             
             actual_time_minutes = int((time.time() - start_time) / 60)
             
@@ -2098,7 +2788,7 @@ def extraction_stage(
             print(f"   Estimated Time: {worker_config['estimated_time_minutes']} minutes")
             print(f"   Actual Time: {actual_time_minutes} minutes")
             print(f"   Accuracy: {'+' if actual_time_minutes <= worker_config['estimated_time_minutes'] else '-'}")
-            print(f"   Workers Used: {worker_count}")
+            print(f"   Workers Used: {len(workers)}")
             print(f"   Throughput: {len(extracted_products) / max(1, actual_time_minutes)} products/minute")
         
         return {
@@ -2112,7 +2802,7 @@ def extraction_stage(
             'worker_config': worker_config,
             'actual_time_minutes': int((time.time() - start_time) / 60) if 'start_time' in locals() else None
         }
-        
+    
     except Exception as e:
         print(f"Extraction failed: {e}")
         return {
@@ -2125,6 +2815,202 @@ def extraction_stage(
 # STAGE 3: CATEGORIZATION (Queue-Based)
 # =============================================================================
 
+# Products packed into one categorization request, so the ~27KB category list
+# is paid for once per group instead of once per product. 1 sends every
+# product on its own, as before.
+CATEGORIZATION_BATCH_SIZE = max(1, int(os.environ.get('CATEGORIZATION_BATCH_SIZE', '10')))
+
+# Estimated product-text tokens per packed request - long descriptions make smaller groups
+CATEGORIZATION_BATCH_TOKENS = int(os.environ.get('CATEGORIZATION_BATCH_TOKENS', '8000'))
+
+# Reply tokens allowed per product in a packed request
+CATEGORIZATION_REPLY_TOKENS = 400
+
+CATEGORIZATION_SYSTEM_PROMPT = "You are a product categorization expert for HSA/FSA eligibility."
+
+def categorization_product_fields(extraction_data: dict) -> dict:
+    """The product fields the categorization prompt shows, as text"""
+    return {
+        'name': str(extraction_data.get('name', '')),
+        'description': str(extraction_data.get('description', '')),
+        'brand': str(extraction_data.get('brand', '')),
+        'features': str(extraction_data.get('features', ''))
+    }
+
+def pack_categorization_groups(pending: list, max_products: int = None, max_tokens: int = None) -> list:
+    """
+    Split pending (product_id, extraction_data, ...) tuples into request groups
+    
+    A group closes at max_products or once its product text would pass
+    max_tokens (4 characters per token); a product over the budget on its own
+    gets a group to itself.
+    """
+    max_products = max_products or CATEGORIZATION_BATCH_SIZE
+    max_tokens = max_tokens or CATEGORIZATION_BATCH_TOKENS
+    groups = []
+    group = []
+    group_tokens = 0
+    for item in pending:
+        tokens = sum(len(text) for text in categorization_product_fields(item[1]).values()) // 4
+        if group and (len(group) >= max_products or group_tokens + tokens > max_tokens):
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(item)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+def build_packed_categorization_prompt(categories_text: str, valid_categories: str, products: list) -> str:
+    """
+    One prompt for several (product_id, extraction_data) pairs
+    
+    The category list comes first so every packed request starts with the
+    same prefix, which OpenAI's prompt caching also discounts.
+    """
+    import json
+    
+    products_json = json.dumps(
+        [{'product_id': product_id, **categorization_product_fields(extraction_data)} for product_id, extraction_data in products],
+        ensure_ascii=False, indent=1
+    )
+    return f"""Available Categories:
+{categories_text}
+
+CRITICAL CONSTRAINT: You must ONLY use category names from this exact list. Do NOT create or invent new categories.
+
+VALID CATEGORIES ONLY:
+["{valid_categories}"]
+
+Classify EACH of the {len(products)} products below into the most appropriate categories from the list above. For each product, select 1-3 categories ranked by relevance (primary = most relevant). Leave secondary/tertiary as empty strings "" when fewer categories fit. Judge every product on its own fields only.
+
+Products:
+{products_json}
+
+Respond with JSON containing exactly one result per product_id:
+{{
+    "results": [
+        {{
+            "product_id": "PRODUCT_ID_FROM_THE_LIST_ABOVE",
+            "primary_category": "MUST_BE_EXACT_MATCH_FROM_LIST_ABOVE",
+            "secondary_category": "SECOND_MOST_RELEVANT_OR_EMPTY_STRING",
+            "tertiary_category": "THIRD_MOST_RELEVANT_OR_EMPTY_STRING",
+            "reasoning": "Brief explanation of why these categories were chosen from the valid list",
+            "confidence": 85
+        }}
+    ]
+}}"""
+
+def strip_json_fence(response_content: str) -> str:
+    """A reply without the ```json fence the model sometimes wraps it in"""
+    if response_content.startswith('```json'):
+        return response_content.replace('```json', '').replace('```', '').strip()
+    return response_content
+
+def parse_packed_categorization(response_content: str, categories: dict) -> dict:
+    """
+    Valid entries of a packed reply by product_id
+    
+    An entry counts when its primary category, and any secondary or tertiary
+    one given, is in the category list. Malformed, missing and invalid
+    entries are simply left out - their products are sent again on their own.
+    """
+    import json
+    
+    try:
+        reply = json.loads(strip_json_fence(response_content))
+    except ValueError:
+        return {}
+    entries = reply.get('results') if isinstance(reply, dict) else reply
+    
+    valid = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict) or not entry.get('product_id'):
+            continue
+        chosen = [entry.get('primary_category')] + [entry.get(key) for key in ('secondary_category', 'tertiary_category') if entry.get(key)]
+        if all(isinstance(category, str) and category in categories for category in chosen):
+            valid[str(entry['product_id'])] = entry
+    return valid
+
+def categorization_reply_validator(categories: dict):
+    """Accepts a single-product categorization reply whose primary category is in the list"""
+    import json
+    
+    def validate(response_content: str) -> bool:
+        return json.loads(strip_json_fence(response_content)).get('primary_category') in categories
+    
+    return validate
+
+def packed_reply_validator(categories: dict, product_ids: list):
+    """Accepts a packed categorization reply with a valid entry for every product in its group"""
+    def validate(response_content: str) -> bool:
+        entries = parse_packed_categorization(response_content, categories)
+        return all(str(product_id) in entries for product_id in product_ids)
+    
+    return validate
+
+def categorize_packed(llm, pending: list, categories: dict, categories_text: str, valid_categories: str, worker_id: str, use_cache: bool = True) -> list:
+    """
+    Categorize pending (product_id, extraction_data, single_request, work_item)
+    tuples with packed requests
+    
+    Returns one reply per product in pending order, in the shape of a
+    single-product reply (JSON text) or the exception its request raised.
+    Products whose packed entry is missing or invalid fall back to their
+    single-product request, sent past the response cache; a packed request
+    that fails outright fails its products, so an outage doesn't multiply
+    into single calls.
+    """
+    import json
+    
+    single_validate = categorization_reply_validator(categories)
+    groups = pack_categorization_groups(pending)
+    requests = []
+    validators = []
+    for group in groups:
+        if len(group) == 1:
+            requests.append(group[0][2])
+            validators.append(single_validate)
+            continue
+        validators.append(packed_reply_validator(categories, [product_id for product_id, _, _, _ in group]))
+        prompt = build_packed_categorization_prompt(
+            categories_text, valid_categories, [(product_id, extraction_data) for product_id, extraction_data, _, _ in group]
+        )
+        requests.append({
+            'model': "gpt-4o-mini",
+            'messages': [
+                {"role": "system", "content": CATEGORIZATION_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            'temperature': 0,
+            'max_tokens': min(16000, CATEGORIZATION_REPLY_TOKENS * len(group)),
+            'response_format': {"type": "json_object"}
+        })
+    
+    replies = {}
+    fallback = []
+    for group, response_content in zip(groups, llm.complete(requests, validators, use_cache=use_cache)):
+        if len(group) == 1 or isinstance(response_content, Exception):
+            for product_id, _, _, _ in group:
+                replies[product_id] = response_content
+            continue
+        entries = parse_packed_categorization(response_content, categories)
+        for item in group:
+            entry = entries.get(str(item[0]))
+            if entry is None:
+                fallback.append(item)
+            else:
+                replies[item[0]] = json.dumps(entry)
+    
+    if fallback:
+        fallback_replies = llm.complete([item[2] for item in fallback], single_validate, use_cache=False)
+        for (product_id, _, _, _), response_content in zip(fallback, fallback_replies):
+            replies[product_id] = response_content
+    
+    print(f"   [{worker_id}] {len(pending)} products in {len(requests)} categorization requests, "
+          f"{len(fallback)} re-sent on their own")
+    return [replies[product_id] for product_id, _, _, _ in pending]
+
 @app.function(
     image=image,
     secrets=[
@@ -2133,13 +3019,17 @@ def extraction_stage(
     ],
     timeout=86400,  # 24 hours - maximum Modal allows
     memory=3072,    # 3GB memory for AI processing tasks
-    max_containers=50
+    max_containers=STAGE_SCALING['categorization'].max_workers
 )
 def categorization_worker(execution_id: str, environment: str = "dev"):
     """
     Categorization worker - processes products from categorization queue using references
+    
+    Takes up to LLM_CONCURRENCY requests' worth of queued products at a time
+    and categorizes them with concurrent OpenAI requests, each packing up to
+    CATEGORIZATION_BATCH_SIZE products; checkpoints and error records stay
+    per product.
     """
-    import openai
     import os
     import uuid
     import time
@@ -2147,201 +3037,233 @@ def categorization_worker(execution_id: str, environment: str = "dev"):
     
     print(f"CATEGORIZATION WORKER STARTED - {execution_id}")
     worker_id = str(uuid.uuid4())[:8]
+    checkpoint_writer = None
+    error_writer = None
+    dead_letter_writer = None
+    llm = None
+    ledger = StageLedger(execution_id, 'categorization', worker_id)
+    handoff_ledger = StageLedger(execution_id, 'classification', worker_id)
     
     try:
+        stage_prefix = f"{environment}/{execution_id}/categorization"
+        checkpoint_writer = CheckpointSegmentWriter(stage_prefix, f"categorization-{worker_id}")
+        error_writer = CheckpointSegmentWriter(f"{environment}/{execution_id}/error", f"categorization-{worker_id}")
+        dead_letter_writer = CheckpointSegmentWriter(f"{environment}/{execution_id}/{DEAD_LETTER_FOLDER}", f"categorization-{worker_id}")
+        completed_ids = CompletedItemIndex(stage_prefix)
+        
         # Load categories and categorization prompt template
         with open('/prompts/flex_product_categories.json', 'r') as f:
             categories_data = json.load(f)
             categories = {cat['name']: cat for cat in categories_data['categories']}
-            
+        
         with open('/prompts/categorization_prompt.txt', 'r') as f:
             categorization_prompt_template = f.read()
-            
+        
         print(f"   [{worker_id}] Loaded {len(categories)} categories and prompt template")
         
-        # Initialize OpenAI
-        client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        # The category list is the bulk of every prompt - built once per worker
+        categories_text = ""
+        for cat_name, cat_data in categories.items():
+            categories_text += f"\n- {cat_name}: {cat_data['description']}\n  Keywords: {', '.join(cat_data['keywords'])}\n"
+        
+        # Create a list of valid category names for the prompt
+        valid_categories = '", "'.join(categories)
+        
+        # Initialize OpenAI - the async runner keeps up to LLM_CONCURRENCY requests in flight
+        llm = ChatCompletionRunner(api_key=os.environ.get("OPENAI_API_KEY"))
         
         queue_name = f"categorization-{execution_id}"
         processed_count = 0
-        empty_checks = 0
         
         while True:
+            # Surplus workers leave between items when the autoscaler shrinks the pool
+            if ledger.retired():
+                print(f"[{worker_id}] Categorization worker retired by the autoscaler - processed {processed_count} products")
+                break
+            
+            work_items = []
             try:
-                # Get work item reference from queue with timeout - now handled in queue_helper
-                work_item = queue_helper(queue_name, "get", timeout=60)
+                # Block briefly for work; in between, the ledger decides whether the stage is done
+                work_item = queue_helper(queue_name, "get", timeout=LEDGER_POLL_SECONDS)
                 
                 # Safety check for None work_item
                 if work_item is None:
                     raise Exception("Empty")
-                    
-                product_id = work_item['product_id']
                 
-                # Check for completion signal
-                if product_id == 'EXTRACTION_COMPLETE':
-                    print(f"[{worker_id}] Received EXTRACTION_COMPLETE signal - categorization worker finished - processed {processed_count} products")
-                    break
-                
-                print(f"   [{worker_id}] Processing: {product_id}")
-                empty_checks = 0  # Reset counter when we get work
-                
-                # Check if already processed (checkpoint)
-                output_path = f"{environment}/{execution_id}/categorization/{product_id}.json"
-                try:
-                    existing_result = download_product_from_s3(output_path)
-                    print(f"   SKIPPING {product_id} - already categorized")
-                    queue_helper(queue_name, "task_done")
-                    continue
-                except:
-                    pass  # Not processed yet
-                
-                # Download product data from S3
-                extraction_data = download_product_from_s3(work_item['s3_path'])
-                
-                # Create categorization prompt using loaded template and categories
-                categories_text = ""
-                category_names = []
-                for cat_name, cat_data in categories.items():
-                    categories_text += f"\n- {cat_name}: {cat_data['description']}\n  Keywords: {', '.join(cat_data['keywords'])}\n"
-                    category_names.append(cat_name)
-                
-                # Create a list of valid category names for the prompt
-                valid_categories = '", "'.join(category_names)
-                
-                # Use the loaded prompt template and substitute variables
-                prompt = categorization_prompt_template.replace(
-                    "{{PRODUCT_NAME}}", str(extraction_data.get('name', ''))
-                ).replace(
-                    "{{PRODUCT_DESCRIPTION}}", str(extraction_data.get('description', ''))
-                ).replace(
-                    "{{PRODUCT_BRAND}}", str(extraction_data.get('brand', ''))
-                ).replace(
-                    "{{PRODUCT_FEATURES}}", str(extraction_data.get('features', ''))
-                ).replace(
-                    "{{CATEGORIES_LIST}}", categories_text
-                ).replace(
-                    "{{VALID_CATEGORY_NAMES}}", valid_categories
+                # Take whatever else is already queued so the products are categorized concurrently
+                work_items = [work_item] + queue_helper(
+                    queue_name, "get_many", max_items=llm.concurrency * CATEGORIZATION_BATCH_SIZE - 1
                 )
+                taken_at = ledger.accounted()
                 
-                # Call OpenAI for categorization
-                try:
-                    response = client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=[
-                            {"role": "system", "content": "You are a product categorization expert for HSA/FSA eligibility."},
+                pending = []  # (product_id, extraction_data, request, work_item) awaiting OpenAI
+                pending_ids = set()
+                for work_item in work_items:
+                    product_id = work_item['product_id']
+                    
+                    print(f"   [{worker_id}] Processing: {product_id}")
+                    
+                    # Check if already processed (checkpoint)
+                    if product_id in completed_ids or product_id in pending_ids:
+                        print(f"   SKIPPING {product_id} - already categorized")
+                        ledger.record('completed')
+                        queue_helper(queue_name, "task_done")
+                        continue
+                    
+                    # Product data travels with the queue item; older items only reference S3
+                    extraction_data = work_item.get('product_data') or download_product_from_s3(work_item['s3_path'])
+                    
+                    # Single-product prompt from the loaded template - packed requests fall back to it
+                    fields = categorization_product_fields(extraction_data)
+                    prompt = categorization_prompt_template.replace(
+                        "{{PRODUCT_NAME}}", fields['name']
+                    ).replace(
+                        "{{PRODUCT_DESCRIPTION}}", fields['description']
+                    ).replace(
+                        "{{PRODUCT_BRAND}}", fields['brand']
+                    ).replace(
+                        "{{PRODUCT_FEATURES}}", fields['features']
+                    ).replace(
+                        "{{CATEGORIES_LIST}}", categories_text
+                    ).replace(
+                        "{{VALID_CATEGORY_NAMES}}", valid_categories
+                    )
+                    
+                    pending_ids.add(product_id)
+                    pending.append((product_id, extraction_data, {
+                        'model': "gpt-4o-mini",
+                        'messages': [
+                            {"role": "system", "content": CATEGORIZATION_SYSTEM_PROMPT},
                             {"role": "user", "content": prompt}
                         ],
-                        temperature=0,
-                        max_tokens=5000
+                        'temperature': 0,
+                        'max_tokens': 5000
+                    }, work_item))
+                
+                # Call OpenAI for the whole group at once - second-pass products are asked again, not replayed from cache
+                use_cache = not any(work_item.get('retry_pass') for _, _, _, work_item in pending)
+                if CATEGORIZATION_BATCH_SIZE > 1:
+                    responses = categorize_packed(llm, pending, categories, categories_text, valid_categories, worker_id, use_cache)
+                else:
+                    responses = llm.complete(
+                        [request for _, _, request, _ in pending], categorization_reply_validator(categories), use_cache=use_cache
                     )
+                ledger.record_llm_cache()
+                ledger.record_rate_limited()
+                
+                for (product_id, extraction_data, _, work_item), response_content in zip(pending, responses):
+                    try:
+                        if isinstance(response_content, Exception):
+                            raise response_content
+                        
+                        response_content = strip_json_fence(response_content)
+                        result = json.loads(response_content)
+                        predicted_category = result.get('primary_category', 'unknown')
+                        
+                        # Validate that the category is in our valid list
+                        if predicted_category not in categories:
+                            print(f"   [{worker_id}] INVALID CATEGORY: '{predicted_category}' not in valid categories")
+                            
+                            # Create error record for S3 error folder
+                            error_record = {
+                                'execution_id': execution_id,
+                                'stage': 'categorization',
+                                'error_type': 'invalid_category',
+                                'product_name': extraction_data.get('name', ''),
+                                'product_url': extraction_data.get('url', ''),
+                                'product_description': extraction_data.get('description', '')[:200],
+                                'invalid_category_attempted': predicted_category,
+                                'ai_raw_response': response_content,
+                                'timestamp': time.time(),
+                                'worker_id': worker_id,
+                                'error_message': f'AI returned invalid category: {predicted_category}',
+                                'action_needed': 'Either add category to flex_product_categories.json or improve prompt'
+                            }
+                            
+                            # Buffer error into the error folder's checkpoint segments
+                            error_writer.add(f"categorization_invalid_category_{product_id}", error_record)
+                            
+                            # Save error product
+                            categorized_product = {
+                                **extraction_data,
+                                'primary_category': 'INVALID_CATEGORY_ERROR',
+                                'invalid_category_attempted': predicted_category,
+                                'category_confidence': 0.0,
+                                'categorization_reasoning': f'AI returned invalid category: {predicted_category}',
+                                'hsa_fsa_likelihood': 'unknown',
+                                'status': 'invalid_category_error',
+                                'categorization_worker_id': worker_id,
+                                'categorization_timestamp': time.time(),
+                                'ai_raw_response': response_content
+                            }
+                        else:
+                            # Valid category - process normally
+                            categorized_product = {
+                                **extraction_data,
+                                'primary_category': predicted_category,
+                                'category_confidence': result.get('confidence', 0.0),
+                                'categorization_reasoning': result.get('reasoning', ''),
+                                'hsa_fsa_likelihood': result.get('hsa_fsa_likelihood', 'unknown'),
+                                'status': 'success',
+                                'categorization_worker_id': worker_id,
+                                'categorization_timestamp': time.time()
+                            }
+                            print(f"   [{worker_id}] {extraction_data.get('name', product_id)} -> {predicted_category}")
                     
-                    response_content = response.choices[0].message.content
-                    if response_content.startswith('```json'):
-                        response_content = response_content.replace('```json', '').replace('```', '').strip()
-                    
-                    result = json.loads(response_content)
-                    predicted_category = result.get('primary_category', 'unknown')
-                    
-                    # Validate that the category is in our valid list
-                    if predicted_category not in categories:
-                        print(f"   [{worker_id}] INVALID CATEGORY: '{predicted_category}' not in valid categories")
-                        
-                        # Create error record for S3 error folder
-                        error_record = {
-                            'execution_id': execution_id,
-                            'stage': 'categorization',
-                            'error_type': 'invalid_category',
-                            'product_name': extraction_data.get('name', ''),
-                            'product_url': extraction_data.get('url', ''),
-                            'product_description': extraction_data.get('description', '')[:200],
-                            'invalid_category_attempted': predicted_category,
-                            'ai_raw_response': response_content,
-                            'timestamp': time.time(),
-                            'worker_id': worker_id,
-                            'error_message': f'AI returned invalid category: {predicted_category}',
-                            'action_needed': 'Either add category to flex_product_categories.json or improve prompt'
-                        }
-                        
-                        # Save error to S3 error folder
-                        import boto3
-                        s3_client = boto3.client('s3')
-                        error_key = f"{environment}/{execution_id}/error/categorization_invalid_category_{product_id}.json"
-                        s3_client.put_object(
-                            Bucket='flex-ai',
-                            Key=error_key,
-                            Body=json.dumps(error_record, indent=2),
-                            ContentType='application/json'
-                        )
-                        print(f"   [{worker_id}] Error saved to s3://flex-ai/{error_key}")
+                    except Exception as openai_error:
+                        if set_aside_for_retry('categorization', execution_id, work_item, openai_error):
+                            print(f"   [{worker_id}] OpenAI error: {openai_error} - {product_id} set aside for the second pass")
+                            ledger.record('deferred')
+                            queue_helper(queue_name, "task_done")
+                            continue
                         
-                        # Save error product
+                        print(f"   [{worker_id}] OpenAI error: {openai_error}")
                         categorized_product = {
                             **extraction_data,
-                            'primary_category': 'INVALID_CATEGORY_ERROR',
-                            'invalid_category_attempted': predicted_category,
+                            'primary_category': 'error',
                             'category_confidence': 0.0,
-                            'categorization_reasoning': f'AI returned invalid category: {predicted_category}',
+                            'categorization_reasoning': f'OpenAI error: {str(openai_error)}',
                             'hsa_fsa_likelihood': 'unknown',
-                            'status': 'invalid_category_error',
+                            'status': 'error',
                             'categorization_worker_id': worker_id,
                             'categorization_timestamp': time.time(),
-                            'ai_raw_response': response_content
+                            'error_details': str(openai_error),
+                            'error_class': type(openai_error).__name__
                         }
+                        dead_letter_writer.add(
+                            f"categorization_{product_id}",
+                            dead_letter_record('categorization', product_id, extraction_data, openai_error, work_item)
+                        )
+                    
+                    # Buffer categorized product into the current checkpoint segment
+                    checkpoint_writer.add(product_id, categorized_product)
+                    completed_ids.add(product_id)
+                    
+                    # Queue for next stage (classification) - only if successful
+                    if categorized_product.get('status') == 'success':
+                        queue_helper(f"classification-{execution_id}", "put", {
+                            'product_id': product_id,
+                            'product_data': categorized_product,
+                            'stage': 'classification',
+                            'execution_id': execution_id
+                        })
+                        handoff_ledger.record('enqueued')
+                        print(f"   [{worker_id}] Queued {product_id} for classification")
                     else:
-                        # Valid category - process normally
-                        categorized_product = {
-                            **extraction_data,
-                            'primary_category': predicted_category,
-                            'category_confidence': result.get('confidence', 0.0),
-                            'categorization_reasoning': result.get('reasoning', ''),
-                            'hsa_fsa_likelihood': result.get('hsa_fsa_likelihood', 'unknown'),
-                            'status': 'success',
-                            'categorization_worker_id': worker_id,
-                            'categorization_timestamp': time.time()
-                        }
-                        print(f"   [{worker_id}] {extraction_data.get('name', product_id)} -> {predicted_category}")
-                    
-                except Exception as openai_error:
-                    print(f"   [{worker_id}] OpenAI error: {openai_error}")
-                    categorized_product = {
-                        **extraction_data,
-                        'primary_category': 'error',
-                        'category_confidence': 0.0,
-                        'categorization_reasoning': f'OpenAI error: {str(openai_error)}',
-                        'hsa_fsa_likelihood': 'unknown',
-                        'status': 'error',
-                        'categorization_worker_id': worker_id,
-                        'categorization_timestamp': time.time(),
-                        'error_details': str(openai_error)
-                    }
-                
-                # Save categorized product to S3 immediately (checkpoint)
-                upload_product_to_s3(categorized_product, output_path)
-                print(f"   [{worker_id}] CHECKPOINTED: {output_path}")
-                
-                # Queue for next stage (classification) - only if successful
-                if categorized_product.get('status') == 'success':
-                    queue_helper(f"classification-{execution_id}", "put", {
-                        'product_id': product_id,
-                        's3_path': output_path,
-                        'stage': 'classification',
-                        'execution_id': execution_id
-                    })
-                    print(f"   [{worker_id}] Queued {product_id} for classification")
-                else:
-                    print(f"   [{worker_id}] Skipping {product_id} for classification - categorization failed")
-                
-                processed_count += 1
-                queue_helper(queue_name, "task_done")
-                
+                        print(f"   [{worker_id}] Skipping {product_id} for classification - categorization failed")
+                    
+                    ledger.record('completed' if categorized_product.get('status') == 'success' else 'failed')
+                    processed_count += 1
+                    queue_helper(queue_name, "task_done")
+            
             except Exception as queue_error:
                 if "Empty" in str(queue_error):
-                    print(f"   [{worker_id}] Queue empty, waiting for more work...")
-                    import time
-                    time.sleep(2)  # Shorter wait
-                    empty_checks += 1
-                    if empty_checks >= 5:  # 10 seconds of empty queue = done
-                        print(f"[{worker_id}] Queue empty for 10+ seconds, assuming work complete - processed {processed_count} products")
+                    checkpoint_writer.flush_if_due()
+                    error_writer.flush_if_due()
+                    dead_letter_writer.flush_if_due()
+                    handoff_ledger.publish()
+                    if ledger.is_drained():
+                        print(f"[{worker_id}] Categorization input drained - worker finished - processed {processed_count} products")
                         break
                     continue
                 elif "ClientClosed" in str(queue_error):
@@ -2349,12 +3271,25 @@ def categorization_worker(execution_id: str, environment: str = "dev"):
                     break
                 else:
                     print(f"   [{worker_id}] Queue error: {queue_error}")
+                    if work_items:
+                        ledger.record('failed', len(work_items) - (ledger.accounted() - taken_at))
                     queue_helper(queue_name, "task_done")
                     continue
-                    
+    
     except Exception as e:
         print(f"[{worker_id}] Categorization worker failed: {e}")
         return {'status': 'failed', 'error': str(e), 'worker_id': worker_id}
+    finally:
+        if checkpoint_writer:
+            checkpoint_writer.close()
+        if error_writer:
+            error_writer.close()
+        if dead_letter_writer:
+            dead_letter_writer.close()
+        if llm:
+            llm.close()
+        ledger.publish()
+        handoff_ledger.publish()
     
     return {'status': 'success', 'processed_count': processed_count, 'worker_id': worker_id}
 
@@ -2394,6 +3329,20 @@ def categorization_stage(
 # STAGE 4: CLASSIFICATION
 # =============================================================================
 
+def parse_classification_reply(response_content: str) -> dict:
+    """The JSON object of a classification reply, which usually comes in a ```json block"""
+    import json
+
+    if '```json' in response_content:
+        json_start = response_content.find('```json') + 7
+        json_end = response_content.find('```', json_start)
+        return json.loads(response_content[json_start:json_end].strip())
+    return json.loads(response_content.strip())
+
+def valid_classification_reply(response_content: str) -> bool:
+    """Accepts a classification reply that parses and carries an eligibility status"""
+    return bool(parse_classification_reply(response_content).get('eligibilityStatus'))
+
 @app.function(
     image=image,
     secrets=[
@@ -2402,13 +3351,15 @@ def categorization_stage(
     ],
     timeout=86400,  # 24 hours - maximum Modal allows
     memory=3072,    # 3GB memory for AI processing tasks
-    max_containers=50
+    max_containers=STAGE_SCALING['classification'].max_workers
 )
 def classification_worker(execution_id: str, environment: str = "dev"):
     """
     Classification worker - processes products from classification queue using references
+    
+    Up to LLM_CONCURRENCY queued products are classified together, each with its
+    own OpenAI request in flight; results are still checkpointed one by one.
     """
-    import openai
     import os
     import uuid
     import time
@@ -2416,8 +3367,17 @@ def classification_worker(execution_id: str, environment: str = "dev"):
     
     print(f"CLASSIFICATION WORKER STARTED - {execution_id}")
     worker_id = str(uuid.uuid4())[:8]
+    checkpoint_writer = None
+    dead_letter_writer = None
+    llm = None
+    ledger = StageLedger(execution_id, 'classification', worker_id)
     
     try:
+        stage_prefix = f"{environment}/{execution_id}/classification"
+        checkpoint_writer = CheckpointSegmentWriter(stage_prefix, f"classification-{worker_id}")
+        dead_letter_writer = CheckpointSegmentWriter(f"{environment}/{execution_id}/{DEAD_LETTER_FOLDER}", f"classification-{worker_id}")
+        completed_ids = CompletedItemIndex(stage_prefix)
+        
         # Load eligibility prompt template and category-specific guides
         with open('/prompts/feligibity.txt', 'r') as f:
             eligibility_prompt_template = f.read()
@@ -2426,109 +3386,117 @@ def classification_worker(execution_id: str, environment: str = "dev"):
             guides_data = json.load(f)
             # Create lookup dict by category name for easy access
             category_guides = {guide['category']: guide['items'] for guide in guides_data['guide']}
-            
+        
         print(f"   [{worker_id}] Loaded eligibility prompt template and category-specific guides for {len(category_guides)} categories")
         
-        # Initialize OpenAI
-        client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        # Initialize OpenAI - the async runner keeps up to LLM_CONCURRENCY requests in flight
+        llm = ChatCompletionRunner(api_key=os.environ.get("OPENAI_API_KEY"))
         
         queue_name = f"classification-{execution_id}"
         processed_count = 0
         
         while True:
+            # Surplus workers leave between items when the autoscaler shrinks the pool
+            if ledger.retired():
+                print(f"[{worker_id}] Classification worker retired by the autoscaler - processed {processed_count} products")
+                break
+            
+            work_items = []
             try:
-                # Get work item reference from queue with timeout - now handled in queue_helper
-                work_item = queue_helper(queue_name, "get", timeout=60)
+                # Block briefly for work; in between, the ledger decides whether the stage is done
+                work_item = queue_helper(queue_name, "get", timeout=LEDGER_POLL_SECONDS)
                 
                 # Safety check for None work_item
                 if work_item is None:
                     raise Exception("Empty")
-                    
-                product_id = work_item['product_id']
-                
-                # Check for completion signal
-                if product_id == 'CATEGORIZATION_COMPLETE':
-                    print(f"[{worker_id}] Received CATEGORIZATION_COMPLETE signal - classification worker finished - processed {processed_count} products")
-                    break
                 
-                print(f"   [{worker_id}] Processing: {product_id}")
-                empty_checks = 0  # Reset counter when we get work
+                # Take whatever else is already queued so the products are classified concurrently
+                work_items = [work_item] + queue_helper(queue_name, "get_many", max_items=llm.concurrency - 1)
+                taken_at = ledger.accounted()
                 
-                # Check if already processed (checkpoint)
-                output_path = f"{environment}/{execution_id}/classification/{product_id}.json"
-                try:
-                    existing_result = download_product_from_s3(output_path)
-                    print(f"   SKIPPING {product_id} - already classified")
-                    queue_helper(queue_name, "task_done")
-                    continue
-                except:
-                    pass  # Not processed yet
+                finished = []  # (product_id, classified_product) ready to checkpoint
+                pending = []   # (product_id, categorization_data, request, work_item) awaiting OpenAI
+                pending_ids = set()
+                for work_item in work_items:
+                    product_id = work_item['product_id']
+                    
+                    print(f"   [{worker_id}] Processing: {product_id}")
+                    
+                    # Check if already processed (checkpoint)
+                    if product_id in completed_ids or product_id in pending_ids:
+                        print(f"   SKIPPING {product_id} - already classified")
+                        ledger.record('completed')
+                        queue_helper(queue_name, "task_done")
+                        continue
+                    pending_ids.add(product_id)
+                    
+                    # Product data travels with the queue item; older items only reference S3
+                    categorization_data = work_item.get('product_data') or download_product_from_s3(work_item['s3_path'])
+                    
+                    # Skip products with categorization errors
+                    if categorization_data.get('status') == 'invalid_category_error':
+                        print(f"   [{worker_id}] SKIPPING classification for {categorization_data.get('name', product_id)} - invalid category error in previous stage")
+                        # Pass through the error product unchanged
+                        finished.append((product_id, {
+                            **categorization_data,
+                            'eligibility_status': 'SKIPPED_DUE_TO_CATEGORIZATION_ERROR',
+                            'eligibility_rationale': f'Classification skipped because categorization failed with invalid category: {categorization_data.get("invalid_category_attempted", "unknown")}',
+                            'additional_considerations': 'Fix categorization error first',
+                            'lmn_qualification_probability': 'N/A',
+                            'classification_confidence': 0,
+                            'classification_worker_id': worker_id,
+                            'classification_timestamp': time.time()
+                        }))
+                        continue
+                    
+                    # Get the category from categorization step
+                    category = categorization_data.get('primary_category', 'unknown')
+                    
+                    # Get category-specific guide items
+                    category_guide_items = category_guides.get(category, [])
+                    
+                    if category_guide_items:
+                        # Format the category-specific guide
+                        category_specific_guide = f"Category: {category}\n\nHSA/FSA Guidelines for {category}:\n"
+                        for item in category_guide_items:
+                            category_specific_guide += f"\n{item['name']}\n{item['eligibility']}\n{item['description']}\n"
+                        print(f"   [{worker_id}] Using {len(category_guide_items)} guide items for category: {category}")
+                    else:
+                        category_specific_guide = f"Category: {category}\n\nNo specific guidelines found for this category. Use general HSA/FSA rules."
+                        print(f"   [{worker_id}] No specific guide found for category: {category}")
+                    
+                    # Use the loaded prompt template and substitute variables
+                    prompt = eligibility_prompt_template.replace(
+                        "{{Flex Product Guide}}", category_specific_guide
+                    ).replace(
+                        "{{PRODUCT_NAME}}", str(categorization_data.get('name', ''))
+                    ).replace(
+                        "{{PRODUCT_DESCRIPTION}}", str(categorization_data.get('description', ''))
+                    )
+                    
+                    pending.append((product_id, categorization_data, {
+                        'model': "gpt-4o-mini",
+                        'messages': [
+                            {"role": "user", "content": prompt}
+                        ],
+                        'temperature': 0,
+                        'max_tokens': 5000
+                    }, work_item))
                 
-                # Download product data from S3
-                categorization_data = download_product_from_s3(work_item['s3_path'])
+                # Call OpenAI for the whole group at once - second-pass products are asked again, not replayed from cache
+                use_cache = not any(work_item.get('retry_pass') for _, _, _, work_item in pending)
+                responses = llm.complete(
+                    [request for _, _, request, _ in pending], valid_classification_reply, use_cache=use_cache
+                )
+                ledger.record_llm_cache()
+                ledger.record_rate_limited()
                 
-                # Skip products with categorization errors
-                if categorization_data.get('status') == 'invalid_category_error':
-                    print(f"   [{worker_id}] SKIPPING classification for {categorization_data.get('name', product_id)} - invalid category error in previous stage")
-                    # Pass through the error product unchanged
-                    classified_product = {
-                        **categorization_data,
-                        'eligibility_status': 'SKIPPED_DUE_TO_CATEGORIZATION_ERROR',
-                        'eligibility_rationale': f'Classification skipped because categorization failed with invalid category: {categorization_data.get("invalid_category_attempted", "unknown")}',
-                        'additional_considerations': 'Fix categorization error first',
-                        'lmn_qualification_probability': 'N/A',
-                        'classification_confidence': 0,
-                        'classification_worker_id': worker_id,
-                        'classification_timestamp': time.time()
-                    }
-                else:
+                for (product_id, categorization_data, _, work_item), response_content in zip(pending, responses):
                     try:
-                        # Get the category from categorization step
-                        category = categorization_data.get('primary_category', 'unknown')
-                        
-                        # Get category-specific guide items
-                        category_guide_items = category_guides.get(category, [])
-                        
-                        if category_guide_items:
-                            # Format the category-specific guide
-                            category_specific_guide = f"Category: {category}\n\nHSA/FSA Guidelines for {category}:\n"
-                            for item in category_guide_items:
-                                category_specific_guide += f"\n{item['name']}\n{item['eligibility']}\n{item['description']}\n"
-                            print(f"   [{worker_id}] Using {len(category_guide_items)} guide items for category: {category}")
-                        else:
-                            category_specific_guide = f"Category: {category}\n\nNo specific guidelines found for this category. Use general HSA/FSA rules."
-                            print(f"   [{worker_id}] No specific guide found for category: {category}")
-                        
-                        # Use the loaded prompt template and substitute variables
-                        prompt = eligibility_prompt_template.replace(
-                            "{{Flex Product Guide}}", category_specific_guide
-                        ).replace(
-                            "{{PRODUCT_NAME}}", str(categorization_data.get('name', ''))
-                        ).replace(
-                            "{{PRODUCT_DESCRIPTION}}", str(categorization_data.get('description', ''))
-                        )
-                        
-                        response = client.chat.completions.create(
-                            model="gpt-4o-mini",
-                            messages=[
-                                {"role": "user", "content": prompt}
-                            ],
-                            temperature=0,
-                            max_tokens=5000
-                        )
-                        
-                        response_content = response.choices[0].message.content
+                        if isinstance(response_content, Exception):
+                            raise response_content
                         
-                        # Extract JSON from response (it should be in ```json blocks)
-                        if '```json' in response_content:
-                            json_start = response_content.find('```json') + 7
-                            json_end = response_content.find('```', json_start)
-                            json_content = response_content[json_start:json_end].strip()
-                        else:
-                            # Fallback if no markdown blocks
-                            json_content = response_content.strip()
-                        
-                        result = json.loads(json_content)
+                        result = parse_classification_reply(response_content)
                         
                         classified_product = {
                             **categorization_data,
@@ -2543,8 +3511,14 @@ def classification_worker(execution_id: str, environment: str = "dev"):
                         }
                         
                         print(f"   [{worker_id}] {categorization_data.get('name', product_id)} -> {result.get('eligibilityStatus', 'unknown')}")
-                        
+                    
                     except Exception as classification_error:
+                        if set_aside_for_retry('classification', execution_id, work_item, classification_error):
+                            print(f"   [{worker_id}] Classification error: {classification_error} - {product_id} set aside for the second pass")
+                            ledger.record('deferred')
+                            queue_helper(queue_name, "task_done")
+                            continue
+                        
                         print(f"   [{worker_id}] Classification error: {classification_error}")
                         classified_product = {
                             **categorization_data,
@@ -2555,33 +3529,54 @@ def classification_worker(execution_id: str, environment: str = "dev"):
                             'classification_confidence': 0,
                             'status': 'error',
                             'classification_worker_id': worker_id,
-                            'classification_timestamp': time.time()
+                            'classification_timestamp': time.time(),
+                            'error_class': type(classification_error).__name__
                         }
+                        dead_letter_writer.add(
+                            f"classification_{product_id}",
+                            dead_letter_record('classification', product_id, categorization_data, classification_error, work_item)
+                        )
+                    
+                    finished.append((product_id, classified_product))
                 
-                # Save result to S3
-                upload_product_to_s3(classified_product, output_path)
-                
-                processed_count += 1
-                print(f"   [{worker_id}] Saved to S3: {output_path}")
-                queue_helper(queue_name, "task_done")
-                
+                for product_id, classified_product in finished:
+                    # Buffer result into the current checkpoint segment
+                    checkpoint_writer.add(product_id, classified_product)
+                    completed_ids.add(product_id)
+                    
+                    ledger.record('failed' if classified_product.get('status') == 'error' else 'completed')
+                    processed_count += 1
+                    queue_helper(queue_name, "task_done")
+            
             except Exception as queue_error:
                 if "Empty" in str(queue_error):
-                    print(f"   [{worker_id}] Queue empty, waiting for more work or completion signal...")
-                    import time
-                    time.sleep(5)  # Wait before retrying
+                    checkpoint_writer.flush_if_due()
+                    dead_letter_writer.flush_if_due()
+                    if ledger.is_drained():
+                        print(f"[{worker_id}] Classification input drained - worker finished - processed {processed_count} products")
+                        break
                     continue
                 elif "ClientClosed" in str(queue_error):
                     print(f"[{worker_id}] Connection closed - classification worker finished gracefully - processed {processed_count} products")
                     break
                 else:
                     print(f"   [{worker_id}] Queue error: {queue_error}")
+                    if work_items:
+                        ledger.record('failed', len(work_items) - (ledger.accounted() - taken_at))
                     queue_helper(queue_name, "task_done")
                     continue
-                    
+    
     except Exception as worker_error:
         print(f"   [{worker_id}] Worker error: {worker_error}")
         raise
+    finally:
+        if checkpoint_writer:
+            checkpoint_writer.close()
+        if dead_letter_writer:
+            dead_letter_writer.close()
+        if llm:
+            llm.close()
+        ledger.publish()
 
 @app.function(
     image=image,
@@ -2640,23 +3635,22 @@ def turbopuffer_stage(
     Returns:
         Dict with upload results
     """
-    import boto3
     import pandas as pd
-    from io import StringIO
     import turbopuffer as tpuf
     import openai
     import os
+    import time
     
     print(f"STAGE 5: TURBOPUFFER UPLOAD")
     print(f"Execution ID: {execution_id}")
     
     try:
         # Read classification results
-        s3_client = boto3.client('s3')
+        storage = get_storage_backend()
         classification_key = f"{environment}/{execution_id}/classification/classified_products.csv"
         
-        response = s3_client.get_object(Bucket='flex-ai', Key=classification_key)
-        classification_df = pd.read_csv(StringIO(response['Body'].read().decode('utf-8')))
+        body = storage.get(classification_key)
+        classification_df = read_csv_payload(body)
         
         print(f"Uploading {len(classification_df)} products to Turbopuffer")
         
@@ -2670,81 +3664,92 @@ def turbopuffer_stage(
         namespace = f"products-{environment}-{execution_id}"
         uploaded_products = []
         
-        for i, (_, product) in enumerate(classification_df.iterrows()):
-            # Skip products with errors from previous stages
-            if product.get('status') == 'invalid_category_error' or product.get('eligibility_status') == 'SKIPPED_DUE_TO_CATEGORIZATION_ERROR':
-                print(f"   SKIPPING Turbopuffer upload for {product['name']} - has errors from previous stages")
-                # Pass through the error product unchanged
-                uploaded_products.append({
-                    **product.to_dict(),
-                    'turbopuffer_id': '',
-                    'namespace': namespace,
-                    'upload_success': False,
-                    'upload_error': 'Skipped due to categorization/classification errors'
-                })
-                continue
-                
-            try:
-                print(f"   Uploading {i+1}/{len(classification_df)}: {product['name']}")
-                
-                # Generate embedding
-                embedding_text = f"{product['name']} {product['description']} {product.get('features', '')} {product.get('brand', '')}"
-                
-                embedding_response = openai_client.embeddings.create(
-                    model="text-embedding-ada-002",
-                    input=embedding_text[:8000]
-                )
-                
-                embedding_vector = embedding_response.data[0].embedding
-                
-                # Upload to Turbopuffer
-                row_data = {
-                    'id': f"{execution_id}_{i+1}",
-                    'vector': embedding_vector,
-                    'name': str(product['name'])[:100],
-                    'url': str(product['url']),
-                    'category': str(product.get('primary_category', 'unknown'))[:50],
-                    'eligibility': str(product.get('eligibility_status', 'unknown'))[:20]
-                }
-                
-                result = tpuf_client.namespaces().write(
-                    namespace=namespace,
-                    distance_metric='cosine_distance',
-                    upsert_rows=[row_data]
-                )
-                
-                uploaded_product = {
-                    **product.to_dict(),
-                    'turbopuffer_id': f"{execution_id}_{i+1}",
-                    'namespace': namespace,
-                    'upload_success': True
-                }
+        # Products whose upload failed transiently get one more pass at the end
+        first_pass = [(i, product) for i, (_, product) in enumerate(classification_df.iterrows())]
+        second_pass = []
+        
+        for pass_products, retry_pass in ((first_pass, False), (second_pass, True)):
+            if retry_pass and pass_products:
+                print(f"SECOND PASS turbopuffer: retrying {len(pass_products)} products in {SECOND_PASS_DELAY_SECONDS}s")
+                time.sleep(SECOND_PASS_DELAY_SECONDS)
+            
+            for i, product in pass_products:
+                # Skip products with errors from previous stages
+                if product.get('status') == 'invalid_category_error' or product.get('eligibility_status') == 'SKIPPED_DUE_TO_CATEGORIZATION_ERROR':
+                    print(f"   SKIPPING Turbopuffer upload for {product['name']} - has errors from previous stages")
+                    # Pass through the error product unchanged
+                    uploaded_products.append({
+                        **product.to_dict(),
+                        'turbopuffer_id': '',
+                        'namespace': namespace,
+                        'upload_success': False,
+                        'upload_error': 'Skipped due to categorization/classification errors'
+                    })
+                    continue
                 
-                uploaded_products.append(uploaded_product)
-                print(f"   Uploaded: {product['name']}")
+                try:
+                    print(f"   Uploading {i+1}/{len(classification_df)}: {product['name']}")
+                    
+                    # Generate embedding
+                    embedding_text = f"{product['name']} {product['description']} {product.get('features', '')} {product.get('brand', '')}"
+                    
+                    embedding_response = call_with_retries(
+                        limited_embeddings,
+                        openai_client,
+                        model="text-embedding-ada-002",
+                        input=embedding_text[:8000]
+                    )
+                    
+                    embedding_vector = embedding_response.data[0].embedding
+                    
+                    # Upload to Turbopuffer
+                    row_data = {
+                        'id': f"{execution_id}_{i+1}",
+                        'vector': embedding_vector,
+                        'name': str(product['name'])[:100],
+                        'url': str(product['url']),
+                        'category': str(product.get('primary_category', 'unknown'))[:50],
+                        'eligibility': str(product.get('eligibility_status', 'unknown'))[:20]
+                    }
+                    
+                    result = call_with_retries(
+                        tpuf_client.namespaces().write,
+                        namespace=namespace,
+                        distance_metric='cosine_distance',
+                        upsert_rows=[row_data]
+                    )
+                    
+                    uploaded_product = {
+                        **product.to_dict(),
+                        'turbopuffer_id': f"{execution_id}_{i+1}",
+                        'namespace': namespace,
+                        'upload_success': True
+                    }
+                    
+                    uploaded_products.append(uploaded_product)
+                    print(f"   Uploaded: {product['name']}")
                 
-            except Exception as e:
-                print(f"   Upload error: {e}")
-                uploaded_products.append({
-                    **product.to_dict(),
-                    'turbopuffer_id': '',
-                    'namespace': namespace,
-                    'upload_success': False,
-                    'upload_error': str(e)
-                })
+                except Exception as e:
+                    if not retry_pass and is_transient_error(e):
+                        print(f"   Upload error: {e} - set aside for the second pass")
+                        second_pass.append((i, product))
+                        continue
+                    
+                    print(f"   Upload error: {e}")
+                    uploaded_products.append({
+                        **product.to_dict(),
+                        'turbopuffer_id': '',
+                        'namespace': namespace,
+                        'upload_success': False,
+                        'upload_error': str(e),
+                        'upload_error_class': type(e).__name__
+                    })
         
         # Save results
         final_df = pd.DataFrame(uploaded_products)
         final_key = f"{environment}/{execution_id}/turbopuffer/uploaded_products.csv"
         
-        csv_buffer = StringIO()
-        final_df.to_csv(csv_buffer, index=False)
-        s3_client.put_object(
-            Bucket='flex-ai',
-            Key=final_key,
-            Body=csv_buffer.getvalue(),
-            ContentType='text/csv'
-        )
+        upload_csv(final_df, final_key)
         
         successful_uploads = len([p for p in uploaded_products if p.get('upload_success', False)])
         print(f"Uploaded {successful_uploads}/{len(uploaded_products)} products")
@@ -2760,7 +3765,7 @@ def turbopuffer_stage(
             'turbopuffer_namespace': namespace,
             's3_path': f"s3://flex-ai/{final_key}"
         }
-        
+    
     except Exception as e:
         print(f"Turbopuffer upload failed: {e}")
         return {
@@ -2787,21 +3792,17 @@ def csv_processing_worker(execution_id: str, environment: str, csv_file_path: st
     """
     import uuid
     import pandas as pd
-    import boto3
-    import json
     import time
-    from io import StringIO
     
     print(f"CSV PROCESSING WORKER STARTED - {execution_id}")
     worker_id = str(uuid.uuid4())[:8]
     
     # Read CSV file once for this worker
-    s3_client = boto3.client('s3')
     if csv_file_path.startswith('s3://'):
         bucket = csv_file_path.replace('s3://', '').split('/')[0]
         key = '/'.join(csv_file_path.replace('s3://', '').split('/')[1:])
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        df = pd.read_csv(StringIO(response['Body'].read().decode('utf-8')))
+        body = get_storage_backend(bucket).get(key)
+        df = read_csv_payload(body)
     else:
         df = pd.read_csv(csv_file_path)
     
@@ -2809,20 +3810,23 @@ def csv_processing_worker(execution_id: str, environment: str, csv_file_path: st
     
     queue_name = f"csv-processing-{execution_id}"
     processed_count = 0
-    empty_checks = 0
+    checkpoint_writer = CheckpointSegmentWriter(
+        f"{environment}/{execution_id}/extraction", f"csv-processing-{worker_id}"
+    )
+    ledger = StageLedger(execution_id, 'csv-processing', worker_id)
+    handoff_ledger = StageLedger(execution_id, 'categorization', worker_id)
     
     while True:
         try:
             # Get work item from CSV processing queue
-            work_item = queue_helper(queue_name, "get")
+            work_item = queue_helper(queue_name, "get", timeout=LEDGER_POLL_SECONDS)
             if not work_item:
                 raise Exception("Empty")
-                
+            
             csv_row_index = work_item['csv_row_index']
             product_id = work_item['product_id']
             
             print(f"   [{worker_id}] Processing CSV row {csv_row_index}: {product_id}")
-            empty_checks = 0  # Reset counter when we get work
             
             # Get row data from DataFrame
             row = df.iloc[csv_row_index]
@@ -2844,34 +3848,29 @@ def csv_processing_worker(execution_id: str, environment: str, csv_file_path: st
                 'csv_row_index': csv_row_index
             }
             
-            # Save to S3 as extraction result
-            extraction_path = f"{environment}/{execution_id}/extraction/{product_id}.json"
-            s3_client.put_object(
-                Bucket='flex-ai',
-                Key=extraction_path, 
-                Body=json.dumps(fake_extracted_product, indent=2),
-                ContentType='application/json'
-            )
+            # Buffer as extraction result
+            checkpoint_writer.add(product_id, fake_extracted_product)
             
             # Queue for categorization (cascading like main pipeline)
             queue_helper(f"categorization-{execution_id}", "put", {
                 'product_id': product_id,
-                's3_path': extraction_path,
+                'product_data': fake_extracted_product,
                 'stage': 'categorization',
                 'execution_id': execution_id
             })
+            handoff_ledger.record('enqueued')
             
             print(f"   [{worker_id}] Processed and queued {product_id} for categorization")
+            ledger.record('completed')
             processed_count += 1
             queue_helper(queue_name, "task_done")
-            
+        
         except Exception as queue_error:
             if "Empty" in str(queue_error):
-                print(f"   [{worker_id}] CSV processing queue empty, waiting for more work...")
-                time.sleep(2)  # Shorter wait
-                empty_checks += 1
-                if empty_checks >= 5:  # 10 seconds of empty queue = done
-                    print(f"[{worker_id}] Queue empty for 10+ seconds, assuming work complete - processed {processed_count} CSV rows")
+                checkpoint_writer.flush_if_due()
+                handoff_ledger.publish()
+                if ledger.is_drained():
+                    print(f"[{worker_id}] CSV processing input drained - processed {processed_count} CSV rows")
                     break
                 continue
             elif "ClientClosed" in str(queue_error):
@@ -2879,9 +3878,13 @@ def csv_processing_worker(execution_id: str, environment: str, csv_file_path: st
                 break
             else:
                 print(f"   [{worker_id}] Queue error: {queue_error}")
+                ledger.record('failed')
                 queue_helper(queue_name, "task_done")
                 continue
     
+    checkpoint_writer.close()
+    ledger.publish()
+    handoff_ledger.publish()
     print(f"[{worker_id}] CSV processing worker completed - processed {processed_count} CSV rows")
     return {"processed_count": processed_count, "worker_id": worker_id}
 
@@ -2911,10 +3914,7 @@ def reclassify_csv_simple(
     """
     import uuid
     import pandas as pd
-    import boto3
-    import json
     import time
-    from io import StringIO
     
     if not execution_id:
         execution_id = str(uuid.uuid4())[:8]
@@ -2928,12 +3928,11 @@ def reclassify_csv_simple(
     print("=" * 80)
     
     # Read CSV
-    s3_client = boto3.client('s3')
     if csv_file_path.startswith('s3://'):
         bucket = csv_file_path.replace('s3://', '').split('/')[0]
         key = '/'.join(csv_file_path.replace('s3://', '').split('/')[1:])
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        df = pd.read_csv(StringIO(response['Body'].read().decode('utf-8')))
+        body = get_storage_backend(bucket).get(key)
+        df = read_csv_payload(body)
     else:
         df = pd.read_csv(csv_file_path)
     
@@ -2945,15 +3944,15 @@ def reclassify_csv_simple(
     if limit:
         df = df.head(limit)
         print(f"Limited to {limit} products")
-        
+    
     print(f"Processing {len(df)} products")
     
     # STEP 1: Start all workers immediately and create extraction data in parallel
     print(f"\nSTEP 1: Starting all workers and creating extraction data in parallel...")
     
-    # Use fixed worker counts for maximum performance 
-    categorization_worker_count = 40
-    classification_worker_count = 40
+    # Starting worker counts - the autoscalers adjust them while the stages run
+    categorization_worker_count = calculate_optimal_workers(len(df), 'categorization')['worker_count']
+    classification_worker_count = calculate_optimal_workers(len(df), 'classification')['worker_count']
     
     print(f"CATEGORIZATION WORKERS: {categorization_worker_count}")
     print(f"CLASSIFICATION WORKERS: {classification_worker_count}")
@@ -2974,15 +3973,26 @@ def reclassify_csv_simple(
     for i in range(classification_worker_count):
         class_worker = classification_worker.spawn(execution_id, environment)
         classification_workers.append(class_worker)
-        
+    
+    categorization_scaler = QueueAutoscaler(
+        'categorization', execution_id,
+        lambda: categorization_worker.spawn(execution_id, environment), categorization_workers
+    )
+    classification_scaler = QueueAutoscaler(
+        'classification', execution_id,
+        lambda: classification_worker.spawn(execution_id, environment), classification_workers
+    )
+    
     print("Both stages now running in parallel from the start!")
     print("Pipeline flow: CSV Products → Categorize → Classify (both simultaneous)")
     
     # Now create extraction data and queue for categorization as we go
     print(f"Creating extraction data and queueing {len(df)} products for categorization...")
+    checkpoint_writer = CheckpointSegmentWriter(f"{environment}/{execution_id}/extraction", "reclassify-csv")
+    categorization_ledger = StageLedger(execution_id, 'categorization')
     
     for i, (_, row) in enumerate(df.iterrows()):
-        product_id = f'csv_product_{i+skip_rows:06d}'
+        product_id = product_id_for_csv_row(row)
         
         extraction_data = {
             'product_id': product_id,
@@ -3000,73 +4010,48 @@ def reclassify_csv_simple(
             'csv_row_index': i + skip_rows
         }
         
-        # Save to S3
-        extraction_path = f"{environment}/{execution_id}/extraction/{product_id}.json"
-        s3_client.put_object(
-            Bucket='flex-ai',
-            Key=extraction_path,
-            Body=json.dumps(extraction_data, indent=2),
-            ContentType='application/json'
-        )
+        # Buffer as extraction result
+        checkpoint_writer.add(product_id, extraction_data)
         
         # Queue for categorization immediately (so workers can start processing)
-        extraction_s3_path = f"{environment}/{execution_id}/extraction/{product_id}.json"
         categorization_queue.put({
             "product_id": product_id,
-            "s3_path": extraction_s3_path,
+            "product_data": extraction_data,
             "stage": "categorization",
             "execution_id": execution_id
         })
+        categorization_ledger.record('enqueued')
         
         # Progress update every 1000 products
         if (i + 1) % 1000 == 0:
             print(f"   Created and queued {i + 1}/{len(df)} products...")
     
+    checkpoint_writer.close()
     print(f"Created and queued all {len(df)} products for processing!")
     
-    # CSV "extraction" is complete - now signal categorization workers to finish (like main pipeline)
-    print("CSV extraction complete! Signaling categorization workers to finish...")
-    
-    # Signal categorization workers that extraction is complete (exactly like main pipeline)
-    for i in range(categorization_worker_count):
-        categorization_queue.put({
-            'product_id': 'EXTRACTION_COMPLETE',
-            'stage': 'categorization',
-            'execution_id': execution_id,
-            'signal': 'EXTRACTION_COMPLETE'
-        })
-    
-    print("Sent EXTRACTION_COMPLETE signals to all categorization workers")
+    # CSV "extraction" is complete - categorization workers finish once the ledger accounts for every product
+    print("CSV extraction complete! Closing categorization input...")
+    categorization_ledger.close_input()
     
     # Wait for categorization workers to complete (like main pipeline waits for extraction)
     print("Waiting for categorization workers to complete...")
-    for worker in categorization_workers:
-        worker.get()  # This blocks until the worker completes
-    
-    print("All categorization workers completed! Signaling classification workers to finish...")
-    
-    # Signal classification workers that categorization is complete (exactly like main pipeline)
-    classification_queue_name = f"classification-{execution_id}"
-    for i in range(classification_worker_count):
-        classification_queue = Queue.from_name(classification_queue_name, create_if_missing=True)
-        classification_queue.put({
-            'product_id': 'CATEGORIZATION_COMPLETE',
-            'stage': 'classification',
-            'execution_id': execution_id,
-            'signal': 'CATEGORIZATION_COMPLETE'
-        })
+    autoscale_until_done(categorization_scaler, classification_scaler)
+    run_second_pass('categorization', execution_id, lambda: categorization_worker.spawn(execution_id, environment),
+                    classification_scaler)
     
-    print("Sent CATEGORIZATION_COMPLETE signals to all classification workers")
+    print("All categorization workers completed! Closing classification input...")
+    StageLedger(execution_id, 'classification').close_input()
     
     # Wait for classification workers to complete
     print("Waiting for classification workers to complete...")
-    for worker in classification_workers:
-        worker.get()
+    autoscale_until_done(classification_scaler)
+    run_second_pass('classification', execution_id, lambda: classification_worker.spawn(execution_id, environment))
     
     print("All workers completed! Both categorization and classification stages finished!")
+    llm_cache = llm_cache_report(execution_id)
     
     # STEP 4: Create final CSV
-    print(f"\nSTEP 4: Creating final CSV...")
+    print("\nSTEP 4: Creating final CSV...")
     
     # Define output path
     output_csv_path = f"s3://flex-ai/{environment}/{execution_id}/output/classified_products.csv"
@@ -3085,9 +4070,10 @@ def reclassify_csv_simple(
             'environment': environment,
             'products_processed': len(df),
             'final_csv_path': output_csv_path,
-            'consolidation_result': 'completed'
+            'consolidation_result': 'completed',
+            'llm_cache': llm_cache
         }
-        
+    
     except Exception as e:
         print(f"Error creating final CSV: {e}")
         return {
@@ -3096,7 +4082,8 @@ def reclassify_csv_simple(
             'environment': environment,
             'products_processed': len(df),
             'error': str(e),
-            'final_csv_path': output_csv_path
+            'final_csv_path': output_csv_path,
+            'llm_cache': llm_cache
         }
 
 @app.function(
@@ -3135,10 +4122,7 @@ def reclassify_csv_products(
     """
     import uuid
     import pandas as pd
-    import boto3
-    import json
     import time
-    from io import StringIO
     
     if not execution_id:
         execution_id = str(uuid.uuid4())[:8]
@@ -3154,54 +4138,53 @@ def reclassify_csv_products(
         # Read CSV file (from S3 or local path)
         print(f"Reading CSV file...")
         
-        s3_client = boto3.client('s3')
-        
         if csv_file_path.startswith('s3://'):
             # Read from S3
             bucket = csv_file_path.replace('s3://', '').split('/')[0]
             key = '/'.join(csv_file_path.replace('s3://', '').split('/')[1:])
             
             print(f"Reading from S3: s3://{bucket}/{key}")
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            df = pd.read_csv(StringIO(response['Body'].read().decode('utf-8')))
+            body = get_storage_backend(bucket).get(key)
+            df = read_csv_payload(body)
         else:
             # Try to read as local file (for testing)
             df = pd.read_csv(csv_file_path)
         
         if limit:
             df = df.head(limit)
-            
+        
         print(f"Loaded {len(df)} products from CSV")
         
         # Convert CSV data to pipeline format with intelligent batching
         print(f"Converting CSV data to pipeline format...")
         
-        s3_client = boto3.client('s3')
-        
-        # Hardcode maximum workers for fastest processing
+        # Starting worker counts - the autoscalers adjust them while the stages run
         total_products = len(df)
-        categorization_workers = 50  # Maximum workers for speed
-        classification_workers = 50  # Maximum workers for speed
+        categorization_workers = calculate_optimal_workers(total_products, 'categorization')['worker_count']
+        classification_workers = calculate_optimal_workers(total_products, 'classification')['worker_count']
         
         print(f"Processing {total_products} products:")
         print(f"   Categorization workers: {categorization_workers}")
         print(f"   Classification workers: {classification_workers}")
         print(f"   Batch processing: Initial batch={min(1000, total_products)}, Background batches=500 each")
         
-        # Create cascading queues (mimic main pipeline)
+        # Create the CSV processing queue (mimic main pipeline)
         from modal import Queue
         csv_processing_queue = Queue.from_name(f"csv-processing-{execution_id}", create_if_missing=True)
-        categorization_queue = Queue.from_name(f"categorization-{execution_id}", create_if_missing=True)
-        classification_queue = Queue.from_name(f"classification-{execution_id}", create_if_missing=True)
         
         # Create lightweight CSV row references for queue (not full product data)
         # Skip first 1000 rows that were already processed
         skip_rows = 1000
         csv_work_items = []
+        queued_ids = set()
         for i in range(skip_rows, total_products):  # Start from row 1000
+            product_id = product_id_for_csv_row(df.iloc[i])
+            if product_id in queued_ids:
+                continue  # Duplicate rows share one classification
+            queued_ids.add(product_id)
             csv_work_items.append({
                 'csv_row_index': i,
-                'product_id': f'csv_product_{i:06d}',
+                'product_id': product_id,
                 'execution_id': execution_id,
                 'environment': environment
             })
@@ -3216,9 +4199,14 @@ def reclassify_csv_products(
         initial_batch_size = min(1000, len(csv_work_items))
         print(f"Queueing first {initial_batch_size} CSV work items to start workers...")
         
+        # Count every row up front - workers only stop once the ledger accounts for them all
+        csv_processing_ledger = StageLedger(execution_id, 'csv-processing')
+        csv_processing_ledger.record('enqueued', len(csv_work_items))
+        csv_processing_ledger.publish()
+        
         for i in range(initial_batch_size):
             csv_processing_queue.put(csv_work_items[i])
-            
+        
         # Start ALL workers immediately for maximum parallelism
         print(f"Starting {min(10, categorization_workers)} CSV processing workers...")
         csv_processing_workers = []
@@ -3233,7 +4221,7 @@ def reclassify_csv_products(
         for i in range(categorization_workers):
             cat_worker = categorization_worker.spawn(execution_id, environment)
             categorization_worker_list.append(cat_worker)
-            
+        
         # Start classification workers immediately  
         print(f"Starting {classification_workers} classification workers...")
         classification_worker_list = []
@@ -3241,6 +4229,15 @@ def reclassify_csv_products(
             class_worker = classification_worker.spawn(execution_id, environment)
             classification_worker_list.append(class_worker)
         
+        categorization_scaler = QueueAutoscaler(
+            'categorization', execution_id,
+            lambda: categorization_worker.spawn(execution_id, environment), categorization_worker_list
+        )
+        classification_scaler = QueueAutoscaler(
+            'classification', execution_id,
+            lambda: classification_worker.spawn(execution_id, environment), classification_worker_list
+        )
+        
         print("All 3 stages now running in parallel!")
         
         # Queue remaining items in background while workers are processing
@@ -3263,6 +4260,8 @@ def reclassify_csv_products(
                 # Small delay between batches to avoid overwhelming the queue
                 time.sleep(0.1)
         
+        csv_processing_ledger.close_input()
+        
         print(f"All workers started! Processing {len(csv_work_items)} remaining products with full parallelism...")
         
         print("All 3 stages now running in parallel!")
@@ -3272,68 +4271,37 @@ def reclassify_csv_products(
         # Let all stages run in parallel and only wait at the very end
         print("Monitoring progress... All 3 stages processing in parallel...")
         
-        # Completion signals already added to queue after work items
-        
         # Wait for CSV processing workers to complete (they feed the pipeline)
         print("Waiting for CSV processing workers to complete...")
-        for worker in csv_processing_workers:
-            worker.get()
+        autoscale_until_done(csv_processing_workers, categorization_scaler, classification_scaler)
         
-        print("CSV processing completed! Now signaling downstream stages to finish...")
-        
-        # Now send categorization completion signals  
-        for i in range(categorization_workers):
-            categorization_queue.put({
-                'product_id': 'EXTRACTION_COMPLETE',
-                'stage': 'categorization',
-                'execution_id': execution_id,
-                'signal': 'EXTRACTION_COMPLETE'
-            })
+        print("CSV processing completed! Closing categorization input...")
+        StageLedger(execution_id, 'categorization').close_input()
         
         # Wait for categorization workers to complete
         print("Waiting for categorization workers to complete...")
-        for worker in categorization_worker_list:
-            worker.get()
-        
-        print("Categorization completed! Signaling classification workers...")
+        autoscale_until_done(categorization_scaler, classification_scaler)
+        run_second_pass('categorization', execution_id, lambda: categorization_worker.spawn(execution_id, environment),
+                        classification_scaler)
         
-        # Send classification completion signals (revert to working approach)
-        for i in range(classification_workers):
-            classification_queue.put({
-                'product_id': 'CATEGORIZATION_COMPLETE',
-                'stage': 'classification',
-                'execution_id': execution_id,
-                'signal': 'CATEGORIZATION_COMPLETE'
-            })
+        print("Categorization completed! Closing classification input...")
+        StageLedger(execution_id, 'classification').close_input()
         
         # Wait for classification workers to complete
         print("Waiting for classification workers to complete...")
-        for worker in classification_worker_list:
-            worker.get()
+        autoscale_until_done(classification_scaler)
+        run_second_pass('classification', execution_id, lambda: classification_worker.spawn(execution_id, environment))
         
         print("All workers completed!")
         
         # Create output CSV - copy of input with 3 new columns added
-        print(f"\nCreating output CSV (input + 3 new columns)...")
+        print("\nCreating output CSV (input + 3 new columns)...")
         
         # Read classification results
-        classification_prefix = f"{environment}/{execution_id}/classification/"
-        response = s3_client.list_objects_v2(
-            Bucket='flex-ai',
-            Prefix=classification_prefix
-        )
-        
-        classified_products = {}
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                if obj['Key'].endswith('.json'):
-                    try:
-                        product_data = download_product_from_s3(obj['Key'])
-                        csv_row_index = product_data.get('csv_row_index')
-                        if csv_row_index is not None:
-                            classified_products[csv_row_index] = product_data
-                    except Exception as e:
-                        print(f"Error reading {obj['Key']}: {e}")
+        classified_products = {
+            product_data['product_id']: product_data
+            for product_data in load_stage_checkpoints(f"{environment}/{execution_id}/classification")
+        }
         
         # Add new columns to original DataFrame
         output_df = df.copy()
@@ -3344,8 +4312,9 @@ def reclassify_csv_products(
         # Fill in the new columns from classification results
         processed_count = 0
         for index, row in output_df.iterrows():
-            if index in classified_products:
-                product_data = classified_products[index]
+            product_id = product_id_for_csv_row(row)
+            if product_id in classified_products:
+                product_data = classified_products[product_id]
                 output_df.at[index, 'category'] = product_data.get('primary_category', '')
                 output_df.at[index, 'eligibility_status'] = product_data.get('eligibility_status', '')
                 output_df.at[index, 'rationale'] = product_data.get('eligibility_rationale', '')
@@ -3353,20 +4322,13 @@ def reclassify_csv_products(
         
         # Save output CSV
         output_key = f"{environment}/{execution_id}/output/dermstore_with_classifications.csv"
-        csv_buffer = StringIO()
-        output_df.to_csv(csv_buffer, index=False)
-        s3_client.put_object(
-            Bucket='flex-ai',
-            Key=output_key,
-            Body=csv_buffer.getvalue(),
-            ContentType='text/csv'
-        )
+        upload_csv(output_df, output_key)
         
         # Calculate stats
         total_products = len(output_df)
         processed_products = processed_count
         
-        print(f"\nRESULTS SUMMARY:")
+        print("\nRESULTS SUMMARY:")
         print(f"   Total products in CSV: {total_products}")
         print(f"   Products successfully classified: {processed_products}")
         print(f"   Products not processed: {total_products - processed_products}")
@@ -3384,7 +4346,7 @@ def reclassify_csv_products(
             'categorization_workers_used': categorization_workers,
             'classification_workers_used': classification_workers
         }
-        
+    
     except Exception as e:
         print(f"CSV re-classification failed: {e}")
         return {
@@ -3450,7 +4412,7 @@ def api_run_pipeline(data: dict):
             "monitor_s3": f"https://s3.console.aws.amazon.com/s3/buckets/flex-ai?region=us-west-2&prefix={environment}/{execution_id}/",
             "note": "Pipeline is running in the background. Check S3 for results or use call_id to monitor status."
         }
-            
+    
     except Exception as e:
         return {"status": "error", "error": str(e)}
 
@@ -3468,14 +4430,14 @@ def api_discovery(data: dict):
         base_url = data.get("base_url")
         if not base_url:
             return {"status": "error", "error": "base_url is required"}
-            
+        
         max_products = data.get("max_products", 50)
         environment = data.get("environment", "dev")
         execution_id = data.get("execution_id")
         
         result = discovery_stage.remote(base_url, max_products, environment, execution_id)
         return {"status": result['status'], "result": result}
-        
+    
     except Exception as e:
         return {"status": "error", "error": str(e)}
 
@@ -3576,6 +4538,7 @@ def run_full_pipeline(
                 is_success = stage_result['status'] in ['success', 'completed_in_overlap']
                 status_emoji = "PASS" if is_success else "FAIL"
                 print(f"   {status_emoji} {stage_name.title()}: {stage_result['status']}")
+        llm_cache = llm_cache_report(execution_id)
         print(f"=" * 80)
         
         return {
@@ -3583,9 +4546,10 @@ def run_full_pipeline(
             'execution_id': execution_id,
             'environment': environment,
             'base_url': base_url,
-            'results': pipeline_results
+            'results': pipeline_results,
+            'llm_cache': llm_cache
         }
-        
+    
     except Exception as e:
         print(f"Pipeline failed: {e}")
         return {
@@ -3603,78 +4567,19 @@ def run_full_pipeline(
 )
 def consolidate_json_to_csv(execution_id: str, stage_name: str, environment: str = "dev"):
     """
-    Consolidate individual JSON files into a single CSV for a completed stage
+    Consolidate a completed stage's checkpoint segments into a single CSV
     """
-    import boto3
-    import json
     import pandas as pd
-    from io import StringIO
     
     print(f"Consolidating {stage_name} JSON files to CSV for execution {execution_id}")
     
-    s3_client = boto3.client('s3')
-    
-    # Read all JSON files for this stage (handle pagination for large result sets)
-    stage_prefix = f"{environment}/{execution_id}/{stage_name}/"
-    
-    all_objects = []
-    continuation_token = None
-    
-    while True:
-        if continuation_token:
-            response = s3_client.list_objects_v2(
-                Bucket='flex-ai',
-                Prefix=stage_prefix,
-                ContinuationToken=continuation_token
-            )
-        else:
-            response = s3_client.list_objects_v2(
-                Bucket='flex-ai',
-                Prefix=stage_prefix
-            )
-        
-        if 'Contents' in response:
-            all_objects.extend(response['Contents'])
-        
-        if response.get('IsTruncated'):
-            continuation_token = response.get('NextContinuationToken')
-        else:
-            break
-    
-    print(f"Found {len(all_objects)} total files in S3")
-    
-    if not all_objects:
-        return {"status": "error", "message": f"No files found for {stage_name}"}
-    
-    processed_products = []
-    processed_count = 0
-    error_count = 0
-    
-    # Process JSON files in batches for better performance
-    json_objects = [obj for obj in all_objects if obj['Key'].endswith('.json')]
-    print(f"Processing {len(json_objects)} JSON files...")
-    
-    for obj in json_objects:
-        try:
-            # Download and parse each JSON file
-            obj_response = s3_client.get_object(Bucket='flex-ai', Key=obj['Key'])
-            product_data = json.loads(obj_response['Body'].read().decode('utf-8'))
-            processed_products.append(product_data)
-            processed_count += 1
-            
-            if processed_count % 500 == 0:
-                print(f"Processed {processed_count}/{len(json_objects)} JSON files... ({error_count} errors)")
-                
-        except Exception as e:
-            error_count += 1
-            if error_count % 100 == 0:
-                print(f"Errors so far: {error_count} (latest: {obj['Key']}: {e})")
-            continue
+    # Checkpoint segments (plus any legacy per-product files) are concatenated
+    processed_products = load_stage_checkpoints(f"{environment}/{execution_id}/{stage_name}")
     
-    print(f"Final result: {processed_count} successful, {error_count} errors")
+    print(f"Final result: {len(processed_products)} products")
     
     if not processed_products:
-        return {"status": "error", "message": f"No valid JSON files found for {stage_name}"}
+        return {"status": "error", "message": f"No checkpointed products found for {stage_name}"}
     
     # Create DataFrame and CSV
     results_df = pd.DataFrame(processed_products)
@@ -3691,17 +4596,13 @@ def consolidate_json_to_csv(execution_id: str, stage_name: str, environment: str
     
     # Upload CSV to S3
     results_key = f"{environment}/{execution_id}/{stage_name}/{csv_filename}"
-    csv_buffer = StringIO()
-    results_df.to_csv(csv_buffer, index=False)
-    s3_client.put_object(
-        Bucket='flex-ai',
-        Key=results_key,
-        Body=csv_buffer.getvalue(),
-        ContentType='text/csv'
-    )
+    upload_csv(results_df, results_key)
     
     print(f"Successfully created {csv_filename} with {len(processed_products)} products")
     
+    # Resumed runs read this instead of the whole manifest
+    write_completed_index_snapshot(f"{environment}/{execution_id}/{stage_name}")
+    
     return {
         "status": "success",
         "stage": stage_name,
@@ -3749,7 +4650,7 @@ def api_classification_stage(data: dict):
             "function_call_id": result.object_id,
             "message": f"Classification stage started for execution {execution_id}"
         }
-        
+    
     except Exception as e:
         return {"error": str(e)}
 
@@ -3794,7 +4695,7 @@ def api_consolidate_csv(data: dict):
             "function_call_id": result.object_id,
             "message": f"CSV consolidation started for execution {execution_id}"
         }
-        
+    
     except Exception as e:
         return {"error": str(e)}
 
@@ -3846,7 +4747,7 @@ def api_reclassify_csv(data: dict):
             "function_call_id": result.object_id,
             "check_status_url": f"https://modal.com/functions/{result.object_id}"
         }
-        
+    
     except Exception as e:
         print(f"API Error: {e}")
         return {"status": "error", "error": str(e)}
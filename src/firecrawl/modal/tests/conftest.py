@@ -0,0 +1,34 @@
+"""
+Shared fixtures for the offline tests
+Nothing here reaches S3, Modal or OpenAI
+"""
+
+import pytest
+
+from ..pipeline import storage
+from ..pipeline.storage import InMemoryStorageBackend, set_storage_backend
+
+@pytest.fixture
+def memory_storage(monkeypatch):
+    """A fresh in-memory backend for the default bucket, dropped after the test"""
+    monkeypatch.setattr(storage, '_storage_backends', {})
+    backend = InMemoryStorageBackend()
+    set_storage_backend(backend)
+    return backend
+
+class FakeClock:
+    """Stands in for the time module - sleeping moves the clock instead of waiting"""
+    
+    def __init__(self, now: float):
+        self.now = now
+    
+    def time(self) -> float:
+        return self.now
+    
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+@pytest.fixture
+def fake_clock():
+    """A clock at a round 10-second mark, for modules whose time is patched with it"""
+    return FakeClock(10_000_000.0)
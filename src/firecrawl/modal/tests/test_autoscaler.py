@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Stage Autoscaler Tests
+Spawn and retire decisions from batch completion records
+"""
+
+import pytest
+
+from ..pipeline import autoscaler
+from ..pipeline.autoscaler import StageAutoscaler, StageScaling, QueuePoolScaler, AUTOSCALE_COOLDOWN_SECONDS
+
+# Extraction: 60s per item prior, 100 containers, 200 items/min
+@pytest.fixture
+def scaler(fake_clock, monkeypatch):
+    monkeypatch.setattr(autoscaler, 'time', fake_clock)
+    scaler = StageAutoscaler('extraction', total_items=1000, target_minutes=30)
+    assert scaler.initial_workers(batch_count=50) == 34  # ceil(1000 items * 60s / 1800s)
+    return scaler
+
+def test_start_is_capped_by_batches_and_containers(fake_clock, monkeypatch):
+    monkeypatch.setattr(autoscaler, 'time', fake_clock)
+    
+    assert StageAutoscaler('extraction', 1000, target_minutes=30).initial_workers(batch_count=10) == 10
+    assert StageAutoscaler('extraction', 100000, target_minutes=30).initial_workers(batch_count=500) == 100
+    assert StageAutoscaler('extraction', 1, target_minutes=30).initial_workers(batch_count=1) == 1
+
+def test_scaling_can_be_passed_for_a_pool_outside_the_stage_table(fake_clock, monkeypatch):
+    monkeypatch.setattr(autoscaler, 'time', fake_clock)
+    scaling = StageScaling(max_workers=100, max_items_per_minute=300, seconds_per_item=20)
+    
+    assert StageAutoscaler('gtm', 900, target_minutes=15, scaling=scaling).initial_workers(batch_count=900) == 20
+
+def test_no_decision_during_cooldown(scaler, fake_clock):
+    scaler.record({'items': 10, 'seconds': 6000})
+    fake_clock.now += AUTOSCALE_COOLDOWN_SECONDS - 1
+    
+    assert scaler.desired_workers(active_workers=34, remaining_batches=40) is None
+
+def test_slow_batches_spawn_workers(scaler, fake_clock):
+    scaler.record({'items': 10, 'seconds': 1200})  # 120s per item
+    fake_clock.now += 60
+    
+    # Latency estimate moves 30% towards 120s: 78s per item for 990 items in 1740s
+    assert scaler.desired_workers(active_workers=34, remaining_batches=60) == 45
+    assert scaler.peak_workers == 45
+
+def test_fast_batches_retire_workers(scaler, fake_clock):
+    scaler.record({'items': 10, 'seconds': 60})  # 6s per item
+    fake_clock.now += 60
+    
+    assert scaler.desired_workers(active_workers=34, remaining_batches=40) == 25
+    assert scaler.peak_workers == 34
+
+def test_small_adjustments_are_ignored(scaler, fake_clock):
+    fake_clock.now += 60
+    
+    # 35 wanted against 34 running - not worth a cold start
+    assert scaler.desired_workers(active_workers=34, remaining_batches=40) is None
+
+def test_never_more_workers_than_batches_left(scaler, fake_clock):
+    scaler.record({'items': 10, 'seconds': 1200})
+    fake_clock.now += 60
+    
+    assert scaler.desired_workers(active_workers=34, remaining_batches=3) == 3
+
+def test_rate_limiting_cuts_the_ceiling_then_probes_back(scaler, fake_clock):
+    scaler.record({'items': 20, 'seconds': 1200, 'rate_limited': 15})
+    fake_clock.now += 60
+    
+    # 5 of 20 items got through in a minute - 5 items/min at 60s each is 5 workers
+    assert scaler.desired_workers(active_workers=34, remaining_batches=40) == 5
+    assert scaler.items_per_minute_ceiling == pytest.approx(5)
+    
+    fake_clock.now += 60
+    scaler.desired_workers(active_workers=5, remaining_batches=40)
+    assert scaler.items_per_minute_ceiling == pytest.approx(6.25)
+
+def test_failing_items_hold_the_pool(scaler, fake_clock):
+    scaler.record({'items': 10, 'seconds': 1200, 'errors': 8})
+    fake_clock.now += 60
+    
+    # Slow enough to want 45 workers, but more workers won't fix failures
+    assert scaler.desired_workers(active_workers=34, remaining_batches=60) is None
+
+def test_reused_batches_count_as_done_but_not_as_latency(scaler, fake_clock):
+    scaler.record({'items': 500, 'seconds': 1, 'reused': True})
+    fake_clock.now += 60
+    
+    assert scaler.seconds_per_item == 60
+    assert scaler.completed_items == 500
+    assert scaler.desired_workers(active_workers=34, remaining_batches=40) == 18  # ceil(500 * 60 / 1740)
+
+def test_nothing_left_means_no_decision(scaler, fake_clock):
+    fake_clock.now += 60
+    
+    assert scaler.desired_workers(active_workers=34, remaining_batches=0) is None
+
+def test_slow_queue_pool_grows(scaler, fake_clock):
+    pool = QueuePoolScaler(scaler)
+    fake_clock.now += 60
+    
+    # 34 workers finished 10 items in a minute - 204s each moves the estimate to 103.2s
+    assert pool.poll({'completed': 10}, running_workers=34, backlog=500) == 25
+    assert scaler.seconds_per_item == pytest.approx(103.2)
+
+def test_rate_limited_queue_pool_retires_workers(scaler, fake_clock):
+    pool = QueuePoolScaler(scaler)
+    fake_clock.now += 60
+    
+    assert pool.poll({'completed': 20, 'rate_limited': 15}, running_workers=34, backlog=500) == -28
+    
+    # Stop tokens not taken yet count as retired - a clean window probes back up from 6 workers, not 34
+    fake_clock.now += 60
+    assert pool.poll({'completed': 30, 'rate_limited': 15}, running_workers=34, backlog=500, pending_retirements=28) == 5
+
+def test_failing_queue_pool_does_not_grow(scaler, fake_clock):
+    pool = QueuePoolScaler(scaler)
+    fake_clock.now += 60
+    
+    assert pool.poll({'completed': 2, 'failed': 8}, running_workers=34, backlog=500) <= 0
+    assert scaler.completed_items == 10
+
+def test_idle_queue_pool_time_is_not_latency(scaler, fake_clock):
+    pool = QueuePoolScaler(scaler)
+    fake_clock.now += 600
+    
+    # Nothing queued for ten minutes, then one minute of work
+    assert pool.poll({'completed': 0}, running_workers=34, backlog=0) == 0
+    fake_clock.now += 60
+    pool.poll({'completed': 34}, running_workers=34, backlog=500)
+    assert scaler.seconds_per_item == pytest.approx(60)
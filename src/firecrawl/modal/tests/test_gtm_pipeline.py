@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+GTM Pipeline Tests
+The categorize and classify stages against a fake OpenAI client, a local rate limiter and an in-memory cache
+"""
+
+import importlib
+import json
+import os
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+# gtm/pipeline.py imports pipeline/ as a top-level package, the way Modal ships it
+MODAL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CATEGORIZATION_REPLY = json.dumps({
+    'primary_category': 'Nutritional Supplements & Vitamins',
+    'secondary_category': '',
+    'tertiary_category': '',
+    'reasoning': 'A vitamin supplement',
+    'confidence': 90
+})
+CLASSIFICATION_REPLY = json.dumps({
+    'eligibilityStatus': 'Not Eligible',
+    'explanation': 'General wellness supplement',
+    'additionalConsiderations': '',
+    'lmnQualificationProbability': 'Low',
+    'confidencePercentage': 85
+})
+PRODUCT = {'name': 'Vitamin D3', 'detailed_description': 'Daily vitamin D3 softgels', 'ingredients': '', 'conditions_treats': ''}
+
+def response(content: str):
+    return SimpleNamespace(
+        model='gpt-4o-mini',
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason='stop')],
+        usage=SimpleNamespace(prompt_tokens=100, completion_tokens=20, total_tokens=120)
+    )
+
+class FakeOpenAI:
+    """Stands in for openai.OpenAI - replies in order and counts the requests sent"""
+    
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.sent = 0
+        # Only the raw-response call the rate limiter makes - a direct create() would fail
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            with_raw_response=SimpleNamespace(create=self.create)
+        ))
+    
+    def create(self, **request):
+        reply = self.replies[self.sent]
+        self.sent += 1
+        return SimpleNamespace(headers={}, parse=lambda: response(reply))
+
+@pytest.fixture
+def gtm(monkeypatch):
+    """gtm.pipeline with a process-local rate limiter and the LLM cache on an in-memory backend"""
+    monkeypatch.syspath_prepend(MODAL_DIR)
+    gtm_pipeline = importlib.import_module('gtm.pipeline')
+    storage = importlib.import_module('pipeline.storage')
+    llm_cache = importlib.import_module('pipeline.llm_cache')
+    rate_limiter = importlib.import_module('pipeline.rate_limiter')
+    
+    monkeypatch.setattr(storage, '_storage_backends', {})
+    storage.set_storage_backend(storage.InMemoryStorageBackend())
+    cache = llm_cache.LLMResponseCache()
+    monkeypatch.setattr(rate_limiter, 'llm_response_cache', lambda: cache)
+    monkeypatch.setattr(rate_limiter, '_rate_limiters', {
+        'gpt-4o-mini': rate_limiter.RateLimiter('openai-gpt-4o-mini', store=rate_limiter.LocalRateLimitStore())
+    })
+    return gtm_pipeline
+
+def gpt_limiter(gtm):
+    return importlib.import_module('pipeline.rate_limiter').openai_rate_limiter('gpt-4o-mini')
+
+def fake_openai(monkeypatch, replies):
+    client = FakeOpenAI(replies)
+    monkeypatch.setattr(openai, 'OpenAI', lambda **kwargs: client)
+    return client
+
+def test_categorization_takes_budget_from_the_rate_limiter_and_is_cached(gtm, monkeypatch):
+    client = fake_openai(monkeypatch, [CATEGORIZATION_REPLY])
+    limiter = gpt_limiter(gtm)
+    
+    first = gtm.stage2_categorize_content(PRODUCT)
+    requests_left = limiter.requests_left
+    second = gtm.stage2_categorize_content(PRODUCT)
+    
+    assert limiter.claimed_keys
+    assert limiter.requests_left == requests_left  # the cached answer used no budget
+
+    assert first['status'] == 'success' and not first['llm_cached']
+    assert second['status'] == 'success' and second['llm_cached']
+    assert second['primary_category'] == 'Nutritional Supplements & Vitamins'
+    assert client.sent == 1
+
+def test_unparseable_categorization_reply_is_not_served_again(gtm, monkeypatch):
+    client = fake_openai(monkeypatch, ['Sorry, I cannot help with that.', CATEGORIZATION_REPLY])
+    
+    assert gtm.stage2_categorize_content(PRODUCT)['primary_category'] == 'Parse Error'
+    assert gtm.stage2_categorize_content(PRODUCT)['primary_category'] == 'Nutritional Supplements & Vitamins'
+    assert client.sent == 2
+
+def test_classification_reply_is_validated_before_caching(gtm, monkeypatch):
+    categorization = json.loads(CATEGORIZATION_REPLY)
+    client = fake_openai(monkeypatch, ['{"explanation": "missing status"}', CLASSIFICATION_REPLY])
+    
+    rejected = gtm.stage3_classify_eligibility(PRODUCT, categorization)
+    accepted = gtm.stage3_classify_eligibility(PRODUCT, categorization)
+    cached = gtm.stage3_classify_eligibility(PRODUCT, categorization)
+    
+    assert rejected['status'] == 'success' and rejected['eligibilityStatus'] == 'Unknown'
+    assert accepted['eligibilityStatus'] == 'Not Eligible' and not accepted['llm_cached']
+    assert cached['eligibilityStatus'] == 'Not Eligible' and cached['llm_cached']
+    assert client.sent == 2
+
+def test_reply_validators_check_parsed_fields(gtm):
+    assert gtm.valid_categorization_reply(CATEGORIZATION_REPLY)
+    assert not gtm.valid_categorization_reply('{"reasoning": "no category"}')
+    assert gtm.valid_classification_reply(CLASSIFICATION_REPLY)
+    assert not gtm.valid_classification_reply('not json')
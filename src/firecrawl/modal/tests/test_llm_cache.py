@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+LLM Response Cache Tests
+Only replies the caller's validator accepts are stored and served
+"""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from ..pipeline import rate_limiter
+from ..pipeline.llm_cache import LLMResponseCache
+from ..pipeline.rate_limiter import LocalRateLimitStore, RateLimiter, limited_chat_completion_sync
+
+REQUEST = {
+    'model': 'gpt-4o-mini',
+    'messages': [{'role': 'user', 'content': 'Categorize: Vitamin D3'}],
+    'temperature': 0
+}
+
+def valid_category(content: str) -> bool:
+    return json.loads(content).get('category') in {'Vitamins', 'First Aid'}
+
+def response(content: str, finish_reason: str = 'stop'):
+    return SimpleNamespace(
+        model='gpt-4o-mini',
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason=finish_reason)],
+        usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+    )
+
+class FakeChatClient:
+    """Stands in for openai.OpenAI - replies in order and counts the requests sent"""
+    
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.sent = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            with_raw_response=SimpleNamespace(create=self.create)
+        ))
+    
+    def create(self, **request):
+        reply = self.replies[self.sent]
+        self.sent += 1
+        return SimpleNamespace(headers={}, parse=lambda: response(reply))
+
+@pytest.fixture
+def cache(memory_storage, monkeypatch):
+    cache = LLMResponseCache()
+    monkeypatch.setattr(rate_limiter, 'llm_response_cache', lambda: cache)
+    monkeypatch.setattr(rate_limiter, '_rate_limiters', {
+        'gpt-4o-mini': RateLimiter('openai-gpt-4o-mini', store=LocalRateLimitStore())
+    })
+    return cache
+
+def test_accepted_reply_is_served_from_cache(cache):
+    cache.store(REQUEST, response('{"category": "Vitamins"}'), valid_category)
+    
+    cached = cache.lookup(REQUEST, valid_category)
+    assert cached.cached
+    assert cached.choices[0].message.content == '{"category": "Vitamins"}'
+
+def test_rejected_reply_is_not_stored(cache, memory_storage):
+    cache.store(REQUEST, response('{"category": "Made Up"}'), valid_category)
+    cache.store(REQUEST, response('not json'), valid_category)
+    
+    assert cache.lookup(REQUEST, valid_category) is None
+    assert not memory_storage.objects
+
+def test_truncated_reply_is_not_stored(cache):
+    cache.store(REQUEST, response('{"category": "Vitamins"}', finish_reason='length'), valid_category)
+    
+    assert cache.lookup(REQUEST, valid_category) is None
+
+def test_lookup_drops_entries_the_validator_rejects(cache):
+    cache.store(REQUEST, response('{"category": "Vitamins"}'), lambda content: True)
+    
+    assert cache.lookup(REQUEST, lambda content: False) is None
+    assert cache.lookup(REQUEST, valid_category) is not None
+
+def test_rejected_reply_is_asked_again(cache):
+    client = FakeChatClient(['{"category": "Made Up"}', '{"category": "Vitamins"}', 'unused'])
+    
+    first = limited_chat_completion_sync(client, validate=valid_category, **REQUEST)
+    second = limited_chat_completion_sync(client, validate=valid_category, **REQUEST)
+    third = limited_chat_completion_sync(client, validate=valid_category, **REQUEST)
+    
+    assert first.choices[0].message.content == '{"category": "Made Up"}'
+    assert second.choices[0].message.content == '{"category": "Vitamins"}'
+    assert getattr(third, 'cached', False)
+    assert client.sent == 2
+
+def test_use_cache_false_asks_again(cache):
+    client = FakeChatClient(['{"category": "Vitamins"}', '{"category": "First Aid"}'])
+    
+    limited_chat_completion_sync(client, validate=valid_category, **REQUEST)
+    fresh = limited_chat_completion_sync(client, validate=valid_category, use_cache=False, **REQUEST)
+    
+    assert client.sent == 2
+    assert fresh.choices[0].message.content == '{"category": "First Aid"}'
+    assert cache.lookup(REQUEST, valid_category).choices[0].message.content == '{"category": "First Aid"}'
+
+def test_nothing_is_cached_without_a_validator(cache):
+    client = FakeChatClient(['{"category": "Vitamins"}', '{"category": "Vitamins"}'])
+    
+    limited_chat_completion_sync(client, **REQUEST)
+    limited_chat_completion_sync(client, **REQUEST)
+    
+    assert client.sent == 2
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Product Identity Tests
+Equivalent links share an ID, different products and variants don't
+"""
+
+import pytest
+
+from ..pipeline.product_identity import canonicalize_url, product_id_for_url
+
+@pytest.mark.parametrize('url,canonical', [
+    ('https://www.Example.com/p/vitamin-d/', 'https://example.com/p/vitamin-d'),
+    ('http://example.com:80//p//vitamin-d', 'https://example.com/p/vitamin-d'),
+    ('example.com/p/vitamin-d#reviews', 'https://example.com/p/vitamin-d'),
+    ('https://example.com:8443/p/vitamin-d', 'https://example.com:8443/p/vitamin-d'),
+    ('https://example.com/', 'https://example.com/'),
+    ('', '')
+])
+def test_equivalent_links_normalize(url, canonical):
+    assert canonicalize_url(url) == canonical
+
+def test_tracking_params_are_dropped():
+    url = 'https://example.com/p/vitamin-d?utm_source=mail&utm_campaign=spring&gclid=abc&fbclid=def&_ga=1.2&pk_kwd=x'
+    
+    assert canonicalize_url(url) == 'https://example.com/p/vitamin-d'
+
+@pytest.mark.parametrize('param', ['sku', 'variant', 'size', 'count', 'qty', 'quantity', 'style', 'flavor'])
+def test_variant_params_are_kept(param):
+    small = f"https://example.com/p/vitamin-d?{param}=30"
+    large = f"https://example.com/p/vitamin-d?{param}=90"
+    
+    assert canonicalize_url(small) == small
+    assert product_id_for_url(small) != product_id_for_url(large)
+
+@pytest.mark.parametrize('param', ['source', 'cid', 'ref', 'affiliate'])
+def test_generic_params_are_kept(param):
+    assert canonicalize_url(f"https://example.com/p?{param}=1") == f"https://example.com/p?{param}=1"
+
+def test_remaining_params_are_sorted():
+    assert canonicalize_url('https://example.com/p?size=L&color=red&utm_medium=cpc') == 'https://example.com/p?color=red&size=L'
+
+def test_product_ids_are_stable():
+    product_id = product_id_for_url('https://www.example.com/p/vitamin-d?utm_source=mail')
+    
+    assert product_id == product_id_for_url('http://example.com/p/vitamin-d/')
+    assert product_id.startswith('p_') and len(product_id) == 18
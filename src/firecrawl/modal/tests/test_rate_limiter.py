@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Rate Limiter Tests
+Lease claims, window expiry and x-ratelimit-* header handling on the local store
+"""
+
+import pytest
+
+from ..pipeline import rate_limiter
+from ..pipeline.rate_limiter import (
+    RateLimiter, LocalRateLimitStore, parse_reset_seconds,
+    RATE_WINDOW_SECONDS, LEASES_PER_WINDOW, RATE_LIMIT_HEADROOM
+)
+
+# One lease is 0.9 * 10s / 60s / 20 = 0.75% of a minute's quota
+LEASE_SHARE = RATE_LIMIT_HEADROOM * RATE_WINDOW_SECONDS / 60 / LEASES_PER_WINDOW
+
+@pytest.fixture
+def clock(fake_clock, monkeypatch):
+    # Starts a rate window, so leases claimed now belong to it
+    monkeypatch.setattr(rate_limiter, 'time', fake_clock)
+    return fake_clock
+
+def window_leases(store, name, window):
+    return [key for key in store.values if key.startswith(f"{name}:{window}:")]
+
+def test_reset_header_parsing():
+    assert parse_reset_seconds('20ms') == pytest.approx(0.02)
+    assert parse_reset_seconds('1s') == 1
+    assert parse_reset_seconds('6m0s') == 360
+    assert parse_reset_seconds('1h2m3s') == 3723
+    assert parse_reset_seconds('2.5') == 2.5
+    assert parse_reset_seconds('') is None
+    assert parse_reset_seconds('soon') is None
+
+def test_one_lease_serves_many_requests(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    
+    for _ in range(10):
+        assert limiter.acquire(tokens=100) == 0
+    
+    window = int(clock.now // RATE_WINDOW_SECONDS)
+    assert len(window_leases(store, 'test', window)) == 1
+    assert limiter.requests_left == pytest.approx(4000 * LEASE_SHARE - 10)
+    assert limiter.tokens_left == pytest.approx(400000 * LEASE_SHARE - 1000)
+
+def test_waits_for_the_next_window_when_leases_run_out(clock):
+    store = LocalRateLimitStore()
+    window = int(clock.now // RATE_WINDOW_SECONDS)
+    for lease in range(LEASES_PER_WINDOW):
+        store.claim(f"test:{window}:{lease}")
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    
+    waited = limiter.acquire()
+    
+    assert RATE_WINDOW_SECONDS <= waited <= RATE_WINDOW_SECONDS + 0.2
+    assert len(window_leases(store, 'test', window + 1)) == 1
+
+def test_unused_budget_expires_with_its_window(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    limiter.acquire()
+    
+    clock.now += RATE_WINDOW_SECONDS
+    limiter.acquire()
+    
+    # The leftover of the first lease is gone - only the new lease's budget remains
+    assert limiter.requests_left == pytest.approx(4000 * LEASE_SHARE - 1)
+
+def test_overdraft_carries_into_the_next_window(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    lease_tokens = 400000 * LEASE_SHARE
+    
+    limiter.acquire(tokens=int(lease_tokens * 1.5))
+    clock.now += RATE_WINDOW_SECONDS
+    limiter.acquire(tokens=0)
+    
+    assert limiter.tokens_left == pytest.approx(lease_tokens - lease_tokens * 0.5, abs=1)
+
+def test_old_leases_are_released(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    first_window = int(clock.now // RATE_WINDOW_SECONDS)
+    
+    for _ in range(3):
+        limiter.acquire()
+        clock.now += RATE_WINDOW_SECONDS
+    limiter.acquire()
+    
+    assert not window_leases(store, 'test', first_window)
+    assert not window_leases(store, 'test', first_window + 1)
+    assert len(window_leases(store, 'test', first_window + 2)) == 1
+    assert len(window_leases(store, 'test', first_window + 3)) == 1
+
+def test_limit_headers_replace_the_quota_for_every_container(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    
+    limiter.observe({'x-ratelimit-limit-requests': '10000', 'x-ratelimit-limit-tokens': '2000000'})
+    
+    assert (limiter.requests_per_minute, limiter.tokens_per_minute) == (10000, 2000000)
+    other = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    other.acquire()
+    assert other.requests_left == pytest.approx(10000 * LEASE_SHARE - 1)
+
+def test_nearly_empty_bucket_pauses_the_cluster(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    
+    limiter.observe({
+        'x-ratelimit-limit-requests': '4000',
+        'x-ratelimit-remaining-requests': '50',
+        'x-ratelimit-reset-requests': '6s'
+    })
+    
+    assert store.get('test:state')['paused_until'] == pytest.approx(clock.now + 6)
+    other = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    assert other.acquire() >= 6
+
+def test_healthy_remaining_does_not_pause(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    
+    limiter.observe({
+        'x-ratelimit-limit-requests': '4000',
+        'x-ratelimit-remaining-requests': '3000',
+        'x-ratelimit-reset-requests': '6s'
+    })
+    
+    assert limiter.paused_until == 0
+    assert store.get('test:state') is None
+
+def test_rate_limit_error_pauses_even_without_headers(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    
+    class RateLimitError(Exception):
+        status_code = 429
+    limiter.observe_error(RateLimitError('slow down'))
+    
+    assert limiter.paused_until == pytest.approx(clock.now + 1)
+    
+    limiter.observe_error(ValueError('not a rate limit'))
+    assert limiter.paused_until == pytest.approx(clock.now + 1)
+
+def test_retry_after_header_sets_the_pause(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter('test', store=store, requests_per_minute=4000, tokens_per_minute=400000)
+    
+    limiter.observe({'retry-after': '20'})
+    
+    assert limiter.paused_until == pytest.approx(clock.now + 20)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Product Registry Tests
+Carry-forward decisions against the in-memory storage backend
+"""
+
+import pandas as pd
+
+from ..pipeline.s3_utils import S3Manager, BatchReference
+from ..pipeline.registry import ProductRegistry, fingerprint_row, stage_version
+
+def products(count):
+    return pd.DataFrame({
+        'url': [f"https://shop.example.com/p/{i}" for i in range(count)],
+        'name': [f"Product {i}" for i in range(count)]
+    })
+
+def run_stage(s3_manager, execution_id, version, input_path):
+    """Split the input, 'categorize' the changed rows and record them - returns the carried count"""
+    registry = ProductRegistry(s3_manager, 'dev', execution_id, 'categorization', version, 'csv')
+    changed_path, carried_batch = registry.split_input(input_path)
+    if changed_path:
+        changed = s3_manager.download_dataframe(changed_path)
+        changed['category'] = 'Vitamins'
+        output_path = f"s3://{s3_manager.bucket}/dev/{execution_id}/categorization/batch_0001_output.csv"
+        s3_manager.upload_dataframe(changed, output_path)
+        registry.record([BatchReference(
+            execution_id=execution_id, stage='categorization', batch_number=1,
+            item_count=len(changed), s3_input_path=changed_path, s3_output_path=output_path, environment='dev'
+        )])
+    return carried_batch.item_count if carried_batch else 0
+
+def test_fingerprint_ignores_volatile_columns_but_not_version():
+    row = {'url': 'https://shop.example.com/p/1', 'name': 'Product 1', 'batch_number': 3}
+    
+    assert fingerprint_row(row, 'v1') == fingerprint_row({**row, 'batch_number': 9}, 'v1')
+    assert fingerprint_row(row, 'v1') != fingerprint_row(row, 'v2')
+
+def test_stage_version_changes_with_prompt_text():
+    assert stage_version('gpt-4o-mini', 'Classify this product') == stage_version('gpt-4o-mini', 'Classify this product')
+    assert stage_version('gpt-4o-mini', 'Classify this product') != stage_version('gpt-4o-mini', 'Classify this item')
+
+def test_unchanged_products_are_carried_until_the_prompt_changes(memory_storage):
+    s3_manager = S3Manager()
+    input_path = f"s3://{s3_manager.bucket}/dev/extraction.csv"
+    s3_manager.upload_dataframe(products(5), input_path)
+    first_prompt = stage_version('gpt-4o-mini', 'prompt v1')
+    
+    assert run_stage(s3_manager, 'exec_1', first_prompt, input_path) == 0
+    assert run_stage(s3_manager, 'exec_2', first_prompt, input_path) == 5
+    assert run_stage(s3_manager, 'exec_3', stage_version('gpt-4o-mini', 'prompt v2'), input_path) == 0
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Retry Handoff Numbering Tests
+Second-pass outputs get the same downstream batch number on every run
+"""
+
+from types import SimpleNamespace
+
+from ..pipeline.retries import retry_handoff_span, retry_handoff_number
+
+def test_span_is_a_power_of_ten_above_every_batch_number():
+    assert retry_handoff_span([]) == 10
+    assert retry_handoff_span([SimpleNamespace(batch_number=n) for n in range(1, 10)]) == 10
+    assert retry_handoff_span([SimpleNamespace(batch_number=n) for n in range(1, 11)]) == 100
+
+def test_handoff_numbers_follow_the_source_batch():
+    assert retry_handoff_number(7, 0, 100) == 107
+    assert retry_handoff_number(7, 1, 100) == 207
+    assert retry_handoff_number(107, 1, 100) == 307
+
+def test_handoff_numbers_never_collide():
+    span = 100
+    first_pass = set(range(1, span))
+    
+    # Every path through extraction, categorization and classification second passes
+    numbers_by_stage = [set(first_pass)]
+    for stage_index in range(3):
+        incoming = numbers_by_stage[-1]
+        handed_off = {retry_handoff_number(number, stage_index, span) for number in incoming}
+        assert len(handed_off) == len(incoming)
+        assert not handed_off & incoming
+        numbers_by_stage.append(incoming | handed_off)
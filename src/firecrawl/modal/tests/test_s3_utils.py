@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+S3 Utilities Tests
+Stage artifacts against the in-memory storage backend
+"""
+
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ..pipeline.s3_utils import (
+    S3Manager, BatchReference, StreamingDataFrameWriter, stream_combine_batch_results,
+    token_balanced_row_starts, _encode_csv_blocks, _row_range_batches, decompress_bytes, PRIORITY_COLUMN
+)
+
+def products(count):
+    return pd.DataFrame({
+        'url': [f"https://example.com/p/{i}" for i in range(count)],
+        'name': [f"Product {i}" for i in range(count)],
+        'price': [i * 1.5 for i in range(count)]
+    })
+
+def artifact_path(s3_manager, filename):
+    return f"s3://{s3_manager.bucket}/dev/exec_test/extraction/{filename}"
+
+# ============================================================================
+# ROW-ADDRESSABLE ARTIFACTS
+# ============================================================================
+
+def test_csv_blocks_decode_on_their_own():
+    df = products(25)
+    body, content_encoding, row_index = _encode_csv_blocks(df, 'gzip', block_rows=10)
+    
+    assert content_encoding == 'gzip'
+    assert row_index['rows'] == 25
+    assert row_index['bytes'] == len(body)
+    assert [first_row for first_row, _ in row_index['blocks']] == [0, 10, 20]
+    
+    # The second block alone is headerless CSV for rows 10-19
+    second_start, third_start = row_index['blocks'][1][1], row_index['blocks'][2][1]
+    lines = decompress_bytes(body[second_start:third_start]).decode('utf-8').splitlines()
+    assert len(lines) == 10
+    assert lines[0].startswith('https://example.com/p/10,')
+
+def test_empty_dataframe_still_gets_a_row_index():
+    _, _, row_index = _encode_csv_blocks(pd.DataFrame(columns=['url']), 'none')
+    
+    assert row_index['rows'] == 0
+    assert row_index['columns'] == ['url']
+
+@pytest.mark.parametrize('filename,compression', [
+    ('rows.csv', 'gzip'),
+    ('rows.csv', 'none'),
+    ('rows.parquet', None)
+])
+@pytest.mark.parametrize('row_start,row_end', [(0, 3), (998, 1003), (1500, 2600), (2990, 3000), (0, 3000)])
+def test_row_range_round_trip(memory_storage, filename, compression, row_start, row_end):
+    s3_manager = S3Manager()
+    df = products(3000)
+    path = artifact_path(s3_manager, filename)
+    assert s3_manager.upload_dataframe(df, path, compression=compression)
+    
+    rows = s3_manager.read_row_range(path, row_start, row_end)
+    
+    pd.testing.assert_frame_equal(rows, df.iloc[row_start:row_end].reset_index(drop=True))
+    assert s3_manager.count_addressable_rows(path) == 3000
+
+def test_row_range_projects_columns(memory_storage):
+    s3_manager = S3Manager()
+    path = artifact_path(s3_manager, 'rows.csv')
+    s3_manager.upload_dataframe(products(1200), path)
+    
+    rows = s3_manager.read_row_range(path, 1100, 1105, columns=['url', 'missing'])
+    
+    assert list(rows.columns) == ['url']
+    assert rows['url'].tolist() == [f"https://example.com/p/{i}" for i in range(1100, 1105)]
+
+def test_streamed_artifact_is_row_addressable(memory_storage):
+    s3_manager = S3Manager()
+    df = products(2500)
+    path = artifact_path(s3_manager, 'streamed.csv')
+    with StreamingDataFrameWriter(s3_manager, path, block_rows=400) as writer:
+        for start in range(0, len(df), 700):
+            writer.write(df.iloc[start:start + 700])
+    
+    assert s3_manager.count_rows(path) == 2500
+    pd.testing.assert_frame_equal(
+        s3_manager.read_row_range(path, 650, 1250), df.iloc[650:1250].reset_index(drop=True)
+    )
+
+def test_stale_row_index_is_ignored(memory_storage):
+    s3_manager = S3Manager()
+    path = artifact_path(s3_manager, 'rows.csv')
+    s3_manager.upload_dataframe(products(50), path)
+    
+    # Overwritten by something that doesn't write an index
+    memory_storage.put(path.split('/', 3)[3], b'url\nhttps://example.com/other\n')
+    
+    assert s3_manager.count_addressable_rows(path) is None
+    assert s3_manager.count_rows(path) == 1
+
+# ============================================================================
+# BATCH CUT POINTS
+# ============================================================================
+
+def test_equal_tokens_cut_equal_batches():
+    assert token_balanced_row_starts(np.full(12, 100.0), 4) == [0, 3, 6, 9]
+
+def test_long_items_get_smaller_batches():
+    item_tokens = np.array([1000.0, 1000.0, 100.0, 100.0, 100.0, 100.0, 100.0, 100.0, 100.0, 100.0])
+    
+    # Two long items then eight short ones - the short ones share the second batch
+    assert token_balanced_row_starts(item_tokens, 2) == [0, 2]
+    assert token_balanced_row_starts(item_tokens, 3) == [0, 1, 2]
+
+def test_cut_points_cover_every_row_once():
+    item_tokens = np.random.default_rng(7).uniform(100, 3000, size=997)
+    
+    row_starts = token_balanced_row_starts(item_tokens, 40)
+    
+    assert row_starts[0] == 0
+    assert row_starts == sorted(set(row_starts))
+    assert row_starts[-1] < len(item_tokens)
+    assert len(row_starts) <= 40
+
+def test_oversized_item_means_fewer_batches():
+    assert token_balanced_row_starts(np.array([10000.0, 10.0, 10.0]), 3) == [0, 1]
+    assert token_balanced_row_starts(np.array([]), 3) == []
+    assert token_balanced_row_starts(np.array([5.0]), 3) == [0]
+
+def test_row_range_batches_cover_the_artifact(memory_storage):
+    s3_manager = S3Manager()
+    path = artifact_path(s3_manager, 'extracted_products.csv')
+    
+    batches = _row_range_batches(s3_manager, path, 25, 10, 'exec_test', 'categorization', 'dev', 'csv', columns=['url'])
+    
+    assert [(batch.row_start, batch.row_end, batch.item_count) for batch in batches] == [(0, 10, 10), (10, 20, 10), (20, 25, 5)]
+    assert [batch.batch_number for batch in batches] == [0, 1, 2]
+    assert all(batch.s3_input_path == path and batch.columns == ['url'] for batch in batches)
+    assert batches[2].s3_output_path.endswith('/dev/exec_test/categorization/batch_2_output.csv')
+
+def test_row_range_batches_follow_given_cut_points(memory_storage):
+    s3_manager = S3Manager()
+    path = artifact_path(s3_manager, 'extracted_products.parquet')
+    
+    batches = _row_range_batches(s3_manager, path, 25, 10, 'exec_test', 'categorization', 'dev', 'parquet', row_starts=[0, 4, 20])
+    
+    assert [(batch.row_start, batch.row_end) for batch in batches] == [(0, 4), (4, 20), (20, 25)]
+    assert batches[0].s3_output_path.endswith('batch_0_output.parquet')
+
+def test_batch_input_reads_its_row_range(memory_storage):
+    s3_manager = S3Manager()
+    df = products(1500)
+    path = artifact_path(s3_manager, 'extracted_products.csv')
+    s3_manager.upload_dataframe(df, path)
+    
+    batch_ref = _row_range_batches(s3_manager, path, 1500, 600, 'exec_test', 'categorization', 'dev', 'csv')[1]
+    
+    pd.testing.assert_frame_equal(s3_manager.read_batch_input(batch_ref), df.iloc[600:1200].reset_index(drop=True))
+
+# ============================================================================
+# COMBINING BATCH OUTPUTS
+# ============================================================================
+
+def batch_output(s3_manager, batch_number, df):
+    path = f"s3://{s3_manager.bucket}/dev/exec_test/categorization/batch_{batch_number}_output.csv"
+    s3_manager.upload_dataframe(df, path)
+    return BatchReference(
+        execution_id='exec_test', stage='categorization', batch_number=batch_number,
+        item_count=len(df), s3_input_path='', s3_output_path=path, environment='dev'
+    )
+
+def test_combine_merges_ordered_batches_reading_each_once(memory_storage, monkeypatch):
+    s3_manager = S3Manager()
+    batches = [
+        batch_output(s3_manager, 1, pd.DataFrame({'name': ['a1', 'a2', 'a3', 'a4'], PRIORITY_COLUMN: [1, 2, 2, None]})),
+        batch_output(s3_manager, 2, pd.DataFrame({'name': ['b1', 'b2', 'b3'], PRIORITY_COLUMN: [1, 3, None]})),
+        batch_output(s3_manager, 3, pd.DataFrame({'name': ['c1'], PRIORITY_COLUMN: [2]}))
+    ]
+    
+    reads = Counter()
+    iter_chunks = S3Manager.iter_dataframe_chunks
+    def counting_iter_chunks(self, s3_path, *args, **kwargs):
+        reads[s3_path] += 1
+        return iter_chunks(self, s3_path, *args, **kwargs)
+    monkeypatch.setattr(S3Manager, 'iter_dataframe_chunks', counting_iter_chunks)
+    
+    output_path = f"s3://{s3_manager.bucket}/dev/exec_test/categorization/categorized_products.csv"
+    summary = stream_combine_batch_results(
+        batches, output_path, count_columns=[PRIORITY_COLUMN], chunksize=2, order_by=PRIORITY_COLUMN
+    )
+    
+    assert summary['success']
+    assert summary['total_items'] == 8
+    assert set(reads.values()) == {1}
+    
+    combined = s3_manager.download_dataframe(output_path)
+    assert combined['name'].tolist() == ['a1', 'b1', 'a2', 'a3', 'c1', 'b2', 'a4', 'b3']
+
+def test_combine_without_order_keeps_batch_order(memory_storage):
+    s3_manager = S3Manager()
+    batches = [
+        batch_output(s3_manager, 1, pd.DataFrame({'name': ['a1', 'a2'], PRIORITY_COLUMN: [3, 1]})),
+        batch_output(s3_manager, 2, pd.DataFrame({'name': ['b1'], PRIORITY_COLUMN: [2]}))
+    ]
+    
+    output_path = f"s3://{s3_manager.bucket}/dev/exec_test/categorization/categorized_products.csv"
+    summary = stream_combine_batch_results(batches, output_path, count_columns=[PRIORITY_COLUMN])
+    
+    assert summary['total_items'] == 3
+    assert summary['value_counts'][PRIORITY_COLUMN] == {3: 1, 1: 1, 2: 1}
+    assert s3_manager.download_dataframe(output_path)['name'].tolist() == ['a1', 'a2', 'b1']
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Storage Backend Tests
+Key-range listing against the in-memory backend
+"""
+
+from ..pipeline.storage import split_key_ranges, list_keys
+
+def test_key_ranges_split_at_each_shard():
+    assert split_key_ranges('checkpoints/', ['a', '8', '4']) == [
+        (None, 'checkpoints/4'),
+        ('checkpoints/4', 'checkpoints/8'),
+        ('checkpoints/8', 'checkpoints/a'),
+        ('checkpoints/a', None)
+    ]
+
+def test_key_ranges_start_after_a_key():
+    assert split_key_ranges('checkpoints/', ['4', '8'], start_after='checkpoints/5') == [
+        ('checkpoints/5', 'checkpoints/8'),
+        ('checkpoints/8', None)
+    ]
+
+def test_key_ranges_without_shards_are_one_listing():
+    assert split_key_ranges('checkpoints/', []) == [(None, None)]
+
+def _populate(backend):
+    keys = [f"dev/exec/categorization/{shard}{i:03d}.json" for shard in '0123456789abcdef' for i in range(5)]
+    keys += ['dev/exec/categorization/manifest.txt', 'dev/exec/categorization/nested/0001.json', 'dev/exec/other/0001.json']
+    for key in keys:
+        backend.put(key, b'{}')
+    return keys
+
+def test_parallel_listing_matches_a_single_listing(memory_storage):
+    _populate(memory_storage)
+    prefix = 'dev/exec/categorization/'
+    
+    single = list_keys(prefix, suffix='.json')
+    memory_storage.parallel_listing = True
+    sharded = list_keys(prefix, suffix='.json', shards='0123456789abcdef', max_workers=4)
+    
+    assert sharded == single
+    assert len(single) == 16 * 5 + 1
+    assert single == sorted(single)
+    assert all(key.startswith(prefix) for key in single)
+
+def test_listing_direct_children_after_a_key(memory_storage):
+    keys = _populate(memory_storage)
+    memory_storage.parallel_listing = True
+    prefix = 'dev/exec/categorization/'
+    
+    listed = list_keys(prefix, direct_children_only=True, start_after=f"{prefix}7004.json", shards='0123456789abcdef')
+    
+    expected = sorted(key for key in keys if key.startswith(prefix) and '/' not in key[len(prefix):] and key > f"{prefix}7004.json")
+    assert listed == expected
+    assert f"{prefix}manifest.txt" in listed